@@ -1,12 +1,27 @@
 """Password manager that saves users/passwords into a MongoDB database
 """
 
+import argparse
+import functools
 import getpass
 import os
-import re
-from utility import utility
-from cryptography.fernet import Fernet
-from typing import Any
+import threading
+from utility import attachments
+from utility import audit
+from utility import breach
+from utility import entries
+from utility import existence
+from utility import history
+from utility import packed
+from utility import prefetch
+from utility import profiling
+from utility import queryplan
+from utility import storage as storage_backends
+from utility import strength
+from utility import vault
+from utility import watcher
+from utility import writebehind
+from typing import Any, Dict, List, Set
 from rich.console import Console
 from rich.table import Table
 import platform
@@ -14,136 +29,198 @@ import subprocess
 
 console = Console()
 
+# Follow change streams so other sessions' edits reach this one's caches
+watch_changes = False
 
-def generate_user_fernet_key() -> Any:
-    """Generates a unique Fernet key for the user
+# Users whose record another session deleted while they were logged in
+_deleted_elsewhere: Set[str] = set()
+_deleted_lock = threading.Lock()
 
-    Returns:
-        Any: Returns the Fernet key
+# Names of the user menu choices in profiling captures
+USER_MENU_ACTIONS = {"1": "add", "2": "retrieve", "3": "update",
+                     "4": "delete_service", "5": "change_master",
+                     "6": "delete_user", "7": "audit", "8": "attachments",
+                     "9": "history", "10": "logout"}
+
+
+def warm_up_storage() -> None:
+    """Starts connecting to the database while the menu is shown
     """
 
-    key = Fernet.generate_key()
-    return key
+    if isinstance(vault.storage, prefetch.PrefetchBackend):
+        vault.storage.warm_up()
 
 
-def store_fernet_key_locally(fernet_key: Any, user_id: Any) -> None:
-    """Stores the Fernet key locally for a user
+def prefetch_user(username: str) -> None:
+    """Starts reading a user's record while their password is typed
 
     Args:
-        fernet_key (Any): The Fernet key
-        user_id (Any): Name of the user
+        username (str): User's name
     """
 
-    key_filename = f"user_{user_id}_fernet.key"
-    with open(key_filename, "wb") as key_file:
-        key_file.write(fernet_key)
+    if isinstance(vault.storage, prefetch.PrefetchBackend):
+        vault.storage.prefetch("users", "names", {"username": username})
 
 
-def load_fernet_key_locally(user_id: Any) -> Any:
-    """Loads the user's Fernet key from local storage
+def prefetch_vault(username: str) -> None:
+    """Starts reading and decrypting a user's vault after login
 
     Args:
-        user_id (Any): Name of the user
-
-    Returns:
-        Any: Fernet key stored locally on system
+        username (str): User's name
     """
 
-    key_filename = f"user_{user_id}_fernet.key"
-    with open(key_filename, "rb") as key_file:
-        key = key_file.read()
-    return key
+    if isinstance(vault.storage, prefetch.PrefetchBackend):
+        vault.storage.prefetch("users", "names", {"username": username})
+        vault.storage.prefetch_vault(
+            username, vault.load_fernet_key_locally(username))
 
 
-def encrypt_password(fernet_key: Any, password: Any) -> Any:
-    """Encrypts a password using Fernet key
+def forget_prefetched(username: str) -> None:
+    """Wipes anything prefetched for a user who logged out
 
     Args:
-        fernet_key (Any): The Fernet key
-        password (Any): user password
-
-    Returns:
-        bytes: The user's encrypted password
+        username (str): User's name
     """
 
-    fernet = Fernet(fernet_key)
-    encrypted_password = fernet.encrypt(password.encode())
-    return encrypted_password
+    if isinstance(vault.storage, prefetch.PrefetchBackend):
+        vault.storage.forget(username)
 
 
-def decrypt_password(fernet_key: Any, encrypted_password: Any) -> Any:
-    """Decrypts user passwords
+def configure_watch(enabled: bool | None = None) -> None:
+    """Chooses whether logged in sessions follow MongoDB change streams
 
     Args:
-        fernet_key (Any): Fernet key
-        encrypted_password (Any): User's encrypted password
-
-    Returns:
-        Any: Decrypted user's password
+        enabled (bool | None, optional): Whether to watch. Defaults to
+            $PM_WATCH, then off.
     """
 
-    fernet = Fernet(fernet_key)
-    decrypted_password = fernet.decrypt(encrypted_password)
-    return decrypted_password.decode()
+    global watch_changes
+
+    if enabled is None:
+        enabled = os.environ.get(watcher.WATCH_ENV, "").lower() in (
+            "1", "on", "true", "yes")
+    watch_changes = enabled
 
 
-def user_exists(username: str) -> Any:
-    """Check if the username already exists
+def start_watching(username: str) -> watcher.VaultWatcher | None:
+    """Follows the changes other sessions make to a user's vault
 
     Args:
         username (str): User's name
 
     Returns:
-        Any: If username is not found, it returns none,
-            else returns username
+        watcher.VaultWatcher | None: The running watcher, or None if
+            watching is off or the backend has no change streams
     """
 
-    existing_user_M = utility.find_entries("users",
-                                           "names", {'username': username})
-    return existing_user_M is not None
+    with _deleted_lock:
+        _deleted_elsewhere.discard(username)
+    if not watch_changes or not isinstance(
+            storage_backends.innermost(vault.storage),
+            storage_backends.MongoBackend):
+        return None
+    vault_watcher = watcher.VaultWatcher(username)
+    vault_watcher.subscribe(functools.partial(apply_vault_change, username))
+    vault_watcher.start()
+    return vault_watcher
 
 
-def service_exists(username: str, service_name: str) -> Any:
-    """Check if service name already exists
+def apply_vault_change(username: str, change: Dict[str, Any]) -> None:
+    """Brings cached reads up to date with a change from a VaultWatcher
+
+    A prefetched vault has the changed entry replaced or removed; other
+    cached answers about the changed collection are dropped.
+
+    Args:
+        username (str): User the watcher follows
+        change (Dict[str, Any]): Change from utility.watcher
+    """
+
+    if change["source"] == "user":
+        database_name, collection_name = "users", "names"
+        if change["operation"] == "delete":
+            with _deleted_lock:
+                _deleted_elsewhere.add(username)
+    else:
+        database_name, collection_name = "passwords", username
+
+    backend: Any = vault.storage
+    while backend is not None:
+        if isinstance(backend, prefetch.PrefetchBackend) \
+                and change["source"] == "vault" \
+                and not packed.is_packed_id(change["document_key"]):
+            backend.apply_change(username, change,
+                                 vault.load_fernet_key_locally(username))
+        elif isinstance(backend, (prefetch.PrefetchBackend,
+                                  existence.ExistenceBackend)):
+            # A packed vault is rewritten as a whole
+            backend.invalidate(database_name, collection_name)
+        backend = getattr(backend, "inner", None)
+
+
+def deleted_elsewhere(username: str) -> bool:
+    """Tells whether another session deleted a logged in user
 
     Args:
         username (str): User's name
-        service_name (str): The name of the website/service
 
     Returns:
-        Any: If service name is found returns True else retrns False
+        bool: True if a watcher saw the user's record deleted
     """
 
-    existing_service = utility.find_entries("passwords",
-                                            username,
-                                            {'service_name': service_name})
+    with _deleted_lock:
+        return username in _deleted_elsewhere
 
-    if existing_service:
-        return True
-    else:
-        return False
 
+def print_pending_writes() -> None:
+    """Warns when journaled writes are failing to reach the database
+    """
+
+    if (isinstance(vault.storage, writebehind.WriteBehindBackend)
+            and vault.storage.last_error is not None):
+        console.print(f"[bold red]{vault.storage.pending} change(s) saved "
+                      f"locally but not yet stored: "
+                      f"{vault.storage.last_error}")
+
+
+def close_storage(timeout: float = 10.0) -> None:
+    """Waits for journaled writes before the program exits
+
+    Args:
+        timeout (float, optional): Seconds to wait. Defaults to 10.
+    """
+
+    for warning in vault.close_storage(timeout):
+        console.print(warning, style="bold orange1", markup=False)
 
-def validate_master_password(password: Any) -> Any:
+
+def validate_master_password(password: Any, username: str = "") -> Any:
     """Validate master password strength
 
     Args:
         password (Any): User's master password
+        username (str, optional): User's name. Defaults to "".
 
     Returns:
-        Any: If the master password's strength meets
-        requirements return True, else return False
-    """
-
-    if (
-        len(password) >= 8
-        and re.search(r'[A-Z]', password)
-        and re.search(r'[a-z]', password)
-        and re.search(r'\d', password)
-        and re.search(r'[@#$%^&+=!]', password)
-    ):
-        return True
-    return False
+        Any: If the master password is hard enough to guess and not in a
+        known data breach return True, else return False
+    """
+
+    result = vault.check_master_password(password, username)
+    return result.score >= strength.MIN_SCORE
+
+
+def print_password_feedback(result: strength.StrengthResult) -> None:
+    """Prints a strength score and the reasons behind it
+
+    Args:
+        result (strength.StrengthResult): Result of vault.check_master_password
+    """
+
+    console.print(f"[bold orange1]Strength: {result.score}/4 "
+                  f"(at least {strength.MIN_SCORE}/4 required)")
+    for line in result.feedback:
+        console.print(f"[orange1]- {line}")
 
 
 def create_user(username: str, master_password: Any) -> None:
@@ -155,28 +232,12 @@ def create_user(username: str, master_password: Any) -> None:
         master_password (Any): User's master password
     """
 
-    query1 = {"username": username}
-    existing_user = utility.find_entries("users", "names", query1)
-
-    if existing_user:
+    if not vault.create_user(username, master_password):
         clear_screen()
         console.print(
             "[bold red underline]Username already exists. Please "
             "choose a different username.")
-
     else:
-
-        fernet_key_M = generate_user_fernet_key()
-
-        encrypted_master_password_M = encrypt_password(fernet_key_M,
-                                                       master_password)
-
-        query = ({"username": username,
-                  "master_password": encrypted_master_password_M})
-
-        utility.insert_entry("users", "names", query)
-
-        store_fernet_key_locally(fernet_key_M, username)
         clear_screen()
         console.print("\n[bold green underline]User created successfully")
 
@@ -193,37 +254,14 @@ def authenticate_user(username: str, master_password: Any) -> Any:
         return False, else return True
     """
 
-    query = {"username": username}
-
-    if os.path.exists(f"user_{username}_fernet.key"):
-
-        query = {"username": username}
-
-        resultMongo = utility.find_entries("users", "names", query)
-
-        if resultMongo != []:
-
-            encrypted_master_password_M = resultMongo[0]['master_password']
-
-            object_id_M = resultMongo[0]['username']
-
-            fernet_key_M = load_fernet_key_locally(
-                object_id_M)
-
-            decrypted_master_password_M = decrypt_password(
-                fernet_key_M, encrypted_master_password_M)
-            try:
-                if master_password == decrypted_master_password_M:
-                    return True
-            except Exception as e:
-                clear_screen()
-                console.print("[bold red underline]Error during "
-                              f"password decryption: {e}")
-
-        return False
-
-    else:
-        return False
+    try:
+        return vault.authenticate_user(username, master_password)
+    except Exception as e:
+        clear_screen()
+        console.print("[bold red underline]Error during "
+                      f"password decryption: {e}")
+    vault.log_access(username, "login_failed")
+    return False
 
 
 # Function to modify the user's master password
@@ -242,31 +280,25 @@ def update_user_master_password(username: str,
         meet strength requirements return False, else return True
     """
 
-    if not user_exists(username):
+    if not vault.user_exists(username):
         clear_screen()
         console.print("[bold red underline]User does not exist.")
         return False
 
-    if not validate_master_password(new_master_password):
+    result = vault.check_master_password(new_master_password, username)
+    if result.score < strength.MIN_SCORE:
         clear_screen()
         console.print(
             "[bold red underline]New master password "
             "does not meet the strength requirements.")
+        print_password_feedback(result)
         return False
 
-    user_info_M = utility.find_entries("users", "names",
-                                       {'username': username})
-
-    fernet_key_M = load_fernet_key_locally(user_info_M[0]['username'])
-
-    encrypted_new_master_password_M = encrypt_password(
-        fernet_key_M, new_master_password)
-
-    old_data = {'username': username,
-                'master_password': user_info_M[0]['master_password']}
-    new_data = {'username': username,
-                'master_password': encrypted_new_master_password_M}
-    utility.update_entry("users", "names", old_data, new_data)
+    if not vault.change_master_password(username, new_master_password):
+        clear_screen()
+        console.print("[bold red underline]The master password was "
+                      "changed in another session.")
+        return False
 
     return True
 
@@ -281,102 +313,111 @@ def delete_user(username: str) -> Any:
         Any: Returns True once the user and passwords have been deleted.
     """
 
-    if not user_exists(username):
+    if not vault.delete_user(username):
         clear_screen()
         console.print("[bold red underline]User does not exist.")
         return False
 
-    utility.delete_collection("passwords", username)
-
-    utility.delete_entry("users", "names", {'username': username})
-
-    key_filename = f"user_{username}_fernet.key"
-    if os.path.exists(key_filename):
-        os.remove(key_filename)
-
     return True
 
 
-def add_password(username: str, service_name: str, username_entry: str,
-                 password_entry: str) -> Any:
-    """Adds an entry into the Passsword Manager
-       including Service name, Username, and password.
-
-    Args:
-        username (str): User's name
-        service_name (str): Name of the website/service being added
-        username_entry (str): Username for the website/service
-        password_entry (str): Password for the website/service
-
-    Returns:
-        Any: If the user exists in the user table
-        add the entry and return True, else return False
-    """
-
-    query1 = {"username": username}
-    existing_user = utility.find_entries("users", "names", query1)
-
-    if existing_user is not None:
-
-        # Load the user's Fernet key
-        fernet_key_M = load_fernet_key_locally(existing_user[0]['username'])
-
-        # Encrypt the password entry using the user's Fernet key
-        encrypted_password_entry_M = encrypt_password(
-            fernet_key_M, password_entry)
-
-        query = {"username": existing_user[0]['username'],
-                 "service_name": service_name,
-                 "username_entry": username_entry,
-                 "password_entry": encrypted_password_entry_M}
-
-        utility.insert_entry("passwords", existing_user[0]['username'], query)
-
-        return True
-    else:
-        return False
-
-
 def retrieve_passwords(username: str) -> None:
     """Retrieve password entries for a user
 
     Args:
         username (str): User's name
     """
-    user_id_M = utility.find_entries("users", "names", {"username": username})
+    user_id_M = vault.storage.find_entries("users", "names",
+                                           {"username": username})
 
     if user_id_M is not None:
-        entries_M = utility.find_entries("passwords", username)
-
         print()
         table = Table(title=f"Entries for {username} ")
 
         table.add_column("Service", justify="left", style="cyan", no_wrap=True)
         table.add_column("Username", style="magenta")
         table.add_column("Password", justify="left", style="green")
+        table.add_column("Attachments", style="yellow")
+
+        with prefetch.timed("load vault"):
+            entries_M = None
+            if isinstance(vault.storage, prefetch.PrefetchBackend):
+                entries_M = vault.storage.take_vault(username)
+            if entries_M is None:
+                fernet_key_M = vault.load_fernet_key_locally(
+                    user_id_M[0]['username'])
+                entries_M = entries.load_vault_entries(vault.storage, username)
+                entries.decrypt_entries(fernet_key_M, entries_M)
+
+        # Only the files documents are read, never attachment content
+        attached: Dict[str, List[str]] = {}
+        for attachment in attachments.list_attachments(
+                attachments.store_for(vault.storage),
+                vault.load_fernet_key_locally(username), username):
+            attached.setdefault(attachment.service_name, []).append(
+                describe_attachment(attachment))
+
+        try:
+            for entry in entries_M:
+                if entry.secret is not None:
+                    table.add_row(
+                        entry.service_name, entry.username_entry,
+                        entry.secret.reveal(),
+                        "\n".join(attached.get(entry.service_name, [])))
+
+            console.print(table)
+            vault.log_access(username, "view")
+
+            console.input(
+                "[bold dodger_blue1 underline]Press enter to continue....")
+        finally:
+            entries.wipe_entries(entries_M)
+        del table
+        clear_screen()
 
-        fernet_key_M = load_fernet_key_locally(user_id_M[0]['username'])
+    else:
+        clear_screen()
+        console.print("\n[bold red underline]No password entries found.")
 
-        for entry in entries_M:
-            decrypted_password_M = decrypt_password(fernet_key_M,
-                                                    entry['password_entry'])
 
-            table.add_row(entry['service_name'], entry['username_entry'],
-                          decrypted_password_M)
+def audit_passwords(username: str) -> None:
+    """Report reused, weak and old password entries for a user
 
-        console.print(table)
+    Args:
+        username (str): User's name
+    """
 
-        console.input(
-            "[bold dodger_blue1 underline]Press enter to continue....")
-        clear_screen()
+    fernet_key_M = vault.load_fernet_key_locally(username)
+    report = audit.audit_vault(vault.storage, username, fernet_key_M,
+                               breach_checker=breach.default_checker())
+
+    print()
+    table = Table(title=f"Audit of {report.total} entries for {username} ")
 
+    table.add_column("Issue", justify="left", style="red", no_wrap=True)
+    table.add_column("Services", style="cyan")
+
+    for services in report.reused:
+        table.add_row("Reused password", ", ".join(services))
+    for service_name in report.breached:
+        table.add_row("Found in a data breach", service_name)
+    for service_name, score in report.weak:
+        table.add_row(f"Weak password (score {score}/4)", service_name)
+    for service_name, age in report.old:
+        table.add_row(f"Not changed for {age} days", service_name)
+
+    if table.row_count:
+        console.print(table)
     else:
-        clear_screen()
-        console.print("\n[bold red underline]No password entries found.")
+        console.print("[bold green underline]No issues found.")
+
+    console.input(
+        "[bold dodger_blue1 underline]Press enter to continue....")
+    clear_screen()
 
 
 def update_service(username: str, service_name: str, new_username: str,
-                   new_password: str) -> Any:
+                   new_password: str, urls: List[str] | None = None) -> Any:
     """Update the username and password for an existing service
 
     Args:
@@ -384,61 +425,85 @@ def update_service(username: str, service_name: str, new_username: str,
         service_name (str): Name of website/service
         new_username (str): New username for website/service
         new_password (str): New password for website/service
+        urls (List[str] | None, optional): New URLs of the service's login
+            pages, None keeps the stored ones. Defaults to None.
+
+    Raises:
+        ValueError: Raised if one of the URLs has no host
 
     Returns:
         Any: If an existing entry was found for the website/service
         update the entry and return True, else return error message and False
     """
 
-    user_id_M = utility.find_entries("users", "names", {"username": username})
+    if not vault.user_exists(username):
+        clear_screen()
+        console.print("[bold red underline]User not found.")
+        return False
 
-    if user_id_M:
-        fernet_key_M = load_fernet_key_locally(user_id_M[0]['username'])
+    return vault.update_service(username, service_name, new_username,
+                                new_password, urls)
 
-        encrypted_new_password_M = encrypt_password(fernet_key_M, new_password)
 
-        user_id_M = utility.find_entries("passwords", user_id_M[0]['username'],
-                                         {"service_name": service_name})
+def describe_attachment(attachment: attachments.Attachment) -> str:
+    """Formats an attachment's metadata for the entry listing
 
-        if user_id_M:
-            old_data = {'service_name': service_name,
-                        'username_entry': user_id_M[0]['username_entry'],
-                        'password_entry': user_id_M[0]['password_entry']}
-            new_data = {'service_name': service_name,
-                        'username_entry': new_username,
-                        'password_entry': encrypted_new_password_M}
-            utility.update_entry("passwords",
-                                 user_id_M[0]['username'], old_data, new_data)
+    Args:
+        attachment (attachments.Attachment): The attachment
 
-            return True
-        else:
-            return False
+    Returns:
+        str: e.g. "id_rsa (3.2 KB)" or "note: Recovery codes"
+    """
 
-    else:
-        clear_screen()
-        console.print("[bold red underline]User not found.")
-        return False
+    if attachment.kind == "note":
+        return f"note: {attachment.name}"
+    return f"{attachment.name} ({attachments.format_size(attachment.length)})"
 
 
-def delete_service_and_passwords(username: str, service_name: str) -> Any:
-    """Delete a service and its passwords
+def add_attachment(username: str, service_name: str, path: str) -> Any:
+    """Encrypts a file into an attachment of an entry
 
     Args:
         username (str): User's name
         service_name (str): Name of website/service
+        path (str): File to attach, read in blocks
 
     Returns:
-        Any: If no entries are found for that website/service
-        return false, else delete the entry and return True
+        Any: False if the service does not exist, else True
     """
 
-    return_entry = service_exists(username, service_name)
-
-    if return_entry is False:
+    if not vault.service_exists(username, service_name):
         return False
 
-    utility.delete_entry("passwords", username, {'service_name': service_name})
+    with open(path, "rb") as source:
+        attachments.upload(attachments.store_for(vault.storage),
+                           vault.load_fernet_key_locally(username), username,
+                           service_name, os.path.basename(path), source)
+    vault.log_access(username, "attach", service_name)
+    return True
 
+
+def add_secure_note(username: str, service_name: str, title: str,
+                    text: str) -> Any:
+    """Stores an encrypted note on an entry
+
+    Args:
+        username (str): User's name
+        service_name (str): Name of website/service
+        title (str): Title of the note
+        text (str): The note
+
+    Returns:
+        Any: False if the service does not exist, else True
+    """
+
+    if not vault.service_exists(username, service_name):
+        return False
+
+    attachments.add_note(attachments.store_for(vault.storage),
+                         vault.load_fernet_key_locally(username), username,
+                         service_name, title, text)
+    vault.log_access(username, "add_note", service_name)
     return True
 
 
@@ -468,13 +533,26 @@ def main_choice_two() -> None:
     """
     clear_screen()
     username = console.input("\n[bold green underline]Enter your username: ")
+    prefetch_user(username)
     console.print("[bold green underline]Enter your master password: ")
     master_password = getpass.getpass("")
-    if authenticate_user(username, master_password):
+    with (prefetch.timed("authenticate"),
+          profiling.profiled("login", vault.storage, username)):
+        authenticated = authenticate_user(username, master_password)
+    if authenticated:
+        prefetch_vault(username)
+        vault_watcher = start_watching(username)
         clear_screen()
         console.print("\n[bold green underline]Login successful.")
 
         while True:
+            print_pending_writes()
+            if deleted_elsewhere(username):
+                console.print("[bold red underline]This user was deleted "
+                              "in another session.")
+                forget_prefetched(username)
+                vault.forget_fernet_key(username)
+                break
             console.print("\n[bold dodger_blue1 underline]User Menu")
 
             console.print("[cyan]1. Add Password Entry")
@@ -484,39 +562,58 @@ def main_choice_two() -> None:
                 "[magenta]4. Delete a Service and associated password")
             console.print("[cyan]5. Change Master Password")
             console.print("[magenta]6. Delete current User and passwords")
-            console.print("[cyan]7. Logout")
+            console.print("[cyan]7. Audit Password Entries")
+            console.print("[magenta]8. Attachments and Secure Notes")
+            console.print("[cyan]9. Password History")
+            console.print("[magenta]10. Logout")
 
             user_choice = console.input(
                 "\n[bold dodger_blue1 underline]Enter your choice: ")
+            action = USER_MENU_ACTIONS.get(user_choice, "invalid")
 
-            if user_choice == "1":
-                choice_one(username)
+            with profiling.profiled(action, vault.storage, username):
+                if user_choice == "1":
+                    choice_one(username)
 
-            elif user_choice == "2":
-                choice_two(username)
+                elif user_choice == "2":
+                    choice_two(username)
 
-            elif user_choice == "3":
-                choice_three(username)
+                elif user_choice == "3":
+                    choice_three(username)
 
-            elif user_choice == "4":
-                choice_four(username)
+                elif user_choice == "4":
+                    choice_four(username)
 
-            elif user_choice == "5":
-                choice_five(username)
+                elif user_choice == "5":
+                    choice_five(username)
 
-            elif user_choice == "6":
-                choice_six(username)
-                break
+                elif user_choice == "6":
+                    choice_six(username)
+                    break
 
-            elif user_choice == "7":
-                choice_seven()
-                break
+                elif user_choice == "7":
+                    choice_seven(username)
 
-            else:
-                clear_screen()
-                console.print(
-                    "[bold red underline]Invalid choice. "
-                    "Please choose a valid option.")
+                elif user_choice == "8":
+                    choice_eight(username)
+
+                elif user_choice == "9":
+                    choice_nine(username)
+
+                elif user_choice == "10":
+                    choice_ten()
+                    forget_prefetched(username)
+                    vault.forget_fernet_key(username)
+                    break
+
+                else:
+                    clear_screen()
+                    console.print(
+                        "[bold red underline]Invalid choice. "
+                        "Please choose a valid option.")
+
+        if vault_watcher is not None:
+            vault_watcher.stop()
 
     else:
         clear_screen()
@@ -537,9 +634,19 @@ def choice_one(username: str) -> None:
         "[bold orange1 underline]Enter the username: ")
     password_entry = console.input(
         "[bold orange1 underline]Enter the password: ")
+    urls = console.input(
+        "[bold orange1 underline]Enter the login page URLs, comma "
+        "separated (optional): ").split(",")
+
+    try:
+        added = vault.add_password(username, service_name, username_entry,
+                                   password_entry, urls)
+    except ValueError as e:
+        clear_screen()
+        console.print(f"[bold red underline]{e}")
+        return
 
-    if add_password(username, service_name, username_entry,
-                    password_entry):
+    if added:
         clear_screen()
         console.print(
             "\n[bold green underline]Password entry added successfully.")
@@ -576,8 +683,20 @@ def choice_three(username: str) -> None:
         "[bold orange1 underline]Enter the new password: ")
     # new_password = getpass.getpass(
     #     "Enter the new password: ")
+    new_urls = console.input(
+        "[bold orange1 underline]Enter the new login page URLs, comma "
+        "separated (enter to keep): ")
+
+    try:
+        updated = update_service(username, service_name, new_username,
+                                 new_password,
+                                 new_urls.split(",") if new_urls else None)
+    except ValueError as e:
+        clear_screen()
+        console.print(f"[bold red underline]{e}")
+        return
 
-    if update_service(username, service_name, new_username, new_password):
+    if updated:
         clear_screen()
         console.print(
             f'\n[bold green underline]Password for {service_name} '
@@ -605,7 +724,8 @@ def choice_four(username: str) -> None:
         " (yes/no): ")
 
     if confirmation.lower() == "yes":
-        return_entry = delete_service_and_passwords(username, service_name)
+        return_entry = vault.delete_service_and_passwords(username,
+                                                          service_name)
         if return_entry is True:
             clear_screen()
             console.print(
@@ -670,7 +790,159 @@ def choice_six(username: str) -> None:
         console.print("\n[bold orange1 underline]User deletion canceled.")
 
 
-def choice_seven() -> None:
+def choice_seven(username: str) -> None:
+    """Audit stored passwords for reuse, weakness and age
+
+    Args:
+        username (str): User's name
+    """
+    clear_screen()
+    audit_passwords(username)
+
+
+def choice_eight(username: str) -> None:
+    """Add, view, save and delete attachments and secure notes
+
+    Args:
+        username (str): User's name
+    """
+    clear_screen()
+    store = attachments.store_for(vault.storage)
+    fernet_key_M = vault.load_fernet_key_locally(username)
+    listed = attachments.list_attachments(store, fernet_key_M, username)
+
+    table = Table(title=f"Attachments for {username} ")
+    table.add_column("#", justify="right")
+    table.add_column("Service", style="cyan", no_wrap=True)
+    table.add_column("Attachment", style="magenta")
+    table.add_column("Added", style="green")
+    for number, attachment in enumerate(listed, start=1):
+        table.add_row(str(number), attachment.service_name,
+                      describe_attachment(attachment),
+                      f"{attachment.uploaded_at:%Y-%m-%d %H:%M}")
+    console.print(table)
+
+    console.print("[cyan]a. Attach a file")
+    console.print("[magenta]n. Add a secure note")
+    console.print("[cyan]v. View a secure note")
+    console.print("[magenta]s. Save an attachment to a file")
+    console.print("[cyan]d. Delete an attachment or note")
+    action = console.input(
+        "\n[bold dodger_blue1 underline]Enter your choice "
+        "(enter to go back): ").strip().lower()
+
+    if action in ("a", "n"):
+        service_name = console.input(
+            "[bold orange1 underline]Enter the service name: ")
+        if action == "a":
+            path = console.input(
+                "[bold orange1 underline]Enter the path of the file: ")
+            try:
+                added = add_attachment(username, service_name, path)
+            except OSError as e:
+                clear_screen()
+                console.print(f"[bold red underline]Cannot read {path}: {e}")
+                return
+        else:
+            title = console.input("[bold orange1 underline]Enter a title: ")
+            text = console.input("[bold orange1 underline]Enter the note: ")
+            added = add_secure_note(username, service_name, title, text)
+        clear_screen()
+        if added:
+            console.print("[bold green underline]Attachment stored.")
+        else:
+            console.print(f"[bold red underline]Service {service_name} "
+                          "not found.")
+        return
+
+    if action not in ("v", "s", "d"):
+        clear_screen()
+        return
+
+    choice = console.input(
+        "[bold orange1 underline]Enter the attachment number: ")
+    if not choice.isdigit() or not 1 <= int(choice) <= len(listed):
+        clear_screen()
+        console.print("[bold red underline]No such attachment.")
+        return
+    attachment = listed[int(choice) - 1]
+
+    if action == "v" and attachment.kind != "note":
+        clear_screen()
+        console.print("[bold red underline]Only notes can be viewed, save "
+                      "files instead.")
+    elif action == "v":
+        clear_screen()
+        console.print(f"[bold underline]{attachment.name}\n")
+        console.print(attachments.read_note(store, fernet_key_M, username,
+                                            attachment.file_id),
+                      markup=False)
+        vault.log_access(username, "view_note", attachment.service_name)
+        console.input(
+            "\n[bold dodger_blue1 underline]Press enter to continue....")
+        clear_screen()
+    elif action == "s":
+        path = console.input(
+            "[bold orange1 underline]Save to (file path): ")
+        written = attachments.save(store, fernet_key_M, username,
+                                   attachment.file_id, path)
+        vault.log_access(username, "save_attachment", attachment.service_name)
+        clear_screen()
+        console.print(f"[bold green underline]Saved {written} bytes to "
+                      f"{path}.")
+    else:
+        store.delete(username, attachment.file_id)
+        vault.log_access(username, "delete_attachment",
+                         attachment.service_name)
+        clear_screen()
+        console.print("[bold bright_yellow underline]Attachment deleted.")
+
+
+def choice_nine(username: str) -> None:
+    """Show and restore the previous passwords of a service
+
+    Args:
+        username (str): User's name
+    """
+    clear_screen()
+    service_name = console.input(
+        "\n[bold orange1 underline]Enter the service name: ")
+    versions = history.versions(vault.storage, username, service_name)
+    if not versions:
+        clear_screen()
+        console.print(f"[bold red underline]No previous passwords for "
+                      f"{service_name}.")
+        return
+
+    fernet_key_M = vault.load_fernet_key_locally(username)
+    table = Table(title=f"Previous passwords for {service_name} ")
+    table.add_column("#", justify="right")
+    table.add_column("Username", style="magenta")
+    table.add_column("Password", style="green")
+    table.add_column("Replaced", style="cyan")
+    for version in versions:
+        with version.decrypt(fernet_key_M) as secret:
+            table.add_row(str(version.number), version.username_entry,
+                          secret.reveal(),
+                          f"{version.replaced_at:%Y-%m-%d %H:%M}")
+    console.print(table)
+    del table
+
+    choice = console.input(
+        "\n[bold dodger_blue1 underline]Enter the number to restore "
+        "(enter to go back): ").strip()
+    clear_screen()
+    if not choice:
+        return
+    if choice.isdigit() and vault.restore_password(username, service_name,
+                                                   int(choice)):
+        console.print(f"[bold green underline]Password for {service_name} "
+                      "restored.")
+    else:
+        console.print("[bold red underline]No such version.")
+
+
+def choice_ten() -> None:
     """Logout of Password Manager
     """
     clear_screen()
@@ -707,16 +979,18 @@ def main() -> None:
                 "\n[bold dodger_blue1 underline]Enter your username: ")
 
             console.print(
-                "[bold dodger_blue1 underline]\nPassword must meet the "
-                "following requirements:")
-            console.print("[bold dark_cyan]- At least 8 characters long")
-            console.print(
-                "[bold dodger_blue1]- At least one uppercase letter (A-Z)")
+                "[bold dodger_blue1 underline]\nPassword must be hard to "
+                "guess:")
             console.print(
-                "[bold dark_cyan]- At least one lowercase letter (a-z)")
-            console.print("[bold dodger_blue1]- At least one digit (0-9)")
+                "[bold dark_cyan]- Avoid common words, names, dates, "
+                "keyboard patterns and repeats")
             console.print(
-                "[bold dark_cyan]- At least one special character (@#$%^&+=!)")
+                "[bold dodger_blue1]- Several unrelated words or a long "
+                "random password score best")
+            if os.environ.get(breach.CORPUS_ENV):
+                console.print(
+                    "[bold dark_cyan]- Must not appear in a known data "
+                    "breach")
 
             console.print(
                 "\n[bold dodger_blue1 underline]Enter your master password: ")
@@ -727,13 +1001,17 @@ def main() -> None:
             confirm_password = getpass.getpass("")
 
             if master_password == confirm_password:
-                if validate_master_password(master_password):
-                    create_user(username, master_password)
-                else:
+                with profiling.profiled("create_user"):
+                    result = vault.check_master_password(
+                        master_password, username)
+                    if result.score >= strength.MIN_SCORE:
+                        create_user(username, master_password)
+                if result.score < strength.MIN_SCORE:
                     clear_screen()
                     console.print(
                         "[bold red underline]Password does not meet "
                         "the strength requirements.")
+                    print_password_feedback(result)
             else:
                 clear_screen()
                 console.print(
@@ -746,6 +1024,7 @@ def main() -> None:
         elif choice == "3":
             clear_screen()
             console.print("\n[bold green underline]Goodbye!\n")
+            close_storage()
             break
 
         else:
@@ -757,4 +1036,49 @@ def main() -> None:
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Password Manager")
+    parser.add_argument("--backend", choices=storage_backends.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault (default: $PM_STORAGE_MODE "
+                        "or documents)")
+    parser.add_argument("--keystore",
+                        help="single file holding every user's key "
+                        "(default: $PM_KEYSTORE or one key file per user)")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile capture of every menu "
+                        "action to DIR (default: $PM_PROFILE)")
+    parser.add_argument("--write-behind", metavar="JOURNAL", nargs="?",
+                        const=writebehind.DEFAULT_JOURNAL_PATH,
+                        help="acknowledge edits once journaled locally and "
+                        "store them in the background (default: "
+                        "$PM_WRITE_BEHIND)")
+    parser.add_argument("--access-log", action="store_true", default=None,
+                        help="record who viewed or changed which entry in "
+                        "audit.events (default: $PM_ACCESS_LOG)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record every database call, redacted, for "
+                        "replay with utility.trace (default: $PM_TRACE)")
+    parser.add_argument("--explain", choices=queryplan.EXPLAIN_MODES,
+                        help="explain MongoDB queries and warn about, or "
+                        "fail on, collection scans (default: $PM_EXPLAIN)")
+    parser.add_argument("--watch", action="store_true", default=None,
+                        help="follow MongoDB change streams so edits made "
+                        "in other sessions reach this one (default: "
+                        "$PM_WATCH)")
+    args = parser.parse_args()
+
+    vault.configure_storage(args.backend, args.sqlite_path,
+                            args.storage_mode, args.write_behind, args.trace,
+                            args.explain)
+    vault.configure_keystore(args.keystore)
+    vault.configure_access_log(args.access_log)
+    configure_watch(args.watch)
+    profiling.configure(args.profile)
+    warm_up_storage()
+
     main()
@@ -0,0 +1,334 @@
+"""Module recording who viewed, added, changed or deleted which entry
+
+Writing an audit record next to every vault operation would double its
+round trips. AccessLog.record() only appends the event to an in-memory
+queue; a background thread writes the queue to audit.events in batches, one
+insert_entries call per batch, and retries while the database is
+unreachable. A retried batch keeps its _ids, so events an earlier attempt
+stored are recognised by their duplicate key and not written twice. close()
+drains the queue before the process exits, and is also registered with
+atexit for exits that skip it.
+
+On MongoDB the collection gets compound indexes for queries by user,
+service and time, and a TTL index on the event time so events older than
+the retention period are removed by the server. Other backends prune
+expired events when the log starts. Events are written to the backend
+underneath the write-behind journal and the caches.
+
+Events look like:
+
+    {"user": "Peter", "action": "update", "service": "github",
+     "at": datetime, "host": "laptop", "pid": 4242}
+
+Usage:
+    python -m utility.accesslog query [--user U] [--service S]
+        [--action A] [--since ISO] [--until ISO]
+"""
+
+import argparse
+import atexit
+import os
+import queue
+import socket
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import Any, Dict, List
+from utility import storage
+from utility import utility
+from utility.storage import (MongoBackend, StorageBackend, as_utc,
+                             innermost)
+
+ACCESS_LOG_ENV = "PM_ACCESS_LOG"
+DATABASE = "audit"
+COLLECTION = "events"
+DEFAULT_RETENTION_DAYS = 365
+BATCH_SIZE = 500
+FLUSH_SECONDS = 1.0
+RETRY_SECONDS = 2.0
+MAX_QUEUED = 100000
+INDEXES = ([("user", 1), ("at", -1)],
+           [("user", 1), ("service", 1), ("at", -1)])
+
+
+def ensure_indexes(backend: StorageBackend,
+                   retention_days: int = DEFAULT_RETENTION_DAYS) -> None:
+    """Prepares the events collection for queries and expiry
+
+    Args:
+        backend (StorageBackend): Backend holding the events
+        retention_days (int, optional): Days events are kept.
+            Defaults to 365.
+    """
+
+    if isinstance(backend, MongoBackend):
+        for keys in INDEXES:
+            utility.create_index(DATABASE, COLLECTION, keys)
+        utility.create_index(DATABASE, COLLECTION, [("at", 1)],
+                             expire_after_seconds=retention_days * 86400)
+    else:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        backend.delete_entries(DATABASE, COLLECTION, {"at": {"$lt": cutoff}})
+
+
+class AccessLog:
+    """Queue of access events written in batches by a background thread
+
+    Args:
+        backend (StorageBackend): Backend to write the events to; wrappers
+            are skipped
+        batch_size (int, optional): Most events per insert. Defaults to 500.
+        flush_seconds (float, optional): Longest an event waits in the
+            queue. Defaults to 1 second.
+        max_queued (int, optional): Events kept while the database is
+            unreachable; older ones are dropped beyond it.
+            Defaults to 100000.
+    """
+
+    def __init__(self, backend: StorageBackend,
+                 batch_size: int = BATCH_SIZE,
+                 flush_seconds: float = FLUSH_SECONDS,
+                 max_queued: int = MAX_QUEUED) -> None:
+        self.backend = innermost(backend)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.last_error: Exception | None = None
+        self.dropped = 0
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(max_queued)
+        self._host = socket.gethostname()
+        # Events recorded but not yet written, including a batch in flight
+        self._unwritten = 0
+        self._written = threading.Condition()
+        self._retry: List[Dict[str, Any]] = []
+        self._stop = threading.Event()
+        self._closed = False
+        self._worker = threading.Thread(target=self._drain_forever,
+                                        daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    @property
+    def pending(self) -> int:
+        """Events not yet written
+        """
+
+        with self._written:
+            return self._unwritten
+
+    def record(self, username: str, action: str,
+               service_name: str | None = None, **details: Any) -> None:
+        """Queues an event without waiting for the database
+
+        Args:
+            username (str): User who acted
+            action (str): What they did, e.g. "view" or "delete"
+            service_name (str | None, optional): Entry acted on.
+                Defaults to None.
+            **details (Any): Further fields stored with the event
+        """
+
+        event = {"user": username, "action": action,
+                 "service": service_name, "at": datetime.now(timezone.utc),
+                 "host": self._host, "pid": os.getpid(), **details}
+        with self._written:
+            self._unwritten += 1
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                # Keep the newest events when the database stays away
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self.dropped += 1
+                self._done(1)
+
+    def _done(self, count: int) -> None:
+        """Counts events as written or dropped
+        """
+
+        with self._written:
+            self._unwritten -= count
+            self._written.notify_all()
+
+    def _take_batch(self, wait: float) -> List[Dict[str, Any]]:
+        """Waits for an event, then takes up to a batch without waiting
+        """
+
+        try:
+            batch = [self._queue.get(timeout=wait)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        """Inserts a batch, returning False if the database failed
+        """
+
+        try:
+            try:
+                self.backend.insert_entries(DATABASE, COLLECTION, batch)
+            except (BulkWriteError, DuplicateKeyError):
+                # A failed attempt stored part of the batch, _ids included
+                for event in batch:
+                    try:
+                        self.backend.insert_entry(DATABASE, COLLECTION,
+                                                  event)
+                    except DuplicateKeyError:
+                        pass
+        except Exception as ex:
+            self.last_error = ex
+            return False
+        self.last_error = None
+        self._done(len(batch))
+        return True
+
+    def _drain_forever(self) -> None:
+        """Writes queued events until the log is closed
+        """
+
+        while not self._stop.is_set():
+            batch = self._retry or self._take_batch(self.flush_seconds)
+            if batch and not self._write(batch):
+                # Left for the next attempt, or for close()
+                self._retry = batch
+                self._stop.wait(RETRY_SECONDS)
+            else:
+                self._retry = []
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Waits until every recorded event has been written
+
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to 10.
+
+        Returns:
+            bool: True if nothing is left to write
+        """
+
+        with self._written:
+            return self._written.wait_for(lambda: self._unwritten == 0,
+                                          timeout)
+
+    def close(self, timeout: float = 10.0) -> int:
+        """Stops the worker and writes the remaining events
+
+        Args:
+            timeout (float, optional): Seconds to wait for the worker.
+                Defaults to 10.
+
+        Returns:
+            int: Events that could not be written
+        """
+
+        if self._closed:
+            return 0
+        self._closed = True
+        atexit.unregister(self.close)
+        self._stop.set()
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            return self.pending
+
+        batch = self._retry
+        while batch or not self._queue.empty():
+            batch = batch or self._take_batch(0)
+            if not self._write(batch):
+                break
+            batch = []
+        return self.pending
+
+
+def query_events(backend: StorageBackend, username: str | None = None,
+                 service_name: str | None = None, action: str | None = None,
+                 since: datetime | None = None,
+                 until: datetime | None = None) -> List[Dict[str, Any]]:
+    """Finds events, newest first
+
+    The filter leads with user and service, then the time range, matching
+    the compound indexes.
+
+    Args:
+        backend (StorageBackend): Backend holding the events
+        username (str | None, optional): Only this user's events.
+        service_name (str | None, optional): Only events on this entry.
+        action (str | None, optional): Only this action.
+        since (datetime | None, optional): Events at or after this time,
+            naive times are UTC.
+        until (datetime | None, optional): Events before this time.
+
+    Returns:
+        List[Dict[str, Any]]: Matching events
+    """
+
+    query: Dict[str, Any] = {}
+    if username is not None:
+        query["user"] = username
+    if service_name is not None:
+        query["service"] = service_name
+    if since is not None or until is not None:
+        query["at"] = {}
+        if since is not None:
+            query["at"]["$gte"] = as_utc(since)
+        if until is not None:
+            query["at"]["$lt"] = as_utc(until)
+    if action is not None:
+        query["action"] = action
+
+    events = list(innermost(backend).find_entries(DATABASE, COLLECTION,
+                                                  query or None))
+    # Reversed first so events recorded in the same microsecond stay in
+    # newest first order too
+    events.reverse()
+    events.sort(key=lambda event: as_utc(event["at"]), reverse=True)
+    return events
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for querying the access log
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.accesslog")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+    search = commands.add_parser("query", help="list access events")
+    search.add_argument("--user")
+    search.add_argument("--service")
+    search.add_argument("--action")
+    search.add_argument("--since", type=datetime.fromisoformat,
+                        help="ISO date or time, UTC unless an offset is "
+                        "given")
+    search.add_argument("--until", type=datetime.fromisoformat)
+    args = parser.parse_args(argv)
+
+    backend = storage.get_backend(args.backend, args.sqlite_path)
+    events = query_events(backend, args.user, args.service, args.action,
+                          args.since, args.until)
+    for event in events:
+        print(f"{as_utc(event['at']):%Y-%m-%d %H:%M:%S} {event['user']:<16} "
+              f"{event['action']:<16} {event.get('service') or '-':<24} "
+              f"{event.get('host', '')}:{event.get('pid', '')}")
+    print(f"{len(events)} events", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,764 @@
+"""Long running vault agent serving a logged in user over a Unix socket
+
+Like ssh-agent, the agent is unlocked once with the master password and then
+answers get/list/add/update/delete requests from scripts without
+reconnecting, re-authenticating or re-reading the key file. Decrypted entries
+are cached in memory until the agent has been idle for its TTL, after which
+the session is locked and the cache wiped.
+
+Every request and response is one BSON document. A BSON document starts with
+its own little-endian int32 length, which doubles as the frame header.
+
+Usage:
+    python -m utility.agent start --username NAME [--ttl SECONDS] [--watch]
+    python -m utility.agent get SERVICE
+    python -m utility.agent match URL
+    python -m utility.agent list
+    python -m utility.agent lock | stop
+"""
+
+import argparse
+import getpass
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import bson
+from typing import Any, Dict, List
+from utility import packed
+from utility import storage
+from utility import urlmatch
+from utility import vault
+from utility import watcher
+from utility.entries import (Secret, VaultEntry, decrypt_entries,
+                             iter_vault_entries, wipe_entries)
+
+SOCKET_ENV = "PM_AGENT_SOCK"
+TTL_ENV = "PM_AGENT_TTL"
+DEFAULT_TTL = 900.0
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class AgentError(Exception):
+    """Raised when the agent refuses or fails a request
+    """
+
+
+def default_socket_path() -> str:
+    """Returns the agent socket path
+
+    Returns:
+        str: $PM_AGENT_SOCK, else pm-agent.sock in $XDG_RUNTIME_DIR,
+            else a per-user file in /tmp
+    """
+
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "pm-agent.sock")
+    return f"/tmp/pm-agent-{os.getuid()}.sock"
+
+
+def _read_exactly(sock: socket.socket, size: int) -> bytes:
+    """Reads exactly size bytes from a socket
+
+    Args:
+        sock (socket.socket): Connected socket
+        size (int): Number of bytes to read
+
+    Raises:
+        EOFError: Raised if the peer closed the connection first
+
+    Returns:
+        bytes: The bytes read
+    """
+
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def read_frame(sock: socket.socket) -> Dict[str, Any]:
+    """Reads one BSON framed message
+
+    Args:
+        sock (socket.socket): Connected socket
+
+    Raises:
+        AgentError: Raised if the frame is larger than MAX_FRAME_SIZE
+
+    Returns:
+        Dict[str, Any]: The decoded message
+    """
+
+    header = _read_exactly(sock, 4)
+    (size,) = struct.unpack("<i", header)
+    if size < 5 or size > MAX_FRAME_SIZE:
+        raise AgentError(f"invalid frame size {size}")
+    return bson.decode(header + _read_exactly(sock, size - 4))
+
+
+def write_frame(sock: socket.socket, message: Dict[str, Any]) -> None:
+    """Writes one BSON framed message
+
+    Args:
+        sock (socket.socket): Connected socket
+        message (Dict[str, Any]): The message to send
+    """
+
+    sock.sendall(bson.encode(message))
+
+
+class VaultSession:
+    """Unlocked vault state held by the agent
+
+    Holds the user's Fernet key, a cache of decrypted entries keyed by
+    service name and an index of their URLs for autofill. Cached passwords
+    are wipeable secrets that are zeroed when the session locks. Writes go
+    through utility.vault so they store exactly the same documents as the
+    interactive program.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL) -> None:
+        self.ttl = ttl
+        self.username: str | None = None
+        self._fernet_key: Any = None
+        self._cache: Dict[str, VaultEntry] | None = None
+        self._services_by_id: Dict[Any, str] = {}
+        self._urls = urlmatch.UrlIndex()
+        self._last_used = time.monotonic()
+        self._lock = threading.RLock()
+
+    def unlock(self, username: str, master_password: str) -> None:
+        """Authenticates the user and unlocks the session
+
+        Any session already unlocked is locked first, even if the new
+        authentication fails.
+
+        Args:
+            username (str): User's name
+            master_password (str): User's master password
+
+        Raises:
+            AgentError: Raised if authentication fails
+        """
+
+        with self._lock:
+            self.lock()
+            if not vault.authenticate_user(username, master_password):
+                raise AgentError("authentication failed")
+            self.username = username
+            self._fernet_key = vault.load_fernet_key_locally(username)
+            self._last_used = time.monotonic()
+
+    def lock(self) -> None:
+        """Forgets the key and the decrypted entries
+        """
+
+        with self._lock:
+            if self.username is not None:
+                vault.forget_fernet_key(self.username)
+            self.username = None
+            self._fernet_key = None
+            self._drop_cache()
+
+    def _drop_cache(self) -> None:
+        """Wipes the decrypted entries so the next request reloads them
+        """
+
+        if self._cache is not None:
+            wipe_entries(self._cache.values())
+        self._cache = None
+        self._services_by_id = {}
+        self._urls.clear()
+
+    def expire_if_idle(self) -> bool:
+        """Locks the session if it has been idle longer than the TTL
+
+        Returns:
+            bool: True if the session was locked by this call
+        """
+
+        with self._lock:
+            idle = time.monotonic() - self._last_used
+            if self.username is not None and idle > self.ttl:
+                self.lock()
+                return True
+            return False
+
+    def _require_unlocked(self) -> str:
+        self.expire_if_idle()
+        if self.username is None:
+            raise AgentError("agent is locked")
+        self._last_used = time.monotonic()
+        return self.username
+
+    def _entries(self) -> Dict[str, VaultEntry]:
+        """Returns the decrypted entry cache, loading it on first use
+        """
+
+        username = self._require_unlocked()
+        if self._cache is None:
+            self._cache = {}
+            for batch in iter_vault_entries(vault.storage, username):
+                decrypt_entries(self._fernet_key, batch)
+                for entry in batch:
+                    self._store(entry)
+        return self._cache
+
+    def _store(self, entry: VaultEntry) -> None:
+        """Puts a decrypted entry in the cache, wiping the one it replaces
+        """
+
+        if self._cache is None:
+            return
+        replaced = self._cache.get(entry.service_name)
+        if replaced is not None and replaced is not entry:
+            replaced.wipe()
+        self._cache[entry.service_name] = entry
+        self._urls.add(entry.service_name, entry.urls)
+        if entry.entry_id is not None:
+            self._services_by_id[entry.entry_id] = entry.service_name
+
+    def apply_change(self, change: Dict[str, Any]) -> None:
+        """Applies a change pushed by a VaultWatcher to the cache
+
+        Args:
+            change (Dict[str, Any]): Change from utility.watcher
+        """
+
+        with self._lock:
+            if change["source"] == "user":
+                if change["operation"] == "delete":
+                    self.lock()
+                return
+            if self._cache is None:
+                return
+
+            if packed.is_packed_id(change["document_key"]):
+                # A packed vault is rewritten as a whole, so reload it when
+                # its header moves to a new version
+                if change["document_key"] == packed.HEADER_ID:
+                    self._drop_cache()
+                return
+
+            service_name = self._services_by_id.pop(change["document_key"],
+                                                    None)
+            if service_name is not None:
+                removed = self._cache.pop(service_name, None)
+                if removed is not None:
+                    removed.wipe()
+                self._urls.remove(service_name)
+
+            document = change.get("document")
+            if change["operation"] != "delete" and document is not None:
+                entry = VaultEntry.from_document(document)
+                decrypt_entries(self._fernet_key, [entry])
+                self._store(entry)
+
+    def _plaintext_entry(self, service_name: str, username_entry: str,
+                         password_entry: str,
+                         urls: List[str] | None = None) -> VaultEntry:
+        """Builds a cache entry for a password the caller already knows
+        """
+
+        entry = VaultEntry(None, service_name, username_entry, None,
+                           urls=urls)
+        entry.secret = Secret(password_entry.encode())
+        return entry
+
+    def get(self, service_name: str) -> Dict[str, Any]:
+        """Returns one decrypted entry
+
+        Args:
+            service_name (str): Name of the website/service
+
+        Raises:
+            AgentError: Raised if the service is not found
+
+        Returns:
+            Dict[str, Any]: service_name, username_entry and password
+        """
+
+        with self._lock:
+            entry = self._entries().get(service_name)
+            if entry is None or entry.secret is None:
+                raise AgentError(f"service {service_name} not found")
+            return {'service_name': entry.service_name,
+                    'username_entry': entry.username_entry,
+                    'password': entry.secret.reveal()}
+
+    def match(self, url: str) -> List[Dict[str, Any]]:
+        """Returns the decrypted entries for a page, most specific first
+
+        Args:
+            url (str): The page's URL
+
+        Returns:
+            List[Dict[str, Any]]: service_name, username_entry and password
+                of every entry with a URL on the page's site
+        """
+
+        with self._lock:
+            username = self._require_unlocked()
+            if self._cache is None:
+                # Until the vault is loaded, the indexed domains field finds
+                # the few candidates without decrypting every entry
+                found = [VaultEntry.from_document(document) for document in
+                         urlmatch.find_for_url(vault.storage, username, url)]
+                decrypt_entries(self._fernet_key, found)
+                try:
+                    return [{'service_name': entry.service_name,
+                             'username_entry': entry.username_entry,
+                             'password': entry.secret.reveal()}
+                            for entry in found if entry.secret is not None]
+                finally:
+                    wipe_entries(found)
+
+            entries = self._entries()
+            return [{'service_name': service_name,
+                     'username_entry': entries[service_name].username_entry,
+                     'password': secret.reveal()}
+                    for service_name in self._urls.match(url)
+                    if (secret := entries[service_name].secret) is not None]
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Lists the service names and usernames without passwords
+
+        Returns:
+            List[Dict[str, Any]]: One dictionary per entry
+        """
+
+        with self._lock:
+            return [{'service_name': entry.service_name,
+                     'username_entry': entry.username_entry}
+                    for entry in self._entries().values()]
+
+    def add(self, service_name: str, username_entry: str,
+            password_entry: str, urls: List[str] | None = None) -> None:
+        """Adds an entry to the vault and the cache
+
+        Args:
+            service_name (str): Name of the website/service
+            username_entry (str): Username for the website/service
+            password_entry (str): Password for the website/service
+            urls (List[str] | None, optional): URLs of the login pages.
+                Defaults to None.
+
+        Raises:
+            AgentError: Raised if the entry could not be added
+        """
+
+        with self._lock:
+            self._entries()
+            try:
+                added = vault.add_password(self._require_unlocked(),
+                                           service_name, username_entry,
+                                           password_entry, urls)
+            except ValueError as ex:
+                raise AgentError(str(ex)) from None
+            if not added:
+                raise AgentError("failed to add password entry")
+            self._store(self._plaintext_entry(service_name, username_entry,
+                                              password_entry, urls))
+
+    def update(self, service_name: str, username_entry: str,
+               password_entry: str) -> None:
+        """Updates an entry in the vault and the cache
+
+        Args:
+            service_name (str): Name of the website/service
+            username_entry (str): New username for the website/service
+            password_entry (str): New password for the website/service
+
+        Raises:
+            AgentError: Raised if the service is not found
+        """
+
+        with self._lock:
+            self._entries()
+            urls = self._cache[service_name].urls \
+                if self._cache and service_name in self._cache else None
+            if not vault.update_service(self._require_unlocked(),
+                                        service_name, username_entry,
+                                        password_entry):
+                raise AgentError(f"service {service_name} not found")
+            self._store(self._plaintext_entry(service_name, username_entry,
+                                              password_entry, urls))
+
+    def delete(self, service_name: str) -> None:
+        """Deletes an entry from the vault and the cache
+
+        Args:
+            service_name (str): Name of the website/service
+
+        Raises:
+            AgentError: Raised if the service is not found
+        """
+
+        with self._lock:
+            entries = self._entries()
+            if not vault.delete_service_and_passwords(
+                    self._require_unlocked(), service_name):
+                raise AgentError(f"service {service_name} not found")
+            removed = entries.pop(service_name, None)
+            if removed is not None:
+                removed.wipe()
+            self._urls.remove(service_name)
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    """Removes a socket left behind by an agent that is no longer running
+
+    Args:
+        socket_path (str): Path the agent will listen on
+
+    Raises:
+        AgentError: Raised if an agent answers on the path or the path is
+            not a socket
+    """
+
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise AgentError(f"{socket_path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            raise AgentError(f"an agent is already listening on "
+                             f"{socket_path}")
+    os.remove(socket_path)
+
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    """Threaded Unix socket server sharing one VaultSession
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, session: VaultSession) -> None:
+        self.session = session
+        self.socket_path = socket_path
+        _remove_stale_socket(socket_path)
+
+        # Only the owner may connect to the socket. It is bound in a
+        # private directory and linked into place once restricted, which
+        # fails rather than replacing an agent that started meanwhile.
+        private_dir = tempfile.mkdtemp(
+            prefix=".pm-agent-",
+            dir=os.path.dirname(os.path.abspath(socket_path)))
+        bound_path = os.path.join(private_dir, "agent.sock")
+        try:
+            super().__init__(bound_path, AgentRequestHandler)
+            try:
+                os.chmod(bound_path, 0o600)
+                os.link(bound_path, socket_path)
+            except FileExistsError:
+                super().server_close()
+                raise AgentError(f"an agent is already listening on "
+                                 f"{socket_path}") from None
+            except BaseException:
+                super().server_close()
+                raise
+        finally:
+            if os.path.exists(bound_path):
+                os.remove(bound_path)
+            os.rmdir(private_dir)
+        self.server_address = socket_path
+
+        self._closed = threading.Event()
+        self._reaper = threading.Thread(target=self._reap, daemon=True)
+        self._reaper.start()
+
+    def _reap(self) -> None:
+        """Locks the session once it has been idle for its TTL, until the
+        server is closed
+        """
+
+        while not self._closed.wait(min(1.0, self.session.ttl)):
+            self.session.expire_if_idle()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._closed.set()
+        self._reaper.join()
+        self.session.lock()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def dispatch(self, request: Dict[str, Any]) -> Any:
+        """Runs one request against the session
+
+        Args:
+            request (Dict[str, Any]): Decoded request with an "op" field
+
+        Raises:
+            AgentError: Raised for unknown operations
+
+        Returns:
+            Any: The operation's result
+        """
+
+        op = request.get("op")
+        session = self.session
+
+        if op == "unlock":
+            session.unlock(request["username"], request["master_password"])
+            return None
+        if op == "lock":
+            session.lock()
+            return None
+        if op == "get":
+            return session.get(request["service_name"])
+        if op == "match":
+            return session.match(request["url"])
+        if op == "list":
+            return session.list()
+        if op == "add":
+            session.add(request["service_name"], request["username_entry"],
+                        request["password_entry"], request.get("urls"))
+            return None
+        if op == "update":
+            session.update(request["service_name"],
+                           request["username_entry"],
+                           request["password_entry"])
+            return None
+        if op == "delete":
+            session.delete(request["service_name"])
+            return None
+        if op == "stop":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return None
+        raise AgentError(f"unknown operation {op}")
+
+
+def _describe(ex: Exception) -> str:
+    """Turns an exception into the error message sent to clients
+    """
+
+    if isinstance(ex, AgentError):
+        return str(ex)
+    return type(ex).__name__ + (f": {ex}" if str(ex) else "")
+
+
+class AgentRequestHandler(socketserver.BaseRequestHandler):
+    """Serves framed requests on one client connection until it closes
+    """
+
+    server: AgentServer
+
+    def handle(self) -> None:
+        while True:
+            try:
+                request = read_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            except Exception as ex:
+                # The stream cannot be resynchronised after a bad frame
+                write_frame(self.request, {"ok": False,
+                                           "error": _describe(ex)})
+                return
+
+            try:
+                result = self.server.dispatch(request)
+                response = {"ok": True, "result": result}
+            except KeyError as ex:
+                response = {"ok": False, "error": f"missing field {ex}"}
+            except Exception as ex:
+                # Every request gets a reply, whatever went wrong
+                response = {"ok": False, "error": _describe(ex)}
+            write_frame(self.request, response)
+
+
+class AgentClient:
+    """Client for the vault agent. One connection is reused for all calls.
+    """
+
+    def __init__(self, socket_path: str | None = None) -> None:
+        self.socket_path = socket_path or default_socket_path()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.socket_path)
+
+    def close(self) -> None:
+        """Closes the connection to the agent
+        """
+
+        self._sock.close()
+
+    def __enter__(self) -> "AgentClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def request(self, op: str, **fields: Any) -> Any:
+        """Sends one request and waits for its response
+
+        Args:
+            op (str): Operation name
+            **fields (Any): Operation arguments
+
+        Raises:
+            AgentError: Raised if the agent reports an error
+
+        Returns:
+            Any: The operation's result
+        """
+
+        write_frame(self._sock, {"op": op, **fields})
+        response = read_frame(self._sock)
+        if not response.get("ok"):
+            raise AgentError(response.get("error", "unknown error"))
+        return response.get("result")
+
+    def unlock(self, username: str, master_password: str) -> None:
+        self.request("unlock", username=username,
+                     master_password=master_password)
+
+    def lock(self) -> None:
+        self.request("lock")
+
+    def get(self, service_name: str) -> Dict[str, Any]:
+        result: Dict[str, Any] = self.request("get",
+                                              service_name=service_name)
+        return result
+
+    def match(self, url: str) -> List[Dict[str, Any]]:
+        result: List[Dict[str, Any]] = self.request("match", url=url)
+        return result
+
+    def list(self) -> List[Dict[str, Any]]:
+        result: List[Dict[str, Any]] = self.request("list")
+        return result
+
+    def add(self, service_name: str, username_entry: str,
+            password_entry: str, urls: List[str] | None = None) -> None:
+        self.request("add", service_name=service_name,
+                     username_entry=username_entry,
+                     password_entry=password_entry, urls=urls)
+
+    def update(self, service_name: str, username_entry: str,
+               password_entry: str) -> None:
+        self.request("update", service_name=service_name,
+                     username_entry=username_entry,
+                     password_entry=password_entry)
+
+    def delete(self, service_name: str) -> None:
+        self.request("delete", service_name=service_name)
+
+    def stop(self) -> None:
+        self.request("stop")
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for starting and querying the agent
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.agent")
+    parser.add_argument("--socket", default=None,
+                        help="socket path (default: $PM_AGENT_SOCK)")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault")
+    parser.add_argument("--keystore",
+                        help="single file holding every user's key "
+                        "(default: $PM_KEYSTORE)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    start = commands.add_parser("start", help="start the agent")
+    start.add_argument("--username", required=True)
+    start.add_argument("--ttl", type=float,
+                       default=float(os.environ.get(TTL_ENV, DEFAULT_TTL)),
+                       help="idle seconds before the vault is locked")
+    start.add_argument("--watch", action="store_true",
+                       help="follow MongoDB change streams to keep the "
+                       "cache current with other sessions")
+    start.add_argument("--resume-file", default=None,
+                       help="file keeping change stream resume tokens")
+    get = commands.add_parser("get", help="print one entry")
+    get.add_argument("service_name")
+    match = commands.add_parser("match",
+                                help="list the entries for a page URL")
+    match.add_argument("url")
+    commands.add_parser("list", help="list service names")
+    commands.add_parser("lock", help="lock the vault")
+    commands.add_parser("stop", help="stop the agent")
+
+    args = parser.parse_args(argv)
+    socket_path = args.socket or default_socket_path()
+
+    try:
+        if args.command == "start":
+            vault.configure_storage(args.backend, args.sqlite_path,
+                                    args.storage_mode)
+            vault.configure_keystore(args.keystore)
+            session = VaultSession(args.ttl)
+            session.unlock(args.username,
+                           getpass.getpass("Master password: "))
+            vault_watcher = None
+            if args.watch:
+                vault_watcher = watcher.VaultWatcher(args.username,
+                                                     args.resume_file)
+                vault_watcher.subscribe(session.apply_change)
+                vault_watcher.start()
+            try:
+                with AgentServer(socket_path, session) as server:
+                    print(f"Agent listening on {socket_path}")
+                    server.serve_forever()
+            finally:
+                if vault_watcher is not None:
+                    vault_watcher.stop()
+            return 0
+
+        with AgentClient(socket_path) as client:
+            if args.command == "get":
+                entry = client.get(args.service_name)
+                print(f"{entry['username_entry']}\t{entry['password']}")
+            elif args.command == "match":
+                for entry in client.match(args.url):
+                    print(f"{entry['service_name']}\t"
+                          f"{entry['username_entry']}")
+            elif args.command == "list":
+                for entry in client.list():
+                    print(f"{entry['service_name']}\t"
+                          f"{entry['username_entry']}")
+            elif args.command == "lock":
+                client.lock()
+            elif args.command == "stop":
+                client.stop()
+    except EOFError:
+        print("Error: the agent closed the connection", file=sys.stderr)
+        return 1
+    except (AgentError, OSError) as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
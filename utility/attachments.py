@@ -0,0 +1,546 @@
+"""Module storing encrypted file attachments and secure notes per entry
+
+An entry can carry files (SSH keys, recovery codes, certificates) and
+secure notes. Their content is encrypted as a stream of fixed size records,
+
+    record = envelope(block of plaintext, bound to file id, index, final)
+
+so a multi-megabyte file is never held in memory on upload or download and
+records cannot be reordered, swapped between files or cut off without
+decryption failing. A note is an attachment whose content is text.
+
+On MongoDB the records are written to GridFS, one bucket per user in the
+attachments database. Other backends store the same layout as
+<user>.files and <user>.chunks collections. A file's metadata (service,
+kind, encrypted name) lives in its files document, so listing attachments
+never reads their content.
+"""
+
+import io
+import os
+import struct
+import gridfs
+from bson import ObjectId
+from cryptography.fernet import InvalidToken
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Dict, Iterator, List, Protocol
+from utility import envelope
+from utility import utility
+from utility.envelope import Cipher
+from utility.storage import MongoBackend, StorageBackend, innermost
+
+DATABASE = "attachments"
+BLOCK_SIZE = 64 * 1024
+CHUNK_SIZE = 255 * 1024
+READ_AHEAD = 4
+KINDS = ("file", "note")
+
+
+class AttachmentError(Exception):
+    """Raised when an attachment is missing or its chunks are incomplete
+    """
+
+
+@dataclass
+class Attachment:
+    """Metadata of a stored attachment
+
+    Attributes:
+        file_id (ObjectId): Identifier of the stored file
+        service_name (str): Entry the attachment belongs to
+        name (str): File name or note title
+        kind (str): "file" or "note"
+        length (int): Size of the plaintext in bytes
+        uploaded_at (datetime): When it was stored
+    """
+
+    file_id: ObjectId
+    service_name: str
+    name: str
+    kind: str
+    length: int
+    uploaded_at: datetime
+
+
+class Upload(Protocol):
+    """Byte stream being written to an AttachmentStore
+    """
+
+    def write(self, data: bytes) -> Any: ...
+
+    def close(self) -> None: ...
+
+    def abort(self) -> None: ...
+
+
+class Download(Protocol):
+    """Byte stream being read from an AttachmentStore
+    """
+
+    metadata: Any
+
+    def read(self, size: int = -1) -> bytes: ...
+
+    def close(self) -> None: ...
+
+
+class AttachmentStore(Protocol):
+    """Chunked byte storage the encrypted attachments are written to
+    """
+
+    def open_upload(self, username: str, file_id: ObjectId,
+                    metadata: Dict[str, Any]) -> Upload: ...
+
+    def open_download(self, username: str, file_id: ObjectId) -> Download: ...
+
+    def list_files(self, username: str,
+                   service_name: str | None = None
+                   ) -> List[Dict[str, Any]]: ...
+
+    def delete(self, username: str, file_id: ObjectId) -> None: ...
+
+    def delete_all(self, username: str) -> None: ...
+
+
+class GridFSStore:
+    """AttachmentStore keeping each user's files in a GridFS bucket
+    """
+
+    def _bucket(self, username: str) -> Any:
+        return gridfs.GridFSBucket(utility.get_client()[DATABASE],
+                                   bucket_name=username,
+                                   chunk_size_bytes=CHUNK_SIZE)
+
+    def open_upload(self, username: str, file_id: ObjectId,
+                    metadata: Dict[str, Any]) -> Upload:
+        upload: Upload = self._bucket(username).open_upload_stream_with_id(
+            file_id, str(file_id), metadata=metadata)
+        return upload
+
+    def open_download(self, username: str, file_id: ObjectId) -> Download:
+        try:
+            download: Download = self._bucket(username).open_download_stream(
+                file_id)
+        except gridfs.errors.NoFile:
+            raise AttachmentError(f"No attachment {file_id}") from None
+        return download
+
+    def list_files(self, username: str,
+                   service_name: str | None = None) -> List[Dict[str, Any]]:
+        query = {} if service_name is None else {
+            "metadata.service_name": service_name}
+        return [{"_id": grid_out._id, "length": grid_out.length,
+                 "uploadDate": grid_out.upload_date,
+                 "metadata": grid_out.metadata}
+                for grid_out in self._bucket(username).find(query)]
+
+    def delete(self, username: str, file_id: ObjectId) -> None:
+        try:
+            self._bucket(username).delete(file_id)
+        except gridfs.errors.NoFile:
+            pass
+
+    def delete_all(self, username: str) -> None:
+        database = utility.get_client()[DATABASE]
+        database.drop_collection(f"{username}.files")
+        database.drop_collection(f"{username}.chunks")
+
+
+class _DocumentUpload:
+    """Upload writing chunk documents, then the files document
+    """
+
+    def __init__(self, backend: StorageBackend, username: str,
+                 file_id: ObjectId, metadata: Dict[str, Any]) -> None:
+        self._backend = backend
+        self._username = username
+        self._file_id = file_id
+        self._metadata = metadata
+        self._buffer = bytearray()
+        self._chunks = 0
+        self._length = 0
+
+    def _flush(self, data: bytes) -> None:
+        self._backend.insert_entry(DATABASE, f"{self._username}.chunks", {
+            "files_id": self._file_id, "n": self._chunks, "data": data})
+        self._chunks += 1
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        self._length += len(data)
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._flush(bytes(self._buffer[:CHUNK_SIZE]))
+            del self._buffer[:CHUNK_SIZE]
+
+    def close(self) -> None:
+        if self._buffer:
+            self._flush(bytes(self._buffer))
+            self._buffer.clear()
+        # Written last, like GridFS, so an interrupted upload is not listed
+        self._backend.insert_entry(DATABASE, f"{self._username}.files", {
+            "_id": self._file_id, "filename": str(self._file_id),
+            "length": self._length, "chunkSize": CHUNK_SIZE,
+            "uploadDate": datetime.now(timezone.utc),
+            "metadata": self._metadata})
+
+    def abort(self) -> None:
+        self._backend.delete_entries(DATABASE, f"{self._username}.chunks",
+                                     {"files_id": self._file_id})
+
+
+class _DocumentDownload:
+    """Download streaming chunk documents in order
+    """
+
+    def __init__(self, backend: StorageBackend, username: str,
+                 files: Dict[str, Any]) -> None:
+        self.metadata = files["metadata"]
+        self._chunks = (document for batch in backend.iter_entries(
+            DATABASE, f"{username}.chunks", {"files_id": files["_id"]},
+            batch_size=READ_AHEAD) for document in batch)
+        self._expected = -(-files["length"] // files["chunkSize"])
+        self._next = 0
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            if chunk["n"] != self._next:
+                raise AttachmentError(f"Chunk {self._next} is missing")
+            self._buffer += chunk["data"]
+            self._next += 1
+        if self._next < self._expected and len(self._buffer) < size:
+            raise AttachmentError(f"Chunk {self._next} is missing")
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self) -> None:
+        self._chunks.close()
+
+
+class DocumentStore:
+    """AttachmentStore using GridFS's layout on any StorageBackend
+
+    Args:
+        backend (StorageBackend): Backend holding the documents
+    """
+
+    def __init__(self, backend: StorageBackend) -> None:
+        self.backend = backend
+
+    def open_upload(self, username: str, file_id: ObjectId,
+                    metadata: Dict[str, Any]) -> Upload:
+        return _DocumentUpload(self.backend, username, file_id, metadata)
+
+    def open_download(self, username: str, file_id: ObjectId) -> Download:
+        files = self.backend.find_entries(DATABASE, f"{username}.files",
+                                          {"_id": file_id})
+        if not files:
+            raise AttachmentError(f"No attachment {file_id}")
+        return _DocumentDownload(self.backend, username, files[0])
+
+    def list_files(self, username: str,
+                   service_name: str | None = None) -> List[Dict[str, Any]]:
+        query = None if service_name is None else {
+            "metadata.service_name": service_name}
+        return list(self.backend.find_entries(DATABASE, f"{username}.files",
+                                              query))
+
+    def delete(self, username: str, file_id: ObjectId) -> None:
+        self.backend.delete_entries(DATABASE, f"{username}.files",
+                                    {"_id": file_id})
+        self.backend.delete_entries(DATABASE, f"{username}.chunks",
+                                    {"files_id": file_id})
+
+    def delete_all(self, username: str) -> None:
+        self.backend.delete_collection(DATABASE, f"{username}.files")
+        self.backend.delete_collection(DATABASE, f"{username}.chunks")
+
+
+def store_for(backend: StorageBackend) -> AttachmentStore:
+    """Returns the attachment store matching a storage backend
+
+    Wrappers such as the write-behind journal and the caches are skipped:
+    attachments are written straight to the backend underneath them.
+
+    Args:
+        backend (StorageBackend): The configured backend
+
+    Returns:
+        AttachmentStore: GridFS for MongoDB, documents otherwise
+    """
+
+    backend = innermost(backend)
+    if isinstance(backend, MongoBackend):
+        return GridFSStore()
+    return DocumentStore(backend)
+
+
+def _context(file_id: ObjectId, index: int, final: bool) -> bytes:
+    """Returns the associated data binding a record to its place
+    """
+
+    return file_id.binary + struct.pack(">Q?", index, final)
+
+
+def _read_block(source: BinaryIO, size: int) -> bytes:
+    """Reads size bytes, fewer only at the end of the stream
+    """
+
+    parts = []
+    remaining = size
+    while remaining:
+        part = source.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b"".join(parts)
+
+
+def _plaintext_length(length: int, block_size: int) -> int:
+    """Converts a stored length into the length of the plaintext
+    """
+
+    records = max(1, -(-length // (block_size + envelope.OVERHEAD)))
+    return length - records * envelope.OVERHEAD
+
+
+def upload(store: AttachmentStore, fernet_key: Any, username: str,
+           service_name: str, name: str, source: BinaryIO,
+           kind: str = "file", block_size: int = BLOCK_SIZE) -> Attachment:
+    """Encrypts a stream into a new attachment of an entry
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        service_name (str): Entry the attachment belongs to
+        name (str): File name or note title, stored encrypted
+        source (BinaryIO): Content, read one block at a time
+        kind (str, optional): "file" or "note". Defaults to "file".
+        block_size (int, optional): Plaintext bytes per record.
+            Defaults to 64KB.
+
+    Raises:
+        ValueError: Raised if the kind is unknown
+
+    Returns:
+        Attachment: The stored attachment
+    """
+
+    if kind not in KINDS:
+        raise ValueError(f"Unknown attachment kind {kind}")
+
+    cipher = Cipher(fernet_key)
+    file_id = ObjectId()
+    metadata = {"service_name": service_name, "kind": kind,
+                "name": cipher.encrypt(name.encode(), file_id.binary),
+                "block_size": block_size}
+    stream = store.open_upload(username, file_id, metadata)
+
+    length = 0
+    index = 0
+    try:
+        current = _read_block(source, block_size)
+        while True:
+            following = (_read_block(source, block_size)
+                         if len(current) == block_size else b"")
+            final = not following
+            stream.write(cipher.encrypt(current,
+                                        _context(file_id, index, final)))
+            length += len(current)
+            if final:
+                break
+            current = following
+            index += 1
+    except BaseException:
+        stream.abort()
+        raise
+    stream.close()
+    return Attachment(file_id, service_name, name, kind, length,
+                      datetime.now(timezone.utc))
+
+
+def iter_content(store: AttachmentStore, fernet_key: Any, username: str,
+                 file_id: ObjectId) -> Iterator[bytes]:
+    """Streams and decrypts an attachment one block at a time
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        file_id (ObjectId): The attachment
+
+    Raises:
+        AttachmentError: Raised if the attachment does not exist
+        InvalidToken: Raised if the content was modified or cut short
+
+    Yields:
+        Iterator[bytes]: Blocks of plaintext
+    """
+
+    cipher = Cipher(fernet_key)
+    stream = store.open_download(username, file_id)
+    try:
+        record_size = stream.metadata["block_size"] + envelope.OVERHEAD
+        index = 0
+        current = stream.read(record_size)
+        while True:
+            following = (stream.read(record_size)
+                         if len(current) == record_size else b"")
+            final = not following
+            if current[:1] != bytes([envelope.AESGCM_VERSION]):
+                raise InvalidToken
+            yield cipher.decrypt(current, _context(file_id, index, final))
+            if final:
+                return
+            current = following
+            index += 1
+    finally:
+        stream.close()
+
+
+def save(store: AttachmentStore, fernet_key: Any, username: str,
+         file_id: ObjectId, path: str) -> int:
+    """Decrypts an attachment into a file readable only by its owner
+
+    The file only appears once the whole attachment has decrypted.
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        file_id (ObjectId): The attachment
+        path (str): File to write
+
+    Returns:
+        int: Bytes written
+    """
+
+    temporary = f"{path}.part"
+    written = 0
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+    try:
+        with os.fdopen(descriptor, "wb") as target:
+            for block in iter_content(store, fernet_key, username, file_id):
+                target.write(block)
+                written += len(block)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return written
+
+
+def add_note(store: AttachmentStore, fernet_key: Any, username: str,
+             service_name: str, title: str, text: str) -> Attachment:
+    """Stores a secure note on an entry
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        service_name (str): Entry the note belongs to
+        title (str): Title of the note
+        text (str): The note
+
+    Returns:
+        Attachment: The stored note
+    """
+
+    return upload(store, fernet_key, username, service_name, title,
+                  io.BytesIO(text.encode()), kind="note")
+
+
+def read_note(store: AttachmentStore, fernet_key: Any, username: str,
+              file_id: ObjectId) -> str:
+    """Reads a secure note
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        file_id (ObjectId): The note
+
+    Returns:
+        str: The note
+    """
+
+    return b"".join(iter_content(store, fernet_key, username,
+                                 file_id)).decode()
+
+
+def list_attachments(store: AttachmentStore, fernet_key: Any, username: str,
+                     service_name: str | None = None) -> List[Attachment]:
+    """Lists attachments from their metadata, without reading content
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        fernet_key (Any): The user's key
+        username (str): User's name
+        service_name (str | None, optional): Only this entry's attachments.
+            Defaults to None, every entry.
+
+    Returns:
+        List[Attachment]: Attachments ordered by service and upload time
+    """
+
+    cipher = Cipher(fernet_key)
+    listed = []
+    for files in store.list_files(username, service_name):
+        metadata = files["metadata"]
+        listed.append(Attachment(
+            files["_id"], metadata["service_name"],
+            cipher.decrypt(metadata["name"], files["_id"].binary).decode(),
+            metadata["kind"],
+            _plaintext_length(files["length"], metadata["block_size"]),
+            files["uploadDate"]))
+    listed.sort(key=lambda attachment: (attachment.service_name,
+                                        attachment.uploaded_at))
+    return listed
+
+
+def delete_service_attachments(store: AttachmentStore, username: str,
+                               service_name: str) -> int:
+    """Deletes every attachment of an entry
+
+    Args:
+        store (AttachmentStore): Where attachments are kept
+        username (str): User's name
+        service_name (str): The entry
+
+    Returns:
+        int: Attachments deleted
+    """
+
+    files = store.list_files(username, service_name)
+    for document in files:
+        store.delete(username, document["_id"])
+    return len(files)
+
+
+def format_size(length: int) -> str:
+    """Formats a byte count for display
+
+    Args:
+        length (int): Bytes
+
+    Returns:
+        str: e.g. "512 B" or "3.2 KB"
+    """
+
+    size = float(length)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            break
+        size /= 1024
+    return f"{length} B" if unit == "B" else f"{size:.1f} {unit}"
@@ -0,0 +1,268 @@
+"""Module auditing a vault for reused, breached, weak and old passwords
+
+The vault is streamed from the storage backend in batches and decrypted one
+batch at a time into wipeable secrets that are zeroed before the next batch,
+so only batch_size plaintexts are alive at once. Reuse is found in a single
+pass by grouping entries on a keyed hash (HMAC-SHA256 under a random
+per-audit key) of each password; the plaintext itself is never kept.
+
+Every entry records when it was created and when its password last changed
+(created_at and updated_at). Listing stale entries only needs those dates
+and the service names, so stale_entries() asks the database for them with a
+range query on an (owner, updated_at) index instead of reading and
+decrypting the vault.
+
+Usage:
+    python -m utility.audit stale --user U [--days N]
+"""
+
+import argparse
+import math
+import os
+import string
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+from utility import storage
+from utility import utility
+from utility.breach import BreachChecker
+from utility.entries import (decrypt_entries, iter_vault_entries,
+                             wipe_entries)
+from utility.storage import (DEFAULT_BATCH_SIZE, MongoBackend,
+                             StorageBackend, as_utc, innermost)
+
+WEAK_SCORE = 2
+DEFAULT_MAX_AGE_DAYS = 365
+AGE_INDEX = [("username", 1), ("updated_at", 1)]
+
+
+@dataclass
+class AuditReport:
+    """Result of a vault audit
+
+    Attributes:
+        total (int): Number of entries audited
+        reused (List[List[str]]): Groups of services sharing one password
+        breached (List[str]): Services whose password is in the breach corpus
+        weak (List[Tuple[str, int]]): (service, score) for weak passwords
+        old (List[Tuple[str, int]]): (service, age in days) for passwords
+            not changed within the maximum age
+    """
+
+    total: int = 0
+    reused: List[List[str]] = field(default_factory=list)
+    breached: List[str] = field(default_factory=list)
+    weak: List[Tuple[str, int]] = field(default_factory=list)
+    old: List[Tuple[str, int]] = field(default_factory=list)
+
+
+def score_password(password: str) -> int:
+    """Scores a password from 0 (very weak) to 4 (strong)
+
+    The score is based on the brute force entropy of the password's length
+    and character classes.
+
+    Args:
+        password (str): The plaintext password
+
+    Returns:
+        int: Strength score between 0 and 4
+    """
+
+    pool = 0
+    if any(c in string.ascii_lowercase for c in password):
+        pool += 26
+    if any(c in string.ascii_uppercase for c in password):
+        pool += 26
+    if any(c in string.digits for c in password):
+        pool += 10
+    if any(c not in string.ascii_letters + string.digits for c in password):
+        pool += 33
+
+    if pool == 0:
+        return 0
+
+    bits = len(password) * math.log2(pool)
+    if bits < 28:
+        return 0
+    if bits < 36:
+        return 1
+    if bits < 60:
+        return 2
+    if bits < 80:
+        return 3
+    return 4
+
+
+def _age_in_days(timestamp: Any, now: datetime) -> int | None:
+    """Returns how many days ago a stored timestamp was
+
+    Args:
+        timestamp (Any): A datetime, naive values are treated as UTC
+        now (datetime): The current time in UTC
+
+    Returns:
+        int | None: Age in days, or None if the entry has no timestamp
+    """
+
+    if not isinstance(timestamp, datetime):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    age: int = (now - timestamp).days
+    return age
+
+
+def audit_vault(backend: StorageBackend, username: str, fernet_key: Any,
+                batch_size: int = DEFAULT_BATCH_SIZE,
+                max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+                breach_checker: BreachChecker | None = None) -> AuditReport:
+    """Audits every entry in a user's vault
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        fernet_key (Any): The user's Fernet key
+        batch_size (int, optional): Entries decrypted at a time.
+            Defaults to 1000.
+        max_age_days (int, optional): Entries unchanged for longer are
+            reported as old. Defaults to 365.
+        breach_checker (BreachChecker | None, optional): Offline breach
+            corpus to check every password against. Defaults to None.
+
+    Returns:
+        AuditReport: The reused, breached, weak and old entries
+    """
+
+    report = AuditReport()
+    hash_key = os.urandom(32)
+    groups: Dict[bytes, List[str]] = {}
+    now = datetime.now(timezone.utc)
+
+    for batch in iter_vault_entries(backend, username, batch_size):
+        decrypt_entries(fernet_key, batch)
+
+        for entry in batch:
+            if entry.secret is None:
+                continue
+            service_name = entry.service_name
+            digest = entry.secret.digest("sha256", hash_key)
+            groups.setdefault(digest, []).append(service_name)
+
+            if (breach_checker is not None and breach_checker.contains_hash(
+                    entry.secret.digest("sha1"))):
+                report.breached.append(service_name)
+
+            score = score_password(entry.secret.reveal())
+            if score <= WEAK_SCORE:
+                report.weak.append((service_name, score))
+
+            age = _age_in_days(entry.updated_at, now)
+            if age is not None and age > max_age_days:
+                report.old.append((service_name, age))
+
+        report.total += len(batch)
+        wipe_entries(batch)
+
+    report.reused = [services for services in groups.values()
+                     if len(services) > 1]
+    return report
+
+
+def ensure_age_index(backend: StorageBackend, username: str) -> None:
+    """Indexes a vault on owner and password change time
+
+    Only MongoDB vaults are indexed; the other backends filter in process.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+    """
+
+    if isinstance(innermost(backend), MongoBackend):
+        utility.create_index("passwords", username, AGE_INDEX)
+
+
+def stale_entries(backend: StorageBackend, username: str,
+                  max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+                  now: datetime | None = None
+                  ) -> List[Tuple[str, datetime | None]]:
+    """Lists entries whose password has not changed for too long
+
+    Two indexed queries are made, one for entries changed before the
+    cutoff and one for entries stored before timestamps were recorded.
+    Only the service name and change time are fetched; nothing is
+    decrypted.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        max_age_days (int, optional): Entries unchanged for longer are
+            stale. Defaults to 365.
+        now (datetime | None, optional): The current time.
+            Defaults to now.
+
+    Returns:
+        List[Tuple[str, datetime | None]]: (service, last change) oldest
+            first, then entries whose last change is unknown
+    """
+
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=max_age_days)
+    fields = ["service_name", "updated_at"]
+
+    stale = [(document.get("service_name", ""), document["updated_at"])
+             for document in backend.find_entries(
+                 "passwords", username,
+                 {"username": username, "updated_at": {"$lt": cutoff}},
+                 fields)]
+    stale.sort(key=lambda item: as_utc(item[1]))
+    undated: List[Tuple[str, datetime | None]] = [
+        (document.get("service_name", ""), None)
+        for document in backend.find_entries(
+            "passwords", username, {"username": username, "updated_at": None},
+            fields)]
+    return [*stale, *undated]
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for the stale entry report
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.audit")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stale = commands.add_parser(
+        "stale", help="list entries whose password has not changed")
+    stale.add_argument("--user", required=True)
+    stale.add_argument("--days", type=int, default=DEFAULT_MAX_AGE_DAYS,
+                       help="report entries unchanged for longer "
+                       f"(default: {DEFAULT_MAX_AGE_DAYS})")
+    args = parser.parse_args(argv)
+
+    backend = storage.get_backend(args.backend, args.sqlite_path)
+    ensure_age_index(backend, args.user)
+    now = datetime.now(timezone.utc)
+    found = stale_entries(backend, args.user, args.days, now)
+    for service_name, updated_at in found:
+        if updated_at is None:
+            print(f"{service_name:<32} unknown")
+        else:
+            print(f"{service_name:<32} {_age_in_days(updated_at, now)} days")
+    print(f"{len(found)} stale entries", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""Module checking passwords against an offline breached password corpus
+
+The corpus is the "ordered by hash" SHA-1 download of Have I Been Pwned
+(one "HASH:COUNT" line per breached password). convert_corpus() turns it into
+a compact binary file:
+
+    magic      8 bytes   b"PMBREACH"
+    version    4 bytes   unsigned little-endian
+    count      8 bytes   number of hashes
+    prefixes   65537 * 8 bytes, index of the first hash for every 2 byte
+               prefix, followed by count
+    hashes     count * 20 bytes, raw SHA-1 digests in ascending order
+
+BreachChecker memory maps the file, jumps to the hashes sharing the first
+two bytes of the digest and binary searches them, so a lookup reads a few
+pages and the corpus is never loaded into RAM.
+
+Usage:
+    python -m utility.breach convert pwned-passwords-sha1.txt corpus.bin
+    python -m utility.breach check corpus.bin
+    python -m utility.breach bench corpus.bin [--lookups N]
+"""
+
+import argparse
+import getpass
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Any, Dict, Iterable, List
+
+MAGIC = b"PMBREACH"
+VERSION = 1
+HASH_SIZE = 20
+PREFIXES = 65536
+HEADER = struct.Struct("<8sIQ")
+TABLE_OFFSET = HEADER.size
+HASHES_OFFSET = TABLE_OFFSET + (PREFIXES + 1) * 8
+CORPUS_ENV = "PM_BREACH_CORPUS"
+
+
+class CorpusFormatError(ValueError):
+    """Raised when a corpus file is malformed or not sorted
+    """
+
+
+def convert_corpus(lines: Iterable[str], output_path: str) -> int:
+    """Converts sorted "HASH[:COUNT]" text lines to the binary format
+
+    The input is streamed, so corpora larger than memory can be converted.
+
+    Args:
+        lines (Iterable[str]): Lines of hex SHA-1 hashes in ascending order
+        output_path (str): Binary corpus file to write
+
+    Raises:
+        CorpusFormatError: Raised on a malformed or out of order line
+
+    Returns:
+        int: Number of hashes written
+    """
+
+    counts = [0] * PREFIXES
+    previous = b""
+    count = 0
+
+    with open(output_path, "wb") as output:
+        output.write(b"\0" * HASHES_OFFSET)
+
+        for number, line in enumerate(lines, 1):
+            text = line.strip().split(":", 1)[0]
+            if not text:
+                continue
+            try:
+                digest = bytes.fromhex(text)
+            except ValueError:
+                digest = b""
+            if len(digest) != HASH_SIZE:
+                raise CorpusFormatError(f"line {number}: not a SHA-1 hash")
+            if digest <= previous:
+                raise CorpusFormatError(
+                    f"line {number}: hashes must be unique and sorted")
+
+            output.write(digest)
+            counts[int.from_bytes(digest[:2], "big")] += 1
+            previous = digest
+            count += 1
+
+        table = [0]
+        for prefix_count in counts:
+            table.append(table[-1] + prefix_count)
+
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, VERSION, count))
+        output.write(struct.pack(f"<{PREFIXES + 1}Q", *table))
+        output.flush()
+        os.fsync(output.fileno())
+
+    return count
+
+
+class BreachChecker:
+    """Looks up SHA-1 hashes in a memory mapped binary corpus
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise CorpusFormatError(f"{path} is empty")
+
+        if len(self._map) < HASHES_OFFSET:
+            magic, version, self.count = b"", 0, 0
+        else:
+            magic, version, self.count = HEADER.unpack_from(self._map, 0)
+        expected_size = HASHES_OFFSET + self.count * HASH_SIZE
+        if (magic != MAGIC or version != VERSION
+                or len(self._map) != expected_size):
+            self.close()
+            raise CorpusFormatError(f"{path} is not a breach corpus")
+
+    def close(self) -> None:
+        """Unmaps and closes the corpus file
+        """
+
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> "BreachChecker":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def contains_hash(self, digest: bytes) -> bool:
+        """Checks whether a raw SHA-1 digest is in the corpus
+
+        Args:
+            digest (bytes): 20 byte SHA-1 digest
+
+        Returns:
+            bool: True if the digest is in the corpus
+        """
+
+        prefix = int.from_bytes(digest[:2], "big")
+        low, high = struct.unpack_from("<QQ", self._map,
+                                       TABLE_OFFSET + prefix * 8)
+
+        while low < high:
+            middle = (low + high) // 2
+            offset = HASHES_OFFSET + middle * HASH_SIZE
+            candidate = self._map[offset:offset + HASH_SIZE]
+            if candidate < digest:
+                low = middle + 1
+            elif candidate > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def is_breached(self, password: str) -> bool:
+        """Checks whether a password appears in the corpus
+
+        Args:
+            password (str): The plaintext password
+
+        Returns:
+            bool: True if the password has been seen in a breach
+        """
+
+        return self.contains_hash(hashlib.sha1(password.encode()).digest())
+
+
+def benchmark(checker: BreachChecker, lookups: int = 100000) -> float:
+    """Measures lookups per second with random, mostly absent, hashes
+
+    Args:
+        checker (BreachChecker): An open corpus
+        lookups (int, optional): Number of lookups. Defaults to 100000.
+
+    Returns:
+        float: Lookups per second
+    """
+
+    digests = [os.urandom(HASH_SIZE) for _ in range(lookups)]
+    start = time.perf_counter()
+    for digest in digests:
+        checker.contains_hash(digest)
+    return lookups / (time.perf_counter() - start)
+
+
+_checkers: Dict[str, BreachChecker] = {}
+
+
+def default_checker() -> BreachChecker | None:
+    """Returns the checker for the corpus named by $PM_BREACH_CORPUS
+
+    The corpus is opened once per process and reused.
+
+    Returns:
+        BreachChecker | None: The checker, or None if no corpus is set
+    """
+
+    path = os.environ.get(CORPUS_ENV)
+    if not path:
+        return None
+    if path not in _checkers:
+        _checkers[path] = BreachChecker(path)
+    return _checkers[path]
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for converting and querying corpora
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.breach")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="build a binary corpus")
+    convert.add_argument("text_corpus")
+    convert.add_argument("binary_corpus")
+    check = commands.add_parser("check", help="check a password")
+    check.add_argument("binary_corpus")
+    bench = commands.add_parser("bench", help="measure lookups per second")
+    bench.add_argument("binary_corpus")
+    bench.add_argument("--lookups", type=int, default=100000)
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "convert":
+            with open(args.text_corpus, encoding="ascii") as lines:
+                count = convert_corpus(lines, args.binary_corpus)
+            print(f"Wrote {count} hashes to {args.binary_corpus}")
+            return 0
+
+        with BreachChecker(args.binary_corpus) as checker:
+            if args.command == "check":
+                if checker.is_breached(getpass.getpass("Password: ")):
+                    print("Password found in breach corpus")
+                    return 1
+                print("Password not found")
+            else:
+                rate = benchmark(checker, args.lookups)
+                print(f"{checker.count} hashes, {rate:,.0f} lookups/sec, "
+                      f"{1e6 / rate:.2f} us/lookup")
+    except (CorpusFormatError, OSError) as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""Module checking that users, vaults and key files agree
+
+A user lives in three places that are written without a transaction: the
+users.names record, the passwords.<user> collection and the local
+user_<name>_fernet.key file. A crash between those writes leaves orphans.
+check_consistency() reads each source once (one query for every user record,
+one listing of the vault collections and one directory listing), compares
+them as sets and then verifies keys and vaults on a thread pool, so the
+per-user work overlaps its database round trips instead of running them one
+after another. A user's history, digest and attachment collections are
+listed too, so data left behind by a deleted user is found as well.
+
+Verifying a user decrypts their master password with their key file and,
+for the sampled vaults, decrypts every entry. Keys kept in a keystore count
+as present but cannot be verified, since they are wrapped under the
+master password. repair() removes orphans:
+vault, history, digest and attachment collections and key files without a
+user and, when asked, users whose key file is gone (their data can no
+longer be decrypted). Users are dropped with utility.vault's
+delete_user_data, like delete_user and deprovisioning do.
+
+Usage:
+    python -m utility.consistency [--sample F] [--workers N] [--repair]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import InvalidToken
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Set, Tuple
+from utility import attachments
+from utility import history
+from utility import merkle
+from utility import packed
+from utility.envelope import Cipher
+from utility.keystore import Keystore
+from utility import storage
+from utility import vault
+from utility.storage import DEFAULT_BATCH_SIZE, StorageBackend
+
+DEFAULT_WORKERS = 16
+KEY_FILE_PATTERN = re.compile(r"^user_(.+)_fernet\.key$")
+# Databases holding per user collections besides the vault, with the
+# suffixes added to the user's name
+USER_DATA_SUFFIXES = {history.DATABASE: ("",),
+                      merkle.DATABASE: (".nodes", ".entries"),
+                      attachments.DATABASE: (".files", ".chunks")}
+
+
+@dataclass
+class ConsistencyReport:
+    """Inconsistencies found by check_consistency
+
+    Attributes:
+        users (int): Number of user records
+        vaults_checked (int): Number of vaults whose entries were decrypted
+        entries_checked (int): Number of entries decrypted
+        users_without_keys (List[str]): Users with no key file
+        vaults_without_users (List[str]): Vault collections with no user
+        data_without_users (List[str]): Users with no record that still
+            have history, digest or attachment collections
+        keys_without_users (List[str]): Key files with no user
+        wrong_keys (List[str]): Users whose key does not decrypt their
+            master password
+        undecryptable (List[Tuple[str, str]]): (user, service) for entries
+            their user's key cannot decrypt
+    """
+
+    users: int = 0
+    vaults_checked: int = 0
+    entries_checked: int = 0
+    users_without_keys: List[str] = field(default_factory=list)
+    vaults_without_users: List[str] = field(default_factory=list)
+    data_without_users: List[str] = field(default_factory=list)
+    keys_without_users: List[str] = field(default_factory=list)
+    wrong_keys: List[str] = field(default_factory=list)
+    undecryptable: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def consistent(self) -> bool:
+        """True if nothing was found
+        """
+        return not (self.users_without_keys or self.vaults_without_users
+                    or self.data_without_users or self.keys_without_users
+                    or self.wrong_keys or self.undecryptable)
+
+
+def key_path(key_dir: str, username: str) -> str:
+    """Returns the path of a user's key file
+
+    Args:
+        key_dir (str): Directory holding the key files
+        username (str): User's name
+
+    Returns:
+        str: The key file path
+    """
+
+    return os.path.join(key_dir, f"user_{username}_fernet.key")
+
+
+def list_key_files(key_dir: str) -> Set[str]:
+    """Lists the users that have a key file
+
+    Args:
+        key_dir (str): Directory holding the key files
+
+    Returns:
+        Set[str]: User names taken from the key file names
+    """
+
+    names = set()
+    with os.scandir(key_dir) as directory:
+        for item in directory:
+            match = KEY_FILE_PATTERN.match(item.name)
+            if match and item.is_file():
+                names.add(match.group(1))
+    return names
+
+
+def list_data_owners(backend: StorageBackend) -> Set[str]:
+    """Lists the users that have history, digests or attachments
+
+    Args:
+        backend (StorageBackend): Where the data is stored
+
+    Returns:
+        Set[str]: User names taken from the collection names
+    """
+
+    names = set()
+    for database_name, suffixes in USER_DATA_SUFFIXES.items():
+        for collection_name in backend.list_collection_names(database_name):
+            for suffix in suffixes:
+                if collection_name.endswith(suffix):
+                    end = len(collection_name) - len(suffix)
+                    names.add(collection_name[:end])
+    return names
+
+
+def _verify_user(backend: StorageBackend, key_dir: str,
+                 record: Dict[str, Any], check_vault: bool,
+                 batch_size: int) -> Tuple[bool, int, List[str]]:
+    """Checks one user's key against their master password and vault
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        key_dir (str): Directory holding the key files
+        record (Dict[str, Any]): The user's users.names record
+        check_vault (bool): Whether to decrypt every vault entry
+        batch_size (int): Entries read per batch
+
+    Returns:
+        Tuple[bool, int, List[str]]: Whether the key opens the master
+            password, the entries checked and the undecryptable services
+    """
+
+    username = record['username']
+    with open(key_path(key_dir, username), "rb") as key_file:
+        cipher = Cipher(key_file.read())
+
+    try:
+        cipher.decrypt(record['master_password'])
+    except (InvalidToken, TypeError):
+        return False, 0, []
+    if not check_vault:
+        return True, 0, []
+
+    checked = 0
+    failed = []
+    for batch in backend.iter_entries("passwords", username,
+                                      batch_size=batch_size):
+        for entry in batch:
+            checked += 1
+            try:
+                cipher.decrypt(entry['password_entry'])
+            except (InvalidToken, TypeError, KeyError):
+                failed.append(str(entry.get('service_name', entry['_id'])))
+    return True, checked, failed
+
+
+def check_consistency(backend: StorageBackend, key_dir: str = ".",
+                      sample: float = 1.0, workers: int = DEFAULT_WORKERS,
+                      batch_size: int = DEFAULT_BATCH_SIZE,
+                      seed: Any = None,
+                      keystore: Keystore | None = None) -> ConsistencyReport:
+    """Cross-checks user records, vault collections and key files
+
+    Args:
+        backend (StorageBackend): Where users and vaults are stored
+        key_dir (str, optional): Directory holding the key files.
+            Defaults to the working directory, like passwordManager.
+        sample (float, optional): Fraction of vaults whose entries are
+            decrypted. Defaults to 1.0, every vault.
+        workers (int, optional): Threads verifying users. Defaults to 16.
+        batch_size (int, optional): Entries read per batch.
+            Defaults to 1000.
+        seed (Any, optional): Seed for choosing the sampled vaults.
+            Defaults to None.
+        keystore (Keystore | None, optional): Keystore holding further
+            keys. Defaults to None.
+
+    Returns:
+        ConsistencyReport: What was checked and found
+    """
+
+    records = {record['username']: record
+               for record in backend.find_entries("users", "names")}
+    vaults = set(backend.list_collection_names("passwords"))
+    data_owners = list_data_owners(backend)
+    key_files = list_key_files(key_dir)
+    keys = key_files | set(keystore.names() if keystore else [])
+
+    report = ConsistencyReport(users=len(records))
+    report.users_without_keys = sorted(set(records) - keys)
+    report.vaults_without_users = sorted(vaults - set(records))
+    report.data_without_users = sorted(data_owners - set(records))
+    report.keys_without_users = sorted(keys - set(records))
+
+    keyed = sorted(set(records) & key_files)
+    sampled = set(random.Random(seed).sample(
+        keyed, round(len(keyed) * min(max(sample, 0.0), 1.0))))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            lambda name: _verify_user(backend, key_dir, records[name],
+                                      name in sampled and name in vaults,
+                                      batch_size),
+            keyed)
+        for username, (key_ok, checked, failed) in zip(keyed, results):
+            if not key_ok:
+                report.wrong_keys.append(username)
+            if checked:
+                report.vaults_checked += 1
+                report.entries_checked += checked
+            report.undecryptable.extend(
+                (username, service_name) for service_name in failed)
+
+    return report
+
+
+def repair(backend: StorageBackend, report: ConsistencyReport,
+           key_dir: str = ".", drop_keyless_users: bool = False,
+           keystore: Keystore | None = None) -> List[str]:
+    """Removes the orphans found by check_consistency
+
+    Each orphan is checked again just before it is removed, so a user
+    created since the check is left alone.
+
+    Args:
+        backend (StorageBackend): Where users and vaults are stored
+        report (ConsistencyReport): Result of check_consistency
+        key_dir (str, optional): Directory holding the key files.
+            Defaults to the working directory.
+        drop_keyless_users (bool, optional): Also delete users whose key
+            file is missing, with all their data. Defaults to False.
+        keystore (Keystore | None, optional): Keystore holding further
+            keys. Defaults to None.
+
+    Returns:
+        List[str]: Description of every change made
+    """
+
+    actions = []
+
+    def has_user(username: str) -> bool:
+        return bool(backend.find_entries("users", "names",
+                                         {'username': username}))
+
+    for username in sorted(set(report.vaults_without_users)
+                           | set(report.data_without_users)):
+        if not has_user(username):
+            vault.delete_user_data(backend, username)
+            actions.append(f"dropped the data of {username}")
+
+    for username in report.keys_without_users:
+        if has_user(username):
+            continue
+        if os.path.exists(key_path(key_dir, username)):
+            os.remove(key_path(key_dir, username))
+            actions.append(f"removed key file of {username}")
+        if keystore is not None and keystore.delete(username):
+            actions.append(f"removed keystore key of {username}")
+
+    def has_key(username: str) -> bool:
+        return (os.path.exists(key_path(key_dir, username))
+                or (keystore is not None and username in keystore))
+
+    if drop_keyless_users:
+        for username in report.users_without_keys:
+            if not has_key(username):
+                # Record first: leftover data is found by the next check
+                backend.delete_entry("users", "names",
+                                     {'username': username})
+                vault.delete_user_data(backend, username)
+                actions.append(f"deleted user {username} without a key")
+
+    return actions
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for checking and repairing
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: 0 if consistent or repaired, 1 if problems remain
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.consistency")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault")
+    parser.add_argument("--key-dir", default=".",
+                        help="directory holding the key files")
+    parser.add_argument("--keystore",
+                        help="keystore holding further keys "
+                        "(default: $PM_KEYSTORE)")
+    parser.add_argument("--sample", type=float, default=1.0,
+                        help="fraction of vaults to decrypt fully")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--repair", action="store_true",
+                        help="remove orphaned user data and key files")
+    parser.add_argument("--drop-keyless-users", action="store_true",
+                        help="with --repair, also delete users whose key "
+                        "file is missing")
+    args = parser.parse_args(argv)
+
+    vault.configure_storage(args.backend, args.sqlite_path, args.storage_mode)
+    vault.configure_keystore(args.keystore)
+    report = check_consistency(vault.storage, args.key_dir, args.sample,
+                               args.workers, keystore=vault.keystore)
+
+    print(f"{report.users} users, {report.vaults_checked} vaults and "
+          f"{report.entries_checked} entries checked")
+    findings = [("User without key file", report.users_without_keys),
+                ("Vault without user", report.vaults_without_users),
+                ("Data without user", report.data_without_users),
+                ("Key file without user", report.keys_without_users),
+                ("Key does not match user", report.wrong_keys),
+                ("Entry does not decrypt",
+                 [f"{user}/{service}"
+                  for user, service in report.undecryptable])]
+    for label, names in findings:
+        for name in names:
+            print(f"{label}: {name}")
+
+    if report.consistent:
+        print("No inconsistencies found")
+        return 0
+    if not args.repair:
+        return 1
+
+    for action in repair(vault.storage, report, args.key_dir,
+                         args.drop_keyless_users, vault.keystore):
+        print(f"Repaired: {action}")
+    remaining = check_consistency(vault.storage, args.key_dir, sample=0.0,
+                                  workers=args.workers,
+                                  keystore=vault.keystore)
+    if report.wrong_keys or report.undecryptable:
+        # Entries that do not decrypt need the right key, not a repair
+        return 1
+    return 0 if remaining.consistent else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
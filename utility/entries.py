@@ -0,0 +1,273 @@
+"""Module holding vault entries in a compact form
+
+Documents read from storage are dictionaries carrying every stored field,
+and decrypted passwords are immutable strings that stay in memory until the
+garbage collector reuses them. VaultEntry keeps only the fields the program
+reads in a slotted object, and Secret keeps a plaintext in a bytearray that
+is zeroed as soon as it has been shown or checked.
+
+Python cannot promise that no copy of a plaintext survives: decryption returns
+immutable bytes and anything displayed must become a str. Secret narrows
+those copies to the moment they are needed instead of keeping them for the
+life of the session.
+
+Usage:
+    python -m utility.entries bench [--entries N]
+"""
+
+import argparse
+import base64
+import gc
+import hashlib
+import hmac
+import os
+import sys
+import tracemalloc
+from bson import ObjectId
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+from utility.envelope import Cipher
+from utility.storage import DEFAULT_BATCH_SIZE, StorageBackend
+
+
+class Secret:
+    """A plaintext held in a buffer that can be wiped
+
+    Args:
+        data (bytes | bytearray): The plaintext, copied into the buffer
+    """
+
+    __slots__ = ("_buffer",)
+
+    def __init__(self, data: bytes | bytearray) -> None:
+        self._buffer = bytearray(data)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def __repr__(self) -> str:
+        return "Secret(***)"
+
+    def __enter__(self) -> "Secret":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.wipe()
+
+    def reveal(self) -> str:
+        """Returns the plaintext as a string for display
+
+        Returns:
+            str: The plaintext
+        """
+
+        return self._buffer.decode()
+
+    def digest(self, name: str, key: bytes | None = None) -> bytes:
+        """Hashes the plaintext without converting it to a string
+
+        Args:
+            name (str): hashlib algorithm name such as "sha1"
+            key (bytes | None, optional): HMAC key. Defaults to None,
+                which returns a plain hash.
+
+        Returns:
+            bytes: The digest
+        """
+
+        if key is None:
+            return hashlib.new(name, self._buffer).digest()
+        return hmac.new(key, self._buffer, name).digest()
+
+    def wipe(self) -> None:
+        """Overwrites the plaintext with zeros and empties the buffer
+        """
+
+        self._buffer[:] = bytes(len(self._buffer))
+        self._buffer.clear()
+
+
+class VaultEntry:
+    """The fields of a stored entry that the program uses
+
+    Attributes:
+        entry_id (Any): The document's _id
+        service_name (str): Name of the website/service
+        username_entry (str): Username for the website/service
+        password_entry (Any): The encrypted password
+        updated_at (Any): When the password last changed, if recorded
+        urls (List[str]): URLs of the login pages, if recorded
+        secret (Secret | None): The decrypted password once decrypted
+    """
+
+    __slots__ = ("entry_id", "service_name", "username_entry",
+                 "password_entry", "updated_at", "urls", "secret")
+
+    def __init__(self, entry_id: Any, service_name: str,
+                 username_entry: str, password_entry: Any,
+                 updated_at: Any = None,
+                 urls: List[str] | None = None) -> None:
+        self.entry_id = entry_id
+        self.service_name = service_name
+        self.username_entry = username_entry
+        self.password_entry = password_entry
+        self.updated_at = updated_at
+        self.urls = urls or []
+        self.secret: Secret | None = None
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "VaultEntry":
+        """Builds an entry from a stored document
+
+        Args:
+            document (Dict[str, Any]): Document from passwords.<user>
+
+        Returns:
+            VaultEntry: The entry
+        """
+
+        return cls(document.get('_id'), document['service_name'],
+                   document['username_entry'], document['password_entry'],
+                   document.get('updated_at'), document.get('urls'))
+
+    def wipe(self) -> None:
+        """Wipes and forgets the decrypted password
+        """
+
+        if self.secret is not None:
+            self.secret.wipe()
+            self.secret = None
+
+
+def decrypt_entries(fernet_key: Any, entries: Iterable[VaultEntry]) -> None:
+    """Decrypts the password of every entry into its secret
+
+    Args:
+        fernet_key (Any): The user's Fernet key
+        entries (Iterable[VaultEntry]): Entries to decrypt
+    """
+
+    cipher = Cipher(fernet_key)
+    for entry in entries:
+        entry.secret = Secret(cipher.decrypt(entry.password_entry))
+
+
+def wipe_entries(entries: Iterable[VaultEntry]) -> None:
+    """Wipes the decrypted password of every entry
+
+    Args:
+        entries (Iterable[VaultEntry]): Entries to wipe
+    """
+
+    for entry in entries:
+        entry.wipe()
+
+
+def iter_vault_entries(backend: StorageBackend, username: str,
+                       batch_size: int = DEFAULT_BATCH_SIZE
+                       ) -> Iterator[List[VaultEntry]]:
+    """Streams a user's vault as batches of entries
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        batch_size (int, optional): Entries per batch. Defaults to 1000.
+
+    Yields:
+        Iterator[List[VaultEntry]]: Batches of entries
+    """
+
+    for batch in backend.iter_entries("passwords", username,
+                                      batch_size=batch_size):
+        yield [VaultEntry.from_document(document) for document in batch]
+
+
+def load_vault_entries(backend: StorageBackend,
+                       username: str) -> List[VaultEntry]:
+    """Reads a user's whole vault as entries
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+
+    Returns:
+        List[VaultEntry]: Every entry in the vault
+    """
+
+    return [entry for batch in iter_vault_entries(backend, username)
+            for entry in batch]
+
+
+def _sample_document(number: int) -> Dict[str, Any]:
+    """Builds a document shaped like a stored entry with fresh objects
+    """
+
+    return {'_id': ObjectId(),
+            'username': "Peter".encode().decode(),
+            'service_name': f"service-{number}",
+            'username_entry': f"user-{number}@example.com",
+            'password_entry': base64.urlsafe_b64encode(os.urandom(90))}
+
+
+def _traced_size(build: Callable[[], List[Any]]) -> int:
+    """Returns the bytes still allocated by what build returns
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - before
+        del kept
+    finally:
+        tracemalloc.stop()
+    return size
+
+
+def measure_memory(count: int = 100000) -> Tuple[float, float]:
+    """Measures the memory per entry of documents and of VaultEntry
+
+    Both layouts hold the same synthetic encrypted entries; the document
+    layout is what find_entries returns.
+
+    Args:
+        count (int, optional): Number of entries. Defaults to 100000.
+
+    Returns:
+        Tuple[float, float]: Bytes per entry as documents and as entries
+    """
+
+    documents = _traced_size(
+        lambda: [_sample_document(number) for number in range(count)])
+    entries = _traced_size(
+        lambda: [VaultEntry.from_document(_sample_document(number))
+                 for number in range(count)])
+    return documents / count, entries / count
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for the memory benchmark
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.entries")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="measure memory per entry")
+    bench.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    documents, entries = measure_memory(args.entries)
+    print(f"{args.entries} entries: documents {documents:.0f} B/entry, "
+          f"VaultEntry {entries:.0f} B/entry "
+          f"({100 * (1 - entries / documents):.0f}% less)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
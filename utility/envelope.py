@@ -0,0 +1,173 @@
+"""Module encrypting stored secrets in a compact, versioned format
+
+Passwords used to be stored as Fernet tokens: AES-128-CBC with an
+HMAC-SHA256, base64 encoded. A short password becomes a 100 byte token, and
+every entry costs a cipher pass and a MAC pass. New ciphertexts are stored
+as raw bytes (BSON binary) in an envelope:
+
+    version (1 byte) | nonce (12 bytes) | AES-256-GCM ciphertext and tag
+
+The AES-GCM key is derived from the user's Fernet key with HKDF, so no new
+key has to be stored or migrated. A Fernet token always starts with "g"
+(its base64 encoded 0x80 version byte), which is never an envelope version,
+so decrypt() tells the formats apart by the first byte. Existing entries
+keep working and are rewritten in the new format the next time they are
+written. Password Manager versions older than the envelope cannot read it.
+
+Usage:
+    python -m utility.envelope bench [--count N] [--length N]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+import bson
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from typing import Any, Callable, List, Tuple
+
+AESGCM_VERSION = 1
+NONCE_SIZE = 12
+TAG_SIZE = 16
+OVERHEAD = 1 + NONCE_SIZE + TAG_SIZE
+HKDF_INFO = b"password-manager envelope v1"
+
+
+class Cipher:
+    """Encrypts with AES-GCM and decrypts either format with one user key
+
+    Args:
+        fernet_key (bytes | str): The user's Fernet key
+    """
+
+    __slots__ = ("_fernet_key", "_fernet", "_aesgcm")
+
+    def __init__(self, fernet_key: bytes | str) -> None:
+        self._fernet_key = fernet_key
+        self._fernet: Fernet | None = None
+        self._aesgcm = AESGCM(HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None,
+            info=HKDF_INFO).derive(base64.urlsafe_b64decode(fernet_key)))
+
+    def encrypt(self, data: bytes,
+                associated_data: bytes | None = None) -> bytes:
+        """Encrypts data into an envelope
+
+        Args:
+            data (bytes): The plaintext
+            associated_data (bytes | None, optional): Authenticated but not
+                encrypted context the ciphertext is bound to.
+                Defaults to None.
+
+        Returns:
+            bytes: Version byte, nonce and ciphertext
+        """
+
+        nonce = os.urandom(NONCE_SIZE)
+        return (bytes([AESGCM_VERSION]) + nonce
+                + self._aesgcm.encrypt(nonce, data, associated_data))
+
+    def decrypt(self, token: bytes | str,
+                associated_data: bytes | None = None) -> bytes:
+        """Decrypts an envelope or a Fernet token
+
+        Args:
+            token (bytes | str): The stored ciphertext
+            associated_data (bytes | None, optional): The context given to
+                encrypt(); Fernet tokens have none. Defaults to None.
+
+        Raises:
+            InvalidToken: Raised if the ciphertext was not made with this
+                key or has been modified
+
+        Returns:
+            bytes: The plaintext
+        """
+
+        if isinstance(token, bytes) and token[:1] == bytes([AESGCM_VERSION]):
+            if len(token) < OVERHEAD:
+                raise InvalidToken
+            try:
+                return self._aesgcm.decrypt(token[1:1 + NONCE_SIZE],
+                                            token[1 + NONCE_SIZE:],
+                                            associated_data)
+            except InvalidTag:
+                raise InvalidToken from None
+        if self._fernet is None:
+            self._fernet = Fernet(self._fernet_key)
+        return self._fernet.decrypt(token)
+
+
+def _rate(operation: Callable[[], Any], count: int) -> float:
+    """Returns how many times per second an operation runs
+    """
+
+    started = time.perf_counter()
+    for _ in range(count):
+        operation()
+    return count / (time.perf_counter() - started)
+
+
+def benchmark(count: int = 20000,
+              length: int = 16) -> List[Tuple[str, int, float, float]]:
+    """Compares the stored size and speed of both formats
+
+    Args:
+        count (int, optional): Operations timed per format.
+            Defaults to 20000.
+        length (int, optional): Password length. Defaults to 16.
+
+    Returns:
+        List[Tuple[str, int, float, float]]: Format, BSON bytes of one
+            stored password field, encryptions and decryptions per second
+    """
+
+    key = Fernet.generate_key()
+    password = os.urandom(length // 2 + 1).hex()[:length].encode()
+    fernet = Fernet(key)
+    cipher = Cipher(key)
+    results = []
+    for name, encrypt, decrypt in (
+            ("fernet", fernet.encrypt, fernet.decrypt),
+            ("aes-gcm", cipher.encrypt, cipher.decrypt)):
+        token = encrypt(password)
+        size = len(bson.encode({"password_entry": token}))
+        results.append((name, size,
+                        _rate(lambda: encrypt(password), count),
+                        _rate(lambda: decrypt(token), count)))
+    return results
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for the format benchmark
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.envelope")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench",
+                                help="compare Fernet and AES-GCM entries")
+    bench.add_argument("--count", type=int, default=20000)
+    bench.add_argument("--length", type=int, default=16,
+                       help="password length")
+    args = parser.parse_args(argv)
+
+    print(f"{'format':<10}{'bytes':>8}{'encrypt/s':>12}{'decrypt/s':>12}")
+    results = benchmark(args.count, args.length)
+    for name, size, encrypts, decrypts in results:
+        print(f"{name:<10}{size:>8}{encrypts:>12.0f}{decrypts:>12.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
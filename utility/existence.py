@@ -0,0 +1,370 @@
+"""Module answering existence checks without a database round trip
+
+Creating a user, adding a password, deleting a service and every step of an
+import start by asking whether a user or a service exists. Each question
+used to fetch the matching documents. count_entries(..., limit=1) asks the
+database to stop at the first match and return a number instead, and
+ExistenceBackend remembers the answers for the rest of the session:
+
+* Positive and negative answers are cached per user and per service and
+  kept up to date by the writes that pass through the backend.
+* After a few checks against one vault, its service names are loaded into
+  a Bloom filter. A name the filter has never seen is answered "no"
+  without asking the database; a name it may have seen is confirmed with
+  one count.
+
+Answers reflect the writes made through this backend. Another process
+adding a user is seen after clear(), or after invalidate() for the changed
+collection.
+"""
+
+import hashlib
+import math
+import threading
+from typing import Any, Dict, List
+from utility.storage import ForwardingBackend, StorageBackend
+
+BLOOM_AFTER = 3
+BLOOM_ERROR_RATE = 0.01
+MIN_CAPACITY = 64
+
+
+class BloomFilter:
+    """Set of strings answering "maybe present" or "certainly absent"
+
+    Args:
+        capacity (int): Items the filter is sized for
+        error_rate (float, optional): False positive rate at capacity.
+            Defaults to 0.01.
+    """
+
+    def __init__(self, capacity: int,
+                 error_rate: float = BLOOM_ERROR_RATE) -> None:
+        self.capacity = max(capacity, MIN_CAPACITY)
+        bits = math.ceil(-self.capacity * math.log(error_rate)
+                         / math.log(2) ** 2)
+        self._bits = bytearray((bits + 7) // 8)
+        self._size = len(self._bits) * 8
+        self._hashes = max(1, round(self._size / self.capacity
+                                    * math.log(2)))
+        self.count = 0
+
+    def _positions(self, item: str) -> List[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + number * second) % self._size
+                for number in range(self._hashes)]
+
+    def add(self, item: str) -> None:
+        """Adds an item
+
+        Args:
+            item (str): The item
+        """
+
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: object) -> bool:
+        if not isinstance(item, str):
+            return False
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    @property
+    def full(self) -> bool:
+        """Whether more items were added than the filter is sized for
+        """
+
+        return self.count > self.capacity
+
+
+def _exact(entries: Dict[str, Any] | None, field: str) -> str | None:
+    """Returns the value a query filtering on field alone requires
+    """
+
+    if entries is None or len(entries) != 1:
+        return None
+    value = entries.get(field)
+    return value if isinstance(value, str) else None
+
+
+class ExistenceBackend(ForwardingBackend):
+    """StorageBackend caching whether users and services exist
+
+    Existence checks are count_entries() calls with limit=1 whose filter is
+    a single username (users.names) or service name (a passwords vault).
+
+    Args:
+        inner (StorageBackend): Backend to read and write
+        bloom (bool, optional): Load the service names of frequently
+            checked vaults into Bloom filters. Defaults to True.
+    """
+
+    def __init__(self, inner: StorageBackend, bloom: bool = True) -> None:
+        super().__init__(inner)
+        self.bloom = bloom
+        self._lock = threading.Lock()
+        self._users: Dict[str, bool] = {}
+        self._services: Dict[str, Dict[str, bool]] = {}
+        self._filters: Dict[str, BloomFilter] = {}
+        self._round_trips: Dict[str, int] = {}
+        # Bumped by every write to a vault, so a filter built from a read
+        # that raced with a write is thrown away
+        self._generations: Dict[str, int] = {}
+
+    def clear(self) -> None:
+        """Forgets every cached answer and filter
+        """
+
+        with self._lock:
+            self._users.clear()
+            self._services.clear()
+            self._filters.clear()
+            self._round_trips.clear()
+            for vault in self._generations:
+                self._generations[vault] += 1
+
+    def invalidate(self, database_name: str, collection_name: str) -> None:
+        """Forgets the answers about a collection another session changed
+
+        Args:
+            database_name (str): Name of the database
+            collection_name (str): Name of the collection
+        """
+
+        with self._lock:
+            if (database_name, collection_name) == ("users", "names"):
+                self._users.clear()
+            elif database_name == "passwords":
+                self._written(collection_name)
+                self._services.pop(collection_name, None)
+                self._filters.pop(collection_name, None)
+                self._round_trips.pop(collection_name, None)
+
+    def _user_exists(self, username: str) -> int:
+        with self._lock:
+            cached = self._users.get(username)
+        if cached is not None:
+            return int(cached)
+        count = self.inner.count_entries("users", "names",
+                                         {"username": username}, limit=1)
+        with self._lock:
+            self._users[username] = count > 0
+        return count
+
+    def _service_exists(self, vault: str, service_name: str) -> int:
+        with self._lock:
+            cached = self._services.get(vault, {}).get(service_name)
+            bloom = self._filters.get(vault)
+            if cached is None and bloom is not None \
+                    and service_name not in bloom:
+                cached = False
+                self._services.setdefault(vault, {})[service_name] = False
+            build = (cached is None and bloom is None and self.bloom
+                     and self._round_trips.get(vault, 0) + 1 >= BLOOM_AFTER)
+        if cached is not None:
+            return int(cached)
+        if build:
+            self._build_filter(vault)
+            return self._service_exists(vault, service_name)
+
+        count = self.inner.count_entries("passwords", vault,
+                                         {"service_name": service_name},
+                                         limit=1)
+        with self._lock:
+            self._services.setdefault(vault, {})[service_name] = count > 0
+            self._round_trips[vault] = self._round_trips.get(vault, 0) + 1
+        return count
+
+    def _build_filter(self, vault: str) -> None:
+        """Reads a vault's service names into a Bloom filter
+        """
+
+        with self._lock:
+            generation = self._generations.get(vault, 0)
+        names = [document.get("service_name")
+                 for batch in self.inner.iter_entries("passwords", vault)
+                 for document in batch]
+        self._install_filter(vault, generation, names)
+
+    def _install_filter(self, vault: str, generation: int,
+                        names: List[Any]) -> None:
+        """Keeps a filter of a vault's names unless a write raced the read
+        """
+
+        bloom = BloomFilter(2 * len(names))
+        for name in names:
+            if isinstance(name, str):
+                bloom.add(name)
+        with self._lock:
+            if self._generations.get(vault, 0) == generation:
+                self._filters[vault] = bloom
+            else:
+                # Count again so a busy vault is not rescanned every check
+                self._round_trips[vault] = 0
+
+    def _written(self, vault: str) -> None:
+        """Marks a vault as written; must be called with the lock held
+        """
+
+        self._generations[vault] = self._generations.get(vault, 0) + 1
+        bloom = self._filters.get(vault)
+        if bloom is not None and bloom.full:
+            # Too many false positives; rebuilt by later checks
+            del self._filters[vault]
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        if limit == 1 and (database_name, collection_name) == \
+                ("users", "names"):
+            username = _exact(entries, "username")
+            if username is not None:
+                return self._user_exists(username)
+        if limit == 1 and database_name == "passwords":
+            service_name = _exact(entries, "service_name")
+            if service_name is not None:
+                return self._service_exists(collection_name, service_name)
+        return self.inner.count_entries(database_name, collection_name,
+                                        entries, limit)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        with self._lock:
+            generation = self._generations.get(collection_name, 0)
+        found = self.inner.find_entries(database_name, collection_name,
+                                        entries, projection)
+
+        # A read answers the existence question it filtered on for free
+        if (database_name, collection_name) == ("users", "names"):
+            username = _exact(entries, "username")
+            if username is not None:
+                with self._lock:
+                    self._users[username] = bool(found)
+        elif database_name == "passwords":
+            service_name = _exact(entries, "service_name")
+            if service_name is not None:
+                with self._lock:
+                    if self._generations.get(collection_name, 0) == \
+                            generation:
+                        self._services.setdefault(
+                            collection_name, {})[service_name] = bool(found)
+            elif entries is None and self.bloom and (
+                    projection is None or "service_name" in projection):
+                self._install_filter(
+                    collection_name, generation,
+                    [document.get("service_name") for document in found])
+        return found
+
+    def _inserted(self, database_name: str, collection_name: str,
+                  entries: List[Any]) -> None:
+        with self._lock:
+            if (database_name, collection_name) == ("users", "names"):
+                for entry in entries:
+                    if isinstance(entry.get("username"), str):
+                        self._users[entry["username"]] = True
+            elif database_name == "passwords":
+                self._written(collection_name)
+                answers = self._services.setdefault(collection_name, {})
+                bloom = self._filters.get(collection_name)
+                for entry in entries:
+                    name = entry.get("service_name")
+                    if isinstance(name, str):
+                        answers[name] = True
+                        if bloom is not None:
+                            bloom.add(name)
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self.inner.insert_entry(database_name, collection_name, entry)
+        self._inserted(database_name, collection_name, [entry])
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.insert_entries(database_name, collection_name, entries)
+        self._inserted(database_name, collection_name, entries)
+
+    def _updated(self, database_name: str, collection_name: str,
+                 new_data: Dict[str, Any]) -> None:
+        with self._lock:
+            if (database_name, collection_name) == ("users", "names"):
+                if "username" in new_data:
+                    self._users.clear()
+            elif database_name == "passwords" and "service_name" in new_data:
+                self._written(collection_name)
+                self._services.pop(collection_name, None)
+                bloom = self._filters.get(collection_name)
+                if bloom is not None and isinstance(
+                        new_data["service_name"], str):
+                    bloom.add(new_data["service_name"])
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        matched = self.inner.update_entry(database_name, collection_name,
+                                          old_data, new_data)
+        self._updated(database_name, collection_name, new_data)
+        return matched
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self.inner.update_entries(database_name, collection_name,
+                                  old_data, new_data)
+        self._updated(database_name, collection_name, new_data)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.upsert_entries(database_name, collection_name, entries)
+        # A replaced document may have carried another name
+        self._deleted(database_name, collection_name, {}, True)
+        self._inserted(database_name, collection_name, entries)
+
+    def _deleted(self, database_name: str, collection_name: str,
+                 old_data: Dict[str, Any], many: bool) -> None:
+        # A vault's filter stays valid: it may only claim too much
+        with self._lock:
+            if (database_name, collection_name) == ("users", "names"):
+                answers = self._users
+                name = _exact(old_data, "username")
+            elif database_name == "passwords":
+                self._written(collection_name)
+                answers = self._services.setdefault(collection_name, {})
+                name = _exact(old_data, "service_name")
+            else:
+                return
+            if name is None:
+                answers.clear()
+            elif many:
+                answers[name] = False
+            else:
+                # Only one of several duplicates may have been deleted
+                answers.pop(name, None)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entry(database_name, collection_name, old_data)
+        self._deleted(database_name, collection_name, old_data, False)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entries(database_name, collection_name, old_data)
+        self._deleted(database_name, collection_name, old_data, True)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        self.inner.delete_collection(database_name, collection_name)
+        with self._lock:
+            if (database_name, collection_name) == ("users", "names"):
+                self._users.clear()
+            elif database_name == "passwords":
+                self._written(collection_name)
+                self._services.pop(collection_name, None)
+                self._round_trips.pop(collection_name, None)
+                if self.bloom:
+                    # The vault is known to be empty
+                    self._filters[collection_name] = BloomFilter(0)
@@ -0,0 +1,144 @@
+"""Module keeping the previous passwords of every entry
+
+Updating an entry used to overwrite its password in place. Before an update
+replaces a password, the encrypted value it replaces is copied into the
+user's collection in the history database, and only the newest
+HISTORY_LIMIT copies of each entry are kept. History lives outside the
+passwords collection, so reading a vault never reads it.
+
+    {"service_name": "github", "username_entry": "peter",
+     "password_entry": <encrypted>, "replaced_at": datetime}
+
+Restoring a version makes it the entry's password again and records the
+password it replaces, so a restore can itself be undone.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+from utility.entries import Secret
+from utility.envelope import Cipher
+from utility.storage import StorageBackend, as_utc
+
+DATABASE = "history"
+HISTORY_LIMIT = 10
+
+
+@dataclass
+class Version:
+    """A password an entry used to have
+
+    Attributes:
+        version_id (Any): The history document's _id
+        number (int): 1 for the most recently replaced password
+        username_entry (str): Username stored with the password
+        password_entry (Any): The encrypted password
+        replaced_at (datetime): When it was replaced
+    """
+
+    version_id: Any
+    number: int
+    username_entry: str
+    password_entry: Any
+    replaced_at: datetime
+
+    def decrypt(self, fernet_key: Any) -> Secret:
+        """Decrypts the password into a wipeable secret
+
+        Args:
+            fernet_key (Any): The user's Fernet key
+
+        Returns:
+            Secret: The password
+        """
+
+        return Secret(Cipher(fernet_key).decrypt(self.password_entry))
+
+
+def record(backend: StorageBackend, username: str, document: Dict[str, Any],
+           limit: int = HISTORY_LIMIT) -> None:
+    """Keeps the password of an entry that is about to be replaced
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        document (Dict[str, Any]): The entry's stored document
+        limit (int, optional): Versions kept per entry. Defaults to 10.
+    """
+
+    service_name = document["service_name"]
+    backend.insert_entry(DATABASE, username, {
+        "service_name": service_name,
+        "username_entry": document.get("username_entry", ""),
+        "password_entry": document["password_entry"],
+        "replaced_at": datetime.now(timezone.utc)})
+
+    query = {"service_name": service_name}
+    if backend.count_entries(DATABASE, username, query) > limit:
+        expired = [old.version_id
+                   for old in versions(backend, username, service_name)
+                   if old.number > limit]
+        backend.delete_entries(DATABASE, username,
+                               {"_id": {"$in": expired}})
+
+
+def versions(backend: StorageBackend, username: str,
+             service_name: str) -> List[Version]:
+    """Lists an entry's previous passwords, newest first
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        service_name (str): Name of the website/service
+
+    Returns:
+        List[Version]: The versions, still encrypted
+    """
+
+    documents = list(backend.find_entries(DATABASE, username,
+                                          {"service_name": service_name}))
+    # MongoDB keeps milliseconds, so ties fall back to insertion order
+    documents.sort(key=lambda document: (as_utc(document["replaced_at"]),
+                                         document["_id"]), reverse=True)
+    return [Version(document.get("_id"), number,
+                    document["username_entry"], document["password_entry"],
+                    document["replaced_at"])
+            for number, document in enumerate(documents, start=1)]
+
+
+def forget(backend: StorageBackend, username: str,
+           version: Version) -> None:
+    """Deletes one version
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        version (Version): The version
+    """
+
+    backend.delete_entry(DATABASE, username, {"_id": version.version_id})
+
+
+def delete_service_history(backend: StorageBackend, username: str,
+                           service_name: str) -> None:
+    """Deletes every version of an entry
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        service_name (str): Name of the website/service
+    """
+
+    backend.delete_entries(DATABASE, username,
+                           {"service_name": service_name})
+
+
+def delete_all(backend: StorageBackend, username: str) -> None:
+    """Deletes the history of every entry of a user
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+    """
+
+    backend.delete_collection(DATABASE, username)
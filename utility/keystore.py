@@ -0,0 +1,555 @@
+"""Module keeping every user's Fernet key in one indexed file
+
+Keys used to be user_<name>_fernet.key files in the working directory, one
+per user, opened on every operation. Keystore puts them in a single file:
+
+    magic      8 bytes   b"PMKEYS\\0\\0"
+    version    4 bytes   unsigned little-endian
+    flags      4 bytes   bit 0 set once the file was replaced by compact()
+    slots      8 bytes   size of the hash table, a power of two
+    count      8 bytes   live records
+    used       8 bytes   slots holding a record or a tombstone
+    table      slots * 8 bytes, record offsets (0 empty, 1 deleted)
+    records    u16 name length, u16 wrapped key length, name, 16 byte salt,
+               wrapped key
+
+A user's slot is found by hashing their name and probing linearly, reading
+the memory mapped file, so a lookup costs no system call. The Fernet key is
+stored wrapped (Fernet encrypted) under a key derived from the user's master
+password with scrypt, so the file alone does not reveal any key.
+
+Writers hold an exclusive lock on <path>.lock. A new record is appended and
+flushed before the slot pointing to it is written, so a crash leaves at
+worst an unreferenced record. When the table is 70% used compact() writes
+the live records to a new file, renames it over the old one and flags the
+old file, which tells readers still mapping it to reopen.
+
+Usage:
+    python -m utility.keystore migrate KEYSTORE [--key-dir D] [--remove]
+    python -m utility.keystore list KEYSTORE
+"""
+
+import argparse
+import base64
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from cryptography.fernet import Fernet, InvalidToken
+from typing import Any, Iterable, Iterator, List, Tuple
+from utility import storage
+from utility.envelope import Cipher
+
+MAGIC = b"PMKEYS\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQ")
+RECORD = struct.Struct("<HH")
+SLOT = struct.Struct("<Q")
+EMPTY = 0
+DELETED = 1
+REPLACED = 1
+SALT_SIZE = 16
+MIN_SLOTS = 64
+MAX_LOAD = 0.7
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+KEYSTORE_ENV = "PM_KEYSTORE"
+
+
+class KeystoreError(Exception):
+    """Raised for a malformed keystore or a passphrase that does not fit
+    """
+
+
+def wrapping_key(passphrase: str, salt: bytes) -> bytes:
+    """Derives the Fernet key that wraps a user's key
+
+    Args:
+        passphrase (str): The user's master password
+        salt (bytes): Random per-record salt
+
+    Returns:
+        bytes: A Fernet key
+    """
+
+    derived = hashlib.scrypt(passphrase.encode(), salt=salt, n=SCRYPT_N,
+                             r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+    return base64.urlsafe_b64encode(derived)
+
+
+def _wrap(key: Tuple[str, bytes, str]) -> Tuple[bytes, bytes, bytes]:
+    """Wraps a user's key under their passphrase with a new salt
+
+    Args:
+        key (Tuple[str, bytes, str]): User's name, Fernet key and passphrase
+
+    Returns:
+        Tuple[bytes, bytes, bytes]: Name, salt and wrapped key
+    """
+
+    username, fernet_key, passphrase = key
+    salt = os.urandom(SALT_SIZE)
+    return (username.encode(), salt,
+            Fernet(wrapping_key(passphrase, salt)).encrypt(fernet_key))
+
+
+def _slot_hash(name: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(),
+                          "little")
+
+
+class Keystore:
+    """A single file holding every user's wrapped Fernet key
+
+    Args:
+        path (str): Keystore file, created if missing
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd = -1
+        self._map: mmap.mmap | None = None
+        with self._locked():
+            if not os.path.exists(path):
+                self._write_file(path, MIN_SLOTS, [])
+        self._open()
+
+    def _open(self) -> None:
+        """Opens and maps the file at path, replacing any old mapping
+        """
+
+        self._close_file()
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._remap()
+        magic, version, _, slots, _, _ = HEADER.unpack_from(self._view, 0)
+        if (magic != MAGIC or version != VERSION
+                or len(self._view) < HEADER.size + slots * SLOT.size):
+            self.close()
+            raise KeystoreError(f"{self.path} is not a keystore")
+
+    def _remap(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+
+    @property
+    def _view(self) -> mmap.mmap:
+        if self._map is None:
+            raise KeystoreError("keystore is closed")
+        return self._map
+
+    def _close_file(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def close(self) -> None:
+        """Unmaps and closes the keystore
+        """
+
+        self._close_file()
+
+    def __enter__(self) -> "Keystore":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Holds the writer lock, reopening the file if it was replaced
+        """
+
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._map is not None and self._replaced():
+                    self._open()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _replaced(self) -> bool:
+        flags = HEADER.unpack_from(self._view, 0)[2]
+        return bool(flags & REPLACED)
+
+    def _header(self) -> Tuple[int, int, int]:
+        """Returns slots, count and used, reopening a replaced file
+        """
+
+        if self._replaced():
+            self._open()
+        _, _, _, slots, count, used = HEADER.unpack_from(self._view, 0)
+        return slots, count, used
+
+    def _record(self, offset: int) -> Tuple[bytes, bytes, bytes]:
+        """Reads the record at an offset
+
+        Returns:
+            Tuple[bytes, bytes, bytes]: Name, salt and wrapped key
+        """
+
+        if offset + RECORD.size > len(self._view):
+            # Appended by another writer since the file was mapped
+            self._remap()
+        name_size, wrapped_size = RECORD.unpack_from(self._view, offset)
+        start = offset + RECORD.size
+        end = start + name_size + SALT_SIZE + wrapped_size
+        if end > len(self._view):
+            self._remap()
+        data = self._view[start:end]
+        return (data[:name_size], data[name_size:name_size + SALT_SIZE],
+                data[name_size + SALT_SIZE:])
+
+    def _find(self, name: bytes) -> Tuple[int, int]:
+        """Probes the table for a name
+
+        Returns:
+            Tuple[int, int]: The slot holding the name (-1 if absent) and
+                the first free slot seen (-1 if none)
+        """
+
+        slots = self._header()[0]
+        free = -1
+        index = _slot_hash(name) & (slots - 1)
+        for _ in range(slots):
+            offset = SLOT.unpack_from(self._view,
+                                      HEADER.size + index * SLOT.size)[0]
+            if offset == EMPTY:
+                return -1, free if free >= 0 else index
+            if offset == DELETED:
+                if free < 0:
+                    free = index
+            elif self._record(offset)[0] == name:
+                return index, free
+            index = (index + 1) & (slots - 1)
+        return -1, free
+
+    def __contains__(self, username: object) -> bool:
+        if not isinstance(username, str):
+            return False
+        return self._find(username.encode())[0] >= 0
+
+    def get_key(self, username: str, passphrase: str) -> bytes:
+        """Unwraps a user's Fernet key
+
+        Args:
+            username (str): User's name
+            passphrase (str): The user's master password
+
+        Raises:
+            KeyError: Raised if the user has no key
+            KeystoreError: Raised if the passphrase is wrong
+
+        Returns:
+            bytes: The Fernet key
+        """
+
+        name = username.encode()
+        index = self._find(name)[0]
+        if index < 0:
+            raise KeyError(username)
+        offset = SLOT.unpack_from(self._view,
+                                  HEADER.size + index * SLOT.size)[0]
+        _, salt, wrapped = self._record(offset)
+        try:
+            return Fernet(wrapping_key(passphrase, salt)).decrypt(wrapped)
+        except InvalidToken:
+            raise KeystoreError(f"wrong passphrase for {username}")
+
+    def names(self) -> List[str]:
+        """Lists the users with a key
+
+        Returns:
+            List[str]: User names
+        """
+
+        slots = self._header()[0]
+        names = []
+        for index in range(slots):
+            offset = SLOT.unpack_from(self._view,
+                                      HEADER.size + index * SLOT.size)[0]
+            if offset not in (EMPTY, DELETED):
+                names.append(self._record(offset)[0].decode())
+        return names
+
+    def _write_header(self, count: int, used: int) -> None:
+        header = HEADER.unpack_from(self._view, 0)
+        os.pwrite(self._fd, HEADER.pack(*header[:4], count, used), 0)
+        os.fsync(self._fd)
+
+    def put(self, username: str, fernet_key: bytes, passphrase: str) -> None:
+        """Stores or replaces a user's key, wrapped under a passphrase
+
+        Args:
+            username (str): User's name
+            fernet_key (bytes): The user's Fernet key
+            passphrase (str): The user's master password
+        """
+
+        self._append([_wrap((username, fernet_key, passphrase))])
+
+    def put_many(self, keys: Iterable[Tuple[str, bytes, str]],
+                 workers: int | None = None) -> int:
+        """Stores many keys with one lock, one append and two syncs
+
+        The keys are wrapped in parallel threads; scrypt releases the GIL.
+
+        Args:
+            keys (Iterable[Tuple[str, bytes, str]]): User's name, Fernet key
+                and master password of every user
+            workers (int | None, optional): Threads wrapping keys.
+                Defaults to the number of CPUs.
+
+        Returns:
+            int: Keys stored
+        """
+
+        with ThreadPoolExecutor(workers) as pool:
+            records = list(pool.map(_wrap, keys))
+        self._append(records)
+        return len(records)
+
+    def _append(self, records: List[Tuple[bytes, bytes, bytes]]) -> None:
+        """Appends wrapped records and points their slots at them
+        """
+
+        if not records:
+            return
+        with self._locked():
+            slots, count, used = self._header()
+            if used + len(records) > slots * MAX_LOAD:
+                while used + len(records) > slots * MAX_LOAD:
+                    slots *= 2
+                self._compact(slots)
+                slots, count, used = self._header()
+
+            offset = os.fstat(self._fd).st_size
+            body = bytearray()
+            offsets = []
+            for name, salt, wrapped in records:
+                offsets.append(offset + len(body))
+                body += RECORD.pack(len(name), len(wrapped)) + name + salt
+                body += wrapped
+            os.pwrite(self._fd, body, offset)
+            os.fsync(self._fd)
+            self._remap()
+
+            for (name, _, _), record_offset in zip(records, offsets):
+                index, free = self._find(name)
+                if index < 0:
+                    index = free
+                    count += 1
+                    empty = SLOT.unpack_from(
+                        self._view,
+                        HEADER.size + index * SLOT.size)[0] == EMPTY
+                    used += empty
+                os.pwrite(self._fd, SLOT.pack(record_offset),
+                          HEADER.size + index * SLOT.size)
+            self._write_header(count, used)
+
+    def delete(self, username: str) -> bool:
+        """Removes a user's key
+
+        Args:
+            username (str): User's name
+
+        Returns:
+            bool: True if the user had a key
+        """
+
+        return self.delete_many([username]) == 1
+
+    def delete_many(self, usernames: Iterable[str]) -> int:
+        """Removes the keys of many users with one lock and one sync
+
+        Args:
+            usernames (Iterable[str]): Users' names
+
+        Returns:
+            int: Keys removed
+        """
+
+        with self._locked():
+            _, count, used = self._header()
+            removed = 0
+            for username in usernames:
+                index = self._find(username.encode())[0]
+                if index >= 0:
+                    os.pwrite(self._fd, SLOT.pack(DELETED),
+                              HEADER.size + index * SLOT.size)
+                    removed += 1
+            if removed:
+                self._write_header(count - removed, used)
+            return removed
+
+    def compact(self) -> None:
+        """Rewrites the file without deleted or replaced records
+        """
+
+        with self._locked():
+            count = self._header()[1]
+            slots = MIN_SLOTS
+            while slots * MAX_LOAD / 2 < count + 1:
+                slots *= 2
+            self._compact(slots)
+
+    def _compact(self, slots: int) -> None:
+        """Replaces the file with one holding only live records
+
+        Must be called with the writer lock held.
+        """
+
+        records = []
+        for index in range(self._header()[0]):
+            offset = SLOT.unpack_from(self._view,
+                                      HEADER.size + index * SLOT.size)[0]
+            if offset not in (EMPTY, DELETED):
+                records.append(self._record(offset))
+
+        temporary = f"{self.path}.tmp"
+        self._write_file(temporary, slots, records)
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        # Tell readers still mapping the old file to reopen
+        header = HEADER.unpack_from(self._view, 0)
+        os.pwrite(self._fd, HEADER.pack(header[0], header[1], REPLACED,
+                                        *header[3:]), 0)
+        self._open()
+
+    @staticmethod
+    def _write_file(path: str, slots: int,
+                    records: List[Tuple[bytes, bytes, bytes]]) -> None:
+        """Writes a complete keystore file
+
+        Args:
+            path (str): File to write
+            slots (int): Table size, a power of two
+            records (List[Tuple[bytes, bytes, bytes]]): Name, salt and
+                wrapped key of every record
+        """
+
+        table = [EMPTY] * slots
+        body = bytearray()
+        base = HEADER.size + slots * SLOT.size
+        for name, salt, wrapped in records:
+            index = _slot_hash(name) & (slots - 1)
+            while table[index] != EMPTY:
+                index = (index + 1) & (slots - 1)
+            table[index] = base + len(body)
+            body += RECORD.pack(len(name), len(wrapped)) + name + salt
+            body += wrapped
+
+        with open(path, "wb") as output:
+            output.write(HEADER.pack(MAGIC, VERSION, 0, slots, len(records),
+                                     len(records)))
+            output.write(struct.pack(f"<{slots}Q", *table))
+            output.write(body)
+            output.flush()
+            os.fsync(output.fileno())
+
+
+def migrate_key_files(keystore: Keystore, backend: Any, key_dir: str = ".",
+                      remove: bool = False) -> List[str]:
+    """Moves user_<name>_fernet.key files into a keystore
+
+    Each key is wrapped under its user's master password, which is read
+    from their users.names record with the key itself.
+
+    Args:
+        keystore (Keystore): Destination keystore
+        backend (Any): StorageBackend holding users.names
+        key_dir (str, optional): Directory of the key files.
+            Defaults to the working directory.
+        remove (bool, optional): Delete each key file once stored.
+            Defaults to False.
+
+    Returns:
+        List[str]: Users migrated
+    """
+
+    from utility.consistency import key_path, list_key_files
+
+    records = {record['username']: record
+               for record in backend.find_entries("users", "names")}
+    migrated = []
+    for username in sorted(list_key_files(key_dir)):
+        record = records.get(username)
+        if record is None:
+            continue
+        path = key_path(key_dir, username)
+        with open(path, "rb") as key_file:
+            fernet_key = key_file.read()
+        try:
+            master_password = Cipher(fernet_key).decrypt(
+                record['master_password']).decode()
+        except InvalidToken:
+            continue
+        keystore.put(username, fernet_key, master_password)
+        if remove:
+            os.remove(path)
+        migrated.append(username)
+    return migrated
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for migrating and listing keystores
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.keystore")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate",
+                                  help="move key files into a keystore")
+    migrate.add_argument("keystore")
+    migrate.add_argument("--backend", choices=storage.BACKENDS,
+                         help="storage backend (default: $PM_BACKEND "
+                         "or mongo)")
+    migrate.add_argument("--sqlite-path",
+                         help="database file for the sqlite backend")
+    migrate.add_argument("--key-dir", default=".")
+    migrate.add_argument("--remove", action="store_true",
+                         help="delete key files once migrated")
+    listing = commands.add_parser("list", help="list users with a key")
+    listing.add_argument("keystore")
+    args = parser.parse_args(argv)
+
+    try:
+        with Keystore(args.keystore) as keystore:
+            if args.command == "migrate":
+                # utility.vault imports this module
+                from utility import vault
+                vault.configure_storage(args.backend, args.sqlite_path)
+                migrated = migrate_key_files(keystore, vault.storage,
+                                             args.key_dir, args.remove)
+                print(f"Migrated {len(migrated)} keys to {args.keystore}")
+            else:
+                for username in sorted(keystore.names()):
+                    print(username)
+    except (KeystoreError, OSError) as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
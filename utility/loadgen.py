@@ -0,0 +1,558 @@
+"""Module driving many concurrent users against a storage backend
+
+provision() creates synthetic users with vaults of a chosen size, either
+through create_user()/add_password() as the menu would or in bulk (one
+insert per vault). run_load() then replays a weighted mix of logins, adds,
+updates, retrievals and deletes from a pool of threads and records the
+latency of every operation; with several processes each one takes its own
+share of the users, so processes never race on the same entry. The
+report gives throughput, latency percentiles and the error rate per
+operation type. Threads of one process share its users, so an update can
+lose a race with the delete of the same entry and count as an error, as it
+would for a user editing from two sessions.
+
+Key files are written to the working directory, so the command line runs
+in a fresh temporary directory unless --workdir is given. The command line
+loads the memory backend unless told otherwise; it only works with one
+process. To load a local mongod, pass --backend mongo with --mongo-uri
+mongodb://localhost:27017 or PM_MONGO_URI set: without a URI the mongo
+backend would reach the production cluster, so it is refused.
+
+Usage:
+    python -m utility.loadgen [--backend B] [--mongo-uri URI] [--users N]
+        [--vault-size N] [--threads N] [--processes N]
+        [--duration S | --operations N] [--mix MIX]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+from utility import entries
+from utility import packed
+from utility import storage
+from utility import utility
+from utility import vault
+from utility.storage import StorageBackend
+
+OPERATIONS = ("login", "add", "update", "retrieve", "delete")
+DEFAULT_MIX = "login=10,add=20,update=20,retrieve=40,delete=10"
+MASTER_PASSWORD = "L0ad-Test$ecret!"
+USER_PREFIX = "loadgen"
+
+
+@dataclass
+class OperationStats:
+    """Latencies and failures of one operation type
+
+    Attributes:
+        latencies (List[float]): Seconds taken by each operation
+        errors (int): Operations that raised or returned False
+    """
+
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+
+    def merge(self, other: "OperationStats") -> None:
+        """Adds another worker's results to these
+
+        Args:
+            other (OperationStats): Results to add
+        """
+
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+
+    def percentile(self, percent: float) -> float:
+        """Returns a latency percentile by nearest rank
+
+        Args:
+            percent (float): Percentile between 0 and 100
+
+        Returns:
+            float: Latency in seconds, 0 without samples
+        """
+
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(1, int(-(-percent * len(ordered) // 100)))
+        return ordered[min(rank, len(ordered)) - 1]
+
+
+@dataclass
+class LoadReport:
+    """Results of a load run
+
+    Attributes:
+        elapsed (float): Wall clock seconds of the run
+        operations (Dict[str, OperationStats]): Results per operation type
+    """
+
+    elapsed: float
+    operations: Dict[str, OperationStats]
+
+    def format(self) -> str:
+        """Renders the report as a table
+
+        Returns:
+            str: One line per operation type and a total
+        """
+
+        lines = [f"{'operation':<10}{'count':>8}{'errors':>8}{'err %':>7}"
+                 f"{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"]
+        total = OperationStats()
+        rows = [(name, self.operations[name]) for name in OPERATIONS
+                if name in self.operations]
+        for _, stats in rows:
+            total.merge(stats)
+        for name, stats in rows + [("total", total)]:
+            count = len(stats.latencies)
+            rate = count / self.elapsed if self.elapsed else 0.0
+            error_rate = 100.0 * stats.errors / count if count else 0.0
+            lines.append(
+                f"{name:<10}{count:>8}{stats.errors:>8}{error_rate:>7.1f}"
+                f"{rate:>9.1f}{stats.percentile(50) * 1000:>9.2f}"
+                f"{stats.percentile(95) * 1000:>9.2f}"
+                f"{stats.percentile(99) * 1000:>9.2f}")
+        return "\n".join(lines)
+
+
+class _Vaults:
+    """Service names of every loaded vault, shared by the worker threads
+    """
+
+    def __init__(self, services: Dict[str, List[str]]) -> None:
+        self._services = services
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, backend: StorageBackend,
+             usernames: List[str]) -> "_Vaults":
+        """Reads the service names of each user's vault
+        """
+
+        return cls({username: [document['service_name']
+                               for batch in backend.iter_entries(
+                                   "passwords", username)
+                               for document in batch]
+                    for username in usernames})
+
+    def add(self, username: str, service_name: str) -> None:
+        with self._lock:
+            self._services[username].append(service_name)
+
+    def pick(self, username: str, rng: random.Random) -> str | None:
+        with self._lock:
+            services = self._services[username]
+            return rng.choice(services) if services else None
+
+    def take(self, username: str, rng: random.Random) -> str | None:
+        with self._lock:
+            services = self._services[username]
+            if not services:
+                return None
+            index = rng.randrange(len(services))
+            services[index], services[-1] = services[-1], services[index]
+            return services.pop()
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses an operation mix such as "login=1,retrieve=3"
+
+    Args:
+        text (str): Comma separated operation=weight pairs
+
+    Raises:
+        ValueError: Raised for unknown operations or bad weights
+
+    Returns:
+        Dict[str, float]: Weight of each operation
+    """
+
+    mix: Dict[str, float] = {}
+    for part in text.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}, expected one of "
+                             f"{', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+        if mix[name] < 0:
+            raise ValueError(f"Negative weight for {name}")
+    if not sum(mix.values()):
+        raise ValueError("The operation mix has no weight")
+    return mix
+
+
+def user_name(number: int) -> str:
+    """Returns the name of a synthetic user
+
+    Args:
+        number (int): Index of the user
+
+    Returns:
+        str: The user's name
+    """
+
+    return f"{USER_PREFIX}{number:05d}"
+
+
+def _sample_entry(username: str, number: int) -> Tuple[str, str, str]:
+    """Returns a service, username and password for a synthetic entry
+    """
+
+    return (f"service{number:05d}", f"{username}-{number}",
+            uuid.uuid4().hex)
+
+
+def provision(users: int, vault_size: int, bulk: bool = True) -> List[str]:
+    """Creates synthetic users with full vaults in vault.storage
+
+    Args:
+        users (int): Number of users
+        vault_size (int): Entries in each vault
+        bulk (bool, optional): Write each vault with one insert instead of
+            going through create_user() and add_password(). Defaults to
+            True.
+
+    Returns:
+        List[str]: Names of the users created
+    """
+
+    usernames = [user_name(number) for number in range(users)]
+    for username in usernames:
+        if not bulk:
+            vault.create_user(username, MASTER_PASSWORD)
+            for number in range(vault_size):
+                vault.add_password(username,
+                                   *_sample_entry(username, number))
+            continue
+
+        fernet_key = vault.generate_user_fernet_key()
+        vault.store_fernet_key_locally(fernet_key, username)
+        vault.storage.insert_entry("users", "names", {
+            'username': username,
+            'master_password': vault.encrypt_password(fernet_key,
+                                                      MASTER_PASSWORD)})
+        documents = []
+        now = datetime.now(timezone.utc)
+        for number in range(vault_size):
+            service_name, username_entry, password_entry = \
+                _sample_entry(username, number)
+            documents.append({
+                'username': username, 'service_name': service_name,
+                'username_entry': username_entry,
+                'password_entry': vault.encrypt_password(fernet_key,
+                                                         password_entry),
+                'created_at': now, 'updated_at': now})
+        if documents:
+            vault.storage.insert_entries("passwords", username, documents)
+    return usernames
+
+
+def remove_users(usernames: List[str]) -> None:
+    """Deletes synthetic users, their vaults and their keys
+
+    Args:
+        usernames (List[str]): Users to delete
+    """
+
+    for username in usernames:
+        vault.delete_user(username)
+
+
+def _run_operation(operation: str, username: str, vaults: _Vaults,
+                   rng: random.Random) -> bool:
+    """Runs one operation for a user
+
+    Returns:
+        bool: Whether the operation succeeded
+    """
+
+    if operation == "login":
+        return bool(vault.authenticate_user(username, MASTER_PASSWORD))
+    if operation == "retrieve":
+        loaded = entries.load_vault_entries(vault.storage, username)
+        entries.decrypt_entries(vault.load_fernet_key_locally(username),
+                                loaded)
+        entries.wipe_entries(loaded)
+        return True
+    if operation == "add":
+        service_name = f"service-{uuid.uuid4().hex[:12]}"
+        added = bool(vault.add_password(username, service_name,
+                                        username, uuid.uuid4().hex))
+        if added:
+            vaults.add(username, service_name)
+        return added
+    if operation == "update":
+        picked = vaults.pick(username, rng)
+        return picked is not None and bool(vault.update_service(
+            username, picked, username, uuid.uuid4().hex))
+    taken = vaults.take(username, rng)
+    return taken is not None and bool(
+        vault.delete_service_and_passwords(username, taken))
+
+
+def _worker(usernames: List[str], mix: Dict[str, float], vaults: _Vaults,
+            deadline: float, budget: List[int], budget_lock: threading.Lock,
+            seed: int | None) -> Dict[str, OperationStats]:
+    """Runs operations until the deadline passes or the budget is spent
+    """
+
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = list(mix.values())
+    results = {name: OperationStats() for name in names}
+
+    while time.monotonic() < deadline:
+        with budget_lock:
+            if budget[0] == 0:
+                break
+            budget[0] -= 1
+        operation = rng.choices(names, weights)[0]
+        username = rng.choice(usernames)
+        started = time.perf_counter()
+        try:
+            succeeded = _run_operation(operation, username, vaults, rng)
+        except Exception:
+            succeeded = False
+        results[operation].latencies.append(time.perf_counter() - started)
+        if not succeeded:
+            results[operation].errors += 1
+    return results
+
+
+def run_load(usernames: List[str], mix: Dict[str, float], threads: int = 8,
+             duration: float | None = None, operations: int | None = None,
+             seed: int | None = None) -> LoadReport:
+    """Drives an operation mix against vault.storage from a thread pool
+
+    Args:
+        usernames (List[str]): Provisioned users to act as
+        mix (Dict[str, float]): Weight of each operation
+        threads (int, optional): Concurrent workers. Defaults to 8.
+        duration (float | None, optional): Seconds to run for.
+            Defaults to None, no time limit.
+        operations (int | None, optional): Operations to run in total.
+            Defaults to None, no limit; one of the limits is required.
+        seed (int | None, optional): Seed for repeatable choices.
+            Defaults to None.
+
+    Raises:
+        ValueError: Raised if neither limit is given or there are no users
+
+    Returns:
+        LoadReport: Results per operation type
+    """
+
+    if duration is None and operations is None:
+        raise ValueError("Give a duration or a number of operations")
+    if not usernames:
+        raise ValueError("No users to drive")
+
+    vaults = _Vaults.load(vault.storage, usernames)
+    budget = [-1 if operations is None else operations]
+    budget_lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + duration if duration is not None else float("inf")
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(
+            _worker, usernames, mix, vaults, deadline, budget, budget_lock,
+            None if seed is None else seed + number)
+            for number in range(threads)]
+        results = [future.result() for future in futures]
+    elapsed = time.monotonic() - started
+
+    merged: Dict[str, OperationStats] = {}
+    for result in results:
+        for name, stats in result.items():
+            merged.setdefault(name, OperationStats()).merge(stats)
+    return LoadReport(elapsed, merged)
+
+
+def _process_main(config: Dict[str, Any]) -> LoadReport:
+    """Runs one process's share of the load
+    """
+
+    os.chdir(config["workdir"])
+    vault.configure_storage(config["backend"], config["sqlite_path"],
+                            config["storage_mode"])
+    try:
+        return run_load(config["usernames"], config["mix"],
+                        config["threads"], config["duration"],
+                        config["operations"], config["seed"])
+    finally:
+        vault.close_storage()
+
+
+def run_processes(usernames: List[str], mix: Dict[str, float],
+                  processes: int, threads: int = 8,
+                  duration: float | None = None,
+                  operations: int | None = None, seed: int | None = None,
+                  backend_name: str | None = None,
+                  sqlite_path: str | None = None,
+                  storage_mode: str | None = None) -> LoadReport:
+    """Splits the users across processes, each running run_load()
+
+    Every process opens its own connection to the backend, so the backend
+    must be shared: mongo or sqlite, not memory.
+
+    Args:
+        usernames (List[str]): Provisioned users to act as
+        mix (Dict[str, float]): Weight of each operation
+        processes (int): Number of processes
+        threads (int, optional): Threads per process. Defaults to 8.
+        duration (float | None, optional): Seconds to run for.
+        operations (int | None, optional): Operations in total.
+        seed (int | None, optional): Seed for repeatable choices.
+        backend_name (str | None, optional): Backend for the processes.
+        sqlite_path (str | None, optional): Database file for sqlite.
+        storage_mode (str | None, optional): Storage mode.
+
+    Returns:
+        LoadReport: Results of all processes, merged
+    """
+
+    shares = [usernames[number::processes] for number in range(processes)]
+    shares = [share for share in shares if share]
+    configs = []
+    for number, share in enumerate(shares):
+        quota = None
+        if operations is not None:
+            quota = operations // len(shares) + (
+                number < operations % len(shares))
+        configs.append({
+            "workdir": os.getcwd(), "backend": backend_name,
+            "sqlite_path": sqlite_path, "storage_mode": storage_mode,
+            "usernames": share, "mix": mix, "threads": threads,
+            "duration": duration, "operations": quota,
+            "seed": None if seed is None else seed + 1000 * number})
+
+    started = time.monotonic()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(len(configs)) as pool:
+        reports = pool.map(_process_main, configs)
+    elapsed = time.monotonic() - started
+
+    merged: Dict[str, OperationStats] = {}
+    for report in reports:
+        for name, stats in report.operations.items():
+            merged.setdefault(name, OperationStats()).merge(stats)
+    return LoadReport(elapsed, merged)
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for a load run
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: 0 if no operation failed, 1 otherwise
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.loadgen")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or memory)")
+    parser.add_argument("--mongo-uri",
+                        help="mongod to load with the mongo backend "
+                        "(default: $PM_MONGO_URI)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault")
+    parser.add_argument("--workdir",
+                        help="directory for key files (default: a new "
+                        "temporary directory)")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--vault-size", type=int, default=20)
+    parser.add_argument("--per-entry", action="store_true",
+                        help="provision through create_user and "
+                        "add_password instead of bulk inserts")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads per process")
+    parser.add_argument("--processes", type=int, default=1)
+    limit = parser.add_mutually_exclusive_group()
+    limit.add_argument("--duration", type=float,
+                       help="seconds to run for (default: 10)")
+    limit.add_argument("--operations", type=int,
+                       help="operations to run in total")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--keep-users", action="store_true",
+                        help="leave the synthetic users in the backend")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as error:
+        parser.error(str(error))
+    backend_name = (args.backend or os.environ.get(storage.BACKEND_ENV)
+                    or "memory").lower()
+    if args.mongo_uri:
+        os.environ[utility.MONGO_URI_ENV] = args.mongo_uri
+    if backend_name == "mongo" and not os.environ.get(utility.MONGO_URI_ENV):
+        parser.error("the mongo backend needs --mongo-uri or "
+                     f"${utility.MONGO_URI_ENV}, so the production cluster "
+                     "is never loaded")
+    if args.processes > 1 and backend_name == "memory":
+        parser.error("the memory backend cannot be shared between "
+                     "processes")
+    duration = args.duration
+    if duration is None and args.operations is None:
+        duration = 10.0
+
+    sqlite_path = args.sqlite_path and os.path.abspath(args.sqlite_path)
+    old_cwd = os.getcwd()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pm-loadgen-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    vault.configure_storage(backend_name, sqlite_path, args.storage_mode)
+
+    started = time.monotonic()
+    usernames = provision(args.users, args.vault_size, not args.per_entry)
+    print(f"Provisioned {len(usernames)} users with {args.vault_size} "
+          f"entries in {time.monotonic() - started:.1f} s ({workdir})")
+
+    try:
+        if args.processes > 1:
+            vault.close_storage()
+            report = run_processes(usernames, mix, args.processes,
+                                   args.threads, duration, args.operations,
+                                   args.seed, backend_name, sqlite_path,
+                                   args.storage_mode)
+        else:
+            report = run_load(usernames, mix, args.threads, duration,
+                              args.operations, args.seed)
+    finally:
+        if not args.keep_users:
+            remove_users(usernames)
+        for warning in vault.close_storage():
+            print(warning, file=sys.stderr)
+        os.chdir(old_cwd)
+        if args.workdir is None and not args.keep_users:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.processes} x {args.threads} workers, "
+          f"{report.elapsed:.1f} s")
+    print(report.format())
+    return 1 if any(stats.errors for stats in report.operations.values()) \
+        else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,611 @@
+"""Module keeping a Merkle tree of digests over every vault
+
+Checking that a vault is intact, or finding how a backup differs from the
+live vault, used to mean decrypting and comparing every entry. Instead each
+entry gets a digest, an HMAC of its stored fields keyed with the user's
+Fernet key, and the digests are arranged in a tree:
+
+* an entry falls in the bucket named by the first BUCKET_DIGITS hex digits
+  of the SHA-256 of its service name, 4096 buckets by default,
+* a bucket's hash covers the service names and digests in it,
+* an inner node's hash covers the hashes of its 16 children, one per next
+  hex digit, and the root covers the whole vault.
+
+The tree lives in the digests database, one document per non-empty node
+keyed by its prefix in <user>.nodes and one per entry in <user>.entries:
+
+    {"_id": "a3f", "node": "a3f", "hash": <hex>}
+    {"bucket": "a3f", "service_name": "github", "digest": <hex>}
+
+and the root is kept in the user's users.names record as vault_root.
+Changing an entry rehashes its bucket and the nodes above it only: the
+siblings of all three levels are read in one query and the new nodes are
+written in one bulk upsert. The root is set only if it is still the one
+that was read, and the update is retried otherwise, so sessions changing
+different buckets do not lose each other's changes. verify() rebuilds a
+tree whose nodes disagree with its own digests, as a crash halfway through
+an update leaves it.
+
+Two trees are compared from the root down, one query per level on each
+side, descending only into the children whose hashes differ, so copies of
+a 100k entry vault that differ in a few entries are compared by reading a
+few dozen nodes and the digests of a few buckets. verify() compares the
+stored tree against one computed from the vault as it is now. Digests cover
+the service name, username, encrypted password and URLs; timestamps are
+left out. Users created before digests existed have no vault_root and are
+not tracked until build() is run.
+
+Usage:
+    python -m utility.merkle build --user USER
+    python -m utility.merkle verify --user USER
+    python -m utility.merkle diff --user USER --against-backend BACKEND
+    python -m utility.merkle bench [--entries N] [--changes N]
+"""
+
+import argparse
+import base64
+import getpass
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Protocol, Tuple
+from utility import packed
+from utility import storage
+from utility import utility
+from utility.storage import MongoBackend, StorageBackend, innermost
+
+DATABASE = "digests"
+ROOT_FIELD = "vault_root"
+BUCKET_DIGITS = 3
+HEX_DIGITS = "0123456789abcdef"
+EMPTY = hashlib.sha256(b"").hexdigest()
+MAX_RETRIES = 10
+
+
+def bucket_of(service_name: str) -> str:
+    """Returns the bucket an entry falls in
+
+    Args:
+        service_name (str): Name of the website/service
+
+    Returns:
+        str: The first BUCKET_DIGITS hex digits of the name's SHA-256
+    """
+
+    return hashlib.sha256(
+        service_name.encode()).hexdigest()[:BUCKET_DIGITS]
+
+
+def entry_digest(fernet_key: Any, document: Dict[str, Any]) -> str:
+    """Computes the digest of a stored entry
+
+    Args:
+        fernet_key (Any): The user's Fernet key
+        document (Dict[str, Any]): The entry as stored, password encrypted
+
+    Returns:
+        str: Hex HMAC-SHA256 of the entry's fields
+    """
+
+    password = document.get("password_entry")
+    if isinstance(password, (bytes, bytearray)):
+        password = base64.b64encode(password).decode()
+    fields = [document.get("service_name"), document.get("username_entry"),
+              password, document.get("urls", [])]
+    key = fernet_key if isinstance(fernet_key, bytes) else fernet_key.encode()
+    return hmac.new(key, json.dumps(fields, separators=(",", ":")).encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def _hash_lines(lines: Iterable[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(lines)).encode()).hexdigest()
+
+
+def _bucket_hash(digests: Iterable[Tuple[str, str]]) -> str:
+    """Hashes a bucket from its (service name, digest) pairs
+    """
+
+    return _hash_lines(f"{name}\0{digest}" for name, digest in digests)
+
+
+def _node_hash(children: Dict[str, str]) -> str:
+    """Hashes an inner node from its non-empty children's hashes
+    """
+
+    return _hash_lines(f"{prefix}:{digest}"
+                       for prefix, digest in children.items()
+                       if digest != EMPTY)
+
+
+def _nodes(username: str) -> str:
+    return f"{username}.nodes"
+
+
+def _entries(username: str) -> str:
+    return f"{username}.entries"
+
+
+def _children(prefixes: Iterable[str]) -> List[str]:
+    return [prefix + digit for prefix in prefixes for digit in HEX_DIGITS]
+
+
+class DigestTree(Protocol):
+    """The parts of a tree read while comparing it with another
+    """
+
+    def root(self) -> str | None: ...
+
+    def hashes(self, prefixes: List[str]) -> Dict[str, str]: ...
+
+    def digests(self, buckets: List[str]) -> Dict[str, List[str]]: ...
+
+
+class ComputedTree:
+    """DigestTree computed in memory from a vault's documents
+    """
+
+    def __init__(self, fernet_key: Any,
+                 documents: Iterable[Dict[str, Any]]) -> None:
+        self.entries: List[Dict[str, str]] = [
+            {"bucket": bucket_of(document["service_name"]),
+             "service_name": document["service_name"],
+             "digest": entry_digest(fernet_key, document)}
+            for document in documents]
+
+        buckets: Dict[str, List[Tuple[str, str]]] = {}
+        for entry in self.entries:
+            buckets.setdefault(entry["bucket"], []).append(
+                (entry["service_name"], entry["digest"]))
+        self.nodes = {bucket: _bucket_hash(digests)
+                      for bucket, digests in buckets.items()}
+
+        level = dict(self.nodes)
+        for depth in range(BUCKET_DIGITS - 1, -1, -1):
+            parents: Dict[str, Dict[str, str]] = {}
+            for prefix, digest in level.items():
+                parents.setdefault(prefix[:depth], {})[prefix] = digest
+            level = {prefix: _node_hash(children)
+                     for prefix, children in parents.items()}
+            self.nodes.update(level)
+        self.nodes.setdefault("", EMPTY)
+
+    def root(self) -> str | None:
+        return self.nodes[""]
+
+    def hashes(self, prefixes: List[str]) -> Dict[str, str]:
+        return {prefix: self.nodes[prefix]
+                for prefix in prefixes if prefix in self.nodes}
+
+    def digests(self, buckets: List[str]) -> Dict[str, List[str]]:
+        wanted = set(buckets)
+        found: Dict[str, List[str]] = {}
+        for entry in self.entries:
+            if entry["bucket"] in wanted:
+                found.setdefault(entry["service_name"], []).append(
+                    entry["digest"])
+        return found
+
+
+class StoredTree:
+    """DigestTree read from storage one level at a time
+
+    Attributes:
+        nodes_read (int): Node and digest documents read so far
+    """
+
+    def __init__(self, backend: StorageBackend, username: str) -> None:
+        self.backend = backend
+        self.username = username
+        self.nodes_read = 0
+
+    def root(self) -> str | None:
+        users = self.backend.find_entries("users", "names",
+                                          {"username": self.username})
+        return users[0].get(ROOT_FIELD) if users else None
+
+    def hashes(self, prefixes: List[str]) -> Dict[str, str]:
+        nodes = self.backend.find_entries(DATABASE, _nodes(self.username),
+                                          {"node": {"$in": prefixes}})
+        self.nodes_read += len(nodes)
+        return {node["node"]: node["hash"] for node in nodes}
+
+    def digests(self, buckets: List[str]) -> Dict[str, List[str]]:
+        entries = self.backend.find_entries(DATABASE,
+                                            _entries(self.username),
+                                            {"bucket": {"$in": buckets}})
+        self.nodes_read += len(entries)
+        found: Dict[str, List[str]] = {}
+        for entry in entries:
+            found.setdefault(entry["service_name"], []).append(
+                entry["digest"])
+        return found
+
+
+@dataclass
+class TreeDiff:
+    """Differences between two trees
+
+    Attributes:
+        left_root (str | None): Root of the first tree
+        right_root (str | None): Root of the second tree
+        changed (List[str]): Services whose entries differ
+        only_left (List[str]): Services only the first tree has
+        only_right (List[str]): Services only the second tree has
+        buckets (List[str]): Buckets whose hashes differ
+    """
+
+    left_root: str | None = None
+    right_root: str | None = None
+    changed: List[str] = field(default_factory=list)
+    only_left: List[str] = field(default_factory=list)
+    only_right: List[str] = field(default_factory=list)
+    buckets: List[str] = field(default_factory=list)
+
+    @property
+    def identical(self) -> bool:
+        """True if both trees have the same root
+        """
+
+        return self.left_root == self.right_root
+
+
+def diff_trees(left: DigestTree, right: DigestTree) -> TreeDiff:
+    """Finds the entries two trees disagree on
+
+    Args:
+        left (DigestTree): The first tree
+        right (DigestTree): The second tree
+
+    Returns:
+        TreeDiff: The differing services, found by descending only into
+            subtrees whose hashes differ
+    """
+
+    diff = TreeDiff(left.root(), right.root())
+    if diff.identical:
+        return diff
+
+    differing = [""]
+    for _ in range(BUCKET_DIGITS):
+        prefixes = _children(differing)
+        left_hashes = left.hashes(prefixes)
+        right_hashes = right.hashes(prefixes)
+        differing = [prefix for prefix in prefixes
+                     if left_hashes.get(prefix, EMPTY)
+                     != right_hashes.get(prefix, EMPTY)]
+        if not differing:
+            return diff
+
+    diff.buckets = differing
+    left_digests = left.digests(differing)
+    right_digests = right.digests(differing)
+    for service_name in sorted(set(left_digests) | set(right_digests)):
+        if service_name not in right_digests:
+            diff.only_left.append(service_name)
+        elif service_name not in left_digests:
+            diff.only_right.append(service_name)
+        elif (sorted(left_digests[service_name])
+              != sorted(right_digests[service_name])):
+            diff.changed.append(service_name)
+    return diff
+
+
+def ensure_indexes(backend: StorageBackend, username: str) -> None:
+    """Indexes a user's digests on node and bucket
+
+    Only MongoDB collections are indexed; the other backends filter in
+    process.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+    """
+
+    if isinstance(innermost(backend), MongoBackend):
+        utility.create_index(DATABASE, _nodes(username), [("node", 1)])
+        utility.create_index(DATABASE, _entries(username),
+                             [("bucket", 1), ("service_name", 1)])
+
+
+def build(backend: StorageBackend, username: str, fernet_key: Any) -> str:
+    """Rebuilds a user's tree from their vault
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        fernet_key (Any): The user's Fernet key
+
+    Returns:
+        str: The new root
+    """
+
+    tree = ComputedTree(fernet_key,
+                        backend.find_entries("passwords", username))
+    delete_all(backend, username)
+    ensure_indexes(backend, username)
+    nodes = [{"_id": prefix, "node": prefix, "hash": digest}
+             for prefix, digest in tree.nodes.items() if prefix]
+    if nodes:
+        backend.insert_entries(DATABASE, _nodes(username), nodes)
+        backend.insert_entries(DATABASE, _entries(username), tree.entries)
+
+    root = tree.nodes[""]
+    backend.update_entry("users", "names", {"username": username},
+                         {ROOT_FIELD: root})
+    return root
+
+
+def update(backend: StorageBackend, username: str, fernet_key: Any,
+           service_name: str) -> str | None:
+    """Rehashes a service's entries after they were added, changed or deleted
+
+    Only the service's bucket and the nodes above it are rewritten. Trees
+    built before nodes were keyed by their prefix are rebuilt once.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        fernet_key (Any): The user's Fernet key
+        service_name (str): Name of the website/service
+
+    Returns:
+        str | None: The new root, or None if the user has no tree
+    """
+
+    bucket = bucket_of(service_name)
+    path = [bucket[:depth] for depth in range(BUCKET_DIGITS, -1, -1)]
+    for _ in range(MAX_RETRIES):
+        users = backend.find_entries("users", "names",
+                                     {"username": username}, [ROOT_FIELD])
+        if not users or users[0].get(ROOT_FIELD) is None:
+            return None
+        previous = users[0][ROOT_FIELD]
+
+        entries = [{"bucket": bucket, "service_name": service_name,
+                    "digest": entry_digest(fernet_key, document)}
+                   for document in backend.find_entries(
+                       "passwords", username,
+                       {"service_name": service_name})]
+        stored = backend.find_entries(DATABASE, _entries(username),
+                                      {"bucket": bucket})
+        others = [(entry["service_name"], entry["digest"])
+                  for entry in stored
+                  if entry["service_name"] != service_name]
+        if len(others) < len(stored):
+            backend.delete_entries(DATABASE, _entries(username),
+                                   {"bucket": bucket,
+                                    "service_name": service_name})
+        if entries:
+            backend.insert_entries(DATABASE, _entries(username), entries)
+
+        siblings = backend.find_entries(
+            DATABASE, _nodes(username), {"node": {"$in": _children(path[1:])}})
+        if any(node["_id"] != node["node"] for node in siblings):
+            return build(backend, username, fernet_key)
+        hashes = {node["node"]: node["hash"] for node in siblings}
+        hashes[bucket] = _bucket_hash(
+            others + [(entry["service_name"], entry["digest"])
+                      for entry in entries])
+        for prefix in path[1:]:
+            hashes[prefix] = _node_hash(
+                {child: hashes[child] for child in _children([prefix])
+                 if child in hashes})
+        nodes = [{"_id": prefix, "node": prefix, "hash": hashes[prefix]}
+                 for prefix in path[:-1] if hashes[prefix] != EMPTY]
+        if nodes:
+            backend.upsert_entries(DATABASE, _nodes(username), nodes)
+        emptied = [prefix for prefix in path[:-1] if hashes[prefix] == EMPTY]
+        if emptied:
+            backend.delete_entries(DATABASE, _nodes(username),
+                                   {"node": {"$in": emptied}})
+
+        root: str = hashes[""]
+        if backend.update_entry("users", "names",
+                                {"username": username, ROOT_FIELD: previous},
+                                {ROOT_FIELD: root}):
+            return root
+    # Changed by other sessions on every attempt
+    return build(backend, username, fernet_key)
+
+
+def verify(backend: StorageBackend, username: str,
+           fernet_key: Any) -> TreeDiff:
+    """Checks a vault against its stored tree
+
+    A tree whose nodes disagree with its entry digests although those match
+    the vault, as an interrupted update leaves it, is rebuilt and checked
+    again.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        fernet_key (Any): The user's Fernet key
+
+    Raises:
+        ValueError: Raised if the user has no tree
+
+    Returns:
+        TreeDiff: Stored tree on the left, vault on the right: only_left
+            lists entries missing from the vault, only_right entries the
+            tree does not know and changed entries that were altered
+    """
+
+    stored = StoredTree(backend, username)
+    if stored.root() is None:
+        raise ValueError(f"{username} has no vault digest, run build first")
+    computed = ComputedTree(fernet_key,
+                            backend.find_entries("passwords", username))
+    diff = diff_trees(stored, computed)
+    if not (diff.identical or diff.changed or diff.only_left
+            or diff.only_right):
+        # The nodes lag behind digests that match the vault
+        build(backend, username, fernet_key)
+        diff = diff_trees(StoredTree(backend, username), computed)
+    return diff
+
+
+def delete_all(backend: StorageBackend, username: str) -> None:
+    """Deletes a user's tree
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+    """
+
+    backend.delete_collection(DATABASE, _nodes(username))
+    backend.delete_collection(DATABASE, _entries(username))
+
+
+def benchmark(entries: int = 100000,
+              changes: int = 5) -> Tuple[float, float, int]:
+    """Times comparing two stored copies of a vault that differ slightly
+
+    Args:
+        entries (int, optional): Entries in the vault. Defaults to 100000.
+        changes (int, optional): Entries changed in the second copy.
+            Defaults to 5.
+
+    Returns:
+        Tuple[float, float, int]: Seconds to build a tree, milliseconds to
+            compare the copies and documents read while comparing
+    """
+
+    fernet_key = b"0" * 44
+    documents = [{"service_name": f"service{number}",
+                  "username_entry": "user",
+                  "password_entry": f"secret{number}".encode()}
+                 for number in range(entries)]
+    copies = []
+    for _ in range(2):
+        backend = storage.MemoryBackend()
+        backend.insert_entry("users", "names", {"username": "bench"})
+        backend.insert_entries("passwords", "bench",
+                               [dict(document) for document in documents])
+        copies.append(backend)
+
+    started = time.perf_counter()
+    build(copies[0], "bench", fernet_key)
+    built = time.perf_counter() - started
+    for number in range(changes):
+        copies[1].update_entry(
+            "passwords", "bench", {"service_name": f"service{number}"},
+            {"password_entry": b"changed"})
+    build(copies[1], "bench", fernet_key)
+
+    left = StoredTree(copies[0], "bench")
+    right = StoredTree(copies[1], "bench")
+    started = time.perf_counter()
+    diff_trees(left, right)
+    compared = time.perf_counter() - started
+    return built, compared * 1000, left.nodes_read + right.nodes_read
+
+
+def _load_key(username: str) -> Any:
+    """Reads a user's key file, or unwraps their key from the keystore
+    """
+
+    # utility.vault imports this module, so it is imported on first use
+    from utility import vault
+
+    if os.path.exists(f"user_{username}_fernet.key"):
+        return vault.load_fernet_key_locally(username)
+    if vault.keystore is None or username not in vault.keystore:
+        raise ValueError(f"no key found for {username}")
+    fernet_key = vault.unlock_fernet_key(
+        username, getpass.getpass(f"Master password for {username}: "))
+    if fernet_key is None:
+        raise ValueError("wrong master password")
+    return fernet_key
+
+
+def _print_diff(diff: TreeDiff, left: str, right: str) -> None:
+    for service_name in diff.changed:
+        print(f"changed\t{service_name}")
+    for service_name in diff.only_left:
+        print(f"only in {left}\t{service_name}")
+    for service_name in diff.only_right:
+        print(f"only in {right}\t{service_name}")
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for vault digests
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status, 1 if a vault does not match
+    """
+
+    from utility import vault
+
+    parser = argparse.ArgumentParser(prog="python -m utility.merkle")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault")
+    parser.add_argument("--keystore",
+                        help="single file holding every user's key")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, text in (("build", "rebuild a user's tree from their vault"),
+                       ("verify", "check a vault against its tree")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("--user", required=True)
+    diff = commands.add_parser("diff",
+                               help="compare a user's tree in two backends")
+    diff.add_argument("--user", required=True)
+    diff.add_argument("--against-backend", required=True,
+                      choices=storage.BACKENDS)
+    diff.add_argument("--against-sqlite-path")
+    bench = commands.add_parser("bench", help="time comparing two copies")
+    bench.add_argument("--entries", type=int, default=100000)
+    bench.add_argument("--changes", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        built, compared, read = benchmark(args.entries, args.changes)
+        print(f"{args.entries} entries hashed in {built:.2f} s, copies "
+              f"differing in {args.changes} compared in {compared:.1f} ms "
+              f"reading {read} documents")
+        return 0
+
+    vault.configure_storage(args.backend, args.sqlite_path, args.storage_mode)
+    vault.configure_keystore(args.keystore)
+    try:
+        if args.command == "diff":
+            other = storage.get_backend(args.against_backend,
+                                        args.against_sqlite_path)
+            left = StoredTree(vault.storage, args.user)
+            right = StoredTree(other, args.user)
+            result = diff_trees(left, right)
+            _print_diff(result, "this copy", "the other copy")
+            print(f"{len(result.buckets)} buckets differ, "
+                  f"{left.nodes_read + right.nodes_read} documents read")
+        elif args.command == "build":
+            root = build(vault.storage, args.user, _load_key(args.user))
+            print(f"vault root {root}")
+            return 0
+        else:
+            result = verify(vault.storage, args.user, _load_key(args.user))
+            _print_diff(result, "the digest", "the vault")
+    except ValueError as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+    finally:
+        for warning in vault.close_storage():
+            print(warning, file=sys.stderr)
+
+    print("identical" if result.identical else "differs")
+    return 0 if result.identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
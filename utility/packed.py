@@ -0,0 +1,365 @@
+"""Module storing each vault as one packed, encrypted document
+
+In the default layout every credential is its own document in
+passwords.<user>, so listing a vault streams many small documents.
+PackedBackend instead keeps the whole vault in passwords.<user> as:
+
+    {_id: "vault", _packed: "header", version, chunks: [ids], data}
+    {_id: "chunk:<attempt>:<n>", _packed: "chunk", data}
+
+data is the vault's entries BSON encoded, zlib compressed and encrypted with
+the user's key (see utility.envelope). The header holds the first chunk, so
+a typical vault is read in one small document. Vaults whose blob grows
+towards the 16MB BSON document limit are split into extra chunk documents.
+
+Writes use optimistic concurrency. New chunks are written under ids unique
+to the write attempt, then the header is updated only if its version is
+still the one that was read. If another session won the race the attempt's
+own chunks are removed and the change is re-applied to the fresh vault.
+
+Entries still stored one per document are packed by the first write, so
+existing vaults migrate without a separate step.
+"""
+
+import zlib
+import bson
+from bson import ObjectId
+from cryptography.fernet import InvalidToken
+from pymongo.errors import DuplicateKeyError
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from utility.envelope import Cipher
+from utility.storage import (DEFAULT_BATCH_SIZE, ForwardingBackend,
+                             StorageBackend, matches, project)
+
+HEADER_ID = "vault"
+CHUNK_PREFIX = "chunk:"
+MAX_CHUNK_SIZE = 15 * 1024 * 1024
+MAX_RETRIES = 10
+PACKED_DATABASES = ("passwords",)
+STORAGE_MODE_ENV = "PM_STORAGE_MODE"
+STORAGE_MODES = ("documents", "packed")
+
+
+class PackedConflictError(Exception):
+    """Raised when a vault keeps changing underneath a write
+    """
+
+
+def is_packed_id(document_id: Any) -> bool:
+    """Tells whether an _id belongs to a packed header or chunk
+
+    Args:
+        document_id (Any): The _id of a passwords.<user> document
+
+    Returns:
+        bool: True for the header and chunk documents
+    """
+
+    return isinstance(document_id, str) and (
+        document_id == HEADER_ID or document_id.startswith(CHUNK_PREFIX))
+
+
+class PackedBackend(ForwardingBackend):
+    """StorageBackend packing every vault collection into chunk documents
+
+    Args:
+        inner (StorageBackend): Backend holding the packed documents
+        key_loader (Callable[[str], Any]): Returns a user's Fernet key
+        max_chunk_size (int, optional): Largest data field per document.
+            Defaults to 15MB, below the 16MB BSON limit.
+    """
+
+    def __init__(self, inner: StorageBackend,
+                 key_loader: Callable[[str], Any],
+                 max_chunk_size: int = MAX_CHUNK_SIZE) -> None:
+        super().__init__(inner)
+        self.key_loader = key_loader
+        self.max_chunk_size = max_chunk_size
+
+    def _load(self, collection_name: str
+              ) -> Tuple[Dict[str, Any] | None, List[Dict[str, Any]],
+                         List[Any]]:
+        """Reads and decrypts a packed vault
+
+        A write finishing while the documents are read can remove chunks
+        the header read still lists, so the vault is read again until a
+        consistent copy is seen.
+
+        Args:
+            collection_name (str): User's name
+
+        Raises:
+            PackedConflictError: Raised if every retry saw a vault
+                changing underneath the read
+            InvalidToken: Raised if the vault does not decrypt with the
+                user's key
+
+        Returns:
+            Tuple: The header (None if not packed yet), the entries and the
+                _ids of entries still stored one per document
+        """
+
+        for _ in range(MAX_RETRIES):
+            documents = self.inner.find_entries("passwords", collection_name)
+            header = None
+            chunks: Dict[Any, bytes] = {}
+            entries = []
+            legacy_ids = []
+
+            for document in documents:
+                kind = document.get("_packed")
+                if kind == "header":
+                    header = document
+                elif kind == "chunk":
+                    chunks[document["_id"]] = document["data"]
+                else:
+                    entries.append(document)
+                    legacy_ids.append(document["_id"])
+
+            if header is None:
+                return header, entries, legacy_ids
+            if any(chunk_id not in chunks for chunk_id in header["chunks"]):
+                continue
+
+            blob = b"".join([header["data"]] + [chunks[chunk_id]
+                                                for chunk_id in
+                                                header["chunks"]])
+            cipher = Cipher(self.key_loader(collection_name))
+            try:
+                packed = bson.decode(zlib.decompress(cipher.decrypt(blob)))
+            except (InvalidToken, zlib.error):
+                if self._version(collection_name) == header["version"]:
+                    raise
+                continue
+            return header, packed["entries"] + entries, legacy_ids
+
+        raise PackedConflictError(
+            f"vault {collection_name} changed during {MAX_RETRIES} reads")
+
+    def _version(self, collection_name: str) -> int | None:
+        """Reads the version of a vault's header
+
+        Args:
+            collection_name (str): User's name
+
+        Returns:
+            int | None: The version, None if the vault is not packed
+        """
+
+        headers = self.inner.find_entries("passwords", collection_name,
+                                          {"_id": HEADER_ID}, ["version"])
+        return headers[0]["version"] if headers else None
+
+    def _save(self, collection_name: str, header: Dict[str, Any] | None,
+              entries: List[Dict[str, Any]], legacy_ids: List[Any]) -> bool:
+        """Writes a vault if nobody else changed it since it was read
+
+        Args:
+            collection_name (str): User's name
+            header (Dict[str, Any] | None): Header as read by _load
+            entries (List[Dict[str, Any]]): The new entries
+            legacy_ids (List[Any]): Per document entries to remove
+
+        Returns:
+            bool: False if the vault changed since it was read
+        """
+
+        cipher = Cipher(self.key_loader(collection_name))
+        blob = cipher.encrypt(zlib.compress(bson.encode(
+            {"entries": entries})))
+        pieces = [blob[offset:offset + self.max_chunk_size]
+                  for offset in range(0, len(blob), self.max_chunk_size)]
+
+        version = (header["version"] if header else 0) + 1
+        # Racing writers of the same version must not share chunk ids
+        attempt = ObjectId()
+        chunk_ids = [f"{CHUNK_PREFIX}{attempt}:{number}"
+                     for number in range(1, len(pieces))]
+        if chunk_ids:
+            self.inner.insert_entries("passwords", collection_name, [
+                {"_id": chunk_id, "_packed": "chunk", "data": piece}
+                for chunk_id, piece in zip(chunk_ids, pieces[1:])])
+
+        new_header = {"_packed": "header", "version": version,
+                      "chunks": chunk_ids, "data": pieces[0]}
+        if header is None:
+            new_header["_id"] = HEADER_ID
+            try:
+                self.inner.insert_entry("passwords", collection_name,
+                                        new_header)
+                saved = True
+            except DuplicateKeyError:
+                # Another session created the header first
+                saved = False
+        else:
+            saved = self.inner.update_entry(
+                "passwords", collection_name,
+                {"_id": HEADER_ID, "version": header["version"]},
+                new_header)
+
+        stale = legacy_ids + (header["chunks"] if header else [])
+        if not saved:
+            stale = chunk_ids
+        if stale:
+            self.inner.delete_entries("passwords", collection_name,
+                                      {"_id": {"$in": stale}})
+        return saved
+
+    def _modify(self, collection_name: str,
+                change: Callable[[List[Dict[str, Any]]], bool]) -> bool:
+        """Applies a change to a vault, retrying on concurrent writes
+
+        Args:
+            collection_name (str): User's name
+            change (Callable[[List[Dict[str, Any]]], bool]): Edits the
+                entry list in place and returns False if nothing changed
+
+        Raises:
+            PackedConflictError: Raised if every retry lost the race
+
+        Returns:
+            bool: True if the vault was changed
+        """
+
+        for _ in range(MAX_RETRIES):
+            header, entries, legacy_ids = self._load(collection_name)
+            if not change(entries):
+                return False
+            if self._save(collection_name, header, entries, legacy_ids):
+                return True
+        raise PackedConflictError(
+            f"vault {collection_name} changed during {MAX_RETRIES} retries")
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self.insert_entries(database_name, collection_name, [entry])
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        if database_name not in PACKED_DATABASES:
+            self.inner.insert_entries(database_name, collection_name,
+                                      entries)
+            return
+
+        for entry in entries:
+            entry.setdefault("_id", ObjectId())
+
+        def change(vault: List[Dict[str, Any]]) -> bool:
+            vault.extend(entries)
+            return True
+
+        self._modify(collection_name, change)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        if database_name not in PACKED_DATABASES:
+            return self.inner.find_entries(database_name, collection_name,
+                                           entries, projection)
+
+        _, vault, _ = self._load(collection_name)
+        return [project(entry, projection) for entry in vault
+                if matches(entry, entries)]
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        if database_name not in PACKED_DATABASES:
+            return self.inner.iter_entries(database_name, collection_name,
+                                           entries, batch_size)
+
+        found = self.find_entries(database_name, collection_name, entries)
+        return iter([found[offset:offset + batch_size]
+                     for offset in range(0, len(found), batch_size)])
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        if database_name not in PACKED_DATABASES:
+            return self.inner.count_entries(database_name, collection_name,
+                                            entries, limit)
+
+        count = len(self.find_entries(database_name, collection_name,
+                                      entries))
+        return min(count, limit) if limit > 0 else count
+
+    def _update(self, collection_name: str, old_data: Dict[str, Any],
+                new_data: Dict[str, Any], many: bool) -> bool:
+        def change(vault: List[Dict[str, Any]]) -> bool:
+            matched = False
+            for entry in vault:
+                if matches(entry, old_data):
+                    entry.update(new_data)
+                    matched = True
+                    if not many:
+                        break
+            return matched
+
+        return self._modify(collection_name, change)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        if database_name not in PACKED_DATABASES:
+            return self.inner.update_entry(database_name, collection_name,
+                                           old_data, new_data)
+        return self._update(collection_name, old_data, new_data, False)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        if database_name not in PACKED_DATABASES:
+            self.inner.update_entries(database_name, collection_name,
+                                      old_data, new_data)
+            return
+        self._update(collection_name, old_data, new_data, True)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        if database_name not in PACKED_DATABASES:
+            self.inner.upsert_entries(database_name, collection_name,
+                                      entries)
+            return
+
+        def change(vault: List[Dict[str, Any]]) -> bool:
+            positions = {entry["_id"]: index
+                         for index, entry in enumerate(vault)}
+            for entry in entries:
+                if entry["_id"] in positions:
+                    vault[positions[entry["_id"]]] = entry
+                else:
+                    positions[entry["_id"]] = len(vault)
+                    vault.append(entry)
+            return True
+
+        self._modify(collection_name, change)
+
+    def _delete(self, collection_name: str, old_data: Dict[str, Any],
+                many: bool) -> None:
+        def change(vault: List[Dict[str, Any]]) -> bool:
+            matched = False
+            for entry in list(vault):
+                if matches(entry, old_data):
+                    vault.remove(entry)
+                    matched = True
+                    if not many:
+                        break
+            return matched
+
+        self._modify(collection_name, change)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        if database_name not in PACKED_DATABASES:
+            self.inner.delete_entry(database_name, collection_name, old_data)
+            return
+        self._delete(collection_name, old_data, False)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        if database_name not in PACKED_DATABASES:
+            self.inner.delete_entries(database_name, collection_name,
+                                      old_data)
+            return
+        self._delete(collection_name, old_data, True)
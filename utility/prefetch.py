@@ -0,0 +1,332 @@
+"""Module overlapping database round trips with user input
+
+Logging in used to be a chain of waits: the user types their name and
+password, then the program connects, reads their record and, only when
+"Retrieve Password Entries" is chosen, reads and decrypts the vault.
+
+PrefetchBackend starts those reads early on a small thread pool:
+
+* warm_up() opens the connection (TLS handshake and server selection) while
+  the welcome menu is shown.
+* prefetch() reads a user's record while their password is being typed.
+* prefetch_vault() reads and decrypts the vault right after login.
+
+A prefetched result is handed out once, to the first matching read, and is
+dropped if the collection is written to or it is older than max_age. Changes
+other sessions make to a prefetched vault are applied to it by
+apply_change() instead.
+
+Set PM_TIMING=1 to print how long each step of the critical path took.
+"""
+
+import os
+import sys
+import threading
+import time
+from bson import json_util
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+from utility.entries import (VaultEntry, decrypt_entries, load_vault_entries,
+                             wipe_entries)
+from utility.storage import ForwardingBackend, StorageBackend
+
+TIMING_ENV = "PM_TIMING"
+DEFAULT_MAX_AGE = 60.0
+WORKERS = 4
+
+_Key = Tuple[str, str, str]
+# The _id of a changed document and its new decrypted entry, None if deleted
+_Change = Tuple[Any, VaultEntry | None]
+
+
+@contextmanager
+def timed(label: str) -> Iterator[None]:
+    """Prints how long a block took when $PM_TIMING is set
+
+    Args:
+        label (str): Name of the step
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if os.environ.get(TIMING_ENV):
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"[timing] {label}: {elapsed:.1f} ms", file=sys.stderr)
+
+
+def _wipe_result(future: "Future[List[VaultEntry]]") -> None:
+    """Wipes a discarded vault once its prefetch has finished
+    """
+
+    if future.exception() is None:
+        wipe_entries(future.result())
+
+
+def _wipe_changes(changes: List[_Change]) -> None:
+    """Wipes the entries of changes that will not be applied
+    """
+
+    wipe_entries(entry for _, entry in changes if entry is not None)
+
+
+def _apply_changes(vault: List[VaultEntry], changes: List[_Change]) -> None:
+    """Replaces or removes the changed entries of a vault, in order
+
+    A change the vault was read after leaves it as it was.
+    """
+
+    for entry_id, changed in changes:
+        kept = []
+        for entry in vault:
+            if entry.entry_id == entry_id:
+                entry.wipe()
+            else:
+                kept.append(entry)
+        if changed is not None:
+            kept.append(changed)
+        vault[:] = kept
+
+
+class PrefetchBackend(ForwardingBackend):
+    """StorageBackend that can start reads before they are needed
+
+    Args:
+        inner (StorageBackend): Backend to read from
+        max_age (float, optional): Seconds a prefetched result stays
+            usable. Defaults to 60.
+    """
+
+    def __init__(self, inner: StorageBackend,
+                 max_age: float = DEFAULT_MAX_AGE) -> None:
+        super().__init__(inner)
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(max_workers=WORKERS)
+        self._lock = threading.Lock()
+        self._reads: Dict[_Key, Tuple[float, "Future[Any]"]] = {}
+        self._vaults: Dict[str, Tuple[float,
+                                      "Future[List[VaultEntry]]"]] = {}
+        self._changes: Dict[str, List[_Change]] = {}
+
+    @staticmethod
+    def _key(database_name: str, collection_name: str,
+             query: Dict[str, Any] | None) -> _Key:
+        return (database_name, collection_name, json_util.dumps(query))
+
+    def warm_up(self) -> "Future[Any]":
+        """Opens the connection in the background with a cheap read
+
+        Returns:
+            Future[Any]: Completes once the backend has answered
+        """
+
+        def connect() -> Any:
+            with timed("connect (background)"):
+                return self.inner.list_collection_names("users")
+
+        return self._executor.submit(connect)
+
+    def prefetch(self, database_name: str, collection_name: str,
+                 query: Dict[str, Any] | None = None) -> None:
+        """Starts a find_entries call whose result the next match receives
+
+        Args:
+            database_name (str): Name of the database
+            collection_name (str): Name of the collection
+            query (Dict[str, Any] | None, optional): The filter the later
+                read will use. Defaults to None.
+        """
+
+        future = self._executor.submit(self.inner.find_entries,
+                                       database_name, collection_name,
+                                       query)
+        with self._lock:
+            self._reads[self._key(database_name, collection_name,
+                                  query)] = (time.monotonic(), future)
+
+    def prefetch_vault(self, username: str, fernet_key: Any) -> None:
+        """Starts reading and decrypting a user's vault
+
+        Args:
+            username (str): User's name
+            fernet_key (Any): The user's Fernet key
+        """
+
+        def load() -> List[VaultEntry]:
+            with timed("load vault (background)"):
+                vault = load_vault_entries(self.inner, username)
+                decrypt_entries(fernet_key, vault)
+            return vault
+
+        future = self._executor.submit(load)
+        with self._lock:
+            self._discard_vault(username)
+            self._vaults[username] = (time.monotonic(), future)
+
+    def take_vault(self, username: str) -> List[VaultEntry] | None:
+        """Returns the prefetched decrypted vault, at most once
+
+        Args:
+            username (str): User's name
+
+        Returns:
+            List[VaultEntry] | None: The decrypted entries, or None if none
+                were prefetched or they are out of date
+        """
+
+        with self._lock:
+            started, future = self._vaults.pop(username, (0.0, None))
+            changes = self._changes.pop(username, [])
+        if future is None:
+            return None
+        try:
+            vault = future.result()
+        except Exception:
+            # The caller reads the vault again and sees the error itself
+            _wipe_changes(changes)
+            return None
+        if time.monotonic() - started > self.max_age:
+            wipe_entries(vault)
+            _wipe_changes(changes)
+            return None
+        _apply_changes(vault, changes)
+        return vault
+
+    def apply_change(self, username: str, change: Dict[str, Any],
+                     fernet_key: Any) -> None:
+        """Applies a change another session made to a prefetched vault
+
+        The change is kept until take_vault() hands the vault out, so it
+        also reaches a vault that is still being read.
+
+        Args:
+            username (str): User's name
+            change (Dict[str, Any]): Change from utility.watcher
+            fernet_key (Any): The user's Fernet key
+        """
+
+        with self._lock:
+            for key in [key for key in self._reads
+                        if key[:2] == ("passwords", username)]:
+                del self._reads[key]
+            if username not in self._vaults:
+                return
+
+        entry = None
+        document = change.get("document")
+        if change["operation"] != "delete" and document is not None:
+            entry = VaultEntry.from_document(document)
+            decrypt_entries(fernet_key, [entry])
+        with self._lock:
+            if username in self._vaults:
+                self._changes.setdefault(username, []).append(
+                    (change["document_key"], entry))
+                return
+        if entry is not None:
+            entry.wipe()
+
+    def forget(self, username: str) -> None:
+        """Drops every prefetched read and wipes the user's vault
+
+        Args:
+            username (str): User's name
+        """
+
+        with self._lock:
+            self._discard_vault(username)
+            self._reads.clear()
+
+    def _discard_vault(self, username: str) -> None:
+        """Drops a user's prefetched vault, wiping it once it is read
+
+        Must be called with the lock held.
+        """
+
+        _, future = self._vaults.pop(username, (0.0, None))
+        if future is not None:
+            future.add_done_callback(_wipe_result)
+        _wipe_changes(self._changes.pop(username, []))
+
+    def invalidate(self, database_name: str, collection_name: str) -> None:
+        """Drops prefetched results a write has made stale
+
+        Writes through this backend call it themselves; call it for writes
+        made by other sessions.
+
+        Args:
+            database_name (str): Name of the database
+            collection_name (str): Name of the collection
+        """
+
+        with self._lock:
+            for key in [key for key in self._reads
+                        if key[:2] == (database_name, collection_name)]:
+                del self._reads[key]
+            if database_name == "passwords":
+                self._discard_vault(collection_name)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        if projection is not None:
+            # Prefetched reads hold whole documents
+            return self.inner.find_entries(database_name, collection_name,
+                                           entries, projection)
+        with self._lock:
+            started, future = self._reads.pop(
+                self._key(database_name, collection_name, entries),
+                (0.0, None))
+        if future is not None and time.monotonic() - started <= self.max_age:
+            try:
+                return future.result()
+            except Exception:
+                pass
+        return self.inner.find_entries(database_name, collection_name,
+                                       entries)
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self.inner.insert_entry(database_name, collection_name, entry)
+        self.invalidate(database_name, collection_name)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.insert_entries(database_name, collection_name, entries)
+        self.invalidate(database_name, collection_name)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        matched = self.inner.update_entry(database_name, collection_name,
+                                          old_data, new_data)
+        self.invalidate(database_name, collection_name)
+        return matched
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self.inner.update_entries(database_name, collection_name,
+                                  old_data, new_data)
+        self.invalidate(database_name, collection_name)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.upsert_entries(database_name, collection_name, entries)
+        self.invalidate(database_name, collection_name)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entry(database_name, collection_name, old_data)
+        self.invalidate(database_name, collection_name)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entries(database_name, collection_name, old_data)
+        self.invalidate(database_name, collection_name)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        self.inner.delete_collection(database_name, collection_name)
+        self.invalidate(database_name, collection_name)
@@ -0,0 +1,176 @@
+"""Module capturing a profile of every menu action on request
+
+Run the Password Manager with --profile DIR (or PM_PROFILE=DIR) and every
+menu action is run under cProfile. Each action's stats are written to
+DIR/<time>-<pid>-<action>-n<vault size>.prof, so a slow session can be
+captured where it happens and inspected later with pstats or snakeviz. When
+profiling is off, profiled() only checks one module variable.
+
+cProfile sees only the thread it runs on. Background work such as the
+prefetch and write-behind threads shows up as the time spent waiting for
+it. Actions that wait for input, like the "Press enter" prompt after
+retrieving entries, include that wait in builtins.input.
+
+Usage:
+    python -m utility.profiling summarize DIR [--action A] [--top N]
+"""
+
+import argparse
+import cProfile
+import glob
+import io
+import os
+import pstats
+import re
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+from utility.storage import StorageBackend
+
+PROFILE_ENV = "PM_PROFILE"
+CAPTURE_PATTERN = re.compile(
+    r"^\d+-\d+-(?P<action>[\w-]+)-n(?P<size>\d+)\.prof$")
+
+_directory: str | None = None
+
+
+def configure(directory: str | None = None) -> None:
+    """Turns profiling on or off
+
+    Args:
+        directory (str | None, optional): Where captures are written.
+            Defaults to $PM_PROFILE, then profiling is off.
+    """
+
+    global _directory
+
+    _directory = directory or os.environ.get(PROFILE_ENV) or None
+    if _directory:
+        os.makedirs(_directory, exist_ok=True)
+
+
+def _vault_size(backend: StorageBackend | None, username: str | None) -> int:
+    """Counts a user's entries, outside the profiled region
+    """
+
+    if backend is None or not username:
+        return 0
+    try:
+        return backend.count_entries("passwords", username)
+    except Exception:
+        # The action may have deleted the user or lost the connection
+        return 0
+
+
+@contextmanager
+def profiled(action: str, backend: StorageBackend | None = None,
+             username: str | None = None) -> Iterator[None]:
+    """Profiles a block and writes its stats when profiling is on
+
+    Args:
+        action (str): Name of the menu action, used in the file name
+        backend (StorageBackend | None, optional): Backend to count the
+            vault in. Defaults to None, recording a size of 0.
+        username (str | None, optional): Owner of the vault.
+            Defaults to None.
+    """
+
+    directory = _directory
+    if directory is None:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        size = _vault_size(backend, username)
+        name = re.sub(r"[^\w-]", "_", action)
+        profile.dump_stats(os.path.join(
+            directory, f"{time.time_ns()}-{os.getpid()}-{name}-n{size}.prof"))
+
+
+def list_captures(directory: str) -> Dict[str, List[Tuple[str, int]]]:
+    """Groups the capture files in a directory by action
+
+    Args:
+        directory (str): Directory written by profiled()
+
+    Returns:
+        Dict[str, List[Tuple[str, int]]]: Path and vault size of every
+            capture of each action
+    """
+
+    captures: Dict[str, List[Tuple[str, int]]] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.prof"))):
+        match = CAPTURE_PATTERN.match(os.path.basename(path))
+        if match:
+            captures.setdefault(match.group("action"), []).append(
+                (path, int(match.group("size"))))
+    return captures
+
+
+def summarize(directory: str, action: str | None = None, top: int = 15,
+              sort: str = "tottime") -> str:
+    """Aggregates the hottest functions across captures
+
+    Args:
+        directory (str): Directory written by profiled()
+        action (str | None, optional): Only this action. Defaults to None,
+            every action.
+        top (int, optional): Functions listed per action. Defaults to 15.
+        sort (str, optional): pstats sort key. Defaults to "tottime".
+
+    Returns:
+        str: The report
+    """
+
+    report = io.StringIO()
+    for name, captures in list_captures(directory).items():
+        if action is not None and name != action:
+            continue
+        sizes = [size for _, size in captures]
+        stats = pstats.Stats(*[path for path, _ in captures], stream=report)
+        total = getattr(stats, "total_tt", 0.0)
+        report.write(f"== {name}: {len(captures)} captures, "
+                     f"{total:.3f} s total, "
+                     f"vault size {min(sizes)}-{max(sizes)}\n")
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return report.getvalue()
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for summarizing captures
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.profiling")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary = commands.add_parser("summarize",
+                                  help="aggregate hot functions")
+    summary.add_argument("directory")
+    summary.add_argument("--action")
+    summary.add_argument("--top", type=int, default=15)
+    summary.add_argument("--sort", default="tottime",
+                         help="pstats sort key such as tottime or "
+                         "cumulative")
+    args = parser.parse_args(argv)
+
+    report = summarize(args.directory, args.action, args.top, args.sort)
+    if not report:
+        print(f"No captures in {args.directory}", file=sys.stderr)
+        return 1
+    print(report, end="")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
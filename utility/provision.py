@@ -0,0 +1,368 @@
+"""Module creating and deleting users in bulk from a manifest
+
+create_user() serves one person at the menu: it checks the name, inserts
+one record, writes one key file and clears the screen. Onboarding a cohort
+that way costs several round trips and a file sync per user. provision()
+does the same work in bulk:
+
+* existing users are found with one $in query per chunk of names,
+* master passwords are checked, keys generated and records encrypted in a
+  thread pool,
+* key files are written in one pass, or every key is added to the keystore
+  with one lock and one append,
+* user records are inserted with one insert_many per chunk,
+* vault collections are created with their indexes ahead of first use.
+
+Keys are written before user records, so an interrupted run leaves at worst
+orphaned keys, which utility.consistency reports. deprovision() reverses it
+with $in deletes and one drop per collection.
+
+A manifest has one user per line, optionally followed by a master password:
+
+    alice
+    bob,correct-Horse-battery-st4ple!
+
+Users without a password get a generated one, written to --passwords-out.
+
+Usage:
+    python -m utility.provision create MANIFEST [--passwords-out FILE]
+    python -m utility.provision delete MANIFEST
+"""
+
+import argparse
+import csv
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Tuple
+from utility import audit
+from utility import keystore as keystores
+from utility import merkle
+from utility import packed
+from utility import storage
+from utility import strength
+from utility import urlmatch
+from utility import vault
+from utility.consistency import key_path
+from utility.storage import MongoBackend, StorageBackend, innermost
+
+CHUNK_SIZE = 1000
+PASSWORD_BYTES = 18
+
+
+class ManifestError(ValueError):
+    """Raised when a manifest line is malformed or a name repeats
+    """
+
+
+@dataclass
+class ProvisionReport:
+    """Outcome of a bulk run
+
+    Attributes:
+        done (List[str]): Users created or deleted
+        skipped (List[str]): Users that already existed, or did not exist
+        rejected (Dict[str, str]): Users not created and why
+        passwords (Dict[str, str]): Generated master passwords
+        seconds (float): Time taken
+    """
+
+    done: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    rejected: Dict[str, str] = field(default_factory=dict)
+    passwords: Dict[str, str] = field(default_factory=dict)
+    seconds: float = 0.0
+
+
+def read_manifest(lines: Iterable[str]) -> List[Tuple[str, str | None]]:
+    """Parses manifest lines
+
+    Blank lines and lines starting with # are skipped.
+
+    Args:
+        lines (Iterable[str]): "username[,master password]" lines
+
+    Raises:
+        ManifestError: Raised for an empty or repeated name
+
+    Returns:
+        List[Tuple[str, str | None]]: Names and master passwords, None
+            where one should be generated
+    """
+
+    users: List[Tuple[str, str | None]] = []
+    seen = set()
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row or not row[0].strip() or row[0].startswith("#"):
+            continue
+        username = row[0].strip()
+        if username in seen:
+            raise ManifestError(f"line {number}: {username} listed twice")
+        if "/" in username or "\0" in username:
+            raise ManifestError(f"line {number}: invalid name {username}")
+        seen.add(username)
+        password = ",".join(row[1:]) if len(row) > 1 else ""
+        users.append((username, password or None))
+    return users
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def existing_users(backend: StorageBackend, usernames: List[str],
+                   chunk_size: int = CHUNK_SIZE) -> List[str]:
+    """Finds which of the names already have a user record
+
+    Args:
+        backend (StorageBackend): Where users are stored
+        usernames (List[str]): Names to look up
+        chunk_size (int, optional): Names per query. Defaults to 1000.
+
+    Returns:
+        List[str]: The names that exist
+    """
+
+    found = set()
+    for chunk in _chunks(usernames, chunk_size):
+        for record in backend.find_entries(
+                "users", "names", {"username": {"$in": chunk}}):
+            found.add(record["username"])
+    return [username for username in usernames if username in found]
+
+
+def _prepare(user: Tuple[str, str | None]
+             ) -> Tuple[str, str, bytes, Dict[str, Any]] | Tuple[str, str]:
+    """Checks a user's master password and builds their key and record
+
+    Returns:
+        Tuple[str, str, bytes, Dict[str, Any]] | Tuple[str, str]: Name,
+            master password, Fernet key and users.names record, or name
+            and why the user was rejected
+    """
+
+    username, password = user
+    if password is None:
+        password = secrets.token_urlsafe(PASSWORD_BYTES)
+    else:
+        result = vault.check_master_password(password, username)
+        if result.score < strength.MIN_SCORE:
+            return username, (f"master password scores {result.score}/4, "
+                              f"at least {strength.MIN_SCORE}/4 required")
+
+    fernet_key = vault.generate_user_fernet_key()
+    return (username, password, fernet_key,
+            {"username": username,
+             "master_password": vault.encrypt_password(fernet_key, password),
+             merkle.ROOT_FIELD: merkle.EMPTY})
+
+
+def _create_vault(backend: StorageBackend, username: str) -> None:
+    """Creates a user's vault collection and its indexes
+    """
+
+    if isinstance(innermost(backend), MongoBackend):
+        # Creating the first index creates the collection
+        audit.ensure_age_index(backend, username)
+        urlmatch.ensure_url_index(backend, username)
+        merkle.ensure_indexes(backend, username)
+    elif username not in backend.list_collection_names("passwords"):
+        backend.create_collection("passwords", username)
+
+
+def provision(backend: StorageBackend, users: List[Tuple[str, str | None]],
+              keystore: keystores.Keystore | None = None,
+              key_dir: str = ".", workers: int | None = None,
+              chunk_size: int = CHUNK_SIZE) -> ProvisionReport:
+    """Creates users in bulk
+
+    Args:
+        backend (StorageBackend): Where users are stored
+        users (List[Tuple[str, str | None]]): Names and master passwords,
+            None to generate one
+        keystore (keystores.Keystore | None, optional): Keystore for the
+            keys. Defaults to one key file per user in key_dir.
+        key_dir (str, optional): Directory of the key files.
+            Defaults to the working directory.
+        workers (int | None, optional): Threads preparing users and
+            creating vaults. Defaults to the number of CPUs.
+        chunk_size (int, optional): Users per query and insert.
+            Defaults to 1000.
+
+    Returns:
+        ProvisionReport: Users created, skipped and rejected, and the
+            generated master passwords
+    """
+
+    started = time.perf_counter()
+    report = ProvisionReport()
+    report.skipped = existing_users(backend,
+                                    [username for username, _ in users],
+                                    chunk_size)
+    skipped = set(report.skipped)
+    pending = [user for user in users if user[0] not in skipped]
+    given = {username for username, password in pending if password}
+
+    with ThreadPoolExecutor(workers) as pool:
+        prepared = []
+        for outcome in pool.map(_prepare, pending):
+            if len(outcome) == 2:
+                report.rejected[outcome[0]] = outcome[1]
+            else:
+                prepared.append(outcome)
+
+        if keystore is not None:
+            keystore.put_many([(username, fernet_key, password)
+                               for username, password, fernet_key, _
+                               in prepared], workers)
+        else:
+            for username, _, fernet_key, _ in prepared:
+                with open(key_path(key_dir, username), "wb") as key_file:
+                    key_file.write(fernet_key)
+
+        for chunk in _chunks(prepared, chunk_size):
+            backend.insert_entries("users", "names",
+                                   [record for _, _, _, record in chunk])
+
+        usernames = [username for username, _, _, _ in prepared]
+        list(pool.map(lambda username: _create_vault(backend, username),
+                      usernames))
+
+    report.done = usernames
+    report.passwords = {username: password
+                        for username, password, _, _ in prepared
+                        if username not in given}
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def deprovision(backend: StorageBackend, usernames: List[str],
+                keystore: keystores.Keystore | None = None,
+                key_dir: str = ".", workers: int | None = None,
+                chunk_size: int = CHUNK_SIZE) -> ProvisionReport:
+    """Deletes users, their data and their keys in bulk
+
+    Args:
+        backend (StorageBackend): Where users are stored
+        usernames (List[str]): Users to delete
+        keystore (keystores.Keystore | None, optional): Keystore holding
+            the keys. Key files in key_dir are removed either way.
+        key_dir (str, optional): Directory of the key files.
+            Defaults to the working directory.
+        workers (int | None, optional): Threads dropping collections.
+            Defaults to the number of CPUs.
+        chunk_size (int, optional): Users per delete. Defaults to 1000.
+
+    Returns:
+        ProvisionReport: Users deleted and users that did not exist
+    """
+
+    started = time.perf_counter()
+    report = ProvisionReport()
+    report.done = existing_users(backend, usernames, chunk_size)
+    found = set(report.done)
+    report.skipped = [username for username in usernames
+                      if username not in found]
+
+    # Records first, so a user is never found without their vault
+    for chunk in _chunks(report.done, chunk_size):
+        backend.delete_entries("users", "names",
+                               {"username": {"$in": chunk}})
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(
+            lambda username: vault.delete_user_data(backend, username),
+            report.done))
+
+    if keystore is not None:
+        keystore.delete_many(report.done)
+    for username in report.done:
+        path = key_path(key_dir, username)
+        if os.path.exists(path):
+            os.remove(path)
+        vault.forget_fernet_key(username)
+
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for bulk provisioning
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.provision")
+    parser.add_argument("--backend", choices=storage.BACKENDS,
+                        help="storage backend (default: $PM_BACKEND "
+                        "or mongo)")
+    parser.add_argument("--sqlite-path",
+                        help="database file for the sqlite backend")
+    parser.add_argument("--storage-mode", choices=packed.STORAGE_MODES,
+                        help="one document per entry or one packed "
+                        "document per vault")
+    parser.add_argument("--keystore",
+                        help="single file holding every user's key "
+                        "(default: $PM_KEYSTORE or one key file per user)")
+    parser.add_argument("--key-dir", default=".",
+                        help="directory of the key files")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="create the listed users")
+    create.add_argument("manifest")
+    create.add_argument("--passwords-out", default="provisioned.csv",
+                        help="file receiving generated master passwords")
+    delete = commands.add_parser("delete", help="delete the listed users")
+    delete.add_argument("manifest")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.manifest, newline="", encoding="utf-8") as manifest:
+            users = read_manifest(manifest)
+    except (ManifestError, OSError) as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+
+    vault.configure_storage(args.backend, args.sqlite_path, args.storage_mode)
+    vault.configure_keystore(args.keystore)
+    try:
+        if args.command == "create":
+            report = provision(vault.storage, users, vault.keystore,
+                               args.key_dir, args.workers, args.chunk_size)
+            if report.passwords:
+                descriptor = os.open(args.passwords_out,
+                                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                     0o600)
+                with open(descriptor, "w", newline="",
+                          encoding="utf-8") as output:
+                    csv.writer(output).writerows(report.passwords.items())
+                print(f"Generated master passwords written to "
+                      f"{args.passwords_out}")
+            verb = "Created"
+        else:
+            report = deprovision(vault.storage,
+                                 [username for username, _ in users],
+                                 vault.keystore, args.key_dir, args.workers,
+                                 args.chunk_size)
+            verb = "Deleted"
+    finally:
+        for warning in vault.close_storage():
+            print(warning, file=sys.stderr)
+
+    for username, reason in report.rejected.items():
+        print(f"Rejected {username}: {reason}", file=sys.stderr)
+    print(f"{verb} {len(report.done)} users in {report.seconds:.1f} s, "
+          f"skipped {len(report.skipped)}, rejected {len(report.rejected)}")
+    return 0 if not report.rejected else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
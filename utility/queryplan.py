@@ -0,0 +1,364 @@
+"""Module checking the query plans of storage calls for collection scans
+
+Backends accept any filter, so a new query path can quietly scan a whole
+collection: a vault lookup on a field without an index reads every entry of
+the vault to return one. Run the Password Manager with --explain warn (or
+PM_EXPLAIN=warn) and ExplainingBackend, wrapped directly around the MongoDB
+backend, asks the server to explain each filter before running it:
+
+* the first time each filter shape is seen, and afterwards for a sample of
+  calls. The shape is the filter with its values replaced by their type
+  names, so "find service_name in passwords" is explained once, not once
+  per user and service. A shape whose plan scanned a collection is
+  explained once per collection, since each user's vault has its own size
+  and indexes,
+* the winning plan's stages, the indexes it uses and the documents
+  examined, keys examined and documents returned are kept in records,
+* a plan containing COLLSCAN over a collection of at least min_docs
+  documents emits a CollectionScanWarning, or raises CollectionScanError
+  with --explain fail so tests stop at the query.
+
+Filters that match everything are skipped: reading a whole collection
+scans it by design. Update and delete filters are explained as finds, which
+select their plans the same way. Only MongoDB explains queries; other
+backends are left unwrapped.
+
+With pytest, -W error::utility.queryplan.CollectionScanWarning turns the
+warnings into failures without changing the mode.
+"""
+
+import json
+import random
+import threading
+import warnings
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Protocol, Set, Tuple
+from utility import utility
+from utility.storage import (DEFAULT_BATCH_SIZE, ForwardingBackend,
+                             StorageBackend)
+
+EXPLAIN_ENV = "PM_EXPLAIN"
+EXPLAIN_MODES = ("warn", "fail")
+COLLSCAN_MIN_DOCS = 1000
+MAX_RECORDS = 1000
+
+
+class CollectionScanWarning(UserWarning):
+    """Emitted when a query scans a large collection
+    """
+
+
+class CollectionScanError(Exception):
+    """Raised instead of the warning in fail mode
+    """
+
+
+class Explainer(Protocol):
+    """Where query plans come from
+    """
+
+    def explain(self, database_name: str, collection_name: str,
+                entries: Dict[str, Any], limit: int) -> Dict[str, Any]: ...
+
+    def collection_size(self, database_name: str,
+                        collection_name: str) -> int: ...
+
+
+class MongoExplainer:
+    """Explainer asking the MongoDB server
+    """
+
+    def explain(self, database_name: str, collection_name: str,
+                entries: Dict[str, Any], limit: int) -> Dict[str, Any]:
+        return utility.explain_find(database_name, collection_name, entries,
+                                    limit)
+
+    def collection_size(self, database_name: str,
+                        collection_name: str) -> int:
+        return utility.estimated_count(database_name, collection_name)
+
+
+def filter_shape(entries: Any) -> Any:
+    """Replaces the values of a filter with their type names
+
+    Args:
+        entries (Any): A filter or part of one
+
+    Returns:
+        Any: The same keys and operators with type names for values; lists
+            keep the shapes of their distinct items
+    """
+
+    if isinstance(entries, dict):
+        return {key: filter_shape(value) for key, value in entries.items()}
+    if isinstance(entries, (list, tuple)):
+        shapes: List[Any] = []
+        for item in entries:
+            shape = filter_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return type(entries).__name__
+
+
+@dataclass
+class PlanRecord:
+    """The plan the server chose for one query
+
+    Attributes:
+        operation (str): Storage call, e.g. "find_entries"
+        database (str): Database name
+        collection (str): Collection the query ran against
+        shape (str): The filter's shape as JSON
+        stages (List[str]): Plan stages from the root down
+        indexes (List[str]): Indexes the plan reads
+        docs_examined (int): Documents the server read
+        keys_examined (int): Index keys the server read
+        returned (int): Documents the query returned
+        collection_size (int | None): Documents in the collection, looked
+            up for collection scans only
+    """
+
+    operation: str
+    database: str
+    collection: str
+    shape: str
+    stages: List[str] = field(default_factory=list)
+    indexes: List[str] = field(default_factory=list)
+    docs_examined: int = 0
+    keys_examined: int = 0
+    returned: int = 0
+    collection_size: int | None = None
+
+    @property
+    def collscan(self) -> bool:
+        """True if the plan reads the collection without an index
+        """
+
+        return "COLLSCAN" in self.stages
+
+
+def _walk_plan(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Yields a plan's stages from the root down
+    """
+
+    # Plans run by the slot based engine nest the classic tree
+    plan = plan.get("queryPlan", plan)
+    yield plan
+    children = list(plan.get("inputStages", []))
+    if "inputStage" in plan:
+        children.insert(0, plan["inputStage"])
+    for child in children:
+        yield from _walk_plan(child)
+
+
+def parse_explain(explain: Dict[str, Any], operation: str,
+                  database_name: str, collection_name: str,
+                  shape: str) -> PlanRecord:
+    """Reads the winning plan and its execution statistics
+
+    Args:
+        explain (Dict[str, Any]): Output of the explain command
+        operation (str): Storage call that was explained
+        database_name (str): Database name
+        collection_name (str): Collection name
+        shape (str): The filter's shape as JSON
+
+    Returns:
+        PlanRecord: The plan's stages, indexes and document counts
+    """
+
+    record = PlanRecord(operation, database_name, collection_name, shape)
+    winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+    for stage in _walk_plan(winning):
+        if "stage" in stage:
+            record.stages.append(stage["stage"])
+        if "indexName" in stage:
+            record.indexes.append(stage["indexName"])
+    stats = explain.get("executionStats", {})
+    record.docs_examined = int(stats.get("totalDocsExamined", 0))
+    record.keys_examined = int(stats.get("totalKeysExamined", 0))
+    record.returned = int(stats.get("nReturned", 0))
+    return record
+
+
+class ExplainingBackend(ForwardingBackend):
+    """StorageBackend explaining filters before passing them on
+
+    Attributes:
+        records (Deque[PlanRecord]): The newest explained plans
+        errors (int): Explains that failed; queries still ran
+        last_error (Exception | None): Why the last explain failed
+    """
+
+    def __init__(self, inner: StorageBackend, explainer: Explainer,
+                 mode: str = "warn", min_docs: int = COLLSCAN_MIN_DOCS,
+                 sample_rate: float = 0.0) -> None:
+        """Wraps a backend
+
+        Args:
+            inner (StorageBackend): The MongoDB backend
+            explainer (Explainer): Where plans come from
+            mode (str, optional): "warn" or "fail". Defaults to "warn".
+            min_docs (int, optional): Smallest collection a scan is flagged
+                on. Defaults to 1000.
+            sample_rate (float, optional): Share of calls explained again
+                after the first of their shape. Defaults to 0.
+
+        Raises:
+            ValueError: Raised if the mode is unknown
+        """
+
+        if mode not in EXPLAIN_MODES:
+            raise ValueError(f"Unknown explain mode {mode}. "
+                             f"Choose one of {', '.join(EXPLAIN_MODES)}")
+        super().__init__(inner)
+        self.explainer = explainer
+        self.mode = mode
+        self.min_docs = min_docs
+        self.sample_rate = sample_rate
+        self.records: Deque[PlanRecord] = deque(maxlen=MAX_RECORDS)
+        self.errors = 0
+        self.last_error: Exception | None = None
+        self._seen: Set[Tuple[str, ...]] = set()
+        # Shapes whose plan scanned a collection
+        self._scans: Set[Tuple[str, str, str]] = set()
+        self._lock = threading.Lock()
+
+    def _inspect(self, operation: str, database_name: str,
+                 collection_name: str, entries: Dict[str, Any] | None,
+                 limit: int = 0) -> None:
+        """Explains a filter when its shape is new or it is sampled
+        """
+
+        if not entries:
+            return
+        shape = json.dumps(filter_shape(entries), sort_keys=True)
+        key: Tuple[str, ...] = (operation, database_name, shape)
+        with self._lock:
+            if key in self._scans:
+                # Whether a scan is flagged depends on the collection's
+                # size and indexes, so scans are checked per collection
+                key += (collection_name,)
+            first = key not in self._seen
+            self._seen.add(key)
+        if not first and random.random() >= self.sample_rate:
+            return
+
+        try:
+            record = parse_explain(
+                self.explainer.explain(database_name, collection_name,
+                                       entries, limit),
+                operation, database_name, collection_name, shape)
+            if record.collscan:
+                record.collection_size = self.explainer.collection_size(
+                    database_name, collection_name)
+        except Exception as ex:
+            # Diagnostics must never stop the query itself
+            with self._lock:
+                self.errors += 1
+                self.last_error = ex
+            return
+        with self._lock:
+            self.records.append(record)
+            if record.collscan:
+                self._scans.add((operation, database_name, shape))
+                self._seen.add((operation, database_name, shape,
+                                collection_name))
+
+        if record.collscan and (record.collection_size or 0) >= self.min_docs:
+            message = (f"{operation} on {database_name}.{collection_name} "
+                       f"scans {record.collection_size} documents for "
+                       f"filter {shape}: examined {record.docs_examined}, "
+                       f"returned {record.returned}")
+            if self.mode == "fail":
+                raise CollectionScanError(message)
+            warnings.warn(message, CollectionScanWarning, stacklevel=3)
+
+    def flagged(self) -> List[PlanRecord]:
+        """Lists the recorded plans that scanned a large collection
+
+        Returns:
+            List[PlanRecord]: Plans with COLLSCAN over at least min_docs
+                documents
+        """
+
+        with self._lock:
+            return [record for record in self.records
+                    if record.collscan
+                    and (record.collection_size or 0) >= self.min_docs]
+
+    def report(self) -> str:
+        """Renders the recorded plans as a table
+
+        Returns:
+            str: One line per plan, flagged scans marked with "!"
+        """
+
+        with self._lock:
+            records = list(self.records)
+        lines = [f"  {'operation':<16}{'database':<12}{'plan':<24}"
+                 f"{'examined':>10}{'returned':>10}  filter"]
+        for record in records:
+            flag = ("!" if record.collscan and (record.collection_size or 0)
+                    >= self.min_docs else " ")
+            plan = ">".join(record.stages)
+            lines.append(f"{flag} {record.operation:<16}"
+                         f"{record.database:<12}{plan:<24}"
+                         f"{record.docs_examined:>10}"
+                         f"{record.returned:>10}  {record.shape}")
+        return "\n".join(lines)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        self._inspect("find_entries", database_name, collection_name,
+                      entries)
+        return self.inner.find_entries(database_name, collection_name,
+                                       entries, projection)
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        self._inspect("iter_entries", database_name, collection_name,
+                      entries)
+        return self.inner.iter_entries(database_name, collection_name,
+                                       entries, batch_size)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        self._inspect("count_entries", database_name, collection_name,
+                      entries, limit)
+        return self.inner.count_entries(database_name, collection_name,
+                                        entries, limit)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        self._inspect("update_entry", database_name, collection_name,
+                      old_data, 1)
+        return self.inner.update_entry(database_name, collection_name,
+                                       old_data, new_data)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self._inspect("update_entries", database_name, collection_name,
+                      old_data)
+        self.inner.update_entries(database_name, collection_name,
+                                  old_data, new_data)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._inspect("delete_entry", database_name, collection_name,
+                      old_data, 1)
+        self.inner.delete_entry(database_name, collection_name, old_data)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self._inspect("delete_entries", database_name, collection_name,
+                      old_data)
+        self.inner.delete_entries(database_name, collection_name, old_data)
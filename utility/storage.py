@@ -0,0 +1,848 @@
+"""Module defining the storage backends the Password Manager can run against
+
+The Password Manager only needs a handful of document operations. They are
+described by the StorageBackend protocol and implemented by:
+
+    MongoBackend  - MongoDB Atlas through the functions in utility.py
+    MemoryBackend - process local dictionaries, for tests and benchmarks
+    SQLiteBackend - a single SQLite file, for single host deployments
+
+The backend is chosen at startup with get_backend(), either by name or from
+the PM_BACKEND environment variable.
+"""
+
+import copy
+import os
+import sqlite3
+import threading
+from bson import ObjectId
+from bson import json_util
+from datetime import datetime, timezone
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from typing import Any, Dict, Iterator, List, Protocol, Set, Tuple
+from utility import utility
+
+BACKEND_ENV = "PM_BACKEND"
+SQLITE_PATH_ENV = "PM_SQLITE_PATH"
+DEFAULT_SQLITE_PATH = "password_manager.db"
+DEFAULT_BATCH_SIZE = 1000
+
+
+class StorageBackend(Protocol):
+    """Operations the Password Manager needs from a document store
+    """
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any: ...
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None: ...
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None: ...
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any: ...
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]: ...
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int: ...
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool: ...
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None: ...
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None: ...
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None: ...
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None: ...
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None: ...
+
+    def list_collection_names(self, database_name: str) -> List[str]: ...
+
+
+def _get_field(document: Dict[str, Any], key: str) -> Any:
+    """Looks up a possibly dotted key in a document
+
+    Args:
+        document (Dict[str, Any]): The document to search
+        key (str): Field name, "a.b" looks up field b of sub document a
+
+    Returns:
+        Any: The value, or None if the field is missing
+    """
+
+    value: Any = document
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(value: Any, operator: str, operand: Any) -> bool:
+    """Applies a single query operator to a field value
+
+    Args:
+        value (Any): The value stored in the document
+        operator (str): A MongoDB query operator such as "$gte"
+        operand (Any): The operator's argument
+
+    Raises:
+        ValueError: Raised for operators this module does not support
+
+    Returns:
+        Any: True if the value satisfies the operator
+    """
+
+    if operator == "$eq":
+        return _equals(value, operand)
+    if operator == "$ne":
+        return not _equals(value, operand)
+    if operator == "$in":
+        return any(_equals(value, item) for item in operand)
+    if operator == "$nin":
+        return not any(_equals(value, item) for item in operand)
+    if operator == "$exists":
+        return (value is not None) == bool(operand)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        if value is None:
+            return False
+        if isinstance(value, datetime) and isinstance(operand, datetime):
+            # BSON dates are UTC but come back from JSON without a zone
+            value, operand = as_utc(value), as_utc(operand)
+        try:
+            if operator == "$gt":
+                return bool(value > operand)
+            if operator == "$gte":
+                return bool(value >= operand)
+            if operator == "$lt":
+                return bool(value < operand)
+            return bool(value <= operand)
+        except TypeError:
+            return False
+    raise ValueError(f"Unsupported query operator {operator}")
+
+
+def as_utc(moment: datetime) -> datetime:
+    """Treats naive datetimes as UTC
+
+    Args:
+        moment (datetime): A datetime, naive ones as read back from BSON
+
+    Returns:
+        datetime: The same moment with a time zone
+    """
+
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def _equals(value: Any, operand: Any) -> bool:
+    """Equality with MongoDB semantics for arrays and missing fields
+
+    Args:
+        value (Any): The value stored in the document
+        operand (Any): The value from the filter
+
+    Returns:
+        bool: True if they match
+    """
+
+    if isinstance(value, list) and not isinstance(operand, list):
+        return operand in value
+    return bool(value == operand)
+
+
+def matches(document: Dict[str, Any], query: Dict[str, Any] | None) -> bool:
+    """Checks a document against a MongoDB style filter
+
+    Supports field equality, dotted field names, $or/$and and the comparison
+    operators used by the Password Manager.
+
+    Args:
+        document (Dict[str, Any]): The document to test
+        query (Dict[str, Any] | None): The filter, None matches everything
+
+    Returns:
+        bool: True if the document matches the filter
+    """
+
+    if not query:
+        return True
+
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, sub) for sub in condition):
+                return False
+        elif (isinstance(condition, dict) and condition
+              and all(op.startswith("$") for op in condition)):
+            value = _get_field(document, key)
+            for operator, operand in condition.items():
+                if not _compare(value, operator, operand):
+                    return False
+        elif not _equals(_get_field(document, key), condition):
+            return False
+    return True
+
+
+def project(document: Dict[str, Any],
+            projection: List[str] | None) -> Dict[str, Any]:
+    """Keeps the fields a find asked for, like a MongoDB projection
+
+    Args:
+        document (Dict[str, Any]): A matching document
+        projection (List[str] | None): Top level fields to return besides
+            _id, None for all of them
+
+    Returns:
+        Dict[str, Any]: The document, or a new one with only those fields
+    """
+
+    if projection is None:
+        return document
+    return {key: value for key, value in document.items()
+            if key == "_id" or key in projection}
+
+
+def _id_key(value: Any) -> Any:
+    """Returns a hashable stand-in for an _id
+
+    Args:
+        value (Any): The _id, usually an ObjectId or a string
+
+    Returns:
+        Any: The value itself, or its extended JSON if it is unhashable
+    """
+
+    try:
+        hash(value)
+    except TypeError:
+        return json_util.dumps(value, sort_keys=True)
+    return value
+
+
+def _duplicate_key(database_name: str, collection_name: str,
+                   entries: List[Any], index: int,
+                   single: bool) -> PyMongoError:
+    """Builds the error MongoDB raises for an _id that is already taken
+
+    Args:
+        database_name (str): Database name
+        collection_name (str): Collection name
+        entries (List[Any]): The documents being inserted
+        index (int): Position of the rejected document; the ones before it
+            were inserted
+        single (bool): Whether this was insert_entry rather than
+            insert_entries
+
+    Returns:
+        PyMongoError: DuplicateKeyError for a single insert, BulkWriteError
+            like insert_many raises otherwise
+    """
+
+    message = (f"E11000 duplicate key error collection: {database_name}."
+               f"{collection_name} index: _id_ dup key: "
+               f"{{ _id: {entries[index]['_id']!r} }}")
+    if single:
+        return DuplicateKeyError(message, 11000)
+    return BulkWriteError({
+        "writeErrors": [{"index": index, "code": 11000, "errmsg": message,
+                         "op": entries[index]}],
+        "writeConcernErrors": [], "nInserted": index, "nUpserted": 0,
+        "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+
+
+class ForwardingBackend:
+    """StorageBackend passing every operation on to another backend
+
+    Base class for backends that add behaviour on top of another one; they
+    override only the operations they change.
+    """
+
+    def __init__(self, inner: StorageBackend) -> None:
+        self.inner = inner
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any:
+        return self.inner.create_collection(database_name, collection_name)
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self.inner.insert_entry(database_name, collection_name, entry)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.insert_entries(database_name, collection_name, entries)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        return self.inner.find_entries(database_name, collection_name,
+                                       entries, projection)
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        return self.inner.iter_entries(database_name, collection_name,
+                                       entries, batch_size)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        return self.inner.count_entries(database_name, collection_name,
+                                        entries, limit)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        return self.inner.update_entry(database_name, collection_name,
+                                       old_data, new_data)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self.inner.update_entries(database_name, collection_name,
+                                  old_data, new_data)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.inner.upsert_entries(database_name, collection_name, entries)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entry(database_name, collection_name, old_data)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self.inner.delete_entries(database_name, collection_name, old_data)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        self.inner.delete_collection(database_name, collection_name)
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        return self.inner.list_collection_names(database_name)
+
+
+def innermost(backend: StorageBackend) -> StorageBackend:
+    """Returns the backend underneath every ForwardingBackend wrapper
+
+    Args:
+        backend (StorageBackend): A backend, possibly wrapped
+
+    Returns:
+        StorageBackend: The backend that stores the documents
+    """
+
+    while isinstance(backend, ForwardingBackend):
+        backend = backend.inner
+    return backend
+
+
+class MongoBackend:
+    """StorageBackend backed by MongoDB through utility.py
+    """
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any:
+        return utility.create_collection(database_name, collection_name)
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        utility.insert_entry(database_name, collection_name, entry)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        utility.insert_entries(database_name, collection_name, entries)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        return utility.find_entries(database_name, collection_name, entries,
+                                    projection)
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        return utility.iter_entries(database_name, collection_name, entries,
+                                    batch_size)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        return utility.count_entries(database_name, collection_name, entries,
+                                     limit)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        return utility.update_entry(database_name, collection_name,
+                                    old_data, new_data)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        utility.update_entries(database_name, collection_name,
+                               old_data, new_data)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        utility.upsert_entries(database_name, collection_name, entries)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        utility.delete_entry(database_name, collection_name, old_data)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        utility.delete_entries(database_name, collection_name, old_data)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        utility.delete_collection(database_name, collection_name)
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        return utility.list_collection_names(database_name)
+
+
+class MemoryBackend:
+    """StorageBackend keeping every collection in process memory
+
+    Documents are deep copied on the way in and out so callers cannot
+    mutate stored state, matching the behaviour of a real database. Like
+    MongoDB, an _id can only be used once per collection.
+    """
+
+    def __init__(self) -> None:
+        self._databases: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+        self._ids: Dict[Tuple[str, str], Set[Any]] = {}
+        self._lock = threading.RLock()
+
+    def _collection(self, database_name: str,
+                    collection_name: str) -> List[Dict[str, Any]]:
+        database = self._databases.setdefault(database_name, {})
+        return database.setdefault(collection_name, [])
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any:
+        with self._lock:
+            self._collection(database_name, collection_name)
+            return self.list_collection_names(database_name)
+
+    def _insert(self, database_name: str, collection_name: str,
+                entries: List[Any], single: bool) -> None:
+        with self._lock:
+            collection = self._collection(database_name, collection_name)
+            ids = self._ids.setdefault((database_name, collection_name),
+                                       set())
+            for index, entry in enumerate(entries):
+                # Like pymongo, the caller's document receives its _id
+                entry.setdefault("_id", ObjectId())
+                key = _id_key(entry["_id"])
+                if key in ids:
+                    raise _duplicate_key(database_name, collection_name,
+                                         entries, index, single)
+                ids.add(key)
+                collection.append(copy.deepcopy(entry))
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self._insert(database_name, collection_name, [entry], True)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._insert(database_name, collection_name, entries, False)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        with self._lock:
+            collection = self._databases.get(database_name, {}).get(
+                collection_name, [])
+            return [copy.deepcopy(project(document, projection))
+                    for document in collection
+                    if matches(document, entries)]
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        with self._lock:
+            collection = list(self._databases.get(database_name, {}).get(
+                collection_name, []))
+        batch = []
+        for document in collection:
+            if matches(document, entries):
+                batch.append(copy.deepcopy(document))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        count = 0
+        with self._lock:
+            collection = self._databases.get(database_name, {}).get(
+                collection_name, [])
+            for document in collection:
+                if matches(document, entries):
+                    count += 1
+                    if count == limit:
+                        break
+        return count
+
+    def _update(self, database_name: str, collection_name: str,
+                old_data: Dict[str, Any], new_data: Dict[str, Any],
+                many: bool) -> bool:
+        matched = False
+        with self._lock:
+            collection = self._databases.get(database_name, {}).get(
+                collection_name, [])
+            for document in collection:
+                if matches(document, old_data):
+                    document.update(copy.deepcopy(new_data))
+                    matched = True
+                    if not many:
+                        break
+        return matched
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        return self._update(database_name, collection_name, old_data,
+                            new_data, False)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self._update(database_name, collection_name, old_data, new_data,
+                     True)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        with self._lock:
+            collection = self._collection(database_name, collection_name)
+            ids = self._ids.setdefault((database_name, collection_name),
+                                       set())
+            positions = {_id_key(document["_id"]): index
+                         for index, document in enumerate(collection)}
+            for entry in entries:
+                key = _id_key(entry["_id"])
+                if key in positions:
+                    collection[positions[key]] = copy.deepcopy(entry)
+                else:
+                    positions[key] = len(collection)
+                    ids.add(key)
+                    collection.append(copy.deepcopy(entry))
+
+    def _delete(self, database_name: str, collection_name: str,
+                old_data: Dict[str, Any], many: bool) -> None:
+        with self._lock:
+            collection = self._databases.get(database_name, {}).get(
+                collection_name, [])
+            ids = self._ids.get((database_name, collection_name), set())
+            for document in list(collection):
+                if matches(document, old_data):
+                    collection.remove(document)
+                    ids.discard(_id_key(document["_id"]))
+                    if not many:
+                        break
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._delete(database_name, collection_name, old_data, False)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self._delete(database_name, collection_name, old_data, True)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        with self._lock:
+            self._databases.get(database_name, {}).pop(collection_name, None)
+            self._ids.pop((database_name, collection_name), None)
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        with self._lock:
+            return list(self._databases.get(database_name, {}))
+
+
+class SQLiteBackend:
+    """StorageBackend storing documents as extended JSON in SQLite
+
+    Every document is a row keyed by database and collection name. Filters
+    are evaluated in Python with the same rules as MemoryBackend, which is
+    fast enough for the vault sizes of a single host deployment. A unique
+    index on the document's _id keeps _ids unique per collection.
+    """
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS collections ("
+                " database_name TEXT NOT NULL,"
+                " collection_name TEXT NOT NULL,"
+                " PRIMARY KEY (database_name, collection_name))")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " database_name TEXT NOT NULL,"
+                " collection_name TEXT NOT NULL,"
+                " document TEXT NOT NULL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_collection "
+                "ON documents (database_name, collection_name)")
+            columns = [row[1] for row in self._connection.execute(
+                "PRAGMA table_info(documents)")]
+            if "document_id" not in columns:
+                # Files written before _ids were unique get the column
+                self._connection.execute(
+                    "ALTER TABLE documents ADD COLUMN document_id TEXT")
+                self._connection.executemany(
+                    "UPDATE documents SET document_id = ? WHERE id = ?",
+                    [(self._document_id(json_util.loads(text)), row_id)
+                     for row_id, text in self._connection.execute(
+                         "SELECT id, document FROM documents")])
+            self._connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS documents_id ON documents "
+                "(database_name, collection_name, document_id)")
+
+    def close(self) -> None:
+        """Closes the SQLite connection
+        """
+
+        self._connection.close()
+
+    @staticmethod
+    def _document_id(document: Dict[str, Any]) -> str:
+        return json_util.dumps(document["_id"], sort_keys=True)
+
+    def _rows(self, database_name: str, collection_name: str,
+              query: Dict[str, Any] | None) -> List[Any]:
+        cursor = self._connection.execute(
+            "SELECT id, document FROM documents WHERE database_name = ? "
+            "AND collection_name = ? ORDER BY id",
+            (database_name, collection_name))
+        rows = []
+        for row_id, text in cursor:
+            document = json_util.loads(text)
+            if matches(document, query):
+                rows.append((row_id, document))
+        return rows
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO collections VALUES (?, ?)",
+                (database_name, collection_name))
+        return self.list_collection_names(database_name)
+
+    def _insert(self, database_name: str, collection_name: str,
+                entries: List[Any], single: bool) -> None:
+        for entry in entries:
+            entry.setdefault("_id", ObjectId())
+        rejected = None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO collections VALUES (?, ?)",
+                (database_name, collection_name))
+            for index, entry in enumerate(entries):
+                try:
+                    self._connection.execute(
+                        "INSERT INTO documents (database_name, "
+                        "collection_name, document, document_id) "
+                        "VALUES (?, ?, ?, ?)",
+                        (database_name, collection_name,
+                         json_util.dumps(entry), self._document_id(entry)))
+                except sqlite3.IntegrityError:
+                    # Like an ordered insert_many, keep what came before
+                    rejected = index
+                    break
+        if rejected is not None:
+            raise _duplicate_key(database_name, collection_name, entries,
+                                 rejected, single)
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self._insert(database_name, collection_name, [entry], True)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._insert(database_name, collection_name, entries, False)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        with self._lock:
+            return [project(document, projection) for _, document in
+                    self._rows(database_name, collection_name, entries)]
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        # A separate cursor so other operations may run between batches
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT document FROM documents WHERE database_name = ? "
+                "AND collection_name = ? ORDER BY id",
+                (database_name, collection_name))
+            rows = cursor.fetchmany(batch_size)
+        while rows:
+            batch = [document for document in
+                     (json_util.loads(text) for (text,) in rows)
+                     if matches(document, entries)]
+            if batch:
+                yield batch
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        count = 0
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT document FROM documents WHERE database_name = ? "
+                "AND collection_name = ?", (database_name, collection_name))
+            for (text,) in cursor:
+                if matches(json_util.loads(text), entries):
+                    count += 1
+                    if count == limit:
+                        break
+        return count
+
+    def _update(self, database_name: str, collection_name: str,
+                old_data: Dict[str, Any], new_data: Dict[str, Any],
+                many: bool) -> bool:
+        with self._lock, self._connection:
+            rows = self._rows(database_name, collection_name, old_data)
+            for row_id, document in rows if many else rows[:1]:
+                document.update(new_data)
+                self._connection.execute(
+                    "UPDATE documents SET document = ? WHERE id = ?",
+                    (json_util.dumps(document), row_id))
+        return bool(rows)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        return self._update(database_name, collection_name, old_data,
+                            new_data, False)
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self._update(database_name, collection_name, old_data, new_data,
+                     True)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO collections VALUES (?, ?)",
+                (database_name, collection_name))
+            self._connection.executemany(
+                "INSERT INTO documents (database_name, collection_name, "
+                "document, document_id) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (database_name, collection_name, document_id) "
+                "DO UPDATE SET document = excluded.document",
+                [(database_name, collection_name, json_util.dumps(entry),
+                  self._document_id(entry)) for entry in entries])
+
+    def _delete(self, database_name: str, collection_name: str,
+                old_data: Dict[str, Any], many: bool) -> None:
+        with self._lock, self._connection:
+            rows = self._rows(database_name, collection_name, old_data)
+            self._connection.executemany(
+                "DELETE FROM documents WHERE id = ?",
+                [(row_id,) for row_id, _ in (rows if many else rows[:1])])
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._delete(database_name, collection_name, old_data, False)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self._delete(database_name, collection_name, old_data, True)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM documents WHERE database_name = ? "
+                "AND collection_name = ?", (database_name, collection_name))
+            self._connection.execute(
+                "DELETE FROM collections WHERE database_name = ? "
+                "AND collection_name = ?", (database_name, collection_name))
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT collection_name FROM collections "
+                "WHERE database_name = ? ORDER BY collection_name",
+                (database_name,))
+            return [name for (name,) in cursor]
+
+
+BACKENDS = ("mongo", "memory", "sqlite")
+
+
+def get_backend(name: str | None = None,
+                sqlite_path: str | None = None) -> StorageBackend:
+    """Creates the storage backend selected at startup
+
+    Args:
+        name (str | None, optional): "mongo", "memory" or "sqlite". Defaults
+            to the PM_BACKEND environment variable, then "mongo".
+        sqlite_path (str | None, optional): Database file for the SQLite
+            backend. Defaults to PM_SQLITE_PATH, then password_manager.db.
+
+    Raises:
+        ValueError: Raised if the backend name is unknown
+
+    Returns:
+        StorageBackend: The selected backend
+    """
+
+    name = (name or os.environ.get(BACKEND_ENV) or "mongo").lower()
+
+    if name == "mongo":
+        return MongoBackend()
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path or os.environ.get(
+            SQLITE_PATH_ENV, DEFAULT_SQLITE_PATH))
+    raise ValueError(f"Unknown storage backend {name}. "
+                     f"Choose one of {', '.join(BACKENDS)}")
@@ -0,0 +1,454 @@
+"""Module estimating password strength from how guessable it is
+
+Instead of counting character classes, the password is split into the
+cheapest sequence of patterns an attacker would try: dictionary words (also
+reversed, capitalised or with l33t substitutions), keyboard walks, dates,
+sequences such as "abc" or "987" and repeated characters or chunks. Whatever
+no pattern covers is charged as brute force. The estimated number of guesses
+gives a score from 0 to 4, together with feedback for the user.
+
+The ranked word list in data/common_words.txt is loaded once, on first use.
+
+Usage:
+    python -m utility.strength bench [--rounds N]
+"""
+
+import argparse
+import functools
+import math
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+WORD_LIST = os.path.join(os.path.dirname(__file__), "data",
+                         "common_words.txt")
+MIN_SCORE = 3
+MAX_LENGTH = 64
+
+# Score thresholds on log10(guesses), as used by zxcvbn
+SCORE_THRESHOLDS = (3, 6, 8, 10)
+
+BRUTEFORCE_PER_CHAR = 1.0   # log10(10), zxcvbn's brute force cardinality
+MIN_YEAR = 1900
+MAX_YEAR = 2039
+
+L33T = str.maketrans({'4': 'a', '@': 'a', '8': 'b', '(': 'c', '3': 'e',
+                      '6': 'g', '1': 'i', '!': 'i', '|': 'l', '0': 'o',
+                      '$': 's', '5': 's', '7': 't', '+': 't', '2': 'z'})
+
+GREEDY_REPEAT = re.compile(r"(.+)\1+", re.DOTALL)
+LAZY_REPEAT = re.compile(r"(.+?)\1+", re.DOTALL)
+LAZY_ANCHORED_REPEAT = re.compile(r"^(.+?)\1+$", re.DOTALL)
+
+KEYBOARD_ROWS = ("`1234567890-=", "qwertyuiop[]\\", "asdfghjkl;'",
+                 "zxcvbnm,./")
+
+DATE_PATTERN = re.compile(
+    r"^(?:(\d{1,2})[-/._]?(\d{1,2})[-/._]?(\d{4}|\d{2})"
+    r"|(\d{4})[-/._]?(\d{1,2})[-/._]?(\d{1,2}))$")
+
+
+@dataclass
+class StrengthResult:
+    """Result of a password strength estimate
+
+    Attributes:
+        score (int): 0 (too guessable) to 4 (very unguessable)
+        guesses_log10 (float): log10 of the estimated guesses needed
+        feedback (List[str]): Warnings and suggestions for the user
+    """
+
+    score: int
+    guesses_log10: float
+    feedback: List[str] = field(default_factory=list)
+
+
+@functools.lru_cache(maxsize=1)
+def _ranked_words() -> Dict[str, int]:
+    """Loads the ranked word list once
+
+    Returns:
+        Dict[str, int]: Word to rank, 1 being the most common
+    """
+
+    ranks: Dict[str, int] = {}
+    with open(WORD_LIST, encoding="utf-8") as words:
+        for line in words:
+            word = line.strip()
+            if word and not word.startswith("#"):
+                ranks.setdefault(word, len(ranks) + 1)
+    return ranks
+
+
+@functools.lru_cache(maxsize=1)
+def _longest_word() -> int:
+    """Returns the length of the longest word in the word list
+    """
+
+    return max(len(word) for word in _ranked_words())
+
+
+@functools.lru_cache(maxsize=1)
+def _keyboard_neighbours() -> Dict[str, frozenset[str]]:
+    """Builds the adjacency of keys on a QWERTY keyboard
+
+    Returns:
+        Dict[str, frozenset[str]]: Key to the set of keys touching it
+    """
+
+    positions: Dict[str, Tuple[int, float]] = {}
+    for row, keys in enumerate(KEYBOARD_ROWS):
+        for column, key in enumerate(keys):
+            # Each row is shifted half a key to the right of the one above
+            positions[key] = (row, column + row * 0.5)
+
+    neighbours: Dict[str, frozenset[str]] = {}
+    for key, (key_row, key_column) in positions.items():
+        neighbours[key] = frozenset(
+            other for other, (other_row, other_column) in positions.items()
+            if other != key and abs(other_row - key_row) <= 1
+            and abs(other_column - key_column) <= 1)
+    return neighbours
+
+
+def _case_variations(token: str) -> float:
+    """Returns log10 of the capitalisations an attacker would try
+
+    Args:
+        token (str): The matched text
+
+    Returns:
+        float: 0 for lowercase, log10(2) for first or all uppercase,
+            otherwise one extra bit per uppercase letter
+    """
+
+    uppers = sum(1 for c in token if c.isupper())
+    if uppers == 0:
+        return 0.0
+    if token[0].isupper() and uppers == 1 or uppers == len(token):
+        return math.log10(2)
+    return uppers * math.log10(2)
+
+
+def _dictionary_matches(password: str,
+                        user_inputs: Iterable[str]
+                        ) -> List[Tuple[int, int, float, str]]:
+    """Finds dictionary words, also reversed or in l33t speak
+
+    Args:
+        password (str): The password being estimated
+        user_inputs (Iterable[str]): Extra words such as the username,
+            ranked as the most common words
+
+    Returns:
+        List[Tuple[int, int, float, str]]: (start, end, log10 guesses, kind)
+    """
+
+    ranks = _ranked_words()
+    extra = {word.lower(): 1 for word in user_inputs if len(word) >= 3}
+    longest = max(_longest_word(), *(len(word) for word in extra), 0)
+    lower = password.lower()
+    unleeted = lower.translate(L33T)
+    matches = []
+
+    if extra:
+        ranks = {**ranks, **extra}
+    has_l33t = unleeted != lower
+    reversed_log10 = math.log10(2)
+
+    for start in range(len(password)):
+        for end in range(start + 3,
+                         min(start + longest, len(password)) + 1):
+            token = lower[start:end]
+            rank = ranks.get(token)
+            if rank is not None:
+                matches.append((start, end, math.log10(rank)
+                                + _case_variations(password[start:end]),
+                                "dictionary"))
+            rank = ranks.get(token[::-1])
+            if rank is not None:
+                matches.append((start, end, math.log10(rank) + reversed_log10
+                                + _case_variations(password[start:end]),
+                                "dictionary"))
+            if has_l33t:
+                word = unleeted[start:end]
+                rank = ranks.get(word) if word != token else None
+                if rank is not None:
+                    substitutions = sum(1 for a, b in zip(word, token)
+                                        if a != b)
+                    matches.append((start, end, math.log10(rank)
+                                    + substitutions * math.log10(2)
+                                    + _case_variations(password[start:end]),
+                                    "l33t"))
+    return matches
+
+
+def _keyboard_matches(password: str) -> List[Tuple[int, int, float, str]]:
+    """Finds walks of three or more adjacent keys such as "qwer" or "zaq1"
+
+    Args:
+        password (str): The password being estimated
+
+    Returns:
+        List[Tuple[int, int, float, str]]: (start, end, log10 guesses, kind)
+    """
+
+    neighbours = _keyboard_neighbours()
+    lower = password.lower()
+    matches = []
+    start = 0
+
+    while start < len(lower):
+        end = start + 1
+        while (end < len(lower)
+               and lower[end] in neighbours.get(lower[end - 1], ())):
+            end += 1
+        if end - start >= 3:
+            # About 47 starting keys and 4 likely directions per step
+            guesses = math.log10(47) + (end - start - 1) * math.log10(4)
+            matches.append((start, end, guesses, "keyboard"))
+        start = end
+    return matches
+
+
+def _sequence_matches(password: str) -> List[Tuple[int, int, float, str]]:
+    """Finds runs with a constant step such as "abc", "2468" or "zyx"
+
+    Args:
+        password (str): The password being estimated
+
+    Returns:
+        List[Tuple[int, int, float, str]]: (start, end, log10 guesses, kind)
+    """
+
+    matches = []
+    start = 0
+
+    while start < len(password) - 2:
+        step = ord(password[start + 1]) - ord(password[start])
+        end = start + 1
+        if step != 0 and abs(step) <= 2:
+            while (end < len(password)
+                   and ord(password[end]) - ord(password[end - 1]) == step):
+                end += 1
+        if end - start >= 3:
+            base = 10 if password[start].isdigit() else 26
+            guesses = math.log10(base * (end - start) * (2 if step < 0
+                                                         else 1))
+            matches.append((start, end, guesses, "sequence"))
+            start = end - 1
+        else:
+            start += 1
+    return matches
+
+
+def _repeat_matches(password: str) -> List[Tuple[int, int, float, str]]:
+    """Finds repeated characters or chunks such as "aaaa" or "abcabc"
+
+    Args:
+        password (str): The password being estimated
+
+    Returns:
+        List[Tuple[int, int, float, str]]: (start, end, log10 guesses, kind)
+    """
+
+    matches = []
+    position = 0
+
+    while position < len(password):
+        greedy = GREEDY_REPEAT.search(password, position)
+        lazy = LAZY_REPEAT.search(password, position)
+        if greedy is None or lazy is None:
+            break
+
+        if len(greedy.group(0)) > len(lazy.group(0)):
+            # "aabaab" is "aab" twice, not "a" twice followed by "baab"
+            found = greedy
+            anchored = LAZY_ANCHORED_REPEAT.match(greedy.group(0))
+            chunk = anchored.group(1) if anchored else greedy.group(1)
+        else:
+            found = lazy
+            chunk = lazy.group(1)
+
+        start, end = found.span()
+        repeats = (end - start) // len(chunk)
+        if end - start >= 3:
+            base = (_estimate(chunk, ()).guesses_log10 if len(chunk) > 1
+                    else BRUTEFORCE_PER_CHAR)
+            matches.append((start, end, base + math.log10(repeats),
+                            "repeat"))
+        position = end
+    return matches
+
+
+def _date_matches(password: str) -> List[Tuple[int, int, float, str]]:
+    """Finds years and dates such as "1987", "12/25/99" or "2001-07-04"
+
+    Args:
+        password (str): The password being estimated
+
+    Returns:
+        List[Tuple[int, int, float, str]]: (start, end, log10 guesses, kind)
+    """
+
+    matches = []
+    years = math.log10(MAX_YEAR - MIN_YEAR + 1)
+
+    for start in range(len(password)):
+        if not password[start].isdigit():
+            continue
+        for end in range(start + 4, min(start + 10, len(password)) + 1):
+            token = password[start:end]
+            if len(token) == 4 and token.isdigit():
+                if MIN_YEAR <= int(token) <= MAX_YEAR:
+                    matches.append((start, end, years, "date"))
+                continue
+            found = DATE_PATTERN.match(token)
+            if found and len(token) >= 6:
+                matches.append((start, end, years + math.log10(366),
+                                "date"))
+    return matches
+
+
+def _estimate(password: str, user_inputs: Iterable[str]) -> StrengthResult:
+    """Finds the cheapest pattern cover and scores it
+
+    Args:
+        password (str): The password being estimated
+        user_inputs (Iterable[str]): Extra dictionary words
+
+    Returns:
+        StrengthResult: Score, guesses and the kinds of patterns found
+    """
+
+    head = password[:MAX_LENGTH]
+    matches = (_dictionary_matches(head, user_inputs)
+               + _keyboard_matches(head) + _sequence_matches(head)
+               + _repeat_matches(head) + _date_matches(head))
+
+    by_end: Dict[int, List[Tuple[int, int, float, str]]] = {}
+    for match in matches:
+        by_end.setdefault(match[1], []).append(match)
+
+    # best[i] is the cheapest cover of password[:i] and the match used
+    best: List[Tuple[float, Tuple[int, int, float, str] | None]] = [
+        (0.0, None)]
+    for end in range(1, len(head) + 1):
+        cost, used = best[end - 1][0] + BRUTEFORCE_PER_CHAR, None
+        for match in by_end.get(end, []):
+            # Every extra pattern costs the attacker one more guess choice
+            candidate = best[match[0]][0] + max(match[2], 0.0) + 0.3
+            if candidate < cost:
+                cost, used = candidate, match
+        best.append((cost, used))
+
+    kinds = []
+    position = len(head)
+    while position > 0:
+        used = best[position][1]
+        if used is None:
+            position -= 1
+        else:
+            kinds.append(used[3])
+            position = used[0]
+
+    # Characters past MAX_LENGTH are ignored, which underestimates
+    guesses_log10 = best[-1][0]
+    score = sum(1 for threshold in SCORE_THRESHOLDS
+                if guesses_log10 >= threshold)
+    return StrengthResult(score, guesses_log10, kinds)
+
+
+FEEDBACK = {
+    "dictionary": "Common words and passwords are easy to guess.",
+    "l33t": "Predictable substitutions like '@' for 'a' don't help much.",
+    "keyboard": "Keyboard patterns like 'qwerty' are easy to guess.",
+    "sequence": "Sequences like 'abc' or '123' are easy to guess.",
+    "repeat": "Repeats like 'aaa' or 'abcabc' are easy to guess.",
+    "date": "Dates and years are easy to guess.",
+}
+
+
+def estimate_strength(password: str,
+                      user_inputs: Iterable[str] = ()) -> StrengthResult:
+    """Estimates how hard a password is to guess
+
+    Args:
+        password (str): The password to estimate
+        user_inputs (Iterable[str], optional): Words the password should
+            not be based on, such as the username. Defaults to ().
+
+    Returns:
+        StrengthResult: Score from 0 to 4, guesses and feedback
+    """
+
+    result = _estimate(password, tuple(user_inputs))
+
+    feedback = []
+    for kind in dict.fromkeys(result.feedback):
+        feedback.append(FEEDBACK[kind])
+    if result.score < MIN_SCORE:
+        feedback.append("Add more words or characters that are not "
+                        "part of a common pattern.")
+    result.feedback = feedback
+    return result
+
+
+def benchmark(passwords: Iterable[str], rounds: int = 100) -> float:
+    """Measures the mean time of one estimate
+
+    Args:
+        passwords (Iterable[str]): Passwords to estimate
+        rounds (int, optional): Times to estimate each. Defaults to 100.
+
+    Returns:
+        float: Mean microseconds per estimate
+    """
+
+    passwords = list(passwords)
+    _ranked_words()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for password in passwords:
+            estimate_strength(password)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(passwords)) * 1e6
+
+
+BENCHMARK_PASSWORDS = ("Password1!", "correct horse battery staple",
+                       "qwerty123", "Tr0ub4dor&3", "1qaz2wsx3edc",
+                       "j8#Lq!vZ2@pX9$wR", "01/02/1987", "aaaaaaaaaaaa",
+                       "abcabcabcabc", "NeverGonnaGiveYouUp42")
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for the benchmark
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.strength")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="time the estimator")
+    bench.add_argument("--rounds", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        for password in BENCHMARK_PASSWORDS:
+            result = estimate_strength(password)
+            print(f"{password!r:32} score {result.score} "
+                  f"10^{result.guesses_log10:.1f} guesses")
+        mean = benchmark(BENCHMARK_PASSWORDS, args.rounds)
+        print(f"{mean:.1f} us per estimate")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
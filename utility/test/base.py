@@ -0,0 +1,46 @@
+"""
+Shared setup for tests running the Password Manager on a storage backend
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+import passwordManager as pm
+from utility import storage
+from utility import vault
+
+
+class VaultTestCase(unittest.TestCase):
+    """TestCase that can run the Password Manager on a backend of its own
+    """
+
+    def use_vault(self, backend: storage.StorageBackend | None = None
+                  ) -> storage.StorageBackend:
+        """Works on a backend in a temporary directory until the test ends
+
+        The directory receives the users' key files and the Password
+        Manager's screen output is silenced.
+
+        Args:
+            backend (storage.StorageBackend | None, optional): Backend to
+                store the vaults in. Defaults to a new MemoryBackend.
+
+        Returns:
+            storage.StorageBackend: The backend in use
+        """
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory.name)
+
+        for patch in (mock.patch.object(pm, "clear_screen"),
+                      mock.patch.object(pm, "console")):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        if backend is None:
+            backend = storage.MemoryBackend()
+        vault.set_storage_backend(backend)
+        return backend
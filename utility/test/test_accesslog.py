@@ -0,0 +1,190 @@
+"""
+Test module for accesslog.py
+"""
+
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from typing import Any, List
+from unittest import mock
+import passwordManager as pm
+from utility import accesslog
+from utility import storage
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class GatedBackend(storage.MemoryBackend):
+    """MemoryBackend whose inserts wait for a gate and may fail
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.batches: List[int] = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.failing = False
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self.gate.wait()
+        if self.failing:
+            raise ConnectionError("database unreachable")
+        self.batches.append(len(entries))
+        super().insert_entries(database_name, collection_name, entries)
+
+
+class TestAccessLog(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates an access log over a gated in-memory backend
+        """
+        self.backend = GatedBackend()
+        self.log = accesslog.AccessLog(self.backend, batch_size=50,
+                                       flush_seconds=0.05)
+        self.addCleanup(self.log.close)
+
+    def test_events_written_in_batches(self) -> None:
+        """Tests queued events reach the backend a batch at a time
+        """
+
+        self.backend.gate.clear()
+        for number in range(120):
+            self.log.record("Peter", "view", f"service{number}")
+        self.assertEqual(self.log.pending, 120)
+        self.backend.gate.set()
+
+        self.assertTrue(self.log.flush())
+        self.assertEqual(self.log.pending, 0)
+        self.assertEqual(sum(self.backend.batches), 120)
+        self.assertLessEqual(max(self.backend.batches), 50)
+        self.assertLess(len(self.backend.batches), 120)
+
+    def test_close_drains_queue(self) -> None:
+        """Tests close() writes what the worker could not
+        """
+
+        self.backend.failing = True
+        self.log.record("Peter", "add", "github")
+        self.log.record("Peter", "delete", "github")
+        self.assertFalse(self.log.flush(timeout=0.2))
+        self.assertIsNotNone(self.log.last_error)
+
+        self.backend.failing = False
+        self.assertEqual(self.log.close(), 0)
+        self.assertEqual(
+            [event["action"] for event in accesslog.query_events(
+                self.backend, "Peter")], ["delete", "add"])
+
+    def test_partly_written_batch_is_retried(self) -> None:
+        """Tests events stored by a failed attempt are not blocking retries
+        """
+
+        original = storage.MemoryBackend.insert_entries
+        attempts: List[int] = []
+
+        def half_then_fail(backend: Any, database_name: str,
+                           collection_name: str, entries: List[Any]) -> None:
+            attempts.append(len(entries))
+            if len(attempts) == 1:
+                original(backend, database_name, collection_name,
+                         entries[:2])
+                raise ConnectionError("connection reset")
+            original(backend, database_name, collection_name, entries)
+
+        self.backend.gate.clear()
+        for number in range(4):
+            self.log.record("Peter", "view", f"service{number}")
+        with mock.patch.object(storage.MemoryBackend, "insert_entries",
+                               half_then_fail), \
+                mock.patch.object(accesslog, "RETRY_SECONDS", 0.01):
+            self.backend.gate.set()
+            self.assertTrue(self.log.flush(timeout=5))
+
+        self.assertEqual(len(accesslog.query_events(self.backend, "Peter")),
+                         4)
+        self.assertIsNone(self.log.last_error)
+
+    def test_full_queue_drops_oldest(self) -> None:
+        """Tests a full queue keeps the newest events
+        """
+
+        log = accesslog.AccessLog(self.backend, max_queued=3)
+        self.backend.gate.clear()
+        for number in range(6):
+            log.record("Peter", "view", f"service{number}")
+        self.assertGreaterEqual(log.dropped, 2)
+        self.backend.gate.set()
+        self.assertEqual(log.close(), 0)
+
+        services = [event["service"] for event in accesslog.query_events(
+            self.backend, "Peter")]
+        self.assertEqual(len(services) + log.dropped, 6)
+        self.assertEqual(services[0], "service5")
+
+    def test_query_events(self) -> None:
+        """Tests queries by user, service, action and time range
+        """
+
+        now = datetime.now(timezone.utc)
+        self.backend.insert_entries(accesslog.DATABASE, accesslog.COLLECTION, [
+            {'user': 'Peter', 'action': 'view', 'service': None,
+             'at': now - timedelta(days=2)},
+            {'user': 'Peter', 'action': 'update', 'service': 'github',
+             'at': now - timedelta(hours=1)},
+            {'user': 'Paul', 'action': 'update', 'service': 'github',
+             'at': now}])
+
+        self.assertEqual(len(accesslog.query_events(self.backend, "Peter")),
+                         2)
+        self.assertEqual(len(accesslog.query_events(
+            self.backend, service_name="github")), 2)
+        self.assertEqual(len(accesslog.query_events(
+            self.backend, action="update")), 2)
+        recent = accesslog.query_events(self.backend, "Peter",
+                                        since=now - timedelta(days=1))
+        self.assertEqual([event["action"] for event in recent], ["update"])
+        older = accesslog.query_events(
+            self.backend, until=(now - timedelta(days=1)).replace(
+                tzinfo=None))
+        self.assertEqual([event["action"] for event in older], ["view"])
+
+    def test_expired_events_pruned(self) -> None:
+        """Tests events past the retention period are removed
+        """
+
+        now = datetime.now(timezone.utc)
+        self.backend.insert_entries(accesslog.DATABASE, accesslog.COLLECTION, [
+            {'user': 'Peter', 'action': 'view', 'at': now},
+            {'user': 'Peter', 'action': 'view',
+             'at': now - timedelta(days=400)}])
+        accesslog.ensure_indexes(self.backend, retention_days=365)
+        self.assertEqual(len(accesslog.query_events(self.backend)), 1)
+
+    def test_password_manager_records_access(self) -> None:
+        """Tests vault operations are recorded once the log is on
+        """
+
+        self.use_vault(self.backend)
+        vault.configure_access_log(True)
+        self.addCleanup(vault.configure_access_log, False)
+
+        pm.create_user("Peter", "Sup3r$ecret!")
+        self.assertFalse(pm.authenticate_user("Peter", "wrong"))
+        self.assertTrue(pm.authenticate_user("Peter", "Sup3r$ecret!"))
+        vault.add_password("Peter", "github", "p", "pw")
+        pm.update_service("Peter", "github", "p", "pw2")
+        vault.delete_service_and_passwords("Peter", "github")
+
+        assert vault.access_log is not None
+        self.assertTrue(vault.access_log.flush())
+        events = accesslog.query_events(self.backend, "Peter")
+        self.assertEqual([event["action"] for event in reversed(events)],
+                         ["create_user", "login_failed", "login", "add",
+                          "update", "delete"])
+        self.assertEqual(len(accesslog.query_events(
+            self.backend, "Peter", "github")), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
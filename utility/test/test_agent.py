@@ -0,0 +1,215 @@
+"""
+Test module for agent.py
+"""
+
+import os
+import socket
+import threading
+from unittest import mock
+import passwordManager as pm
+from utility import agent
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestAgent(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Starts an agent for a new user on an in-memory backend
+        """
+        self.use_vault()
+        pm.create_user("Peter", "Sup3r$ecret!")
+        vault.add_password("Peter", "github", "peter", "hunter2")
+
+        self.socket_path = os.path.join(self.directory.name, "agent.sock")
+        self.session = agent.VaultSession(ttl=60)
+        self.server = agent.AgentServer(self.socket_path, self.session)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        """Stops the agent
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_socket_permissions(self) -> None:
+        """Tests that only the owner can use the socket
+        """
+
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+        self.assertFalse([name for name in os.listdir(self.directory.name)
+                          if name.startswith(".pm-agent-")])
+
+    def test_socket_in_use(self) -> None:
+        """Tests a second agent refuses to take over a live socket
+        """
+
+        with self.assertRaises(agent.AgentError):
+            agent.AgentServer(self.socket_path, agent.VaultSession())
+
+        with agent.AgentClient(self.socket_path) as client:
+            self.assertEqual(client.request("lock"), None)
+
+    def test_stale_socket(self) -> None:
+        """Tests a socket left by an agent that died is replaced
+        """
+
+        path = os.path.join(self.directory.name, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(path)
+
+        server = agent.AgentServer(path, agent.VaultSession())
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+        with open(path, "w") as other:
+            other.write("not a socket")
+        with self.assertRaises(agent.AgentError):
+            agent.AgentServer(path, agent.VaultSession())
+        self.assertTrue(os.path.exists(path))
+
+    def test_close_stops_reaper(self) -> None:
+        """Tests closing the server stops its idle reaper thread
+        """
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertFalse(self.server._reaper.is_alive())
+
+    def test_locked_until_unlocked(self) -> None:
+        """Tests that requests fail until the master password is given
+        """
+
+        with agent.AgentClient(self.socket_path) as client:
+            with self.assertRaises(agent.AgentError):
+                client.get("github")
+            with self.assertRaises(agent.AgentError):
+                client.unlock("Peter", "wrong")
+
+            client.unlock("Peter", "Sup3r$ecret!")
+            entry = client.get("github")
+
+        self.assertEqual(entry['username_entry'], 'peter')
+        self.assertEqual(entry['password'], 'hunter2')
+
+    def test_crud(self) -> None:
+        """Tests add, update, list and delete through the agent
+        """
+
+        with agent.AgentClient(self.socket_path) as client:
+            client.unlock("Peter", "Sup3r$ecret!")
+            client.add("gitlab", "pete", "pw1")
+            client.update("gitlab", "pete2", "pw2")
+
+            self.assertEqual(client.get("gitlab")['password'], 'pw2')
+            self.assertEqual(sorted(e['service_name'] for e in client.list()),
+                             ['github', 'gitlab'])
+
+            client.delete("gitlab")
+            with self.assertRaises(agent.AgentError):
+                client.get("gitlab")
+
+        stored = vault.storage.find_entries("passwords", "Peter")
+        self.assertEqual([e['service_name'] for e in stored], ['github'])
+
+    def test_match(self) -> None:
+        """Tests entries are found by the URL of a page
+        """
+
+        vault.add_password("Peter", "google", "peter", "pw1",
+                           ["https://google.com"])
+        vault.add_password("Peter", "google-ads", "ads", "pw2",
+                           ["https://ads.google.com/login"])
+
+        with agent.AgentClient(self.socket_path) as client:
+            client.unlock("Peter", "Sup3r$ecret!")
+            found = client.match("https://ads.google.com/login?next=/")
+            self.assertEqual([e['service_name'] for e in found],
+                             ['google-ads', 'google'])
+            self.assertEqual(found[0]['password'], 'pw2')
+            self.assertEqual(client.match("https://google.co.uk/"), [])
+            # Answered from the indexed query, without loading the vault
+            self.assertIsNone(self.session._cache)
+
+            client.add("mail", "peter", "pw3", ["mail.google.com"])
+            self.assertEqual(client.match("https://mail.google.com/")[0][
+                'service_name'], 'mail')
+            client.update("mail", "peter", "pw4")
+            self.assertEqual(client.match("https://mail.google.com/")[0][
+                'password'], 'pw4')
+            client.delete("google-ads")
+            self.assertEqual(
+                [e['service_name']
+                 for e in client.match("https://ads.google.com/login")],
+                ['google', 'mail'])
+
+    def test_concurrent_clients(self) -> None:
+        """Tests many clients reading at once
+        """
+
+        with agent.AgentClient(self.socket_path) as client:
+            client.unlock("Peter", "Sup3r$ecret!")
+
+        errors = []
+
+        def worker() -> None:
+            with agent.AgentClient(self.socket_path) as client:
+                for _ in range(20):
+                    if client.get("github")['password'] != 'hunter2':
+                        errors.append("wrong password")
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_unexpected_errors_are_replied(self) -> None:
+        """Tests any failure is reported and the connection stays usable
+        """
+
+        with agent.AgentClient(self.socket_path) as client:
+            client.unlock("Peter", "Sup3r$ecret!")
+            with self.assertRaises(agent.AgentError):
+                client.request("add", service_name="gitlab",
+                               username_entry="pete", password_entry=5)
+            with mock.patch.object(self.session, "get",
+                                   side_effect=RuntimeError("storage down")):
+                with self.assertRaisesRegex(agent.AgentError,
+                                            "RuntimeError: storage down"):
+                    client.get("github")
+            self.assertEqual(client.get("github")['password'], 'hunter2')
+
+    def test_client_reports_closed_connection(self) -> None:
+        """Tests the command line client fails cleanly if the agent hangs up
+        """
+
+        path = os.path.join(self.directory.name, "closing.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        def hang_up() -> None:
+            connection, _ = listener.accept()
+            connection.close()
+
+        threading.Thread(target=hang_up, daemon=True).start()
+        with mock.patch("sys.stderr"):
+            self.assertEqual(agent.main(["--socket", path, "list"]), 1)
+
+    def test_idle_ttl(self) -> None:
+        """Tests that an idle session locks itself
+        """
+
+        self.session.unlock("Peter", "Sup3r$ecret!")
+        self.session.ttl = 0
+
+        self.assertTrue(self.session.expire_if_idle())
+        with self.assertRaises(agent.AgentError):
+            self.session.get("github")
@@ -0,0 +1,133 @@
+"""
+Test module for attachments.py
+"""
+
+import io
+import os
+import tempfile
+from cryptography.fernet import Fernet, InvalidToken
+from typing import Any
+from unittest import mock
+import passwordManager as pm
+from utility import attachments
+from utility import storage
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestAttachments(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a document store with small chunks
+        """
+        self.store_directory = tempfile.TemporaryDirectory()
+        self.backend = storage.SQLiteBackend(
+            os.path.join(self.store_directory.name, "pm.db"))
+        self.store = attachments.DocumentStore(self.backend)
+        self.key = Fernet.generate_key()
+        self.patch = mock.patch.object(attachments, "CHUNK_SIZE", 1000)
+        self.patch.start()
+
+    def tearDown(self) -> None:
+        """Closes the database
+        """
+        self.patch.stop()
+        self.backend.close()
+        self.store_directory.cleanup()
+
+    def upload(self, content: bytes, name: str = "id_rsa") -> Any:
+        return attachments.upload(self.store, self.key, "Peter", "github",
+                                  name, io.BytesIO(content), block_size=256)
+
+    def test_stream_round_trip(self) -> None:
+        """Tests files of every record boundary decrypt block by block
+        """
+
+        for size in (0, 1, 256, 257, 5000):
+            content = os.urandom(size)
+            attachment = self.upload(content)
+            blocks = list(attachments.iter_content(
+                self.store, self.key, "Peter", attachment.file_id))
+            self.assertEqual(b"".join(blocks), content)
+            self.assertTrue(all(len(block) <= 256 for block in blocks))
+
+        listed = attachments.list_attachments(self.store, self.key, "Peter")
+        self.assertEqual([item.length for item in listed],
+                         [0, 1, 256, 257, 5000])
+        self.assertEqual(listed[0].name, "id_rsa")
+
+        target = os.path.join(self.store_directory.name, "saved")
+        self.assertEqual(attachments.save(self.store, self.key, "Peter",
+                                          listed[-1].file_id, target), 5000)
+        self.assertEqual(os.stat(target).st_mode & 0o777, 0o600)
+
+    def test_tampering_detected(self) -> None:
+        """Tests files cut at a record boundary or reordered fail
+        """
+
+        record = 256 + 29
+        for cut in (False, True):
+            attachment = self.upload(os.urandom(3 * 256))
+            query = {'files_id': attachment.file_id}
+            data = self.backend.find_entries(attachments.DATABASE,
+                                             "Peter.chunks", query)[0]['data']
+            if cut:
+                data = data[:2 * record]
+            else:
+                data = data[record:2 * record] + data[:record] + \
+                    data[2 * record:]
+            self.backend.update_entry(attachments.DATABASE, "Peter.chunks",
+                                      query, {'data': data})
+            self.backend.update_entry(attachments.DATABASE, "Peter.files",
+                                      {'_id': attachment.file_id},
+                                      {'length': len(data)})
+
+            with self.assertRaises(InvalidToken):
+                b"".join(attachments.iter_content(
+                    self.store, self.key, "Peter", attachment.file_id))
+
+    def test_notes_and_deletes(self) -> None:
+        """Tests notes are listed without their content and removed
+        """
+
+        note = attachments.add_note(self.store, self.key, "Peter", "mail",
+                                    "Recovery codes", "1234 5678")
+        self.upload(b"key")
+        with mock.patch.object(self.backend, "iter_entries") as chunks:
+            listed = attachments.list_attachments(self.store, self.key,
+                                                  "Peter", "mail")
+        chunks.assert_not_called()
+        self.assertEqual([(item.kind, item.name) for item in listed],
+                         [("note", "Recovery codes")])
+        self.assertEqual(attachments.read_note(self.store, self.key, "Peter",
+                                               note.file_id), "1234 5678")
+
+        self.assertEqual(attachments.delete_service_attachments(
+            self.store, "Peter", "mail"), 1)
+        with self.assertRaises(attachments.AttachmentError):
+            attachments.read_note(self.store, self.key, "Peter",
+                                  note.file_id)
+        self.store.delete_all("Peter")
+        self.assertEqual(self.store.list_files("Peter"), [])
+
+    def test_password_manager(self) -> None:
+        """Tests entries own their attachments through pm
+        """
+
+        self.use_vault()
+        with open("codes.txt", "wb") as codes:
+            codes.write(b"1234")
+
+        pm.create_user("Peter", "Sup3r$ecret!")
+        self.assertFalse(pm.add_attachment("Peter", "github",
+                                           "codes.txt"))
+        vault.add_password("Peter", "github", "peter", "hunter2")
+        self.assertTrue(pm.add_attachment("Peter", "github",
+                                          "codes.txt"))
+        self.assertTrue(pm.add_secure_note("Peter", "github", "PIN",
+                                           "0000"))
+        store = attachments.store_for(vault.storage)
+        self.assertEqual(len(store.list_files("Peter")), 2)
+
+        vault.delete_service_and_passwords("Peter", "github")
+        self.assertEqual(store.list_files("Peter"), [])
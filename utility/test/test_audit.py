@@ -0,0 +1,122 @@
+"""
+Test module for audit.py
+"""
+
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+from unittest import mock
+import passwordManager as pm
+from utility import audit
+from utility import storage
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestAudit(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a small vault in an in-memory backend
+        """
+        self.backend = storage.MemoryBackend()
+        self.fernet_key = vault.generate_user_fernet_key()
+
+        old = datetime.now(timezone.utc) - timedelta(days=400)
+        entries = [('github', 'correct-Horse-battery-st4ple!', None),
+                   ('gitlab', 'correct-Horse-battery-st4ple!', None),
+                   ('bank', 'abc', None),
+                   ('mail', 'Zq8#vP2!mW9$kT4&xR7@', old)]
+
+        documents = []
+        for service_name, password, updated_at in entries:
+            document = {'username': 'Peter',
+                        'service_name': service_name,
+                        'username_entry': 'peter',
+                        'password_entry': vault.encrypt_password(
+                            self.fernet_key, password)}
+            if updated_at is not None:
+                document['updated_at'] = updated_at
+            documents.append(document)
+        self.backend.insert_entries("passwords", "Peter", documents)
+
+    def test_audit_vault(self) -> None:
+        """Tests reused, weak and old entries are reported
+        """
+
+        report = audit.audit_vault(self.backend, "Peter", self.fernet_key,
+                                   batch_size=2)
+
+        self.assertEqual(report.total, 4)
+        self.assertEqual(report.reused, [['github', 'gitlab']])
+        self.assertEqual([service for service, _ in report.weak], ['bank'])
+        self.assertEqual([service for service, _ in report.old], ['mail'])
+
+    def test_stale_entries(self) -> None:
+        """Tests stale and undated entries are listed without decrypting
+        """
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        sqlite = storage.SQLiteBackend(os.path.join(directory.name, "db"))
+        self.addCleanup(sqlite.close)
+        now = datetime.now(timezone.utc)
+
+        expected: List[Tuple[storage.StorageBackend, List[str]]] = [
+            (self.backend, ['forum', 'mail', 'github', 'gitlab', 'bank']),
+            (sqlite, ['forum'])]
+        for backend, services in expected:
+            backend.insert_entries("passwords", "Peter", [
+                {'username': 'Peter', 'service_name': 'forum',
+                 'updated_at': now - timedelta(days=800)},
+                {'username': 'Peter', 'service_name': 'shop',
+                 'updated_at': now - timedelta(days=10)}])
+            with mock.patch.object(vault, "decrypt_password") as decrypt:
+                stale = audit.stale_entries(backend, "Peter", 365, now)
+            decrypt.assert_not_called()
+            with mock.patch.object(backend, "find_entries",
+                                   wraps=backend.find_entries) as find:
+                audit.stale_entries(backend, "Peter", 365, now)
+            for call in find.call_args_list:
+                self.assertEqual(call.args[3], ['service_name', 'updated_at'])
+            self.assertEqual([service for service, _ in stale][:2],
+                             services[:2])
+            self.assertCountEqual([service for service, _ in stale],
+                                  services)
+
+    def test_entries_timestamped(self) -> None:
+        """Tests adding and updating an entry record when it changed
+        """
+
+        self.use_vault(self.backend)
+
+        pm.create_user("Paul", "Sup3r$ecret!")
+        vault.add_password("Paul", "github", "paul", "pw")
+        added = self.backend.find_entries("passwords", "Paul")[0]
+        self.assertEqual(added['created_at'], added['updated_at'])
+        pm.update_service("Paul", "github", "paul", "pw2")
+
+        updated = self.backend.find_entries("passwords", "Paul")[0]
+        self.assertEqual(updated['created_at'], added['created_at'])
+        self.assertGreaterEqual(updated['updated_at'],
+                                added['created_at'])
+        self.assertEqual(audit.stale_entries(self.backend, "Paul", 0,
+                                             updated['updated_at']), [])
+
+    def test_new_vaults_are_indexed(self) -> None:
+        """Tests the age index is created together with the vault
+        """
+
+        self.use_vault(self.backend)
+
+        with mock.patch.object(audit, "ensure_age_index") as index:
+            pm.create_user("Paul", "Sup3r$ecret!")
+        index.assert_called_once_with(vault.storage, "Paul")
+
+    def test_score_password(self) -> None:
+        """Tests the strength score range
+        """
+
+        self.assertEqual(audit.score_password(''), 0)
+        self.assertEqual(audit.score_password('abc'), 0)
+        self.assertEqual(audit.score_password('Zq8#vP2!mW9$kT4&xR7@'), 4)
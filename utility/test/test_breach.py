@@ -0,0 +1,66 @@
+"""
+Test module for breach.py
+"""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from utility import breach
+
+BREACHED = ['password', '123456', 'Password1!', 'qwerty']
+
+
+def sha1_line(password: str) -> str:
+    """Returns a corpus line for a password
+    """
+    return hashlib.sha1(password.encode()).hexdigest().upper() + ":42\n"
+
+
+class TestBreach(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Builds a small binary corpus in a temporary directory
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "corpus.bin")
+        lines = sorted(sha1_line(password) for password in BREACHED)
+        self.count = breach.convert_corpus(lines, self.path)
+
+    def tearDown(self) -> None:
+        """Removes the temporary corpus
+        """
+        self.directory.cleanup()
+
+    def test_lookup(self) -> None:
+        """Tests breached and unknown passwords
+        """
+
+        self.assertEqual(self.count, len(BREACHED))
+
+        with breach.BreachChecker(self.path) as checker:
+            for password in BREACHED:
+                self.assertTrue(checker.is_breached(password))
+            self.assertFalse(checker.is_breached('Zq8#vP2!mW9$kT4&xR7@'))
+            self.assertFalse(checker.contains_hash(b'\xff' * 20))
+            self.assertGreater(breach.benchmark(checker, 1000), 0)
+
+    def test_unsorted_corpus(self) -> None:
+        """Tests that an unsorted text corpus is rejected
+        """
+
+        lines = sorted(sha1_line(password) for password in BREACHED)
+        lines.reverse()
+
+        with self.assertRaises(breach.CorpusFormatError):
+            breach.convert_corpus(lines, self.path)
+
+    def test_not_a_corpus(self) -> None:
+        """Tests that other files are rejected
+        """
+
+        with open(self.path, "wb") as corpus:
+            corpus.write(b"not a corpus")
+
+        with self.assertRaises(breach.CorpusFormatError):
+            breach.BreachChecker(self.path)
@@ -0,0 +1,95 @@
+"""
+Test module for consistency.py
+"""
+
+import os
+import passwordManager as pm
+from utility import attachments
+from utility import consistency
+from utility import history
+from utility import merkle
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestConsistency(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates users and then breaks them in every supported way
+        """
+        self.backend = self.use_vault()
+        for username in ("Peter", "Paul", "Mary", "Keyless"):
+            pm.create_user(username, "Sup3r$ecret!")
+            vault.add_password(username, "github", username.lower(), "hunter2")
+
+        # A crash after dropping the user but before the vault and key
+        self.backend.delete_entry("users", "names", {'username': 'Paul'})
+        # A crash after creating the user but before writing the key
+        os.remove("user_Keyless_fernet.key")
+        # An entry written with another key
+        self.backend.insert_entry("passwords", "Mary", {
+            'username': 'Mary', 'service_name': 'bank',
+            'username_entry': 'mary',
+            'password_entry': vault.encrypt_password(
+                vault.generate_user_fernet_key(), "secret")})
+
+    def test_check_and_repair(self) -> None:
+        """Tests every kind of orphan is found and removed
+        """
+
+        report = consistency.check_consistency(self.backend, workers=4)
+
+        self.assertEqual(report.users, 3)
+        self.assertEqual(report.users_without_keys, ['Keyless'])
+        self.assertEqual(report.vaults_without_users, ['Paul'])
+        self.assertEqual(report.keys_without_users, ['Paul'])
+        self.assertEqual(report.undecryptable, [('Mary', 'bank')])
+        self.assertEqual(report.vaults_checked, 2)
+        self.assertEqual(report.entries_checked, 3)
+        self.assertFalse(report.consistent)
+
+        actions = consistency.repair(self.backend, report,
+                                     drop_keyless_users=True)
+        self.assertEqual(len(actions), 3)
+        self.assertFalse(os.path.exists("user_Paul_fernet.key"))
+        self.assertEqual(self.backend.find_entries(
+            "users", "names", {'username': 'Keyless'}), [])
+
+        remaining = consistency.check_consistency(self.backend, sample=0.0)
+        self.assertEqual(remaining.vaults_checked, 0)
+        self.assertTrue(remaining.consistent)
+
+    def test_orphaned_user_data(self) -> None:
+        """Tests history, digests and attachments without a user are found
+        """
+
+        history.record(self.backend, "Paul",
+                       self.backend.find_entries("passwords", "Paul")[0])
+        attachments.add_note(attachments.store_for(self.backend),
+                             vault.generate_user_fernet_key(), "Keyless",
+                             "github", "Codes", "recovery codes")
+        self.backend.delete_collection("passwords", "Paul")
+
+        report = consistency.check_consistency(self.backend, workers=4)
+        self.assertEqual(report.vaults_without_users, [])
+        self.assertEqual(report.data_without_users, ['Paul'])
+
+        consistency.repair(self.backend, report, drop_keyless_users=True)
+        for username in ("Paul", "Keyless"):
+            self.assertEqual(consistency.list_data_owners(self.backend)
+                             & {username}, set())
+            self.assertNotIn(username, self.backend.list_collection_names(
+                "passwords"))
+        self.assertIn("Peter.nodes", self.backend.list_collection_names(
+            merkle.DATABASE))
+        self.assertTrue(consistency.check_consistency(
+            self.backend, sample=0.0).consistent)
+
+    def test_wrong_key(self) -> None:
+        """Tests a key that does not open the master password is reported
+        """
+
+        vault.store_fernet_key_locally(vault.generate_user_fernet_key(),
+                                       "Peter")
+        report = consistency.check_consistency(self.backend)
+        self.assertEqual(report.wrong_keys, ['Peter'])
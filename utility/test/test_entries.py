@@ -0,0 +1,61 @@
+"""
+Test module for entries.py
+"""
+
+import hashlib
+import unittest
+from utility import entries
+from utility import storage
+from utility import vault
+
+
+class TestEntries(unittest.TestCase):
+
+    def test_secret_wipe(self) -> None:
+        """Tests a secret can be read and hashed until it is wiped
+        """
+
+        secret = entries.Secret(b"hunter2")
+        buffer = secret._buffer
+        self.assertEqual(secret.reveal(), "hunter2")
+        self.assertEqual(secret.digest("sha1"),
+                         hashlib.sha1(b"hunter2").digest())
+        self.assertNotIn("hunter2", repr(secret))
+
+        with secret:
+            pass
+        self.assertEqual(len(secret), 0)
+        self.assertEqual(buffer, bytearray())
+
+    def test_vault_entries(self) -> None:
+        """Tests entries are read in batches, decrypted and wiped
+        """
+
+        backend = storage.MemoryBackend()
+        fernet_key = vault.generate_user_fernet_key()
+        backend.insert_entries("passwords", "Peter", [
+            {'username': 'Peter', 'service_name': f"s{number}",
+             'username_entry': 'peter',
+             'password_entry': vault.encrypt_password(fernet_key,
+                                                      f"p{number}")}
+            for number in range(5)])
+
+        batches = list(entries.iter_vault_entries(backend, "Peter", 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+        loaded = entries.load_vault_entries(backend, "Peter")
+        self.assertFalse(hasattr(loaded[0], "__dict__"))
+        entries.decrypt_entries(fernet_key, loaded)
+        self.assertEqual([entry.secret.reveal() for entry in loaded
+                          if entry.secret is not None],
+                         [f"p{number}" for number in range(5)])
+
+        entries.wipe_entries(loaded)
+        self.assertTrue(all(entry.secret is None for entry in loaded))
+
+    def test_measure_memory(self) -> None:
+        """Tests the slotted layout is smaller than documents
+        """
+
+        documents, vault_entries = entries.measure_memory(1000)
+        self.assertLess(vault_entries, documents)
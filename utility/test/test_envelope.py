@@ -0,0 +1,71 @@
+"""
+Test module for envelope.py
+"""
+
+from cryptography.fernet import Fernet, InvalidToken
+import passwordManager as pm
+from utility import envelope
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestEnvelope(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a user key
+        """
+        self.key = Fernet.generate_key()
+        self.cipher = envelope.Cipher(self.key)
+
+    def test_round_trip_and_size(self) -> None:
+        """Tests envelopes decrypt and are smaller than Fernet tokens
+        """
+
+        token = self.cipher.encrypt(b"hunter2")
+        self.assertEqual(token[0], envelope.AESGCM_VERSION)
+        self.assertEqual(self.cipher.decrypt(token), b"hunter2")
+        self.assertLess(len(token),
+                        len(Fernet(self.key).encrypt(b"hunter2")) / 2)
+
+    def test_fernet_tokens_still_decrypt(self) -> None:
+        """Tests existing Fernet tokens are read, as bytes or text
+        """
+
+        token = Fernet(self.key).encrypt(b"hunter2")
+        self.assertEqual(self.cipher.decrypt(token), b"hunter2")
+        self.assertEqual(self.cipher.decrypt(token.decode()), b"hunter2")
+
+    def test_rejects_tampering_and_other_keys(self) -> None:
+        """Tests modified or foreign ciphertexts raise InvalidToken
+        """
+
+        token = bytearray(self.cipher.encrypt(b"hunter2"))
+        token[-1] ^= 1
+        for bad in (bytes(token), token[:10],
+                    envelope.Cipher(Fernet.generate_key()).encrypt(b"x")):
+            with self.assertRaises(InvalidToken):
+                self.cipher.decrypt(bytes(bad))
+
+    def test_entries_upgraded_on_write(self) -> None:
+        """Tests a Fernet entry is rewritten as an envelope when updated
+        """
+
+        self.use_vault()
+
+        pm.create_user("Peter", "Sup3r$ecret!")
+        key = vault.load_fernet_key_locally("Peter")
+        vault.storage.insert_entry("passwords", "Peter", {
+            'username': 'Peter', 'service_name': 'github',
+            'username_entry': 'peter',
+            'password_entry': Fernet(key).encrypt(b"hunter2")})
+
+        stored = vault.storage.find_entries("passwords", "Peter")[0]
+        self.assertEqual(vault.decrypt_password(key, stored['password_entry']),
+                         "hunter2")
+        self.assertTrue(pm.update_service("Peter", "github", "peter",
+                                          "correct horse"))
+        stored = vault.storage.find_entries("passwords", "Peter")[0]
+        self.assertEqual(stored['password_entry'][0],
+                         envelope.AESGCM_VERSION)
+        self.assertEqual(vault.decrypt_password(key, stored['password_entry']),
+                         "correct horse")
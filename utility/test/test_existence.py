@@ -0,0 +1,131 @@
+"""
+Test module for existence.py
+"""
+
+from typing import Any, Dict, List
+import passwordManager as pm
+from utility import existence
+from utility import storage
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class CountingBackend(storage.ForwardingBackend):
+    """MemoryBackend recording the reads that reach it
+    """
+
+    def __init__(self) -> None:
+        super().__init__(storage.MemoryBackend())
+        self.reads: List[Any] = []
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        self.reads.append(("count", collection_name, entries))
+        return self.inner.count_entries(database_name, collection_name,
+                                        entries, limit)
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = storage.DEFAULT_BATCH_SIZE) -> Any:
+        self.reads.append(("scan", collection_name, entries))
+        return self.inner.iter_entries(database_name, collection_name,
+                                       entries, batch_size)
+
+
+class TestExistence(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates an existence cache over a counting backend
+        """
+        self.inner = CountingBackend()
+        self.backend = existence.ExistenceBackend(self.inner)
+
+    def test_bloom_filter(self) -> None:
+        """Tests added items are found and few others are
+        """
+
+        bloom = existence.BloomFilter(1000)
+        for number in range(1000):
+            bloom.add(f"service{number}")
+        self.assertTrue(all(f"service{number}" in bloom
+                            for number in range(1000)))
+        false_positives = sum(f"other{number}" in bloom
+                              for number in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertFalse(bloom.full)
+
+    def test_user_answers_cached(self) -> None:
+        """Tests user checks reach the backend once and follow writes
+        """
+
+        query = {'username': 'Peter'}
+        self.assertEqual(self.backend.count_entries("users", "names", query,
+                                                    limit=1), 0)
+        self.assertEqual(self.backend.count_entries("users", "names", query,
+                                                    limit=1), 0)
+        self.assertEqual(len(self.inner.reads), 1)
+
+        self.backend.insert_entry("users", "names", {'username': 'Peter'})
+        self.assertEqual(self.backend.count_entries("users", "names", query,
+                                                    limit=1), 1)
+        self.backend.delete_entries("users", "names", query)
+        self.assertEqual(self.backend.count_entries("users", "names", query,
+                                                    limit=1), 0)
+        self.assertEqual(len(self.inner.reads), 1)
+
+        self.backend.clear()
+        self.backend.count_entries("users", "names", query, limit=1)
+        self.assertEqual(len(self.inner.reads), 2)
+
+    def test_service_checks_use_filter(self) -> None:
+        """Tests repeated misses are answered by the vault's Bloom filter
+        """
+
+        self.backend.insert_entries("passwords", "Peter", [
+            {'service_name': f"service{number}"} for number in range(50)])
+
+        def exists(name: str) -> int:
+            return self.backend.count_entries(
+                "passwords", "Peter", {'service_name': name}, limit=1)
+
+        self.assertEqual(exists("new0"), 0)
+        self.assertEqual(exists("new1"), 0)
+        self.assertEqual(exists("new2"), 0)
+        scans = [read for read in self.inner.reads if read[0] == "scan"]
+        self.assertEqual(len(scans), 1)
+
+        reads = len(self.inner.reads)
+        for number in range(3, 100):
+            exists(f"new{number}")
+        self.assertLess(len(self.inner.reads) - reads, 10)
+
+        self.assertEqual(exists("service7"), 1)
+        self.backend.insert_entry("passwords", "Peter",
+                                  {'service_name': 'new50'})
+        self.assertEqual(exists("new50"), 1)
+        self.backend.delete_entries("passwords", "Peter",
+                                    {'service_name': 'service7'})
+        self.assertEqual(exists("service7"), 0)
+
+        self.backend.delete_collection("passwords", "Peter")
+        reads = len(self.inner.reads)
+        self.assertEqual(exists("new50"), 0)
+        self.assertEqual(len(self.inner.reads), reads)
+
+    def test_password_manager_checks(self) -> None:
+        """Tests user_exists filters unknown users
+        """
+
+        self.use_vault(self.backend)
+
+        self.assertFalse(vault.user_exists("Peter"))
+        self.assertFalse(vault.add_password("Peter", "github", "p", "pw"))
+        pm.create_user("Peter", "Sup3r$ecret!")
+        self.assertTrue(vault.user_exists("Peter"))
+        self.assertTrue(vault.add_password("Peter", "github", "p", "pw"))
+        self.assertTrue(vault.service_exists("Peter", "github"))
+        self.assertTrue(vault.delete_service_and_passwords("Peter",
+                                                           "github"))
+        self.assertFalse(vault.service_exists("Peter", "github"))
+        self.assertFalse(pm.delete_user("Paul"))
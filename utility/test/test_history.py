@@ -0,0 +1,97 @@
+"""
+Test module for history.py
+"""
+
+import unittest
+from typing import List
+from unittest import mock
+import passwordManager as pm
+from utility import history
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestHistory(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a user with one entry on an in-memory backend
+        """
+        self.backend = self.use_vault()
+        pm.create_user("Peter", "Sup3r$ecret!")
+        vault.add_password("Peter", "github", "peter", "pw0")
+        self.fernet_key = vault.load_fernet_key_locally("Peter")
+
+    def passwords(self) -> List[str]:
+        """Returns the decrypted history of github, newest first
+        """
+
+        return [version.decrypt(self.fernet_key).reveal()
+                for version in history.versions(self.backend, "Peter",
+                                                "github")]
+
+    def test_updates_keep_bounded_history(self) -> None:
+        """Tests updates keep the newest replaced passwords only
+        """
+
+        for number in range(1, history.HISTORY_LIMIT + 3):
+            pm.update_service("Peter", "github", "peter", f"pw{number}")
+
+        self.assertEqual(self.passwords(),
+                         [f"pw{number}" for number in
+                          range(history.HISTORY_LIMIT + 1, 1, -1)])
+        stored = self.backend.find_entries("passwords", "Peter")
+        self.assertEqual(len(stored), 1)
+        self.assertNotIn('history', stored[0])
+
+    def test_restore(self) -> None:
+        """Tests a restored password becomes current and can be undone
+        """
+
+        pm.update_service("Peter", "github", "peter2", "pw1")
+        pm.update_service("Peter", "github", "peter3", "pw2")
+        self.assertEqual(self.passwords(), ["pw1", "pw0"])
+
+        self.assertTrue(vault.restore_password("Peter", "github", 2))
+        current = self.backend.find_entries("passwords", "Peter")[0]
+        self.assertEqual(current['username_entry'], 'peter')
+        self.assertEqual(vault.decrypt_password(self.fernet_key,
+                                                current['password_entry']),
+                         "pw0")
+        self.assertEqual(self.passwords(), ["pw2", "pw1"])
+
+        self.assertFalse(vault.restore_password("Peter", "github", 3))
+        self.assertFalse(vault.restore_password("Peter", "gitlab", 1))
+
+    def test_lost_update_keeps_no_history(self) -> None:
+        """Tests nothing is recorded when another session won the update
+        """
+
+        pm.update_service("Peter", "github", "peter", "pw1")
+        with mock.patch.object(self.backend, "update_entry",
+                               return_value=False):
+            self.assertFalse(pm.update_service("Peter", "github", "peter",
+                                               "pw2"))
+            self.assertFalse(vault.restore_password("Peter", "github", 1))
+
+        self.assertEqual(self.passwords(), ["pw0"])
+
+    def test_deleted_with_entry(self) -> None:
+        """Tests deleting the entry or the user deletes its history
+        """
+
+        pm.update_service("Peter", "github", "peter", "pw1")
+        vault.add_password("Peter", "gitlab", "peter", "pw0")
+        pm.update_service("Peter", "gitlab", "peter", "pw1")
+
+        vault.delete_service_and_passwords("Peter", "github")
+        self.assertEqual(self.passwords(), [])
+        self.assertEqual(len(history.versions(self.backend, "Peter",
+                                              "gitlab")), 1)
+
+        pm.delete_user("Peter")
+        self.assertNotIn("Peter",
+                         self.backend.list_collection_names(history.DATABASE))
+
+
+if __name__ == '__main__':
+    unittest.main()
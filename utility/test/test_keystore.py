@@ -0,0 +1,141 @@
+"""
+Test module for keystore.py
+"""
+
+import os
+from unittest import mock
+import passwordManager as pm
+from utility import keystore
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestKeystore(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a keystore with a cheap key derivation
+        """
+        self.use_vault()
+        patch = mock.patch.object(keystore, "SCRYPT_N", 16)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.store = keystore.Keystore("keys.db")
+
+    def tearDown(self) -> None:
+        """Closes the keystore
+        """
+        self.store.close()
+        vault.keystore = None
+
+    def test_put_get_delete(self) -> None:
+        """Tests keys are wrapped, replaced and deleted
+        """
+
+        self.store.put("Peter", b"key-1", "passphrase")
+        self.assertIn("Peter", self.store)
+        self.assertEqual(self.store.get_key("Peter", "passphrase"), b"key-1")
+        with self.assertRaises(keystore.KeystoreError):
+            self.store.get_key("Peter", "wrong")
+        with self.assertRaises(KeyError):
+            self.store.get_key("Paul", "passphrase")
+
+        self.store.put("Peter", b"key-2", "changed")
+        self.assertEqual(self.store.get_key("Peter", "changed"), b"key-2")
+        self.assertTrue(self.store.delete("Peter"))
+        self.assertNotIn("Peter", self.store)
+        self.assertFalse(self.store.delete("Peter"))
+
+    def test_put_many_delete_many(self) -> None:
+        """Tests keys stored and removed in bulk, growing the table
+        """
+
+        keys = [(f"user{number}", f"key-{number}".encode(), f"pw{number}")
+                for number in range(40)]
+        self.assertEqual(self.store.put_many(keys, workers=2), 40)
+        self.assertEqual(len(self.store.names()), 40)
+        self.assertEqual(self.store.get_key("user39", "pw39"), b"key-39")
+
+        self.assertEqual(self.store.delete_many(
+            ["user0", "user1", "nobody"]), 2)
+        self.assertNotIn("user0", self.store)
+        self.assertEqual(self.store.get_key("user2", "pw2"), b"key-2")
+        self.assertEqual(self.store.put_many([]), 0)
+
+    def test_growth_seen_by_other_readers(self) -> None:
+        """Tests appends and compaction reach a second open keystore
+        """
+
+        reader = keystore.Keystore("keys.db")
+        self.addCleanup(reader.close)
+
+        for number in range(200):
+            self.store.put(f"user{number}", f"key{number}".encode(), "pw")
+        self.store.delete("user7")
+        self.store.compact()
+
+        self.assertEqual(len(reader.names()), 199)
+        self.assertEqual(reader.get_key("user150", "pw"), b"key150")
+        self.assertNotIn("user7", reader)
+        self.assertFalse(os.path.exists("keys.db.tmp"))
+
+    def test_migration(self) -> None:
+        """Tests key files move into the keystore, in bulk or at login
+        """
+
+        pm.create_user("Peter", "Sup3r$ecret!")
+        pm.create_user("Paul", "Sup3r$ecret!")
+        peter_key = vault.load_fernet_key_locally("Peter")
+
+        migrated = keystore.migrate_key_files(self.store, vault.storage,
+                                              remove=True)
+        self.assertEqual(migrated, ["Paul", "Peter"])
+        self.assertFalse(os.path.exists("user_Peter_fernet.key"))
+        self.assertEqual(self.store.get_key("Peter", "Sup3r$ecret!"),
+                         peter_key)
+
+        vault.keystore = self.store
+        pm.create_user("Mary", "Sup3r$ecret!")
+        self.assertFalse(os.path.exists("user_Mary_fernet.key"))
+        self.assertFalse(pm.authenticate_user("Mary", "wrong"))
+        self.assertTrue(pm.authenticate_user("Mary", "Sup3r$ecret!"))
+        self.assertTrue(vault.add_password("Mary", "github", "mary",
+                                           "hunter2"))
+        vault.forget_fernet_key("Mary")
+
+        vault.keystore = None
+        pm.create_user("Anne", "Sup3r$ecret!")
+        vault.keystore = self.store
+        self.assertTrue(pm.authenticate_user("Anne", "Sup3r$ecret!"))
+        self.assertIn("Anne", self.store)
+        self.assertFalse(os.path.exists("user_Anne_fernet.key"))
+        vault.forget_fernet_key("Anne")
+
+    def test_change_master_password(self) -> None:
+        """Tests a failed or interrupted change never locks the user out
+        """
+
+        vault.keystore = self.store
+        pm.create_user("Mary", "Sup3r$ecret!")
+        self.assertTrue(pm.authenticate_user("Mary", "Sup3r$ecret!"))
+
+        with mock.patch.object(vault.storage, "update_entry",
+                               side_effect=OSError("connection lost")):
+            with self.assertRaises(OSError):
+                pm.update_user_master_password("Mary", "N3w-Pa$$phrase!")
+        self.assertTrue(pm.authenticate_user("Mary", "Sup3r$ecret!"))
+
+        self.assertTrue(pm.update_user_master_password("Mary",
+                                                       "N3w-Pa$$phrase!"))
+        vault.forget_fernet_key("Mary")
+        self.assertFalse(pm.authenticate_user("Mary", "Sup3r$ecret!"))
+        self.assertTrue(pm.authenticate_user("Mary", "N3w-Pa$$phrase!"))
+
+        # A crash after the key was rewrapped, before the record changed
+        self.store.put("Mary", vault.load_fernet_key_locally("Mary"),
+                       "L4test-Pa$$phrase!")
+        vault.forget_fernet_key("Mary")
+        self.assertTrue(pm.authenticate_user("Mary", "L4test-Pa$$phrase!"))
+        vault.forget_fernet_key("Mary")
+        self.assertTrue(pm.authenticate_user("Mary", "L4test-Pa$$phrase!"))
+        self.assertFalse(pm.authenticate_user("Mary", "N3w-Pa$$phrase!"))
+        vault.forget_fernet_key("Mary")
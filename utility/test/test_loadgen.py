@@ -0,0 +1,97 @@
+"""
+Test module for loadgen.py
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+import passwordManager as pm
+from utility import loadgen
+from utility import storage
+from utility import utility
+from utility import vault
+
+
+class TestLoadgen(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Selects an in-memory backend and a directory for key files
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        vault.set_storage_backend(storage.MemoryBackend())
+
+    def tearDown(self) -> None:
+        """Restores the working directory
+        """
+        os.chdir(self.old_cwd)
+        self.directory.cleanup()
+
+    def test_parse_mix(self) -> None:
+        """Tests weights are parsed and unknown operations refused
+        """
+
+        self.assertEqual(loadgen.parse_mix("login=1,retrieve"),
+                         {'login': 1.0, 'retrieve': 1.0})
+        with self.assertRaises(ValueError):
+            loadgen.parse_mix("login=1,export=2")
+        with self.assertRaises(ValueError):
+            loadgen.parse_mix("login=0")
+
+    def test_percentile(self) -> None:
+        """Tests percentiles use the nearest rank
+        """
+
+        stats = loadgen.OperationStats([float(n) for n in range(1, 101)])
+        self.assertEqual(stats.percentile(50), 50.0)
+        self.assertEqual(stats.percentile(99), 99.0)
+        self.assertEqual(loadgen.OperationStats().percentile(95), 0.0)
+
+    def test_provision_and_run(self) -> None:
+        """Tests both provisioning paths and a mixed run without errors
+        """
+
+        per_entry = loadgen.provision(1, 2, bulk=False)
+        self.assertEqual(
+            len(vault.storage.find_entries("passwords", per_entry[0])), 2)
+
+        vault.set_storage_backend(storage.MemoryBackend())
+        usernames = loadgen.provision(3, 5)
+        self.assertEqual(
+            len(vault.storage.find_entries("passwords", usernames[2])), 5)
+        self.assertTrue(pm.authenticate_user(usernames[1],
+                                             loadgen.MASTER_PASSWORD))
+
+        mix = loadgen.parse_mix("login=1,add=1,update=1,retrieve=1")
+        report = loadgen.run_load(usernames, mix, threads=4, operations=60,
+                                  seed=7)
+        counts = {name: len(stats.latencies)
+                  for name, stats in report.operations.items()}
+        self.assertEqual(sum(counts.values()), 60)
+        self.assertEqual(sum(stats.errors
+                             for stats in report.operations.values()), 0)
+        self.assertIn("total", report.format())
+
+        loadgen.remove_users(usernames)
+        self.assertEqual(vault.storage.find_entries("users", "names"), [])
+
+    def test_main_stays_off_the_cluster(self) -> None:
+        """Tests runs default to memory and mongo needs an explicit URI
+        """
+
+        environ = {name: value for name, value in os.environ.items()
+                   if name not in (storage.BACKEND_ENV,
+                                   utility.MONGO_URI_ENV)}
+        with mock.patch.dict(os.environ, environ, clear=True), \
+                mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+            with mock.patch.object(vault, "configure_storage",
+                                   wraps=vault.configure_storage) as configure:
+                self.assertEqual(loadgen.main(
+                    ["--users", "2", "--vault-size", "2",
+                     "--operations", "10", "--mix", "retrieve"]), 0)
+            self.assertEqual(configure.call_args.args[0], "memory")
+
+            with self.assertRaises(SystemExit):
+                loadgen.main(["--backend", "mongo"])
@@ -0,0 +1,225 @@
+"""
+Test module for merkle.py
+"""
+
+import unittest
+from typing import Any, List
+from unittest import mock
+import passwordManager as pm
+from utility import merkle
+from utility import storage
+from utility import vault
+from utility import writebehind
+from utility.test.base import VaultTestCase
+
+
+class TestMerkle(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a user with a few entries on an in-memory backend
+        """
+        self.backend = self.use_vault()
+        pm.create_user("Peter", "Sup3r$ecret!")
+        self.fernet_key = vault.load_fernet_key_locally("Peter")
+        for number in range(20):
+            vault.add_password("Peter", f"service{number}", "peter",
+                               f"pw{number}")
+
+    def root(self) -> str | None:
+        """Returns the root stored with the user record
+        """
+
+        return merkle.StoredTree(self.backend, "Peter").root()
+
+    def test_maintained_tree_matches_rebuild(self) -> None:
+        """Tests adds, updates, restores and deletes keep the root exact
+        """
+
+        pm.update_service("Peter", "service1", "peter", "changed")
+        vault.restore_password("Peter", "service1", 1)
+        vault.delete_service_and_passwords("Peter", "service2")
+        maintained = self.root()
+
+        self.assertTrue(merkle.verify(self.backend, "Peter",
+                                      self.fernet_key).identical)
+        self.assertEqual(merkle.build(self.backend, "Peter",
+                                      self.fernet_key), maintained)
+
+        for number in range(20):
+            vault.delete_service_and_passwords("Peter", f"service{number}")
+        self.assertEqual(self.root(), merkle.EMPTY)
+        self.assertEqual(
+            self.backend.find_entries(merkle.DATABASE, "Peter.nodes"), [])
+        self.assertEqual(
+            self.backend.find_entries(merkle.DATABASE, "Peter.entries"), [])
+
+    def test_update_through_write_behind(self) -> None:
+        """Tests nodes are written when writes are journaled first
+        """
+
+        inner = storage.MemoryBackend()
+        backend = writebehind.WriteBehindBackend(inner, "journal.log")
+        self.addCleanup(backend.close)
+        backend.insert_entry("users", "names", {"username": "Paul"})
+        merkle.build(backend, "Paul", self.fernet_key)
+        for number in range(3):
+            backend.insert_entry("passwords", "Paul",
+                                 {"service_name": f"service{number}",
+                                  "username_entry": "paul",
+                                  "password_entry": b"x"})
+            merkle.update(backend, "Paul", self.fernet_key,
+                          f"service{number}")
+        self.assertTrue(backend.flush(5))
+
+        self.assertNotEqual(merkle.StoredTree(inner, "Paul").root(),
+                            merkle.EMPTY)
+        self.assertNotEqual(
+            inner.find_entries(merkle.DATABASE, "Paul.nodes"), [])
+        self.assertTrue(merkle.verify(inner, "Paul",
+                                      self.fernet_key).identical)
+
+    def test_update_round_trips(self) -> None:
+        """Tests an update reads and writes the nodes in one call each
+        """
+
+        vault.add_password("Peter", "github", "peter", "pw")
+        with mock.patch.object(self.backend, "find_entries",
+                               wraps=self.backend.find_entries) as find, \
+                mock.patch.object(self.backend, "upsert_entries",
+                                  wraps=self.backend.upsert_entries
+                                  ) as upsert:
+            merkle.update(self.backend, "Peter", self.fernet_key, "github")
+
+        self.assertEqual(find.call_count, 4)
+        upsert.assert_called_once()
+        self.assertEqual(len(upsert.call_args.args[2]), merkle.BUCKET_DIGITS)
+        self.assertTrue(merkle.verify(self.backend, "Peter",
+                                      self.fernet_key).identical)
+
+    def test_concurrent_updates(self) -> None:
+        """Tests an update that lost the race for the root is retried
+        """
+
+        for service_name in ("github", "gitlab"):
+            self.backend.insert_entry("passwords", "Peter",
+                                      {"service_name": service_name,
+                                       "username_entry": "peter",
+                                       "password_entry": b"x"})
+        upsert = self.backend.upsert_entries
+        raced: List[str | None] = []
+
+        def racing_upsert(*args: Any) -> None:
+            upsert(*args)
+            if not raced:
+                # Another session updates its bucket in the meantime
+                raced.append(None)
+                raced[0] = merkle.update(self.backend, "Peter",
+                                         self.fernet_key, "gitlab")
+
+        with mock.patch.object(self.backend, "upsert_entries",
+                               side_effect=racing_upsert):
+            root = merkle.update(self.backend, "Peter", self.fernet_key,
+                                 "github")
+
+        self.assertIsNotNone(raced[0])
+        self.assertEqual(self.root(), root)
+        self.assertEqual(merkle.build(self.backend, "Peter",
+                                      self.fernet_key), root)
+
+    def test_verify_rebuilds_lagging_nodes(self) -> None:
+        """Tests nodes left behind by an interrupted update are rebuilt
+        """
+
+        bucket = merkle.bucket_of("service1")
+        self.backend.update_entry(merkle.DATABASE, "Peter.nodes",
+                                  {"node": bucket[:1]}, {"hash": "stale"})
+        self.backend.update_entry("users", "names", {"username": "Peter"},
+                                  {merkle.ROOT_FIELD: "stale"})
+
+        self.assertTrue(merkle.verify(self.backend, "Peter",
+                                      self.fernet_key).identical)
+        self.assertNotEqual(self.root(), "stale")
+
+    def test_verify_detects_tampering(self) -> None:
+        """Tests altered, removed and injected entries are reported
+        """
+
+        self.backend.update_entry("passwords", "Peter",
+                                  {"service_name": "service3"},
+                                  {"username_entry": "mallory"})
+        self.backend.delete_entry("passwords", "Peter",
+                                  {"service_name": "service4"})
+        self.backend.insert_entry("passwords", "Peter",
+                                  {"service_name": "rogue",
+                                   "username_entry": "mallory",
+                                   "password_entry": b"x"})
+
+        result = merkle.verify(self.backend, "Peter", self.fernet_key)
+        self.assertFalse(result.identical)
+        self.assertEqual(result.changed, ["service3"])
+        self.assertEqual(result.only_left, ["service4"])
+        self.assertEqual(result.only_right, ["rogue"])
+
+    def test_diff_reads_only_differing_buckets(self) -> None:
+        """Tests two large copies are compared through a few nodes
+        """
+
+        copies = []
+        for _ in range(2):
+            backend = storage.MemoryBackend()
+            backend.insert_entry("users", "names", {"username": "Paul"})
+            backend.insert_entries("passwords", "Paul", [
+                {"service_name": f"service{number}",
+                 "username_entry": "paul",
+                 "password_entry": f"pw{number}".encode()}
+                for number in range(5000)])
+            merkle.build(backend, "Paul", self.fernet_key)
+            copies.append(backend)
+
+        copies[1].update_entry("passwords", "Paul",
+                               {"service_name": "service7"},
+                               {"password_entry": b"changed"})
+        merkle.update(copies[1], "Paul", self.fernet_key, "service7")
+        copies[1].delete_entry("passwords", "Paul",
+                               {"service_name": "service8"})
+        merkle.update(copies[1], "Paul", self.fernet_key, "service8")
+
+        left = merkle.StoredTree(copies[0], "Paul")
+        right = merkle.StoredTree(copies[1], "Paul")
+        result = merkle.diff_trees(left, right)
+        self.assertEqual(result.changed, ["service7"])
+        self.assertEqual(result.only_left, ["service8"])
+        self.assertEqual(result.only_right, [])
+        self.assertLess(left.nodes_read + right.nodes_read, 200)
+
+        same = merkle.StoredTree(copies[0], "Paul")
+        self.assertTrue(merkle.diff_trees(same, same).identical)
+        self.assertEqual(same.nodes_read, 0)
+
+    def test_untracked_users(self) -> None:
+        """Tests users without a root are left alone until built
+        """
+
+        self.backend.insert_entry("users", "names", {"username": "Old"})
+        self.backend.insert_entry("passwords", "Old",
+                                  {"service_name": "github",
+                                   "username_entry": "old",
+                                   "password_entry": b"x"})
+        self.assertIsNone(merkle.update(self.backend, "Old",
+                                        self.fernet_key, "github"))
+        with self.assertRaises(ValueError):
+            merkle.verify(self.backend, "Old", self.fernet_key)
+
+        merkle.build(self.backend, "Old", self.fernet_key)
+        self.assertTrue(merkle.verify(self.backend, "Old",
+                                      self.fernet_key).identical)
+
+        pm.delete_user("Peter")
+        self.assertEqual(
+            [name for name in
+             self.backend.list_collection_names(merkle.DATABASE)
+             if name.startswith("Peter.")], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
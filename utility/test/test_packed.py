@@ -0,0 +1,213 @@
+"""
+Test module for packed.py
+"""
+
+import unittest
+from typing import Any, Dict, List
+from unittest import mock
+from cryptography.fernet import Fernet, InvalidToken
+from utility import packed
+from utility import storage
+
+
+class TestPacked(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Wraps an in-memory backend with small chunks
+        """
+        self.inner = storage.MemoryBackend()
+        self.key = Fernet.generate_key()
+        self.backend = packed.PackedBackend(self.inner, lambda _: self.key,
+                                            max_chunk_size=256)
+
+    def entry(self, service_name: str) -> Dict[str, Any]:
+        """Builds a vault entry
+
+        Args:
+            service_name (str): Name of the service
+
+        Returns:
+            Dict[str, Any]: The entry
+        """
+        return {'username': 'Peter', 'service_name': service_name,
+                'username_entry': 'peter', 'password_entry': 'x' * 64}
+
+    def test_round_trip(self) -> None:
+        """Tests entries are packed, chunked and read back
+        """
+
+        self.backend.insert_entries("passwords", "Peter",
+                                    [self.entry(f"s{n}") for n in range(20)])
+        self.backend.update_entry("passwords", "Peter",
+                                  {'service_name': 's3'},
+                                  {'username_entry': 'changed'})
+        self.backend.delete_entry("passwords", "Peter",
+                                  {'service_name': 's4'})
+
+        raw = self.inner.find_entries("passwords", "Peter")
+        self.assertTrue(all('_packed' in document for document in raw))
+        self.assertGreater(len(raw), 1)
+
+        found = self.backend.find_entries("passwords", "Peter")
+        self.assertEqual(len(found), 19)
+        changed = self.backend.find_entries("passwords", "Peter",
+                                            {'service_name': 's3'})
+        self.assertEqual(changed[0]['username_entry'], 'changed')
+        batches = list(self.backend.iter_entries("passwords", "Peter",
+                                                 batch_size=10))
+        self.assertEqual([len(batch) for batch in batches], [10, 9])
+
+    def test_unmatched_update(self) -> None:
+        """Tests an update matching nothing leaves the vault alone
+        """
+
+        self.backend.insert_entry("passwords", "Peter", self.entry("github"))
+        self.assertFalse(self.backend.update_entry(
+            "passwords", "Peter", {'service_name': 'none'}, {'a': 1}))
+        header = self.inner.find_entries("passwords", "Peter",
+                                         {'_id': packed.HEADER_ID})[0]
+        self.assertEqual(header['version'], 1)
+
+    def test_migrates_legacy_entries(self) -> None:
+        """Tests per-document entries are packed by the first write
+        """
+
+        self.inner.insert_entry("passwords", "Peter", self.entry("github"))
+        self.assertEqual(
+            len(self.backend.find_entries("passwords", "Peter")), 1)
+
+        self.backend.insert_entry("passwords", "Peter", self.entry("gitlab"))
+
+        raw = self.inner.find_entries("passwords", "Peter")
+        self.assertTrue(all('_packed' in document for document in raw))
+        services = sorted(entry['service_name'] for entry in
+                          self.backend.find_entries("passwords", "Peter"))
+        self.assertEqual(services, ['github', 'gitlab'])
+
+    def test_other_databases_pass_through(self) -> None:
+        """Tests only the passwords database is packed
+        """
+
+        self.backend.insert_entry("users", "names", {'username': 'Peter'})
+        self.assertEqual(self.inner.find_entries("users", "names")[0]
+                         ['username'], 'Peter')
+
+    def test_concurrent_chunked_save(self) -> None:
+        """Tests the losing writer removes only the chunks it wrote
+        """
+
+        self.backend.insert_entries("passwords", "Peter",
+                                    [self.entry(f"s{n}") for n in range(20)])
+        other = packed.PackedBackend(self.inner, lambda _: self.key,
+                                     max_chunk_size=256)
+        loaded = [self.backend._load("Peter"), other._load("Peter")]
+        for (_, entries, _), service_name in zip(loaded, ["a", "b"]):
+            entries.append(self.entry(service_name))
+
+        header, entries, legacy_ids = loaded[0]
+        self.assertTrue(self.backend._save("Peter", header, entries,
+                                           legacy_ids))
+        header, entries, legacy_ids = loaded[1]
+        self.assertFalse(other._save("Peter", header, entries, legacy_ids))
+
+        services = {entry['service_name'] for entry in
+                    self.backend.find_entries("passwords", "Peter")}
+        self.assertIn("a", services)
+        self.assertNotIn("b", services)
+        header = self.inner.find_entries("passwords", "Peter",
+                                         {'_packed': 'header'})[0]
+        chunks = self.inner.find_entries("passwords", "Peter",
+                                         {'_packed': 'chunk'})
+        self.assertEqual(sorted(chunk['_id'] for chunk in chunks),
+                         sorted(header['chunks']))
+
+    def test_read_during_save(self) -> None:
+        """Tests a read overlapping a write is retried, not failed
+        """
+
+        self.backend.insert_entries("passwords", "Peter",
+                                    [self.entry(f"s{n}") for n in range(20)])
+        other = packed.PackedBackend(self.inner, lambda _: self.key,
+                                     max_chunk_size=256)
+        original = self.inner.find_entries
+        reads: List[int] = []
+
+        def racing_find(database_name: str, collection_name: str,
+                        *args: Any) -> Any:
+            documents = original(database_name, collection_name, *args)
+            if args or reads:
+                return documents
+            reads.append(1)
+            # The header is read, then a write replaces every chunk
+            # before the cursor reaches them
+            with mock.patch.object(self.inner, "find_entries", original):
+                other.insert_entry("passwords", "Peter", self.entry("mail"))
+            return [document for document in documents
+                    if document.get("_packed") == "header"] + original(
+                        database_name, collection_name,
+                        {'_packed': 'chunk'})
+
+        with mock.patch.object(self.inner, "find_entries", racing_find):
+            services = {entry['service_name'] for entry in
+                        self.backend.find_entries("passwords", "Peter")}
+
+        self.assertEqual(reads, [1])
+        self.assertEqual(len(services), 21)
+        self.assertIn("mail", services)
+
+        for chunk in original("passwords", "Peter", {'_packed': 'chunk'}):
+            self.inner.delete_entry("passwords", "Peter",
+                                    {'_id': chunk['_id']})
+        with self.assertRaises(packed.PackedConflictError):
+            self.backend.find_entries("passwords", "Peter")
+
+    def test_wrong_key(self) -> None:
+        """Tests a vault that does not decrypt is reported, not retried
+        """
+
+        self.backend.insert_entry("passwords", "Peter", self.entry("github"))
+        other = packed.PackedBackend(self.inner,
+                                     lambda _: Fernet.generate_key())
+        with self.assertRaises(InvalidToken):
+            other.find_entries("passwords", "Peter")
+
+    def test_concurrent_first_save(self) -> None:
+        """Tests only one of two sessions packing a new vault wins
+        """
+
+        other = packed.PackedBackend(self.inner, lambda _: self.key)
+        self.assertTrue(self.backend._save("Peter", None,
+                                           [self.entry("a")], []))
+        self.assertFalse(other._save("Peter", None, [self.entry("b")], []))
+        self.assertEqual(len(self.inner.find_entries(
+            "passwords", "Peter", {'_packed': 'header'})), 1)
+
+    def test_conflict_retry(self) -> None:
+        """Tests a write that loses the race is re-applied
+        """
+
+        self.backend.insert_entry("passwords", "Peter", self.entry("github"))
+        original = self.backend._load
+        calls: List[str] = []
+
+        def racing_load(collection_name: str) -> Any:
+            result = original(collection_name)
+            if not calls:
+                # Another session writes between this read and the save
+                calls.append(collection_name)
+                other = packed.PackedBackend(self.inner, lambda _: self.key)
+                other.insert_entry("passwords", "Peter", self.entry("mail"))
+            return result
+
+        with mock.patch.object(self.backend, "_load", racing_load):
+            self.backend.insert_entry("passwords", "Peter",
+                                      self.entry("gitlab"))
+
+        services = sorted(entry['service_name'] for entry in
+                          self.backend.find_entries("passwords", "Peter"))
+        self.assertEqual(services, ['github', 'gitlab', 'mail'])
+
+        with mock.patch.object(self.backend, "_save", return_value=False):
+            with self.assertRaises(packed.PackedConflictError):
+                self.backend.insert_entry("passwords", "Peter",
+                                          self.entry("bank"))
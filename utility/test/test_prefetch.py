@@ -0,0 +1,87 @@
+"""
+Test module for prefetch.py
+"""
+
+import unittest
+from typing import Any, Dict, List
+from utility import prefetch
+from utility import storage
+from utility import vault
+
+
+class CountingBackend(storage.ForwardingBackend):
+    """MemoryBackend counting find_entries calls
+    """
+
+    def __init__(self) -> None:
+        super().__init__(storage.MemoryBackend())
+        self.finds: List[Any] = []
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        self.finds.append((database_name, collection_name, entries))
+        return self.inner.find_entries(database_name, collection_name,
+                                       entries, projection)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Creates a prefetching backend over a counting one
+        """
+        self.inner = CountingBackend()
+        self.inner.insert_entry("users", "names", {'username': 'Peter'})
+        self.backend = prefetch.PrefetchBackend(self.inner)
+
+    def test_prefetch_used_once(self) -> None:
+        """Tests a prefetched read answers one matching find
+        """
+
+        query = {'username': 'Peter'}
+        self.backend.prefetch("users", "names", query)
+        self.assertEqual(
+            self.backend.find_entries("users", "names", query)[0]
+            ['username'], 'Peter')
+        self.assertEqual(len(self.inner.finds), 1)
+
+        self.backend.find_entries("users", "names", query)
+        self.assertEqual(len(self.inner.finds), 2)
+
+    def test_writes_and_age_invalidate(self) -> None:
+        """Tests stale prefetched reads are not returned
+        """
+
+        query = {'username': 'Paul'}
+        self.backend.prefetch("users", "names", query)
+        self.backend.insert_entry("users", "names", {'username': 'Paul'})
+        self.assertEqual(
+            len(self.backend.find_entries("users", "names", query)), 1)
+
+        self.backend.max_age = -1
+        self.backend.prefetch("users", "names", query)
+        self.backend.delete_entry("users", "names", query)
+        self.assertEqual(self.backend.find_entries("users", "names", query),
+                         [])
+
+    def test_prefetch_vault(self) -> None:
+        """Tests the vault is decrypted ahead and dropped after a write
+        """
+
+        fernet_key = vault.generate_user_fernet_key()
+        self.inner.insert_entry("passwords", "Peter", {
+            'username': 'Peter', 'service_name': 'github',
+            'username_entry': 'peter',
+            'password_entry': vault.encrypt_password(fernet_key, 'hunter2')})
+
+        self.backend.prefetch_vault("Peter", fernet_key)
+        loaded = self.backend.take_vault("Peter")
+        self.assertIsNotNone(loaded)
+        if loaded is not None and loaded[0].secret is not None:
+            self.assertEqual(loaded[0].secret.reveal(), 'hunter2')
+        self.assertIsNone(self.backend.take_vault("Peter"))
+
+        self.backend.prefetch_vault("Peter", fernet_key)
+        self.backend.delete_entry("passwords", "Peter",
+                                  {'service_name': 'github'})
+        self.assertIsNone(self.backend.take_vault("Peter"))
@@ -0,0 +1,73 @@
+"""
+Test module for profiling.py
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from utility import profiling
+from utility import storage
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Creates a capture directory and a small vault
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.patch = mock.patch.object(profiling, "_directory", None)
+        self.patch.start()
+        self.backend = storage.MemoryBackend()
+        self.backend.insert_entries("passwords", "Peter",
+                                    [{'service_name': 'github'},
+                                     {'service_name': 'mail'}])
+
+    def tearDown(self) -> None:
+        """Restores the profiling state and removes the captures
+        """
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_disabled(self) -> None:
+        """Tests nothing is written while profiling is off
+        """
+
+        with mock.patch.dict(os.environ, {profiling.PROFILE_ENV: ""}):
+            profiling.configure()
+        with profiling.profiled("add", self.backend, "Peter"):
+            sorted(range(1000))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_capture_and_summarize(self) -> None:
+        """Tests captures are tagged and aggregated per action
+        """
+
+        profiling.configure(self.directory.name)
+        for _ in range(2):
+            with profiling.profiled("retrieve", self.backend, "Peter"):
+                self.backend.find_entries("passwords", "Peter")
+        with profiling.profiled("login"):
+            pass
+
+        captures = profiling.list_captures(self.directory.name)
+        self.assertEqual(sorted(captures), ["login", "retrieve"])
+        self.assertEqual([size for _, size in captures["retrieve"]], [2, 2])
+
+        report = profiling.summarize(self.directory.name, "retrieve")
+        self.assertIn("== retrieve: 2 captures", report)
+        self.assertIn("find_entries", report)
+        self.assertNotIn("== login", report)
+
+    def test_size_is_counted(self) -> None:
+        """Tests the vault size is counted without reading the entries
+        """
+
+        profiling.configure(self.directory.name)
+        with mock.patch.object(self.backend, "iter_entries") as read:
+            with profiling.profiled("add", self.backend, "Peter"):
+                pass
+        read.assert_not_called()
+
+        captures = profiling.list_captures(self.directory.name)
+        self.assertEqual([size for _, size in captures["add"]], [2])
@@ -0,0 +1,107 @@
+"""
+Test module for provision.py
+"""
+
+import io
+import os
+import unittest
+from unittest import mock
+import passwordManager as pm
+from utility import attachments
+from utility import history
+from utility import keystore
+from utility import provision
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestProvision(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Uses an in-memory backend and a temporary key directory
+        """
+        self.backend = self.use_vault()
+        patch = mock.patch.object(keystore, "SCRYPT_N", 16)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_read_manifest(self) -> None:
+        """Tests names, optional passwords, comments and duplicates
+        """
+
+        users = provision.read_manifest(io.StringIO(
+            "# cohort\nalice\n\nbob,Tr1cky,Pass!\n"))
+        self.assertEqual(users, [("alice", None), ("bob", "Tr1cky,Pass!")])
+
+        with self.assertRaises(provision.ManifestError):
+            provision.read_manifest(["alice", "alice"])
+        with self.assertRaises(provision.ManifestError):
+            provision.read_manifest(["../alice"])
+
+    def test_provision_and_deprovision(self) -> None:
+        """Tests users are created ready to log in, then removed
+        """
+
+        pm.create_user("Peter", "Sup3r$ecret!")
+        report = provision.provision(
+            self.backend, [("Peter", None), ("alice", None),
+                           ("bob", "Qu1ck-Zebra&Lantern"),
+                           ("carol", "password")],
+            workers=2, chunk_size=1)
+
+        self.assertEqual(report.done, ["alice", "bob"])
+        self.assertEqual(report.skipped, ["Peter"])
+        self.assertEqual(list(report.rejected), ["carol"])
+        self.assertEqual(list(report.passwords), ["alice"])
+        self.assertTrue(pm.authenticate_user("alice",
+                                             report.passwords["alice"]))
+        self.assertTrue(pm.authenticate_user("bob", "Qu1ck-Zebra&Lantern"))
+        self.assertFalse(vault.user_exists("carol"))
+        self.assertIn("alice", self.backend.list_collection_names("passwords"))
+
+        vault.add_password("alice", "github", "alice", "pw0")
+        pm.update_service("alice", "github", "alice", "pw1")
+        store = attachments.store_for(self.backend)
+        attachments.add_note(store, vault.load_fernet_key_locally("alice"),
+                             "alice", "github", "recovery codes", "123")
+
+        report = provision.deprovision(self.backend,
+                                       ["alice", "bob", "nobody"],
+                                       workers=2, chunk_size=1)
+        self.assertEqual(report.done, ["alice", "bob"])
+        self.assertEqual(report.skipped, ["nobody"])
+        self.assertFalse(vault.user_exists("alice"))
+        self.assertTrue(vault.user_exists("Peter"))
+        self.assertNotIn("alice",
+                         self.backend.list_collection_names("passwords"))
+        self.assertEqual(history.versions(self.backend, "alice", "github"),
+                         [])
+        self.assertEqual(store.list_files("alice"), [])
+        self.assertFalse(os.path.exists("user_alice_fernet.key"))
+
+    def test_keystore(self) -> None:
+        """Tests keys go to the keystore in one bulk write
+        """
+
+        store = keystore.Keystore("keys.db")
+        self.addCleanup(store.close)
+        with mock.patch.object(store, "put_many",
+                               wraps=store.put_many) as put_many:
+            report = provision.provision(self.backend,
+                                         [("alice", None), ("bob", None)],
+                                         keystore=store)
+        put_many.assert_called_once()
+        self.assertEqual(sorted(store.names()), ["alice", "bob"])
+        with mock.patch.object(vault, "keystore", store):
+            self.assertTrue(pm.authenticate_user("bob",
+                                                 report.passwords["bob"]))
+        vault.forget_fernet_key("bob")
+        self.assertFalse(os.path.exists("user_alice_fernet.key"))
+
+        provision.deprovision(self.backend, ["alice", "bob"],
+                              keystore=store)
+        self.assertEqual(store.names(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+"""
+Test module for queryplan.py
+"""
+
+import unittest
+import warnings
+from typing import Any, Dict, List
+from unittest import mock
+from utility import queryplan
+from utility import storage
+from utility import utility
+
+# explain output at executionStats verbosity, in the form MongoDB 6.0 (classic
+# engine) and 7.0 (slot based engine) return it
+EXPLAIN_INDEXED: Dict[str, Any] = {
+    "explainVersion": "1",
+    "queryPlanner": {
+        "namespace": "passwords.Peter",
+        "indexFilterSet": False,
+        "parsedQuery": {"service_name": {"$eq": "github"}},
+        "queryHash": "9A1C5E1B",
+        "planCacheKey": "4C0FE1A8",
+        "maxIndexedOrSolutionsReached": False,
+        "maxIndexedAndSolutionsReached": False,
+        "maxScansToExplodeReached": False,
+        "winningPlan": {
+            "stage": "FETCH",
+            "inputStage": {
+                "stage": "IXSCAN",
+                "keyPattern": {"service_name": 1},
+                "indexName": "service_name_1",
+                "isMultiKey": False,
+                "multiKeyPaths": {"service_name": []},
+                "isUnique": False,
+                "isSparse": False,
+                "isPartial": False,
+                "indexVersion": 2,
+                "direction": "forward",
+                "indexBounds": {"service_name": ['["github", "github"]']}}},
+        "rejectedPlans": []},
+    "executionStats": {
+        "executionSuccess": True,
+        "nReturned": 1,
+        "executionTimeMillis": 0,
+        "totalKeysExamined": 1,
+        "totalDocsExamined": 1,
+        "executionStages": {
+            "stage": "FETCH", "nReturned": 1, "works": 2, "advanced": 1,
+            "docsExamined": 1,
+            "inputStage": {"stage": "IXSCAN", "nReturned": 1,
+                           "keysExamined": 1,
+                           "indexName": "service_name_1"}}},
+    "command": {"find": "Peter", "filter": {"service_name": "github"},
+                "$db": "passwords"},
+    "serverInfo": {"host": "mongo-0", "port": 27017, "version": "6.0.14"},
+    "ok": 1.0}
+
+EXPLAIN_SCAN: Dict[str, Any] = {
+    "explainVersion": "2",
+    "queryPlanner": {
+        "namespace": "passwords.Peter",
+        "indexFilterSet": False,
+        "parsedQuery": {"username_entry": {"$eq": "user1"}},
+        "queryHash": "5F2B7C3D",
+        "planCacheKey": "8E41A0B2",
+        "optimizationTimeMillis": 0,
+        "winningPlan": {
+            "queryPlan": {
+                "stage": "COLLSCAN",
+                "planNodeId": 1,
+                "filter": {"username_entry": {"$eq": "user1"}},
+                "direction": "forward"},
+            "slotBasedPlan": {
+                "slots": "$$RESULT=s5 env: { s1 = TimeZoneDatabase(...) }",
+                "stages": "[1] filter {traverseF(s4, ...)} \n"
+                          "[1] scan s5 s6 none none none none lowPriority "
+                          "[s4 = username_entry] @\"b6a3\" true false"}},
+        "rejectedPlans": []},
+    "executionStats": {
+        "executionSuccess": True,
+        "nReturned": 120,
+        "executionTimeMillis": 2,
+        "totalKeysExamined": 0,
+        "totalDocsExamined": 1200,
+        "executionStages": {"stage": "filter", "planNodeId": 1,
+                            "nReturned": 120, "opens": 1, "closes": 1}},
+    "command": {"find": "Peter", "filter": {"username_entry": "user1"},
+                "$db": "passwords"},
+    "serverInfo": {"host": "mongo-0", "port": 27017, "version": "7.0.8"},
+    "ok": 1.0}
+
+
+class FakeExplainer:
+    """Explainer planning like MongoDB would with single field indexes
+    """
+
+    def __init__(self, backend: storage.MemoryBackend,
+                 indexed: List[str]) -> None:
+        self.backend = backend
+        self.indexed = indexed
+        self.calls = 0
+        self.failing = False
+
+    def explain(self, database_name: str, collection_name: str,
+                entries: Dict[str, Any], limit: int) -> Dict[str, Any]:
+        self.calls += 1
+        if self.failing:
+            raise ConnectionError("explain unavailable")
+        returned = len(self.backend.find_entries(database_name,
+                                                 collection_name, entries))
+        size = self.collection_size(database_name, collection_name)
+        index = next((key for key in entries if key in self.indexed), None)
+        if index is None:
+            plan: Dict[str, Any] = {"stage": "COLLSCAN"}
+            examined = size
+        else:
+            plan = {"stage": "FETCH",
+                    "inputStage": {"stage": "IXSCAN",
+                                   "indexName": f"{index}_1"}}
+            examined = returned
+        return {"queryPlanner": {"winningPlan": plan},
+                "executionStats": {"nReturned": returned,
+                                   "totalDocsExamined": examined,
+                                   "totalKeysExamined": returned}}
+
+    def collection_size(self, database_name: str,
+                        collection_name: str) -> int:
+        return self.backend.count_entries(database_name, collection_name)
+
+
+class TestQueryPlan(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Wraps an in-memory vault of 1200 entries
+        """
+        self.memory = storage.MemoryBackend()
+        self.memory.insert_entries("passwords", "Peter", [
+            {"service_name": f"service{number}",
+             "username_entry": f"user{number % 10}"}
+            for number in range(1200)])
+        self.explainer = FakeExplainer(self.memory, ["service_name"])
+        self.backend = queryplan.ExplainingBackend(self.memory,
+                                                   self.explainer)
+
+    def test_indexed_queries_pass(self) -> None:
+        """Tests indexed and unfiltered queries are not flagged
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", queryplan.CollectionScanWarning)
+            self.backend.find_entries("passwords", "Peter",
+                                      {"service_name": "service1"})
+            self.backend.find_entries("passwords", "Peter")
+
+        record = self.backend.records[0]
+        self.assertEqual(record.stages, ["FETCH", "IXSCAN"])
+        self.assertEqual(record.indexes, ["service_name_1"])
+        self.assertEqual((record.docs_examined, record.returned), (1, 1))
+        self.assertEqual(len(self.backend.records), 1)
+        self.assertEqual(self.backend.flagged(), [])
+
+    def test_collection_scan_warns(self) -> None:
+        """Tests a scan of a large collection warns once per shape
+        """
+
+        with self.assertWarns(queryplan.CollectionScanWarning):
+            self.backend.find_entries("passwords", "Peter",
+                                      {"username_entry": "user1"})
+        with self.assertWarns(queryplan.CollectionScanWarning):
+            self.backend.delete_entries("passwords", "Peter",
+                                        {"username_entry": "user2"})
+        self.backend.find_entries("passwords", "Peter",
+                                  {"username_entry": "user3"})
+
+        self.assertEqual(self.explainer.calls, 2)
+        flagged = self.backend.flagged()
+        self.assertEqual([record.operation for record in flagged],
+                         ["find_entries", "delete_entries"])
+        self.assertEqual(flagged[0].docs_examined, 1200)
+        self.assertEqual(flagged[0].returned, 120)
+        self.assertIn("! find_entries", self.backend.report())
+        self.assertEqual(self.memory.count_entries("passwords", "Peter"),
+                         1080)
+
+    def test_fail_mode_and_threshold(self) -> None:
+        """Tests fail mode stops the query and small collections pass
+        """
+
+        strict = queryplan.ExplainingBackend(self.memory, self.explainer,
+                                             "fail")
+        with self.assertRaises(queryplan.CollectionScanError):
+            strict.update_entry("passwords", "Peter",
+                                {"username_entry": "user1"},
+                                {"username_entry": "changed"})
+        self.assertEqual(self.memory.count_entries(
+            "passwords", "Peter", {"username_entry": "changed"}), 0)
+
+        lenient = queryplan.ExplainingBackend(self.memory, self.explainer,
+                                              "fail", min_docs=5000)
+        self.assertTrue(lenient.update_entry("passwords", "Peter",
+                                             {"username_entry": "user1"},
+                                             {"username_entry": "changed"}))
+        with self.assertRaises(ValueError):
+            queryplan.ExplainingBackend(self.memory, self.explainer, "loud")
+
+    def test_sampling_and_errors(self) -> None:
+        """Tests sampled repeats and that failed explains do not fail calls
+        """
+
+        sampled = queryplan.ExplainingBackend(self.memory, self.explainer,
+                                              sample_rate=1.0)
+        for number in range(3):
+            sampled.count_entries("passwords", "Peter",
+                                  {"service_name": f"service{number}"})
+        self.assertEqual(self.explainer.calls, 3)
+
+        self.explainer.failing = True
+        self.assertEqual(len(sampled.find_entries(
+            "passwords", "Peter", {"service_name": "service1"})), 1)
+        self.assertEqual(sampled.errors, 1)
+        self.assertIsInstance(sampled.last_error, ConnectionError)
+
+    def test_scans_checked_per_collection(self) -> None:
+        """Tests a shape that scanned a small vault is checked on a large one
+        """
+
+        self.memory.insert_entries("passwords", "Paul", [
+            {"service_name": f"service{number}", "username_entry": "paul"}
+            for number in range(10)])
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", queryplan.CollectionScanWarning)
+            self.backend.find_entries("passwords", "Paul",
+                                      {"username_entry": "paul"})
+            self.backend.find_entries("passwords", "Paul",
+                                      {"username_entry": "user1"})
+        with self.assertWarns(queryplan.CollectionScanWarning):
+            self.backend.find_entries("passwords", "Peter",
+                                      {"username_entry": "user1"})
+        self.backend.find_entries("passwords", "Peter",
+                                  {"username_entry": "user2"})
+
+        self.assertEqual(self.explainer.calls, 2)
+        self.assertEqual([record.collection
+                          for record in self.backend.flagged()], ["Peter"])
+
+    def test_mongo_explain_output(self) -> None:
+        """Tests explain output from the server through MongoExplainer
+        """
+
+        def explain_find(database_name: str, collection_name: str,
+                         entries: Dict[str, Any], limit: int
+                         ) -> Dict[str, Any]:
+            return (EXPLAIN_INDEXED if "service_name" in entries
+                    else EXPLAIN_SCAN)
+
+        backend = queryplan.ExplainingBackend(
+            self.memory, queryplan.MongoExplainer())
+        with mock.patch.object(utility, "explain_find", explain_find), \
+                mock.patch.object(utility, "estimated_count",
+                                  return_value=1200):
+            backend.find_entries("passwords", "Peter",
+                                 {"service_name": "service1"})
+            with self.assertWarns(queryplan.CollectionScanWarning):
+                backend.count_entries("passwords", "Peter",
+                                      {"username_entry": "user1"})
+
+        indexed, scan = backend.records
+        self.assertEqual(indexed.stages, ["FETCH", "IXSCAN"])
+        self.assertEqual(indexed.indexes, ["service_name_1"])
+        self.assertFalse(indexed.collscan)
+        self.assertEqual((indexed.keys_examined, indexed.docs_examined,
+                          indexed.returned), (1, 1, 1))
+        self.assertIsNone(indexed.collection_size)
+
+        self.assertEqual(scan.stages, ["COLLSCAN"])
+        self.assertEqual(scan.indexes, [])
+        self.assertEqual((scan.docs_examined, scan.returned,
+                          scan.collection_size), (1200, 120, 1200))
+        self.assertEqual(backend.flagged(), [scan])
+
+    def test_parse_and_shape(self) -> None:
+        """Tests slot based engine plans and filter shapes
+        """
+
+        record = queryplan.parse_explain(
+            {"queryPlanner": {"winningPlan": {"queryPlan": {
+                "stage": "OR", "inputStages": [
+                    {"stage": "IXSCAN", "indexName": "a_1"},
+                    {"stage": "COLLSCAN"}]}}},
+             "executionStats": {"nReturned": 2, "totalDocsExamined": 50}},
+            "find_entries", "passwords", "Peter", "{}")
+        self.assertEqual(record.stages, ["OR", "IXSCAN", "COLLSCAN"])
+        self.assertTrue(record.collscan)
+        self.assertEqual(record.indexes, ["a_1"])
+
+        self.assertEqual(
+            queryplan.filter_shape({"service_name": "github",
+                                    "_id": {"$in": [1, 2, "x"]}}),
+            {"service_name": "str", "_id": {"$in": ["int", "str"]}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+"""
+Test module for storage.py
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from typing import Any
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from utility import storage
+
+
+class BackendTests(unittest.TestCase):
+    """Tests every StorageBackend must pass, run by the subclasses below
+    """
+
+    backend: Any
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Skips the shared tests when run without a backend
+        """
+        if cls is BackendTests:
+            raise unittest.SkipTest("abstract backend tests")
+
+    def test_insert_and_find_entries(self) -> None:
+        """Tests inserting entries and finding them with and without filter
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        entry = [{'name': 'John Doe', 'email': 'john@example.com'},
+                 {'name': 'John Q Public', 'email': 'Public@example.com'},
+                 {'name': 'The Sheriff', 'email': 'Sheriff@example.com'}
+                 ]
+        self.backend.insert_entries(database, collection, entry)
+        self.backend.insert_entry(database, collection,
+                                  {'name': 'Mac Truck', 'key': b'\x00\x01'})
+
+        inserted_entry = self.backend.find_entries(database, collection)
+
+        self.assertEqual(len(inserted_entry), 4)
+        self.assertEqual(inserted_entry[1]['name'], 'John Q Public')
+        self.assertEqual(inserted_entry[3]['key'], b'\x00\x01')
+
+        get_entry = {'email': 'john@example.com'}
+        inserted_entry = self.backend.find_entries(database, collection,
+                                                   get_entry)
+
+        self.assertEqual(len(inserted_entry), 1)
+        self.assertEqual(inserted_entry[0]['name'], 'John Doe')
+
+    def test_find_entries_projection(self) -> None:
+        """Tests a projection returns only the _id and the listed fields
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        self.backend.insert_entries(database, collection, [
+            {'name': 'John Doe', 'email': 'john@example.com', 'age': 40},
+            {'name': 'The Sheriff', 'age': 50}])
+
+        found = self.backend.find_entries(database, collection,
+                                          {'age': {'$gt': 45}},
+                                          ['name', 'email'])
+        self.assertEqual(len(found), 1)
+        self.assertEqual(sorted(found[0]), ['_id', 'name'])
+        self.assertEqual(found[0]['name'], 'The Sheriff')
+        self.assertEqual(len(self.backend.find_entries(database, collection,
+                                                       None, ['age'])), 2)
+
+    def test_iter_entries(self) -> None:
+        """Tests streaming entries in batches
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        entry = [{'name': str(i), 'even': i % 2 == 0} for i in range(5)]
+        self.backend.insert_entries(database, collection, entry)
+
+        batches = list(self.backend.iter_entries(database, collection,
+                                                 batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+        evens = [document['name'] for batch in self.backend.iter_entries(
+            database, collection, {'even': True}) for document in batch]
+        self.assertEqual(evens, ['0', '2', '4'])
+
+    def test_count_entries(self) -> None:
+        """Tests counting matches with and without a limit
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        entry = [{'name': str(i), 'even': i % 2 == 0} for i in range(5)]
+        self.backend.insert_entries(database, collection, entry)
+
+        self.assertEqual(self.backend.count_entries(database, collection), 5)
+        self.assertEqual(self.backend.count_entries(
+            database, collection, {'even': True}), 3)
+        self.assertEqual(self.backend.count_entries(
+            database, collection, {'even': True}, limit=1), 1)
+        self.assertEqual(self.backend.count_entries(
+            database, collection, {'name': 'missing'}, limit=1), 0)
+
+    def test_update_entry_and_entries(self) -> None:
+        """Tests updating the first and all matching entries
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        entry = [{'name': 'John Doe', 'email': 'john@example.com'},
+                 {'name': 'John Q Public', 'email': 'john@example.com'}]
+        self.backend.insert_entries(database, collection, entry)
+
+        self.backend.update_entry(database, collection,
+                                  {'email': 'john@example.com'},
+                                  {'email': 'Wick@example.com'})
+
+        inserted_entry = self.backend.find_entries(database, collection)
+        self.assertEqual(inserted_entry[0]['email'], 'Wick@example.com')
+        self.assertEqual(inserted_entry[1]['email'], 'john@example.com')
+
+        self.backend.update_entries(database, collection, {},
+                                    {'email': 'KT@example.com'})
+
+        inserted_entry = self.backend.find_entries(database, collection)
+        self.assertEqual([e['email'] for e in inserted_entry],
+                         ['KT@example.com', 'KT@example.com'])
+
+    def test_delete_entry_entries_and_collection(self) -> None:
+        """Tests deleting entries and dropping a collection
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        entry = [{'name': 'John Doe', 'email': 'john@example.com'},
+                 {'name': 'John Q Public', 'email': 'jqpublic@example.com'},
+                 {'name': 'The Sheriff', 'email': 'john@example.com'}
+                 ]
+        self.backend.insert_entries(database, collection, entry)
+
+        self.backend.delete_entry(database, collection,
+                                  {'email': 'john@example.com'})
+        inserted_entry = self.backend.find_entries(database, collection)
+        self.assertEqual(inserted_entry[0]['name'], 'John Q Public')
+
+        self.backend.delete_entries(database, collection,
+                                    {'email': {'$ne': 'nobody'}})
+        self.assertEqual(self.backend.find_entries(database, collection), [])
+
+        self.backend.create_collection(database, "other")
+        self.assertEqual(
+            sorted(self.backend.list_collection_names(database)),
+            ["other", collection])
+
+        self.backend.delete_collection(database, collection)
+        self.assertEqual(self.backend.list_collection_names(database),
+                         ["other"])
+
+    def test_unique_ids(self) -> None:
+        """Tests an _id can only be used once per collection
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        self.backend.insert_entry(database, collection, {'_id': 'vault'})
+        with self.assertRaises(DuplicateKeyError):
+            self.backend.insert_entry(database, collection,
+                                      {'_id': 'vault', 'name': 'second'})
+        self.backend.insert_entry(database, "other", {'_id': 'vault'})
+
+        with self.assertRaises(BulkWriteError) as raised:
+            self.backend.insert_entries(database, collection,
+                                        [{'_id': 'a'}, {'_id': 'vault'},
+                                         {'_id': 'b'}])
+        self.assertEqual(raised.exception.details['nInserted'], 1)
+        self.assertEqual(
+            sorted(document['_id'] for document in
+                   self.backend.find_entries(database, collection)),
+            ['a', 'vault'])
+
+        self.backend.delete_entry(database, collection, {'_id': 'vault'})
+        self.backend.insert_entry(database, collection, {'_id': 'vault'})
+        self.backend.delete_collection(database, collection)
+        self.backend.insert_entry(database, collection, {'_id': 'a'})
+
+    def test_upsert_entries(self) -> None:
+        """Tests documents are replaced by _id and new ones inserted
+        """
+
+        database = "test_database"
+        collection = "test_collection"
+
+        self.backend.insert_entry(database, collection,
+                                  {'_id': 'a', 'hash': '1', 'old': True})
+        self.backend.upsert_entries(database, collection,
+                                    [{'_id': 'a', 'hash': '2'},
+                                     {'_id': 'b', 'hash': '3'}])
+        self.assertEqual(
+            sorted(self.backend.find_entries(database, collection),
+                   key=lambda document: document['_id']),
+            [{'_id': 'a', 'hash': '2'}, {'_id': 'b', 'hash': '3'}])
+        self.assertIn(collection,
+                      self.backend.list_collection_names(database))
+        with self.assertRaises(DuplicateKeyError):
+            self.backend.insert_entry(database, collection, {'_id': 'b'})
+
+
+class TestMemoryBackend(BackendTests):
+
+    def setUp(self) -> None:
+        """Creates an empty in-memory backend
+        """
+        self.backend = storage.MemoryBackend()
+
+
+class TestSQLiteBackend(BackendTests):
+
+    def setUp(self) -> None:
+        """Creates a SQLite backend in a temporary directory
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = storage.SQLiteBackend(
+            os.path.join(self.directory.name, "test.db"))
+
+    def tearDown(self) -> None:
+        """Removes the temporary database
+        """
+        self.backend.close()
+        self.directory.cleanup()
+
+    def test_persistence(self) -> None:
+        """Tests that documents survive reopening the database file
+        """
+
+        self.backend.insert_entry("users", "names", {'username': 'Peter'})
+        self.backend.close()
+
+        self.backend = storage.SQLiteBackend(
+            os.path.join(self.directory.name, "test.db"))
+        users = self.backend.find_entries("users", "names")
+        self.assertEqual(users[0]['username'], 'Peter')
+
+    def test_adds_id_index_to_old_files(self) -> None:
+        """Tests files from before unique _ids are indexed when opened
+        """
+
+        path = os.path.join(self.directory.name, "old.db")
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute(
+                "CREATE TABLE documents (id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, database_name TEXT NOT NULL, "
+                "collection_name TEXT NOT NULL, document TEXT NOT NULL)")
+            connection.execute(
+                "INSERT INTO documents (database_name, collection_name, "
+                "document) VALUES ('users', 'names', "
+                "'{\"_id\": \"peter\", \"username\": \"Peter\"}')")
+        connection.close()
+
+        backend = storage.SQLiteBackend(path)
+        self.addCleanup(backend.close)
+        self.assertEqual(backend.find_entries("users", "names")[0]
+                         ['username'], 'Peter')
+        with self.assertRaises(DuplicateKeyError):
+            backend.insert_entry("users", "names", {'_id': 'peter'})
+
+
+class TestMatches(unittest.TestCase):
+
+    def test_operators(self) -> None:
+        """Tests the query operators understood by the local backends
+        """
+
+        document = {'name': 'a', 'age': 5, 'tags': ['x', 'y'],
+                    'meta': {'owner': 'Peter'}}
+
+        self.assertTrue(storage.matches(document, {'age': {'$gte': 5}}))
+        self.assertFalse(storage.matches(document, {'age': {'$lt': 5}}))
+        self.assertTrue(storage.matches(document, {'tags': 'x'}))
+        self.assertTrue(storage.matches(document, {'meta.owner': 'Peter'}))
+        self.assertTrue(storage.matches(document, {'gone': None}))
+        self.assertTrue(storage.matches(
+            document, {'$or': [{'name': 'b'}, {'age': {'$in': [4, 5]}}]}))
+        self.assertFalse(storage.matches(document,
+                                         {'name': {'$exists': False}}))
+
+    def test_get_backend(self) -> None:
+        """Tests selecting a backend by name
+        """
+
+        self.assertIsInstance(storage.get_backend("memory"),
+                              storage.MemoryBackend)
+        with self.assertRaises(ValueError):
+            storage.get_backend("oracle")
@@ -0,0 +1,59 @@
+"""
+Test module for strength.py
+"""
+
+import unittest
+from utility import strength
+
+
+class TestStrength(unittest.TestCase):
+
+    def test_guessable_passwords(self) -> None:
+        """Tests that passwords built from patterns score low
+        """
+
+        for password in ['Password1!', 'qwerty123', 'P@ssw0rd',
+                         '1qaz2wsx3edc', 'aaaaaaaaaaaa', 'abcabcabcabc',
+                         '01/02/1987', 'drowssap', 'Michael1987']:
+            result = strength.estimate_strength(password)
+            self.assertLess(result.score, strength.MIN_SCORE, password)
+            self.assertTrue(result.feedback, password)
+
+    def test_strong_passwords(self) -> None:
+        """Tests that long random passwords and passphrases score high
+        """
+
+        for password in ['j8#Lq!vZ2@pX9$wR', 'NeverGonnaGiveYouUp42',
+                         'correct horse battery staple']:
+            result = strength.estimate_strength(password)
+            self.assertGreaterEqual(result.score, strength.MIN_SCORE,
+                                    password)
+
+    def test_user_inputs(self) -> None:
+        """Tests that a password based on the username is penalised
+        """
+
+        without = strength.estimate_strength('Zebulon$2')
+        with_name = strength.estimate_strength('Zebulon$2', ['zebulon'])
+
+        self.assertLess(with_name.guesses_log10, without.guesses_log10)
+
+    def test_feedback(self) -> None:
+        """Tests that feedback names the pattern found
+        """
+
+        result = strength.estimate_strength('qwertyuiop')
+
+        self.assertIn(strength.FEEDBACK['dictionary'], result.feedback)
+
+        result = strength.estimate_strength('zaqwsxcde')
+
+        self.assertIn(strength.FEEDBACK['keyboard'], result.feedback)
+
+    def test_benchmark(self) -> None:
+        """Tests that an estimate takes well under a millisecond
+        """
+
+        mean = strength.benchmark(strength.BENCHMARK_PASSWORDS, rounds=5)
+
+        self.assertLess(mean, 1000)
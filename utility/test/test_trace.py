@@ -0,0 +1,164 @@
+"""
+Test module for trace.py
+"""
+
+import gzip
+import json
+import os
+import unittest
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+from unittest import mock
+import passwordManager as pm
+from utility import storage
+from utility import trace
+from utility import utility
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestTrace(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Records a session over an in-memory backend with existing data
+        """
+        self.backend = self.use_vault()
+        pm.create_user("Peter", "Sup3r$ecret!")
+        for number in range(5):
+            vault.add_password("Peter", f"service{number}", "peter",
+                               f"pw{number}")
+
+        self.path = "session.trace.gz"
+        self.recorder = trace.RecordingBackend(self.backend, self.path)
+        self.addCleanup(self.recorder.close)
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Closes the recorder and returns the recorded calls
+        """
+
+        self.recorder.close()
+        return list(trace.read_trace(self.path)[1])
+
+    def test_records_are_redacted(self) -> None:
+        """Tests calls are recorded with sizes but without their values
+        """
+
+        vault.set_storage_backend(self.recorder)
+        self.assertTrue(pm.authenticate_user("Peter", "Sup3r$ecret!"))
+        pm.update_service("Peter", "github-service", "peter", "pw")
+        vault.add_password("Peter", "github-service", "peter", "hunter2")
+        batches = list(self.recorder.iter_entries("passwords", "Peter",
+                                                  batch_size=2))
+
+        records = self.records()
+        with gzip.open(self.path, "rt") as raw:
+            text = raw.read()
+        for secret in ("Peter", "github-service", "peter", "hunter2"):
+            self.assertNotIn(secret, text)
+
+        self.assertEqual(records[-1]["op"], "iter_entries")
+        self.assertEqual(records[-1]["n"], 6)
+        self.assertEqual(len(batches), 3)
+        finds = [record for record in records
+                 if record["op"] == "find_entries"
+                 and record["db"] == "users"]
+        self.assertEqual(finds[0]["n"], 1)
+        self.assertEqual(len({record["coll"] for record in records
+                              if record["db"] == "passwords"}), 1)
+        insert = [record for record in records
+                  if record["op"] == "insert_entry"
+                  and record["db"] == "passwords"][0]
+        self.assertEqual(insert["n"], 1)
+        self.assertIn("$bytes", insert["args"][0]["password_entry"])
+
+    def test_replay_reproduces_reads(self) -> None:
+        """Tests a replay finds what the recording found
+        """
+
+        vault.set_storage_backend(self.recorder)
+        self.recorder.find_entries("passwords", "Peter")
+        self.recorder.count_entries("passwords", "Peter",
+                                    {"service_name": {"$in": ["service1",
+                                                              "service2"]}})
+        vault.delete_service_and_passwords("Peter", "service3")
+        self.recorder.find_entries("passwords", "Peter")
+        self.records()
+
+        target = storage.MemoryBackend()
+        report = trace.replay(self.path, target, speed=0)
+        self.assertGreater(report.seeded, 0)
+        self.assertEqual(sum(times.errors
+                             for times in report.operations.values()), 0)
+        collections = target.list_collection_names("passwords")
+        self.assertEqual(len(collections), 1)
+        self.assertGreaterEqual(
+            len(target.find_entries("passwords", collections[0])), 4)
+        self.assertEqual(len(report.operations["find_entries"].replayed),
+                         len(report.operations["find_entries"].recorded))
+        self.assertIn("find_entries", report.format())
+
+        summary = trace.replay(self.path, None)
+        self.assertEqual(summary.operations["find_entries"].replayed, [])
+
+    def test_replay_into_mongo_needs_a_uri(self) -> None:
+        """Tests a mongo replay is refused unless a URI is given
+        """
+
+        self.records()
+        with mock.patch.dict(os.environ,
+                             {utility.MONGO_URI_ENV: "mongodb://cluster"}), \
+                mock.patch.object(trace, "replay") as replay, \
+                mock.patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                trace.main(["replay", self.path, "--backend", "mongo"])
+        replay.assert_not_called()
+
+    def test_seed_document(self) -> None:
+        """Tests documents are built to match the filters they came from
+        """
+
+        now = datetime.now(timezone.utc)
+        for query in ({"service_name": "a", "urls": {"$exists": True}},
+                      {"bucket": {"$in": ["x", "y"]}, "meta.kind": "note"},
+                      {"updated_at": {"$lt": now}},
+                      {"$or": [{"a": 1}, {"b": 2}], "c": {"$ne": 3}}):
+            document = trace._seed_document(query)
+            assert document is not None
+            self.assertTrue(storage.matches(document, query))
+        self.assertIsNone(trace._seed_document({"a": {"$regex": "x"}}))
+        self.assertEqual(trace.restore(trace.Redactor().redact(
+            {"at": now - timedelta(days=1), "size": 3, "blob": b"abc"})),
+            {"at": now - timedelta(days=1), "size": 3, "blob": bytes(256)})
+
+    def test_secret_lengths_are_hidden(self) -> None:
+        """Tests ciphertexts of passwords of different lengths look alike
+        """
+
+        key = vault.load_fernet_key_locally("Peter")
+        redactor = trace.Redactor()
+        redacted = [redactor.redact({"service_name": "github",
+                                     "password_entry": vault.encrypt_password(
+                                         key, password)})
+                    for password in ("a", "hunter2", "x" * 64)]
+        self.assertEqual(redacted[0], redacted[1])
+        self.assertEqual(redacted[1], redacted[2])
+        self.assertEqual(trace.bytes_bucket(257), 512)
+
+    def test_damaged_traces(self) -> None:
+        """Tests a cut off last line is ignored and other files rejected
+        """
+
+        self.recorder.find_entries("users", "names")
+        self.records()
+        with gzip.open(self.path, "at") as raw:
+            raw.write('{"t": 1.0, "op": "find_')
+        self.assertEqual(len(list(trace.read_trace(self.path)[1])), 1)
+
+        with open("other.gz", "wb") as other:
+            other.write(gzip.compress(json.dumps({"a": 1}).encode()))
+        with self.assertRaises(ValueError):
+            trace.read_trace("other.gz")
+
+
+if __name__ == '__main__':
+    unittest.main()
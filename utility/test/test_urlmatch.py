@@ -0,0 +1,92 @@
+"""
+Test module for urlmatch.py
+"""
+
+import unittest
+from unittest import mock
+import passwordManager as pm
+from utility import storage
+from utility import urlmatch
+from utility import vault
+from utility.test.base import VaultTestCase
+
+
+class TestUrlMatch(VaultTestCase):
+
+    def test_registrable_domain(self) -> None:
+        """Tests public suffix rules, wildcards and exceptions
+        """
+
+        cases = {"https://www.example.co.uk/login": "example.co.uk",
+                 "accounts.google.com": "google.com",
+                 "https://peter.github.io/blog": "peter.github.io",
+                 "http://shop.b.ck/": "shop.b.ck",
+                 "http://www.ck/": "www.ck",
+                 "https://BÜCHER.de/": "xn--bcher-kva.de",
+                 "http://192.168.1.1:8080/admin": "192.168.1.1",
+                 "localhost": "localhost"}
+        for url, domain in cases.items():
+            parts = urlmatch.parse_url(url)
+            assert parts is not None
+            self.assertEqual(parts.domain, domain, url)
+        self.assertIsNone(urlmatch.registrable_domain("co.uk"))
+        self.assertIsNone(urlmatch.parse_url("https:///path"))
+
+    def test_ranking(self) -> None:
+        """Tests host and path specificity order the matches
+        """
+
+        index = urlmatch.UrlIndex()
+        index.add("google", ["https://google.com/"])
+        index.add("accounts", ["https://accounts.google.com/"])
+        index.add("signin", ["https://accounts.google.com/signin"])
+        index.add("mail", ["https://mail.google.com/"])
+        index.add("other", ["https://example.com/"])
+
+        self.assertEqual(
+            index.match("https://accounts.google.com/signin/v2?x=1"),
+            ["signin", "accounts", "google", "mail"])
+        self.assertEqual(index.match("https://www.google.com/"),
+                         ["google", "accounts", "mail", "signin"])
+        self.assertEqual(index.match("https://google.de/"), [])
+
+        index.add("signin", ["https://example.com/signin"])
+        index.remove("google")
+        self.assertEqual(index.match("https://example.com/signin"),
+                         ["signin", "other"])
+        self.assertEqual(index.match("https://google.com/"),
+                         ["accounts", "mail"])
+        self.assertEqual(len(index), 4)
+
+    def test_find_for_url(self) -> None:
+        """Tests stored entries are found by their registrable domain
+        """
+
+        backend = storage.MemoryBackend()
+        backend.insert_entries("passwords", "Peter", [
+            {'service_name': 'github', **urlmatch.url_fields(
+                ["https://github.com/login", ""])},
+            {'service_name': 'pages', **urlmatch.url_fields(
+                ["https://peter.github.io/"])},
+            {'service_name': 'bank'}])
+
+        found = urlmatch.find_for_url(backend, "Peter",
+                                      "https://gist.github.com/")
+        self.assertEqual([document['service_name'] for document in found],
+                         ['github'])
+        self.assertEqual(found[0]['urls'], ["https://github.com/login"])
+        with self.assertRaises(ValueError):
+            urlmatch.url_fields(["https://"])
+
+    def test_new_vaults_are_indexed(self) -> None:
+        """Tests the domains index is created together with the vault
+        """
+
+        self.use_vault()
+        with mock.patch.object(urlmatch, "ensure_url_index") as index:
+            pm.create_user("Peter", "Sup3r$ecret!")
+        index.assert_called_once_with(vault.storage, "Peter")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Test module for vault.py
+"""
+
+import os
+import unittest
+from unittest import mock
+from utility import vault
+from utility import writebehind
+from utility.test.base import VaultTestCase
+
+
+class TestVault(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Works in a temporary directory on an in-memory backend
+        """
+        self.backend = self.use_vault()
+
+    def test_user_lifecycle(self) -> None:
+        """Tests the operations report their results instead of printing
+        """
+
+        with mock.patch("builtins.print") as printed:
+            self.assertTrue(vault.create_user("Peter", "Sup3r$ecret!"))
+            self.assertFalse(vault.create_user("Peter", "0ther$ecret!"))
+            self.assertTrue(vault.authenticate_user("Peter", "Sup3r$ecret!"))
+            self.assertFalse(vault.authenticate_user("Peter", "wrong"))
+            self.assertTrue(vault.add_password("Peter", "github", "p", "pw"))
+            self.assertFalse(vault.update_service("Peter", "gitlab", "p",
+                                                  "pw2"))
+            self.assertTrue(vault.delete_user("Peter"))
+            self.assertFalse(vault.delete_user("Peter"))
+        printed.assert_not_called()
+        self.assertFalse(os.path.exists("user_Peter_fernet.key"))
+        self.assertEqual(self.backend.list_collection_names("passwords"), [])
+
+    def test_close_storage_warns_about_unstored_writes(self) -> None:
+        """Tests closing returns a warning for writes still journaled
+        """
+
+        with mock.patch.object(self.backend, "insert_entries",
+                               side_effect=ConnectionError("down")):
+            backend = writebehind.WriteBehindBackend(self.backend,
+                                                     "journal.log")
+            vault.set_storage_backend(backend)
+            backend.insert_entry("users", "names", {"username": "Peter"})
+            warnings = vault.close_storage(timeout=0.1)
+
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("1 change(s) will be stored", warnings[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
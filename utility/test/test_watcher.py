@@ -0,0 +1,275 @@
+"""
+Test module for watcher.py
+"""
+
+import os
+import queue
+import tempfile
+import unittest
+from typing import Any, Dict, List
+from unittest import mock
+from pymongo.errors import AutoReconnect
+import passwordManager as pm
+from utility import agent
+from utility import existence
+from utility import packed
+from utility import prefetch
+from utility import storage
+from utility import vault
+from utility import watcher
+from utility.test.base import VaultTestCase
+
+
+class FakeStream:
+    """Stands in for a pymongo ChangeStream fed from a queue
+    """
+
+    def __init__(self, changes: "queue.Queue[Any]") -> None:
+        self.changes = changes
+        self.resume_token: Any = None
+
+    def __enter__(self) -> "FakeStream":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+    def try_next(self) -> Any:
+        try:
+            change = self.changes.get(timeout=0.05)
+        except queue.Empty:
+            return None
+        if isinstance(change, Exception):
+            raise change
+        self.resume_token = {"_data": change["token"]}
+        return change
+
+
+class FakeCollection:
+    """Stands in for a pymongo Collection that can be watched
+    """
+
+    def __init__(self) -> None:
+        self.changes: "queue.Queue[Any]" = queue.Queue()
+        self.resume_after: List[Any] = []
+
+    def watch(self, pipeline: List[Dict[str, Any]],
+              **options: Any) -> FakeStream:
+        self.resume_after.append(options.get("resume_after"))
+        return FakeStream(self.changes)
+
+    def find_one(self, *args: Any) -> Any:
+        return {"_id": "user-id"}
+
+
+class FakeClient:
+    """Stands in for a MongoClient holding fake collections
+    """
+
+    def __init__(self) -> None:
+        self.collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, database_name: str) -> Any:
+        client = self
+
+        class Database:
+            def __getitem__(self, collection_name: str) -> FakeCollection:
+                name = f"{database_name}.{collection_name}"
+                return client.collections.setdefault(name, FakeCollection())
+
+        return Database()
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Creates a watcher on a fake client
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.token_path = os.path.join(self.directory.name, "tokens.json")
+        self.client = FakeClient()
+        self.vault = self.client["passwords"]["Peter"]
+        self.received: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.patch = mock.patch.object(watcher, "RETRY_SECONDS", 0.01)
+        self.patch.start()
+
+    def tearDown(self) -> None:
+        """Removes the temporary directory
+        """
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_changes_and_resume(self) -> None:
+        """Tests dispatching changes and resuming after a disconnect
+        """
+
+        vault_watcher = watcher.VaultWatcher("Peter", self.token_path,
+                                             self.client)
+        vault_watcher.subscribe(self.received.put)
+        vault_watcher.start()
+
+        self.vault.changes.put({"token": "1", "operationType": "insert",
+                                "documentKey": {"_id": 1},
+                                "fullDocument": {"service_name": "github"}})
+        self.vault.changes.put(AutoReconnect("connection lost"))
+        self.vault.changes.put({"token": "2", "operationType": "delete",
+                                "documentKey": {"_id": 1}})
+
+        first = self.received.get(timeout=5)
+        second = self.received.get(timeout=5)
+        vault_watcher.stop()
+
+        self.assertEqual(first["operation"], "insert")
+        self.assertEqual(first["document"], {"service_name": "github"})
+        self.assertEqual(second["operation"], "delete")
+        self.assertEqual(second["document_key"], 1)
+        self.assertEqual(self.vault.resume_after[:2], [None, {"_data": "1"}])
+        self.assertEqual(len(vault_watcher.errors), 1)
+
+        restarted = watcher.VaultWatcher("Peter", self.token_path,
+                                         self.client)
+        self.assertEqual(restarted.tokens.get("vault"), {"_data": "2"})
+
+    def test_failing_subscriber(self) -> None:
+        """Tests a subscriber error neither stops the stream nor others
+        """
+
+        def fail(change: Dict[str, Any]) -> None:
+            raise KeyError("service_name")
+
+        vault_watcher = watcher.VaultWatcher("Peter", client=self.client)
+        vault_watcher.subscribe(fail)
+        vault_watcher.subscribe(self.received.put)
+        vault_watcher.start()
+        for token in ("1", "2"):
+            self.vault.changes.put({"token": token, "operationType": "delete",
+                                    "documentKey": {"_id": token}})
+
+        first = self.received.get(timeout=5)
+        second = self.received.get(timeout=5)
+        vault_watcher.stop()
+
+        self.assertEqual([first["document_key"], second["document_key"]],
+                         ["1", "2"])
+        self.assertEqual(len(vault_watcher.errors), 2)
+        self.assertIsInstance(vault_watcher.errors[0], KeyError)
+
+
+class TestSessionChanges(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Unlocks an agent session for a user with one entry
+        """
+        self.use_vault()
+        pm.create_user("Peter", "Sup3r$ecret!")
+        vault.add_password("Peter", "github", "peter", "hunter2")
+        self.session = agent.VaultSession()
+        self.session.unlock("Peter", "Sup3r$ecret!")
+        self.session.list()
+
+    def test_apply_change(self) -> None:
+        """Tests that pushed updates and deletes reach the cache
+        """
+
+        entry = vault.storage.find_entries("passwords", "Peter")[0]
+        key = vault.load_fernet_key_locally("Peter")
+        entry['password_entry'] = vault.encrypt_password(key, "changed")
+
+        self.session.apply_change({"source": "vault",
+                                   "operation": "update",
+                                   "document_key": entry['_id'],
+                                   "document": entry})
+        self.assertEqual(self.session.get("github")['password'], "changed")
+
+        self.session.apply_change({"source": "vault",
+                                   "operation": "delete",
+                                   "document_key": entry['_id'],
+                                   "document": None})
+        with self.assertRaises(agent.AgentError):
+            self.session.get("github")
+
+        self.session.apply_change({"source": "vault", "operation": "insert",
+                                   "document_key": "chunk:1:1",
+                                   "document": {"_id": "chunk:1:1",
+                                                "_packed": "chunk",
+                                                "data": b"x"}})
+        self.assertIsNotNone(self.session._cache)
+        self.session.apply_change({"source": "vault",
+                                   "operation": "update",
+                                   "document_key": packed.HEADER_ID,
+                                   "document": {"_id": packed.HEADER_ID,
+                                                "_packed": "header"}})
+        self.assertIsNone(self.session._cache)
+
+        self.session.apply_change({"source": "user", "operation": "delete",
+                                   "document_key": "user-id",
+                                   "document": None})
+        self.assertIsNone(self.session.username)
+
+
+class TestPasswordManagerChanges(VaultTestCase):
+
+    def setUp(self) -> None:
+        """Creates a user behind the caching backends
+        """
+        self.inner = storage.MemoryBackend()
+        self.use_vault(prefetch.PrefetchBackend(
+            existence.ExistenceBackend(self.inner)))
+        pm.create_user("Peter", "Sup3r$ecret!")
+
+    def test_apply_vault_change(self) -> None:
+        """Tests changes from other sessions reach the cached answers
+        """
+
+        self.assertFalse(vault.service_exists("Peter", "github"))
+        self.inner.insert_entry("passwords", "Peter",
+                                {"service_name": "github"})
+        self.assertFalse(vault.service_exists("Peter", "github"))
+
+        pm.apply_vault_change("Peter", {"source": "vault",
+                                        "operation": "insert",
+                                        "document_key": 1,
+                                        "document": None})
+        self.assertTrue(vault.service_exists("Peter", "github"))
+
+        self.assertIsNone(pm.start_watching("Peter"))
+        self.assertFalse(pm.deleted_elsewhere("Peter"))
+        pm.apply_vault_change("Peter", {"source": "user",
+                                        "operation": "delete",
+                                        "document_key": "user-id",
+                                        "document": None})
+        self.assertTrue(pm.deleted_elsewhere("Peter"))
+
+    def test_changes_reach_prefetched_vault(self) -> None:
+        """Tests other sessions' changes are applied to a prefetched vault
+        """
+
+        vault.add_password("Peter", "github", "peter", "pw1")
+        vault.add_password("Peter", "gitlab", "peter", "pw2")
+        pm.prefetch_vault("Peter")
+        github, gitlab = self.inner.find_entries("passwords", "Peter")
+
+        def change(operation: str, document: Dict[str, Any]) -> None:
+            pm.apply_vault_change("Peter", {"source": "vault",
+                                            "operation": operation,
+                                            "document_key": document["_id"],
+                                            "document": document})
+
+        fernet_key = vault.load_fernet_key_locally("Peter")
+        github = dict(github, password_entry=vault.encrypt_password(
+            fernet_key, "pw3"))
+        change("update", github)
+        change("delete", gitlab)
+        mail = {"_id": "mail-id", "service_name": "mail",
+                "username_entry": "pete",
+                "password_entry": vault.encrypt_password(fernet_key, "pw4")}
+        change("insert", mail)
+
+        backend = vault.storage
+        assert isinstance(backend, prefetch.PrefetchBackend)
+        loaded = backend.take_vault("Peter")
+        assert loaded is not None
+        self.assertEqual(sorted((entry.service_name, entry.secret.reveal())
+                                for entry in loaded
+                                if entry.secret is not None),
+                         [("github", "pw3"), ("mail", "pw4")])
@@ -0,0 +1,148 @@
+"""
+Test module for writebehind.py
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+from typing import Any, Dict, List
+from unittest import mock
+from utility import storage
+from utility import writebehind
+
+
+class GatedBackend(storage.ForwardingBackend):
+    """MemoryBackend whose writes wait for a gate and may fail
+    """
+
+    def __init__(self) -> None:
+        super().__init__(storage.MemoryBackend())
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = False
+        self.insert_calls = 0
+
+    def _write(self) -> None:
+        self.gate.wait()
+        if self.fail:
+            raise OSError("cluster unreachable")
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._write()
+        self.insert_calls += 1
+        self.inner.insert_entries(database_name, collection_name, entries)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._write()
+        self.inner.delete_entry(database_name, collection_name, old_data)
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self) -> None:
+        """Creates a journal path in a temporary directory
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.directory.name, "journal.log")
+        self.patch = mock.patch.object(writebehind, "RETRY_SECONDS", 0.01)
+        self.patch.start()
+
+    def tearDown(self) -> None:
+        """Removes the temporary directory
+        """
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_pending_writes_are_visible_and_coalesced(self) -> None:
+        """Tests reads see pending writes and inserts are merged
+        """
+
+        inner = GatedBackend()
+        inner.inner.insert_entry("passwords", "Peter",
+                                 {'service_name': 'old'})
+        inner.gate.clear()
+        backend = writebehind.WriteBehindBackend(inner, self.journal)
+
+        for number in range(5):
+            backend.insert_entry("passwords", "Peter",
+                                 {'service_name': f"s{number}"})
+        backend.update_entry("passwords", "Peter", {'service_name': 's1'},
+                             {'username_entry': 'changed'})
+        backend.delete_entry("passwords", "Peter", {'service_name': 'old'})
+
+        self.assertEqual(inner.inner.find_entries("passwords", "Peter",
+                                                  {'service_name': 's1'}),
+                         [])
+        found = backend.find_entries("passwords", "Peter",
+                                     {'service_name': 's1'})
+        self.assertEqual(found[0]['username_entry'], 'changed')
+        self.assertEqual(
+            len(backend.find_entries("passwords", "Peter")), 5)
+        self.assertIn("Peter", backend.list_collection_names("passwords"))
+
+        inner.gate.set()
+        self.assertTrue(backend.flush(5))
+        self.assertLessEqual(inner.insert_calls, 2)
+        self.assertEqual(len(inner.find_entries("passwords", "Peter")), 5)
+        self.assertTrue(backend.close(5))
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+    def test_pending_reads_share_one_view(self) -> None:
+        """Tests reads with writes pending read the backend only once
+        """
+
+        inner = GatedBackend()
+        inner.inner.insert_entry("passwords", "Peter",
+                                 {'service_name': 'old'})
+        inner.gate.clear()
+        backend = writebehind.WriteBehindBackend(inner, self.journal)
+        backend.insert_entry("passwords", "Peter", {'service_name': 's0'})
+
+        with mock.patch.object(inner, "find_entries",
+                               wraps=inner.find_entries) as find:
+            for number in range(1, 10):
+                self.assertEqual(backend.count_entries("passwords", "Peter"),
+                                 number + 1)
+                backend.insert_entry("passwords", "Peter",
+                                     {'service_name': f"s{number}"})
+            backend.delete_entry("passwords", "Peter",
+                                 {'service_name': 'old'})
+            self.assertEqual(
+                len(backend.find_entries("passwords", "Peter")), 10)
+            self.assertEqual(find.call_count, 1)
+
+            inner.gate.set()
+            self.assertTrue(backend.flush(5))
+            self.assertEqual(backend._views, {})
+            self.assertEqual(
+                len(backend.find_entries("passwords", "Peter")), 10)
+            self.assertEqual(find.call_count, 2)
+        self.assertTrue(backend.close(5))
+
+    def test_failures_are_replayed(self) -> None:
+        """Tests writes that failed are replayed once, after a restart
+        """
+
+        inner = GatedBackend()
+        inner.fail = True
+        backend = writebehind.WriteBehindBackend(inner, self.journal)
+        entry = {'service_name': 'github'}
+        backend.insert_entry("passwords", "Peter", entry)
+        backend.insert_entry("passwords", "Peter", {'service_name': 'mail'})
+
+        self.assertFalse(backend.flush(0.2))
+        self.assertIsInstance(backend.last_error, OSError)
+        self.assertFalse(backend.close(0))
+
+        # The first insert reached the database before the crash
+        restarted_inner = GatedBackend()
+        restarted_inner.inner.insert_entry("passwords", "Peter", entry)
+        restarted = writebehind.WriteBehindBackend(restarted_inner,
+                                                   self.journal)
+        self.assertTrue(restarted.close(5))
+        services = sorted(document['service_name'] for document in
+                          restarted_inner.find_entries("passwords", "Peter"))
+        self.assertEqual(services, ['github', 'mail'])
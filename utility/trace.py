@@ -0,0 +1,643 @@
+"""Module recording storage calls to a trace file and replaying them
+
+Slowdowns reported from the field depend on access patterns that cannot be
+shared, since the data is other people's passwords. Run the Password
+Manager with --trace FILE (or PM_TRACE=FILE) and RecordingBackend, wrapped
+directly around the database backend, writes one line per storage call:
+
+    {"t": 1.042, "op": "find_entries", "db": "passwords",
+     "coll": "h:3f1c0a9e27d4", "args": [{"service_name": "h:9b20e1c4d577"}],
+     "n": 1, "ms": 0.84}
+
+t is seconds since recording started, n the number of documents returned,
+inserted or updated and ms the time the call took. The file is gzip
+compressed JSON lines. Values are redacted before they are written:
+
+* strings, including collection names, become "h:" and 12 hex digits of an
+  HMAC under a salt that is never written, so equal values still match each
+  other but cannot be looked up,
+* bytes keep only their length rounded up to a power of two of at least
+  MIN_BYTES_BUCKET, since the length of a ciphertext gives away the length
+  of the password in it; ObjectIds become tokens,
+* numbers, booleans, dates and field names are kept, so range queries and
+  document shapes survive.
+
+replay() runs a trace again against another backend, normally an in-memory
+one or a scratch local mongod, at the recorded pace, faster, or as fast as
+possible, and reports recorded and replayed latencies side by side. Data
+that existed before recording started is not in the trace, so before each
+read the replayer inserts documents built from the read's filter until it
+would return at least as many as were recorded.
+
+Replay runs the calls one after another; calls recorded concurrently on
+several threads are replayed in the order they started. Never replay into
+a database holding real users: replaying into mongo needs --mongo-uri
+naming a scratch mongod, and is refused without it rather than falling
+back to the cluster.
+
+Usage:
+    python -m utility.trace summary TRACE
+    python -m utility.trace replay TRACE [--backend B] [--mongo-uri URI]
+        [--speed X]
+"""
+
+import argparse
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from bson import ObjectId
+from typing import Any, Callable, Dict, IO, Iterator, List, Tuple
+from utility import storage
+from utility import utility
+from utility.storage import (DEFAULT_BATCH_SIZE, ForwardingBackend,
+                             StorageBackend, matches)
+
+TRACE_ENV = "PM_TRACE"
+TRACE_VERSION = 1
+READ_OPERATIONS = ("find_entries", "iter_entries", "count_entries")
+MIN_BYTES_BUCKET = 256
+
+
+def bytes_bucket(size: int) -> int:
+    """Rounds a byte count up to the size recorded in traces
+
+    Args:
+        size (int): Length of a bytes value
+
+    Returns:
+        int: The next power of two, at least MIN_BYTES_BUCKET
+    """
+
+    return max(MIN_BYTES_BUCKET, 1 << max(size - 1, 0).bit_length())
+
+
+class Redactor:
+    """Replaces values with tokens that keep equality but not content
+    """
+
+    def __init__(self, salt: bytes | None = None) -> None:
+        self._salt = salt or os.urandom(16)
+
+    def token(self, text: str) -> str:
+        """Returns the token of a string
+
+        Args:
+            text (str): The string
+
+        Returns:
+            str: "h:" followed by 12 hex digits
+        """
+
+        return "h:" + hmac.new(self._salt, text.encode(),
+                               hashlib.sha256).hexdigest()[:12]
+
+    def redact(self, value: Any) -> Any:
+        """Redacts a value for the trace file
+
+        Args:
+            value (Any): A document, filter or value
+
+        Returns:
+            Any: The value with JSON safe stand-ins for its data
+        """
+
+        if isinstance(value, str):
+            return self.token(value)
+        if isinstance(value, (bytes, bytearray)):
+            return {"$bytes": bytes_bucket(len(value))}
+        if isinstance(value, ObjectId):
+            return {"$oid": self.token(str(value))}
+        if isinstance(value, datetime):
+            return {"$date": value.isoformat()}
+        if isinstance(value, dict):
+            return {key: self.redact(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(item) for item in value]
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        return self.token(repr(value))
+
+
+def restore(value: Any) -> Any:
+    """Turns the stand-ins of a redacted value back into typed values
+
+    Tokens stay strings, bytes become zero bytes of the recorded size and
+    an ObjectId token always becomes the same ObjectId.
+
+    Args:
+        value (Any): A value read from a trace
+
+    Returns:
+        Any: A value that can be passed to a backend
+    """
+
+    if isinstance(value, dict):
+        if set(value) == {"$bytes"}:
+            return bytes(value["$bytes"])
+        if set(value) == {"$oid"}:
+            return ObjectId(hashlib.sha256(
+                value["$oid"].encode()).hexdigest()[:24])
+        if set(value) == {"$date"}:
+            return datetime.fromisoformat(value["$date"])
+        return {key: restore(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [restore(item) for item in value]
+    return value
+
+
+def _count(result: Any) -> int | None:
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, bool):
+        return int(result)
+    if isinstance(result, int):
+        return result
+    return None
+
+
+class RecordingBackend(ForwardingBackend):
+    """StorageBackend writing every call it forwards to a trace file
+
+    Attributes:
+        path (str): The trace file
+        records (int): Calls written so far
+    """
+
+    def __init__(self, inner: StorageBackend, path: str,
+                 redactor: Redactor | None = None) -> None:
+        super().__init__(inner)
+        self.path = path
+        self.records = 0
+        self._redactor = redactor or Redactor()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._file: IO[str] | None = gzip.open(path, "wt", encoding="utf-8")
+        self._file.write(json.dumps(
+            {"version": TRACE_VERSION,
+             "started": datetime.now().astimezone().isoformat(),
+             "backend": type(storage.innermost(inner)).__name__}) + "\n")
+
+    def _write(self, operation: str, database_name: str,
+               collection_name: str | None, args: List[Any], started: float,
+               elapsed: float, count: int | None,
+               error: str | None = None) -> None:
+        record: Dict[str, Any] = {
+            "t": round(started - self._origin, 6), "op": operation,
+            "db": database_name,
+            "coll": (None if collection_name is None
+                     else self._redactor.token(collection_name)),
+            "args": self._redactor.redact(args), "n": count,
+            "ms": round(elapsed * 1000, 3)}
+        if error is not None:
+            record["error"] = error
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self.records += 1
+
+    def _call(self, operation: str, database_name: str,
+              collection_name: str | None, args: List[Any],
+              call: Callable[[], Any], count: int | None = None) -> Any:
+        """Times a forwarded call and records it, including failures
+        """
+
+        started = time.perf_counter()
+        try:
+            result = call()
+        except Exception as ex:
+            self._write(operation, database_name, collection_name, args,
+                        started, time.perf_counter() - started, None,
+                        type(ex).__name__)
+            raise
+        # Redacted after the call, so ids the database assigned are kept
+        self._write(operation, database_name, collection_name, args,
+                    started, time.perf_counter() - started,
+                    _count(result) if count is None else count)
+        return result
+
+    def create_collection(self, database_name: str,
+                          collection_name: str) -> Any:
+        return self._call("create_collection", database_name,
+                          collection_name, [],
+                          lambda: self.inner.create_collection(
+                              database_name, collection_name))
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self._call("insert_entry", database_name, collection_name, [entry],
+                   lambda: self.inner.insert_entry(
+                       database_name, collection_name, entry), 1)
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._call("insert_entries", database_name, collection_name,
+                   [entries], lambda: self.inner.insert_entries(
+                       database_name, collection_name, entries),
+                   len(entries))
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        args: List[Any] = [entries]
+        if projection is not None:
+            # As keys, the field names survive redaction
+            args.append({name: 1 for name in projection})
+        return self._call("find_entries", database_name, collection_name,
+                          args, lambda: self.inner.find_entries(
+                              database_name, collection_name, entries,
+                              projection))
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        # Only the time spent fetching batches counts, not the consumer's
+        started = time.perf_counter()
+        elapsed = 0.0
+        count = 0
+        batches = self.inner.iter_entries(database_name, collection_name,
+                                          entries, batch_size)
+        error = None
+        try:
+            while True:
+                fetching = time.perf_counter()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - fetching
+                count += len(batch)
+                yield batch
+        except Exception as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            self._write("iter_entries", database_name, collection_name,
+                        [entries, batch_size], started, elapsed, count,
+                        error)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        return int(self._call(
+            "count_entries", database_name, collection_name,
+            [entries, limit], lambda: self.inner.count_entries(
+                database_name, collection_name, entries, limit)))
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        return bool(self._call(
+            "update_entry", database_name, collection_name,
+            [old_data, new_data], lambda: self.inner.update_entry(
+                database_name, collection_name, old_data, new_data)))
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self._call("update_entries", database_name, collection_name,
+                   [old_data, new_data], lambda: self.inner.update_entries(
+                       database_name, collection_name, old_data, new_data))
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._call("upsert_entries", database_name, collection_name,
+                   [entries], lambda: self.inner.upsert_entries(
+                       database_name, collection_name, entries),
+                   len(entries))
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._call("delete_entry", database_name, collection_name,
+                   [old_data], lambda: self.inner.delete_entry(
+                       database_name, collection_name, old_data))
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self._call("delete_entries", database_name, collection_name,
+                   [old_data], lambda: self.inner.delete_entries(
+                       database_name, collection_name, old_data))
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        self._call("delete_collection", database_name, collection_name, [],
+                   lambda: self.inner.delete_collection(
+                       database_name, collection_name))
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        return list(self._call(
+            "list_collection_names", database_name, None, [],
+            lambda: self.inner.list_collection_names(database_name)))
+
+    def close(self) -> None:
+        """Flushes and closes the trace file
+        """
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path: str) -> Tuple[Dict[str, Any],
+                                   Iterator[Dict[str, Any]]]:
+    """Opens a trace file
+
+    Args:
+        path (str): The trace file
+
+    Raises:
+        ValueError: Raised if the file is not a trace this module wrote
+
+    Returns:
+        Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]: The header and the
+            recorded calls in the order they were written
+    """
+
+    trace = gzip.open(path, "rt", encoding="utf-8")
+    try:
+        header = json.loads(trace.readline() or "{}")
+    except (OSError, json.JSONDecodeError) as ex:
+        trace.close()
+        raise ValueError(f"{path} is not a trace: {ex}")
+    if header.get("version") != TRACE_VERSION:
+        trace.close()
+        raise ValueError(f"{path} is not a version {TRACE_VERSION} trace")
+
+    def records() -> Iterator[Dict[str, Any]]:
+        # A crash can cut the file or its last line short
+        with trace:
+            try:
+                for line in trace:
+                    yield json.loads(line)
+            except (EOFError, json.JSONDecodeError):
+                return
+
+    return header, records()
+
+
+def _seed_document(query: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    """Builds a document the filter matches, None if it cannot tell how
+
+    Equality, $eq, $in, $exists and range conditions are understood; for
+    $or the first branch is used.
+    """
+
+    document: Dict[str, Any] = {}
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            branch = _seed_document(condition[0] if condition else None)
+            if branch is None:
+                return None
+            document.update(branch)
+            continue
+        if key == "$and":
+            for sub in condition:
+                branch = _seed_document(sub)
+                if branch is None:
+                    return None
+                document.update(branch)
+            continue
+        value = condition
+        if (isinstance(condition, dict) and condition
+                and all(op.startswith("$") for op in condition)):
+            value = None
+            for operator, operand in condition.items():
+                if operator in ("$eq", "$gte", "$lte"):
+                    value = operand
+                elif operator == "$in" and operand:
+                    value = operand[0]
+                elif operator == "$gt" or operator == "$lt":
+                    step: Any = (timedelta(seconds=1)
+                                 if isinstance(operand, datetime) else 1)
+                    value = operand + step if operator == "$gt" \
+                        else operand - step
+                elif operator == "$exists" and operand:
+                    value = "seed"
+                elif operator not in ("$exists", "$ne", "$nin"):
+                    return None
+            if value is None:
+                continue
+
+        target = document
+        parts = key.split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return document if matches(document, query) else None
+
+
+def _seed(backend: StorageBackend, record: Dict[str, Any],
+          args: List[Any]) -> int:
+    """Inserts documents until a read would find as many as recorded
+
+    Returns:
+        int: Documents inserted
+    """
+
+    wanted = record.get("n") or 0
+    query = args[0] if args else None
+    if record["op"] == "count_entries" and len(args) > 1 and args[1]:
+        wanted = min(wanted, args[1])
+    if not wanted:
+        return 0
+    found = backend.count_entries(record["db"], record["coll"], query,
+                                  wanted)
+    document = _seed_document(query)
+    if found >= wanted or document is None:
+        return 0
+    backend.insert_entries(record["db"], record["coll"],
+                           [dict(document) for _ in range(wanted - found)])
+    return wanted - found
+
+
+def _execute(backend: StorageBackend, record: Dict[str, Any],
+             args: List[Any]) -> None:
+    names = ([record["db"]] if record["coll"] is None
+             else [record["db"], record["coll"]])
+    result = getattr(backend, record["op"])(*names, *args)
+    if record["op"] == "iter_entries":
+        for _ in result:
+            pass
+
+
+@dataclass
+class OperationTimes:
+    """Recorded and replayed latencies of one operation
+
+    Attributes:
+        recorded (List[float]): Seconds each call took when recorded
+        replayed (List[float]): Seconds each call took when replayed
+        errors (int): Replayed calls that raised
+    """
+
+    recorded: List[float] = field(default_factory=list)
+    replayed: List[float] = field(default_factory=list)
+    errors: int = 0
+
+
+def _percentile(latencies: List[float], percent: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1,
+                       int(percent * len(ordered) / 100))]
+
+
+@dataclass
+class ReplayReport:
+    """Results of replaying a trace
+
+    Attributes:
+        elapsed (float): Wall clock seconds of the replay
+        seeded (int): Documents inserted so reads found what they found
+            when recorded
+        operations (Dict[str, OperationTimes]): Latencies per operation
+    """
+
+    elapsed: float = 0.0
+    seeded: int = 0
+    operations: Dict[str, OperationTimes] = field(default_factory=dict)
+
+    def format(self) -> str:
+        """Renders the report as a table
+
+        Returns:
+            str: One line per operation with p50 and p95 latencies in
+                milliseconds and the change in total time
+        """
+
+        lines = [f"{'operation':<22}{'count':>7}{'errors':>7}"
+                 f"{'rec p50':>9}{'rep p50':>9}{'rec p95':>9}{'rep p95':>9}"
+                 f"{'delta':>9}"]
+        for name, times in sorted(self.operations.items()):
+            recorded = sum(times.recorded)
+            delta = "-"
+            if times.replayed and recorded:
+                change = (sum(times.replayed) - recorded) / recorded
+                delta = f"{change:+.0%}"
+            lines.append(
+                f"{name:<22}{len(times.recorded):>7}{times.errors:>7}"
+                f"{_percentile(times.recorded, 50) * 1000:>9.2f}"
+                f"{_percentile(times.replayed, 50) * 1000:>9.2f}"
+                f"{_percentile(times.recorded, 95) * 1000:>9.2f}"
+                f"{_percentile(times.replayed, 95) * 1000:>9.2f}"
+                f"{delta:>9}")
+        return "\n".join(lines)
+
+
+def replay(path: str, backend: StorageBackend | None,
+           speed: float = 1.0, seed: bool = True) -> ReplayReport:
+    """Runs the calls of a trace again
+
+    Args:
+        path (str): The trace file
+        backend (StorageBackend | None): Backend to run them against, None
+            to only summarize the recorded latencies
+        speed (float, optional): 1 keeps the recorded pace, 10 runs ten
+            times faster, 0 runs as fast as possible. Defaults to 1.
+        seed (bool, optional): Insert documents reads expect to find.
+            Defaults to True.
+
+    Raises:
+        ValueError: Raised if the file is not a trace
+
+    Returns:
+        ReplayReport: Latencies per operation
+    """
+
+    report = ReplayReport()
+    _, records = read_trace(path)
+    origin = time.perf_counter()
+    for record in records:
+        times = report.operations.setdefault(record["op"], OperationTimes())
+        times.recorded.append(record["ms"] / 1000)
+        if backend is None:
+            continue
+
+        if speed > 0:
+            wait = record["t"] / speed - (time.perf_counter() - origin)
+            if wait > 0:
+                time.sleep(wait)
+        args = restore(record["args"])
+        if seed and record["op"] in READ_OPERATIONS:
+            report.seeded += _seed(backend, record, args)
+
+        started = time.perf_counter()
+        try:
+            _execute(backend, record, args)
+        except Exception:
+            times.errors += 1
+        times.replayed.append(time.perf_counter() - started)
+    report.elapsed = time.perf_counter() - origin
+    return report
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for trace replay
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.trace")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary = commands.add_parser("summary",
+                                  help="print the recorded latencies")
+    summary.add_argument("trace")
+    run = commands.add_parser("replay", help="run a trace again")
+    run.add_argument("trace")
+    run.add_argument("--backend", choices=storage.BACKENDS,
+                     default="memory",
+                     help="backend to replay against (default: memory)")
+    run.add_argument("--mongo-uri",
+                     help="scratch mongod to replay into, required with "
+                     "--backend mongo")
+    run.add_argument("--sqlite-path",
+                     help="database file for the sqlite backend")
+    run.add_argument("--speed", type=float, default=1.0,
+                     help="pace relative to the recording, 0 for as fast "
+                     "as possible (default: 1)")
+    run.add_argument("--no-seed", action="store_true",
+                     help="do not insert the documents reads expect")
+    args = parser.parse_args(argv)
+    if args.command == "replay" and args.backend == "mongo":
+        if not args.mongo_uri:
+            # Replays insert seeds, deletes and drops: never the cluster
+            parser.error("replaying into mongo needs --mongo-uri naming a "
+                         "scratch mongod")
+        os.environ[utility.MONGO_URI_ENV] = args.mongo_uri
+
+    try:
+        if args.command == "summary":
+            report = replay(args.trace, None)
+        else:
+            report = replay(args.trace,
+                            storage.get_backend(args.backend,
+                                                args.sqlite_path),
+                            args.speed, not args.no_seed)
+    except (OSError, ValueError) as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+
+    print(report.format())
+    if args.command == "replay":
+        print(f"replayed in {report.elapsed:.2f} s, "
+              f"{report.seeded} documents seeded")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
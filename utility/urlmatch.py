@@ -0,0 +1,402 @@
+"""Module matching page URLs to the vault entries that log into them
+
+Entries may store the URLs of their login pages. Each URL is reduced to its
+registrable domain ("accounts.google.co.uk" to "google.co.uk") with the
+public suffix list bundled in data/public_suffix_list.dat, and the domains
+are stored with the entry so the database can find candidates with an
+indexed equality query.
+
+For autofill, UrlIndex keeps the parsed URLs of an unlocked vault in a
+dictionary keyed by registrable domain. A lookup parses the page URL, makes
+one dictionary lookup and ranks the few entries found: an exact host beats
+a parent domain, which beats another host of the same site, and a longer
+matching path beats a shorter one.
+
+The suffix list is read once, on first use, into a dictionary mapping each
+rule to flags, so finding the public suffix of a host takes one lookup per
+label.
+
+Usage:
+    python -m utility.urlmatch domain URL [URL ...]
+    python -m utility.urlmatch bench [--entries N] [--lookups N]
+"""
+
+import argparse
+import functools
+import ipaddress
+import os
+import sys
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+from utility import utility
+from utility.storage import MongoBackend, StorageBackend, innermost
+
+SUFFIX_LIST = os.path.join(os.path.dirname(__file__), "data",
+                           "public_suffix_list.dat")
+
+RULE = 1
+WILDCARD = 2
+EXCEPTION = 4
+
+
+def _to_ascii(host: str) -> str:
+    """Converts internationalised labels to their punycode form
+    """
+
+    if host.isascii():
+        return host
+    return ".".join(label if label.isascii()
+                    else "xn--" + label.encode("punycode").decode()
+                    for label in host.split("."))
+
+
+@functools.lru_cache(maxsize=1)
+def _suffix_rules() -> Dict[str, int]:
+    """Loads the public suffix list once
+
+    Returns:
+        Dict[str, int]: Rule to RULE, WILDCARD and EXCEPTION flags;
+            "*.ck" is stored as "ck" with the WILDCARD flag
+    """
+
+    rules: Dict[str, int] = {}
+    with open(SUFFIX_LIST, encoding="utf-8") as suffixes:
+        for line in suffixes:
+            rule = line.strip()
+            if not rule or rule.startswith("//"):
+                continue
+            flag = RULE
+            if rule.startswith("!"):
+                rule, flag = rule[1:], EXCEPTION
+            elif rule.startswith("*."):
+                rule, flag = rule[2:], WILDCARD
+            rule = _to_ascii(rule.lower())
+            rules[rule] = rules.get(rule, 0) | flag
+    return rules
+
+
+def public_suffix(host: str) -> str:
+    """Returns the public suffix of a host name
+
+    Args:
+        host (str): Lower case host name in ASCII form
+
+    Returns:
+        str: e.g. "co.uk" for "www.example.co.uk"
+    """
+
+    rules = _suffix_rules()
+    labels = host.split(".")
+    for index in range(len(labels)):
+        flags = rules.get(".".join(labels[index:]), 0)
+        if flags & EXCEPTION:
+            return ".".join(labels[index + 1:])
+        if flags & RULE:
+            return ".".join(labels[index:])
+        if flags & WILDCARD and index > 0:
+            return ".".join(labels[index - 1:])
+    return labels[-1]
+
+
+def registrable_domain(host: str) -> str | None:
+    """Returns the domain a host belongs to
+
+    Args:
+        host (str): Lower case host name in ASCII form
+
+    Returns:
+        str | None: The public suffix and one more label, e.g.
+            "example.co.uk", or None if the host is a public suffix
+    """
+
+    suffix = public_suffix(host)
+    if host == suffix:
+        return None
+    return host[:-len(suffix) - 1].rsplit(".", 1)[-1] + "." + suffix
+
+
+class UrlParts(NamedTuple):
+    """The parts of a URL used for matching
+
+    Attributes:
+        host (str): Lower case host name in ASCII form
+        domain (str): Registrable domain, or the host itself for IP
+            addresses and hosts without one
+        path (str): Path, "/" if empty
+    """
+
+    host: str
+    domain: str
+    path: str
+
+
+def parse_url(url: str) -> UrlParts | None:
+    """Splits a URL into host, registrable domain and path
+
+    Args:
+        url (str): URL, with or without a scheme
+
+    Returns:
+        UrlParts | None: The parts, or None if the URL has no host
+    """
+
+    url = url.strip()
+    if "://" not in url:
+        url = "//" + url
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    host = _to_ascii(host.rstrip("."))
+
+    try:
+        ipaddress.ip_address(host)
+        domain: str | None = host
+    except ValueError:
+        domain = registrable_domain(host)
+    return UrlParts(host, domain or host, parts.path or "/")
+
+
+def _specificity(entry: UrlParts, page: UrlParts) -> Tuple[int, int]:
+    """Ranks how closely a stored URL matches a page of the same domain
+
+    Returns:
+        Tuple[int, int]: Host score (2 same host, 1 parent domain, 0 other
+            host of the site) and path score (length of a stored path that
+            prefixes the page's, -1 if it does not)
+    """
+
+    if entry.host == page.host:
+        host = 2
+    elif page.host.endswith("." + entry.host):
+        host = 1
+    else:
+        host = 0
+
+    prefix = entry.path.rstrip("/")
+    if not prefix:
+        path = 0
+    elif page.path == prefix or page.path.startswith(prefix + "/"):
+        path = len(prefix)
+    else:
+        path = -1
+    return host, path
+
+
+class UrlIndex:
+    """Stored URLs of a vault indexed by registrable domain
+    """
+
+    def __init__(self) -> None:
+        self._by_domain: Dict[str, List[Tuple[UrlParts, str]]] = {}
+        self._domains: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+    def add(self, service_name: str, urls: Iterable[str]) -> None:
+        """Indexes an entry's URLs, replacing those indexed before
+
+        Args:
+            service_name (str): Name of the website/service
+            urls (Iterable[str]): The entry's URLs; unparsable ones are
+                skipped
+        """
+
+        self.remove(service_name)
+        domains = []
+        for url in urls:
+            parts = parse_url(url)
+            if parts is None:
+                continue
+            self._by_domain.setdefault(parts.domain, []).append(
+                (parts, service_name))
+            domains.append(parts.domain)
+        if domains:
+            self._domains[service_name] = domains
+
+    def remove(self, service_name: str) -> None:
+        """Removes an entry's URLs
+
+        Args:
+            service_name (str): Name of the website/service
+        """
+
+        for domain in set(self._domains.pop(service_name, [])):
+            kept = [item for item in self._by_domain[domain]
+                    if item[1] != service_name]
+            if kept:
+                self._by_domain[domain] = kept
+            else:
+                del self._by_domain[domain]
+
+    def clear(self) -> None:
+        """Removes every entry
+        """
+
+        self._by_domain.clear()
+        self._domains.clear()
+
+    def match(self, url: str) -> List[str]:
+        """Finds the entries for a page, most specific first
+
+        Args:
+            url (str): The page's URL
+
+        Returns:
+            List[str]: Service names of entries with a URL on the page's
+                registrable domain
+        """
+
+        page = parse_url(url)
+        if page is None:
+            return []
+        best: Dict[str, Tuple[int, int]] = {}
+        for parts, service_name in self._by_domain.get(page.domain, []):
+            score = _specificity(parts, page)
+            if score > best.get(service_name, (-1, -2)):
+                best[service_name] = score
+        return sorted(best, key=lambda name: (-best[name][0],
+                                              -best[name][1], name))
+
+
+def url_fields(urls: Iterable[str]) -> Dict[str, Any]:
+    """Builds the fields an entry stores for its URLs
+
+    Args:
+        urls (Iterable[str]): URLs of the entry's login pages; blank ones
+            are ignored
+
+    Raises:
+        ValueError: Raised if a URL has no host
+
+    Returns:
+        Dict[str, Any]: "urls" as given and their registrable "domains"
+    """
+
+    kept: List[str] = []
+    domains: List[str] = []
+    for url in urls:
+        if not url.strip():
+            continue
+        parts = parse_url(url)
+        if parts is None:
+            raise ValueError(f"Not a URL: {url}")
+        kept.append(url.strip())
+        if parts.domain not in domains:
+            domains.append(parts.domain)
+    return {"urls": kept, "domains": domains}
+
+
+def ensure_url_index(backend: StorageBackend, username: str) -> None:
+    """Indexes a vault on the registrable domains of its URLs
+
+    Only MongoDB vaults are indexed; the other backends filter in process.
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+    """
+
+    if isinstance(innermost(backend), MongoBackend):
+        utility.create_index("passwords", username, [("domains", 1)])
+
+
+def find_for_url(backend: StorageBackend, username: str,
+                 url: str) -> List[Dict[str, Any]]:
+    """Reads the entries for a page from storage, most specific first
+
+    Args:
+        backend (StorageBackend): Where the vault is stored
+        username (str): User's name
+        url (str): The page's URL
+
+    Returns:
+        List[Dict[str, Any]]: Stored documents, passwords still encrypted
+    """
+
+    page = parse_url(url)
+    if page is None:
+        return []
+    documents = {document["service_name"]: document
+                 for document in backend.find_entries(
+                     "passwords", username, {"domains": page.domain})}
+    index = UrlIndex()
+    for service_name, document in documents.items():
+        index.add(service_name, document.get("urls", []))
+    return [documents[service_name] for service_name in index.match(url)]
+
+
+def benchmark(entries: int = 10000,
+              lookups: int = 100000) -> Tuple[float, float]:
+    """Times index lookups for a vault with URLs on many sites
+
+    Args:
+        entries (int, optional): Entries in the vault. Defaults to 10000.
+        lookups (int, optional): Lookups timed. Defaults to 100000.
+
+    Returns:
+        Tuple[float, float]: Seconds to build the index and microseconds
+            per lookup
+    """
+
+    suffixes = ("com", "co.uk", "github.io", "com.au", "de")
+    started = time.perf_counter()
+    index = UrlIndex()
+    for number in range(entries):
+        site = f"site{number // 3}.{suffixes[number % len(suffixes)]}"
+        index.add(f"service{number}", [f"https://login.{site}/account",
+                                       f"https://{site}/"])
+    built = time.perf_counter() - started
+
+    pages = [f"https://www.site{number % (entries // 3 or 1)}."
+             f"{suffixes[number % len(suffixes)]}/account/settings"
+             for number in range(1000)]
+    started = time.perf_counter()
+    for number in range(lookups):
+        index.match(pages[number % len(pages)])
+    return built, (time.perf_counter() - started) / lookups * 1e6
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point for URL matching
+
+    Args:
+        argv (List[str] | None, optional): Arguments, defaults to sys.argv
+
+    Returns:
+        int: Process exit status
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m utility.urlmatch")
+    commands = parser.add_subparsers(dest="command", required=True)
+    domain = commands.add_parser("domain",
+                                 help="print the registrable domain of URLs")
+    domain.add_argument("urls", nargs="+")
+    bench = commands.add_parser("bench", help="time autofill lookups")
+    bench.add_argument("--entries", type=int, default=10000)
+    bench.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    if args.command == "domain":
+        for url in args.urls:
+            parts = parse_url(url)
+            print(f"{url}\t{parts.domain if parts else '-'}")
+        return 0
+
+    started = time.perf_counter()
+    _suffix_rules()
+    print(f"suffix list loaded in "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+    built, lookup = benchmark(args.entries, args.lookups)
+    print(f"{args.entries} entries indexed in {built * 1000:.1f} ms, "
+          f"{lookup:.2f} us per lookup")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
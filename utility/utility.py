@@ -1,17 +1,52 @@
 """Module using APIs to communicate with MongoDB
 """
 
-from pymongo import MongoClient
+import os
+import threading
+from pymongo import MongoClient, ReplaceOne
 from pymongo import errors
 from pymongo.server_api import ServerApi
 from pymongo.errors import OperationFailure
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Tuple
 
 uri = 'mongodb+srv://cluster1.cjufb6h.mongodb.net/?authSource=%24external'  \
     '&authMechanism=MONGODB-X509&retryWrites=true&w=majority'
 
 path_to_certificate = 'utility/pm_cert.pem'
 
+# Overrides the cluster, e.g. mongodb://localhost:27017 for a local mongod
+MONGO_URI_ENV = "PM_MONGO_URI"
+
+_client = None  # type: Any
+_client_lock = threading.Lock()
+
+
+def get_client() -> Any:
+    """Returns the process wide MongoDB client, creating it on first use
+
+    MongoClient keeps a pool of authenticated TLS connections, so sharing
+    one client avoids a new handshake for every operation. When
+    $PM_MONGO_URI is set it is used as is instead of the cluster.
+
+    Returns:
+        Any: The shared MongoClient
+    """
+
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                override = os.environ.get(MONGO_URI_ENV)
+                if override:
+                    _client = MongoClient(override)
+                else:
+                    _client = MongoClient(
+                        uri, tls=True,
+                        tlsCertificateKeyFile=path_to_certificate,
+                        server_api=ServerApi('1'))
+    return _client
+
 
 def create_connection() -> Any:
     """Creates connection to MongoDB database
@@ -20,9 +55,7 @@ def create_connection() -> Any:
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client['testDB']
@@ -47,9 +80,7 @@ def create_collection(database_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -60,6 +91,46 @@ def create_collection(database_name: str,
         raise ex
 
 
+def create_index(database_name: str, collection_name: str,
+                 keys: List[Tuple[str, int]],
+                 expire_after_seconds: int | None = None) -> str:
+    """Creates an index if it does not exist yet
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+        keys (List[Tuple[str, int]]): Fields and directions, 1 or -1
+        expire_after_seconds (int | None, optional): Makes a single field
+            date index a TTL index; an existing TTL index is changed to the
+            new expiry. Defaults to None.
+
+    Raises:
+        ex: Raises an error if found
+
+    Returns:
+        str: Name of the index
+    """
+
+    client = get_client()
+    collection = client[database_name][collection_name]
+    options = {}
+    if expire_after_seconds is not None:
+        options["expireAfterSeconds"] = expire_after_seconds
+
+    try:
+        return str(collection.create_index(keys, **options))
+    except OperationFailure as ex:
+        if expire_after_seconds is None or ex.code not in (85, 86):
+            print(ex)
+            raise ex
+    # IndexOptionsConflict: only the expiry differs
+    client[database_name].command(
+        "collMod", collection_name,
+        index={"keyPattern": dict(keys),
+               "expireAfterSeconds": expire_after_seconds})
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
 def insert_entry(database_name: str,
                  collection_name: str, entry: Dict[str, Any]) -> None:
     """Inserts one {key: value} pair into collection
@@ -74,9 +145,7 @@ def insert_entry(database_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -102,9 +171,7 @@ def insert_entries(database_name: str, collection_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -116,7 +183,8 @@ def insert_entries(database_name: str, collection_name: str,
 
 
 def find_entries(database_name: str, collection_name: str,
-                 entries: Dict[str, Any] | None = None) -> Any:
+                 entries: Dict[str, Any] | None = None,
+                 projection: List[str] | None = None) -> Any:
     """Finds {key: value} listings in a collection
 
     Args:
@@ -129,6 +197,8 @@ def find_entries(database_name: str, collection_name: str,
             for matching keys in {key: value} filter and return all matching
             listings in the collection.
         Variable name "entries" defaults to None
+        projection (List[str] | None, optional): Fields to return besides
+            _id. Defaults to None, returning whole documents.
 
     Raises:
         ex: Raises an error if found
@@ -137,22 +207,20 @@ def find_entries(database_name: str, collection_name: str,
         Any: Returns list of collection dictionary entries
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         if entries is None:
             db = client[database_name]
             collection = db[collection_name]
-            cursor = collection.find()
+            cursor = collection.find(None, projection)
             documents = list(cursor)
             return documents
 
         else:
             db = client[database_name]
             collection = db[collection_name]
-            cursor = collection.find(entries)
+            cursor = collection.find(entries, projection)
             documents = list(cursor)
             return documents
     except OperationFailure as ex:
@@ -160,8 +228,81 @@ def find_entries(database_name: str, collection_name: str,
         raise ex
 
 
+def iter_entries(database_name: str, collection_name: str,
+                 entries: Dict[str, Any] | None = None,
+                 batch_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+    """Streams {key: value} listings from a collection in batches so large
+        collections are never held in memory at once
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+        entries (Dict[str, Any] | None, optional): Filter, None matches every
+            listing. Defaults to None.
+        batch_size (int, optional): Listings per batch. Defaults to 1000.
+
+    Raises:
+        ex: Raises an error if found
+
+    Yields:
+        Iterator[List[Dict[str, Any]]]: Lists of at most batch_size listings
+    """
+
+    client = get_client()
+
+    try:
+        db = client[database_name]
+        collection = db[collection_name]
+        cursor = collection.find(entries or {}).batch_size(batch_size)
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
+
+
+def count_entries(database_name: str, collection_name: str,
+                  entries: Dict[str, Any] | None = None,
+                  limit: int = 0) -> int:
+    """Counts the listings matching a filter without fetching them
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+        entries (Dict[str, Any] | None, optional): Filter, None matches every
+            listing. Defaults to None.
+        limit (int, optional): Stop counting after this many, so
+            limit=1 answers whether any listing matches. Defaults to 0,
+            counting them all.
+
+    Raises:
+        ex: Raises an error if found
+
+    Returns:
+        int: Number of matching listings, at most limit
+    """
+
+    client = get_client()
+
+    try:
+        collection = client[database_name][collection_name]
+        if limit > 0:
+            return int(collection.count_documents(entries or {},
+                                                  limit=limit))
+        return int(collection.count_documents(entries or {}))
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
+
+
 def update_entry(database_name: str, collection_name: str,
-                 old_data: Dict[str, Any], new_data: Dict[str, Any]) -> None:
+                 old_data: Dict[str, Any], new_data: Dict[str, Any]) -> bool:
     """Finds the first matching key of {key: value} filter and
         updates the value
 
@@ -176,16 +317,18 @@ def update_entry(database_name: str, collection_name: str,
 
     Raises:
         ex: Raises an error if found
+
+    Returns:
+        bool: True if an entry matched the filter
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
         collection = db[collection_name]
-        collection.update_one(old_data, {"$set": new_data})
+        result = collection.update_one(old_data, {"$set": new_data})
+        return bool(result.matched_count > 0)
     except OperationFailure as ex:
         print(ex)
         raise ex
@@ -208,9 +351,7 @@ def update_entries(database_name: str, collection_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -221,6 +362,35 @@ def update_entries(database_name: str, collection_name: str,
         raise ex
 
 
+def upsert_entries(database_name: str, collection_name: str,
+                   entries: List[Any]) -> None:
+    """Replaces the listings with the same _ids, inserting new ones, in one
+        bulk write
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+        entries (List[Any]): Listings, each with an _id
+
+    Raises:
+        ex: Raises an error if found
+    """
+
+    if not entries:
+        return
+    client = get_client()
+
+    try:
+        db = client[database_name]
+        collection = db[collection_name]
+        collection.bulk_write([ReplaceOne({"_id": entry["_id"]}, entry,
+                                          upsert=True)
+                               for entry in entries])
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
+
+
 def delete_entry(database_name: str, collection_name: str,
                  old_data: Dict[str, Any]) -> None:
     """Deletes the first matching {key: value} filter entry
@@ -235,9 +405,7 @@ def delete_entry(database_name: str, collection_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -262,9 +430,7 @@ def delete_entries(database_name: str, collection_name: str,
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -286,9 +452,7 @@ def delete_collection(database_name: str, collection_name: str) -> None:
         ex: Raises an error if found
     """
 
-    client = MongoClient(uri, tls=True,
-                         tlsCertificateKeyFile=path_to_certificate,
-                         server_api=ServerApi('1'))   # type: Any
+    client = get_client()
 
     try:
         db = client[database_name]
@@ -297,3 +461,85 @@ def delete_collection(database_name: str, collection_name: str) -> None:
     except OperationFailure as ex:
         print(ex)
         raise ex
+
+
+def list_collection_names(database_name: str) -> List[str]:
+    """Lists the collections in a database
+
+    Args:
+        database_name (str): Name of MongoDB database
+
+    Raises:
+        ex: Raises an error if found
+
+    Returns:
+        List[str]: Names of the collections in the database
+    """
+
+    client = get_client()
+
+    try:
+        db = client[database_name]
+        return list(db.list_collection_names())
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
+
+
+def explain_find(database_name: str, collection_name: str,
+                 entries: Dict[str, Any] | None = None,
+                 limit: int = 0) -> Dict[str, Any]:
+    """Asks the server how it would run a query, without running it for
+        the caller
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+        entries (Dict[str, Any] | None, optional): Filter, None matches every
+            listing. Defaults to None.
+        limit (int, optional): Listings wanted, 0 for all. Defaults to 0.
+
+    Raises:
+        ex: Raises an error if found
+
+    Returns:
+        Dict[str, Any]: The explain output at executionStats verbosity,
+            holding the winning plan and the documents examined
+    """
+
+    client = get_client()
+
+    command: Dict[str, Any] = {"find": collection_name,
+                               "filter": entries or {}}
+    if limit > 0:
+        command["limit"] = limit
+    try:
+        return dict(client[database_name].command(
+            "explain", command, verbosity="executionStats"))
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
+
+
+def estimated_count(database_name: str, collection_name: str) -> int:
+    """Returns a collection's document count from its metadata
+
+    Args:
+        database_name (str): Name of MongoDB database
+        collection_name (str): Name of MongoDB collection
+
+    Raises:
+        ex: Raises an error if found
+
+    Returns:
+        int: Approximate number of documents
+    """
+
+    client = get_client()
+
+    try:
+        return int(client[database_name][
+            collection_name].estimated_document_count())
+    except OperationFailure as ex:
+        print(ex)
+        raise ex
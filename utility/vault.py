@@ -0,0 +1,704 @@
+"""Module holding the storage, keys and vault operations of a session
+
+The Password Manager menu and the tools in this package (the agent, the
+load generator, provisioning, consistency and Merkle checks) share one
+storage chain, one keystore and the same user and entry operations, so they
+all store exactly the same documents. The operations here never print; the
+menu in passwordManager reports their results.
+"""
+
+import os
+from cryptography.fernet import Fernet
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+from utility import accesslog
+from utility import attachments
+from utility import audit
+from utility import breach
+from utility import envelope
+from utility import existence
+from utility import history
+from utility import keystore as keystores
+from utility import merkle
+from utility import packed
+from utility import prefetch
+from utility import queryplan
+from utility import storage as storage_backends
+from utility import strength
+from utility import trace
+from utility import urlmatch
+from utility import writebehind
+
+storage: storage_backends.StorageBackend = storage_backends.get_backend()
+
+keystore: keystores.Keystore | None = None
+
+access_log: accesslog.AccessLog | None = None
+
+trace_recorder: trace.RecordingBackend | None = None
+
+plan_inspector: queryplan.ExplainingBackend | None = None
+
+# Fernet keys unwrapped from the keystore for users logged in this session
+_unlocked_keys: Dict[str, bytes] = {}
+
+
+def set_storage_backend(backend: storage_backends.StorageBackend) -> None:
+    """Selects the storage backend used by every vault operation
+
+    Args:
+        backend (storage_backends.StorageBackend): The backend to use
+    """
+
+    global storage
+    storage = backend
+
+
+def configure_storage(backend_name: str | None = None,
+                      sqlite_path: str | None = None,
+                      storage_mode: str | None = None,
+                      write_behind: str | None = None,
+                      trace_path: str | None = None,
+                      explain: str | None = None) -> None:
+    """Builds the storage backend chosen at startup and selects it
+
+    Args:
+        backend_name (str | None, optional): "mongo", "memory" or "sqlite".
+            Defaults to $PM_BACKEND, then "mongo".
+        sqlite_path (str | None, optional): Database file for the sqlite
+            backend. Defaults to $PM_SQLITE_PATH.
+        storage_mode (str | None, optional): "documents" stores one
+            document per entry, "packed" one encrypted document per vault.
+            Defaults to $PM_STORAGE_MODE, then "documents".
+        write_behind (str | None, optional): Journal file for acknowledging
+            writes before they reach the backend. Defaults to
+            $PM_WRITE_BEHIND, then writing through.
+        trace_path (str | None, optional): File recording every database
+            call for replay, see utility.trace. Defaults to $PM_TRACE, then
+            not recording.
+        explain (str | None, optional): "warn" or "fail" to explain MongoDB
+            queries and flag collection scans, see utility.queryplan.
+            Defaults to $PM_EXPLAIN, then not explaining.
+
+    Raises:
+        ValueError: Raised if the storage mode or explain mode is unknown
+    """
+
+    global trace_recorder, plan_inspector
+
+    backend = storage_backends.get_backend(backend_name, sqlite_path)
+
+    explain = explain or os.environ.get(queryplan.EXPLAIN_ENV)
+    if explain and explain not in queryplan.EXPLAIN_MODES:
+        raise ValueError(f"Unknown explain mode {explain}")
+    plan_inspector = None
+    if explain and isinstance(backend, storage_backends.MongoBackend):
+        plan_inspector = queryplan.ExplainingBackend(
+            backend, queryplan.MongoExplainer(), explain)
+        backend = plan_inspector
+
+    trace_path = trace_path or os.environ.get(trace.TRACE_ENV)
+    if trace_recorder is not None:
+        trace_recorder.close()
+        trace_recorder = None
+    if trace_path:
+        trace_recorder = trace.RecordingBackend(backend, trace_path)
+        backend = trace_recorder
+
+    storage_mode = (storage_mode or os.environ.get(packed.STORAGE_MODE_ENV)
+                    or "documents")
+    if storage_mode == "packed":
+        backend = packed.PackedBackend(backend, load_fernet_key_locally)
+    elif storage_mode != "documents":
+        raise ValueError(f"Unknown storage mode {storage_mode}")
+
+    write_behind = write_behind or os.environ.get(
+        writebehind.WRITE_BEHIND_ENV)
+    if write_behind:
+        backend = writebehind.WriteBehindBackend(backend, write_behind)
+
+    backend = existence.ExistenceBackend(backend)
+
+    set_storage_backend(prefetch.PrefetchBackend(backend))
+
+
+def configure_keystore(path: str | None = None) -> None:
+    """Selects where user Fernet keys are kept
+
+    Args:
+        path (str | None, optional): Keystore file. Defaults to
+            $PM_KEYSTORE, then one key file per user.
+    """
+
+    global keystore
+
+    path = path or os.environ.get(keystores.KEYSTORE_ENV)
+    keystore = keystores.Keystore(path) if path else None
+
+
+def configure_access_log(enabled: bool | None = None) -> None:
+    """Starts recording vault access to the audit.events collection
+
+    Args:
+        enabled (bool | None, optional): Whether to record access.
+            Defaults to $PM_ACCESS_LOG, then off.
+    """
+
+    global access_log
+
+    if enabled is None:
+        enabled = os.environ.get(accesslog.ACCESS_LOG_ENV, "").lower() in (
+            "1", "on", "true", "yes")
+    if access_log is not None:
+        access_log.close()
+        access_log = None
+    if enabled:
+        accesslog.ensure_indexes(storage_backends.innermost(storage))
+        access_log = accesslog.AccessLog(storage)
+
+
+def log_access(username: str, action: str,
+               service_name: str | None = None) -> None:
+    """Records a vault access event if the access log is on
+
+    Args:
+        username (str): User who acted
+        action (str): What they did, e.g. "view" or "delete"
+        service_name (str | None, optional): Entry acted on.
+            Defaults to None.
+    """
+
+    if access_log is not None:
+        access_log.record(username, action, service_name)
+
+
+def close_storage(timeout: float = 10.0) -> List[str]:
+    """Waits for journaled writes and logged events before exiting
+
+    Args:
+        timeout (float, optional): Seconds to wait. Defaults to 10.
+
+    Returns:
+        List[str]: Warnings to show about writes that were not stored and
+            queries that scanned a whole collection
+    """
+
+    warnings = []
+    if isinstance(storage, writebehind.WriteBehindBackend):
+        if not storage.close(timeout):
+            warnings.append(f"{storage.pending} change(s) will be stored "
+                            "when the Password Manager next starts.")
+    if access_log is not None:
+        lost = access_log.close(timeout)
+        if lost:
+            warnings.append(f"{lost} access log event(s) could not be "
+                            "stored.")
+    if trace_recorder is not None:
+        trace_recorder.close()
+    if plan_inspector is not None and plan_inspector.flagged():
+        warnings.append("Queries that scanned a whole collection:\n"
+                        + plan_inspector.report())
+    return warnings
+
+
+def generate_user_fernet_key() -> Any:
+    """Generates a unique Fernet key for the user
+
+    Returns:
+        Any: Returns the Fernet key
+    """
+
+    key = Fernet.generate_key()
+    return key
+
+
+def store_fernet_key_locally(fernet_key: Any, user_id: Any) -> None:
+    """Stores the Fernet key locally for a user
+
+    Args:
+        fernet_key (Any): The Fernet key
+        user_id (Any): Name of the user
+    """
+
+    key_filename = f"user_{user_id}_fernet.key"
+    with open(key_filename, "wb") as key_file:
+        key_file.write(fernet_key)
+
+
+def load_fernet_key_locally(user_id: Any) -> Any:
+    """Loads the user's Fernet key from local storage
+
+    Args:
+        user_id (Any): Name of the user
+
+    Returns:
+        Any: Fernet key stored locally on system
+    """
+
+    if user_id in _unlocked_keys:
+        return _unlocked_keys[user_id]
+
+    key_filename = f"user_{user_id}_fernet.key"
+    with open(key_filename, "rb") as key_file:
+        key = key_file.read()
+    return key
+
+
+def unlock_fernet_key(username: str, master_password: Any) -> Any:
+    """Loads a user's Fernet key at login
+
+    With a keystore the key is unwrapped with the master password and kept
+    in memory until logout.
+
+    Args:
+        username (str): User's name
+        master_password (Any): User's master password
+
+    Returns:
+        Any: The Fernet key, or None if the user has no key or the master
+            password does not unwrap it
+    """
+
+    if keystore is not None and username in keystore:
+        try:
+            key = keystore.get_key(username, master_password)
+        except keystores.KeystoreError:
+            return None
+        _unlocked_keys[username] = key
+        return key
+
+    if os.path.exists(f"user_{username}_fernet.key"):
+        return load_fernet_key_locally(username)
+    return None
+
+
+def forget_fernet_key(username: str) -> None:
+    """Drops a user's unwrapped key at logout
+
+    Args:
+        username (str): User's name
+    """
+
+    _unlocked_keys.pop(username, None)
+
+
+def encrypt_password(fernet_key: Any, password: Any) -> Any:
+    """Encrypts a password with an AES-GCM key derived from the Fernet key
+
+    Args:
+        fernet_key (Any): The Fernet key
+        password (Any): user password
+
+    Returns:
+        bytes: The user's encrypted password, see utility.envelope
+    """
+
+    return envelope.Cipher(fernet_key).encrypt(password.encode())
+
+
+def decrypt_password(fernet_key: Any, encrypted_password: Any) -> Any:
+    """Decrypts user passwords
+
+    Args:
+        fernet_key (Any): Fernet key
+        encrypted_password (Any): User's encrypted password
+
+    Returns:
+        Any: Decrypted user's password
+    """
+
+    cipher = envelope.Cipher(fernet_key)
+    decrypted_password = cipher.decrypt(encrypted_password)
+    return decrypted_password.decode()
+
+
+def user_exists(username: str) -> bool:
+    """Check if the username already exists
+
+    Args:
+        username (str): User's name
+
+    Returns:
+        bool: True if the user has a record, else False
+    """
+
+    return storage.count_entries("users", "names", {'username': username},
+                                 limit=1) > 0
+
+
+def service_exists(username: str, service_name: str) -> bool:
+    """Check if service name already exists
+
+    Args:
+        username (str): User's name
+        service_name (str): The name of the website/service
+
+    Returns:
+        bool: If service name is found returns True else returns False
+    """
+
+    return storage.count_entries("passwords", username,
+                                 {'service_name': service_name},
+                                 limit=1) > 0
+
+
+def check_master_password(password: Any,
+                          username: str = "") -> strength.StrengthResult:
+    """Estimate master password strength with feedback for the user
+
+    Args:
+        password (Any): User's master password
+        username (str, optional): User's name, which the password should
+            not be based on. Defaults to "".
+
+    Returns:
+        strength.StrengthResult: Score from 0 to 4 and feedback. Passwords
+        in the breach corpus named by $PM_BREACH_CORPUS score 0.
+    """
+
+    result = strength.estimate_strength(password, [username])
+
+    checker = breach.default_checker()
+    if checker is not None and checker.is_breached(password):
+        result.score = 0
+        result.feedback.insert(
+            0, "This password appears in a known data breach.")
+
+    return result
+
+
+def create_user(username: str, master_password: Any) -> bool:
+    """Creates a user with a new Fernet key and an empty vault
+
+    Args:
+        username (str): User's name
+        master_password (Any): User's master password
+
+    Returns:
+        bool: False if the username is taken, else True
+    """
+
+    if user_exists(username):
+        return False
+
+    fernet_key = generate_user_fernet_key()
+
+    storage.insert_entry("users", "names", {
+        "username": username,
+        "master_password": encrypt_password(fernet_key, master_password),
+        merkle.ROOT_FIELD: merkle.EMPTY})
+    merkle.ensure_indexes(storage, username)
+    urlmatch.ensure_url_index(storage, username)
+    audit.ensure_age_index(storage, username)
+
+    if keystore is not None:
+        keystore.put(username, fernet_key, master_password)
+    else:
+        store_fernet_key_locally(fernet_key, username)
+    log_access(username, "create_user")
+    return True
+
+
+def authenticate_user(username: str, master_password: Any) -> bool:
+    """Checks a user's master password and unlocks their key
+
+    Args:
+        username (str): User's name
+        master_password (Any): User's master password
+
+    Raises:
+        cryptography.fernet.InvalidToken: Raised if the stored master
+            password cannot be decrypted with the user's key
+
+    Returns:
+        bool: False if the user or their key does not exist or the master
+            password is wrong, else True
+    """
+
+    fernet_key = unlock_fernet_key(username, master_password)
+
+    if fernet_key is not None:
+        users = storage.find_entries("users", "names",
+                                     {"username": username})
+        if users:
+            encrypted_master_password = users[0]['master_password']
+            if master_password == decrypt_password(
+                    fernet_key, encrypted_master_password):
+                if keystore is not None and username not in keystore:
+                    # Move a key file into the keystore on first login
+                    keystore.put(username, fernet_key, master_password)
+                    _unlocked_keys[username] = fernet_key
+                    os.remove(f"user_{username}_fernet.key")
+                log_access(username, "login")
+                return True
+            if keystore is not None and username in keystore:
+                # The keystore already took the new password, but the
+                # change stopped before the record was updated
+                storage.update_entry(
+                    "users", "names",
+                    {"username": username,
+                     "master_password": encrypted_master_password},
+                    {"master_password": encrypt_password(
+                        fernet_key, master_password)})
+                log_access(username, "change_master")
+                log_access(username, "login")
+                return True
+
+    log_access(username, "login_failed")
+    return False
+
+
+def change_master_password(username: str, new_master_password: Any) -> bool:
+    """Replaces a user's master password
+
+    The strength of the new password is not checked here.
+
+    Args:
+        username (str): User's name
+        new_master_password (Any): The new master password
+
+    Returns:
+        bool: False if the user does not exist or the record was changed
+            in another session, else True
+    """
+
+    users = storage.find_entries("users", "names", {'username': username})
+    if not users:
+        return False
+
+    fernet_key = load_fernet_key_locally(username)
+
+    old_data = {'username': username,
+                'master_password': users[0]['master_password']}
+    new_data = {'username': username,
+                'master_password': encrypt_password(fernet_key,
+                                                    new_master_password)}
+
+    # The key is rewrapped first: if the record is not updated after it,
+    # the next login with the new password finishes the change
+    store = (keystore if keystore is not None and username in keystore
+             else None)
+    if store is not None:
+        old_master_password = decrypt_password(
+            fernet_key, users[0]['master_password'])
+        store.put(username, fernet_key, new_master_password)
+    updated = False
+    try:
+        updated = storage.update_entry("users", "names", old_data, new_data)
+    finally:
+        if store is not None and not updated:
+            # Wrapped under the old password again, matching the record
+            store.put(username, fernet_key, old_master_password)
+    if not updated:
+        return False
+
+    log_access(username, "change_master")
+    return True
+
+
+def delete_user_data(backend: storage_backends.StorageBackend,
+                     username: str) -> None:
+    """Drops a user's vault, history, digests and attachments
+
+    Every path removing a user calls this, so none of their data is left
+    behind. The users.names record and the key are not touched.
+
+    Args:
+        backend (storage_backends.StorageBackend): Where the data is stored
+        username (str): User's name
+    """
+
+    backend.delete_collection("passwords", username)
+    history.delete_all(backend, username)
+    merkle.delete_all(backend, username)
+    attachments.store_for(backend).delete_all(username)
+
+
+def delete_user(username: str) -> bool:
+    """Deletes a user, all of their data and their key
+
+    Args:
+        username (str): User's name
+
+    Returns:
+        bool: False if the user does not exist, else True
+    """
+
+    if not user_exists(username):
+        return False
+
+    delete_user_data(storage, username)
+
+    storage.delete_entry("users", "names", {'username': username})
+
+    key_filename = f"user_{username}_fernet.key"
+    if os.path.exists(key_filename):
+        os.remove(key_filename)
+    if keystore is not None:
+        keystore.delete(username)
+    forget_fernet_key(username)
+    log_access(username, "delete_user")
+
+    return True
+
+
+def add_password(username: str, service_name: str, username_entry: str,
+                 password_entry: str, urls: List[str] | None = None) -> bool:
+    """Adds an entry to a user's vault
+
+    Args:
+        username (str): User's name
+        service_name (str): Name of the website/service being added
+        username_entry (str): Username for the website/service
+        password_entry (str): Password for the website/service
+        urls (List[str] | None, optional): URLs of the service's login
+            pages, for autofill. Defaults to None.
+
+    Raises:
+        ValueError: Raised if one of the URLs has no host
+
+    Returns:
+        bool: False if the user does not exist, else True
+    """
+
+    url_data = urlmatch.url_fields(urls) if urls else {}
+
+    if not user_exists(username):
+        return False
+
+    fernet_key = load_fernet_key_locally(username)
+
+    now = datetime.now(timezone.utc)
+    storage.insert_entry("passwords", username, {
+        "username": username,
+        "service_name": service_name,
+        "username_entry": username_entry,
+        "password_entry": encrypt_password(fernet_key, password_entry),
+        "created_at": now,
+        "updated_at": now,
+        **url_data})
+    merkle.update(storage, username, fernet_key, service_name)
+    log_access(username, "add", service_name)
+
+    return True
+
+
+def update_service(username: str, service_name: str, new_username: str,
+                   new_password: str, urls: List[str] | None = None) -> bool:
+    """Replaces the username and password of an entry
+
+    Args:
+        username (str): User's name
+        service_name (str): Name of website/service
+        new_username (str): New username for website/service
+        new_password (str): New password for website/service
+        urls (List[str] | None, optional): New URLs of the service's login
+            pages, None keeps the stored ones. Defaults to None.
+
+    Raises:
+        ValueError: Raised if one of the URLs has no host
+
+    Returns:
+        bool: False if the user or entry does not exist or the entry was
+            changed in another session, else True
+    """
+
+    url_data = urlmatch.url_fields(urls) if urls is not None else {}
+
+    if not user_exists(username):
+        return False
+
+    fernet_key = load_fernet_key_locally(username)
+
+    current = storage.find_entries("passwords", username,
+                                   {"service_name": service_name})
+    if not current:
+        return False
+
+    old_data = {'service_name': service_name,
+                'username_entry': current[0]['username_entry'],
+                'password_entry': current[0]['password_entry']}
+    new_data = {'service_name': service_name,
+                'username_entry': new_username,
+                'password_entry': encrypt_password(fernet_key, new_password),
+                'updated_at': datetime.now(timezone.utc),
+                **url_data}
+    if not storage.update_entry("passwords", username, old_data, new_data):
+        # Changed in another session since it was read
+        return False
+    history.record(storage, username, current[0])
+    merkle.update(storage, username, fernet_key, service_name)
+    log_access(username, "update", service_name)
+
+    return True
+
+
+def delete_service_and_passwords(username: str, service_name: str) -> bool:
+    """Deletes an entry with its history and attachments
+
+    Args:
+        username (str): User's name
+        service_name (str): Name of website/service
+
+    Returns:
+        bool: False if the entry does not exist, else True
+    """
+
+    if not service_exists(username, service_name):
+        return False
+
+    storage.delete_entry("passwords", username, {'service_name': service_name})
+
+    if not service_exists(username, service_name):
+        attachments.delete_service_attachments(
+            attachments.store_for(storage), username, service_name)
+        history.delete_service_history(storage, username, service_name)
+    merkle.update(storage, username, load_fernet_key_locally(username),
+                  service_name)
+    log_access(username, "delete", service_name)
+
+    return True
+
+
+def restore_password(username: str, service_name: str, number: int) -> bool:
+    """Makes a previous password of a service current again
+
+    The password being replaced is kept in the history, so the restore can
+    be undone.
+
+    Args:
+        username (str): User's name
+        service_name (str): Name of website/service
+        number (int): Version to restore, 1 being the most recently
+            replaced password
+
+    Returns:
+        bool: False if the service or version does not exist or the entry
+            was changed in another session, else True
+    """
+
+    current = storage.find_entries("passwords", username,
+                                   {"service_name": service_name})
+    chosen = [version
+              for version in history.versions(storage, username, service_name)
+              if version.number == number]
+    if not current or not chosen:
+        return False
+
+    old_data = {'service_name': service_name,
+                'username_entry': current[0]['username_entry'],
+                'password_entry': current[0]['password_entry']}
+    new_data = {'service_name': service_name,
+                'username_entry': chosen[0].username_entry,
+                'password_entry': chosen[0].password_entry,
+                'updated_at': datetime.now(timezone.utc)}
+    if not storage.update_entry("passwords", username, old_data, new_data):
+        # Changed in another session since it was read
+        return False
+    history.record(storage, username, current[0])
+    history.forget(storage, username, chosen[0])
+    merkle.update(storage, username, load_fernet_key_locally(username),
+                  service_name)
+    log_access(username, "restore", service_name)
+
+    return True
@@ -0,0 +1,190 @@
+"""Module pushing vault changes made by other sessions into local caches
+
+VaultWatcher follows MongoDB change streams on a user's passwords.<user>
+collection and on their users.names record, and calls every subscriber with
+each insert, update, replace or delete. Subscribers such as the agent's
+VaultSession apply the change to their cache instead of refetching the whole
+vault. The Password Manager run with --watch (or PM_WATCH=1) applies the
+changes another session makes to a logged in user's prefetched vault the same
+way, and drops its other cached reads of the changed collection.
+
+The resume token of each stream is saved to a file after every change, so a
+watcher restarted after a disconnect or crash continues where it stopped.
+Errors raised by subscribers are kept in errors and do not stop the stream.
+Change streams need a replica set; a single node replica set started with
+"mongod --replSet rs0" followed by rs.initiate() is enough for testing.
+"""
+
+import os
+import threading
+from bson import json_util
+from pymongo.errors import PyMongoError
+from typing import Any, Callable, Dict, List
+from utility import utility
+
+WATCH_ENV = "PM_WATCH"
+MAX_AWAIT_MS = 1000
+RETRY_SECONDS = 2.0
+
+ChangeCallback = Callable[[Dict[str, Any]], None]
+
+
+class ResumeTokenStore:
+    """Keeps the last resume token of every stream in a small JSON file
+    """
+
+    def __init__(self, path: str | None) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, Any] = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as token_file:
+                self._tokens = json_util.loads(token_file.read())
+
+    def get(self, stream: str) -> Any:
+        """Returns the saved token of a stream
+
+        Args:
+            stream (str): Stream name such as "vault" or "user"
+
+        Returns:
+            Any: The resume token, or None to start from now
+        """
+
+        with self._lock:
+            return self._tokens.get(stream)
+
+    def save(self, stream: str, token: Any) -> None:
+        """Saves a stream's token, replacing the file atomically
+
+        Args:
+            stream (str): Stream name
+            token (Any): The resume token of the last change handled
+        """
+
+        with self._lock:
+            self._tokens[stream] = token
+            if not self.path:
+                return
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as token_file:
+                token_file.write(json_util.dumps(self._tokens))
+            os.replace(temporary, self.path)
+
+
+class VaultWatcher:
+    """Follows change streams for one user's vault and record
+
+    Args:
+        username (str): User's name
+        token_path (str | None, optional): File keeping the resume tokens.
+            Defaults to None, which resumes only within this process.
+        client (Any, optional): MongoClient to use. Defaults to the shared
+            client from utility.get_client().
+    """
+
+    def __init__(self, username: str, token_path: str | None = None,
+                 client: Any = None) -> None:
+        self.username = username
+        self.tokens = ResumeTokenStore(token_path)
+        self._client = client
+        self._subscribers: List[ChangeCallback] = []
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.errors: List[Exception] = []
+
+    def subscribe(self, callback: ChangeCallback) -> None:
+        """Registers a function called with every change
+
+        The change is a dictionary with "source" ("vault" or "user"),
+        "operation", "document_key" and, except for deletes, "document".
+
+        Args:
+            callback (ChangeCallback): Function taking the change
+        """
+
+        self._subscribers.append(callback)
+
+    def start(self) -> None:
+        """Starts one background thread per stream
+        """
+
+        client = self._client or utility.get_client()
+        users = client["users"]["names"]
+
+        # Deletes carry only the _id, so follow the user's record by _id
+        record = users.find_one({"username": self.username}, {"_id": 1})
+        if record is not None:
+            user_filter = {"documentKey._id": record["_id"]}
+        else:
+            user_filter = {"fullDocument.username": self.username}
+
+        streams = {
+            "vault": (client["passwords"][self.username], []),
+            "user": (users, [{"$match": user_filter}]),
+        }
+        self._stop.clear()
+        for name, (collection, pipeline) in streams.items():
+            thread = threading.Thread(target=self._follow,
+                                      args=(name, collection, pipeline),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stops the background threads
+
+        Args:
+            timeout (float | None, optional): Seconds to wait for each
+                thread. Defaults to None.
+        """
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _follow(self, name: str, collection: Any,
+                pipeline: List[Dict[str, Any]]) -> None:
+        """Reads a change stream until stopped, resuming after errors
+
+        Args:
+            name (str): Stream name used for the resume token
+            collection (Any): The watched collection
+            pipeline (List[Dict[str, Any]]): Aggregation filter for changes
+        """
+
+        while not self._stop.is_set():
+            try:
+                with collection.watch(pipeline,
+                                      full_document="updateLookup",
+                                      resume_after=self.tokens.get(name),
+                                      max_await_time_ms=MAX_AWAIT_MS
+                                      ) as stream:
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self._dispatch(name, change)
+                            self.tokens.save(name, stream.resume_token)
+            except PyMongoError as ex:
+                self.errors.append(ex)
+                self._stop.wait(RETRY_SECONDS)
+
+    def _dispatch(self, name: str, change: Dict[str, Any]) -> None:
+        """Passes a change to the subscribers
+
+        Args:
+            name (str): Stream the change came from
+            change (Dict[str, Any]): The raw change event
+        """
+
+        event = {"source": name,
+                 "operation": change.get("operationType"),
+                 "document_key": change.get("documentKey", {}).get("_id"),
+                 "document": change.get("fullDocument")}
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception as ex:
+                # A failing subscriber must not stop the stream for others
+                self.errors.append(ex)
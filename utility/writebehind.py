@@ -0,0 +1,455 @@
+"""Module acknowledging vault writes once they are in a local journal
+
+With a distant MongoDB cluster and w=majority every add, update and delete
+waits for a cross-region round trip. WriteBehindBackend instead appends each
+write to a journal file, fsyncs it and returns, so an edit costs a local
+disk flush. A background thread drains the journal to the real backend in
+order, merging runs of inserts into one insert_entries call, and records an
+acknowledgement line after every write that reached the backend.
+
+Reads see writes that are still pending: a collection with pending writes is
+read from the backend once and the pending writes are applied on top, with
+the same filter rules as MemoryBackend. Later writes update that view until
+the collection has nothing pending.
+
+When the process starts, writes journaled but never acknowledged are
+replayed. Inserts carry their _id in the journal, so an insert that reached
+the backend before a crash is not inserted twice. If the backend keeps
+failing the writes stay in the journal, last_error is set and the worker
+retries until it succeeds.
+
+Journal lines are MongoDB extended JSON:
+
+    {"seq": 7, "op": "insert_entries", "args": ["passwords", "Peter", [...]]}
+    {"ack": 7}
+"""
+
+import copy
+import os
+import threading
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import Any, Dict, Iterator, List, Tuple
+from utility.storage import (DEFAULT_BATCH_SIZE, ForwardingBackend,
+                             MemoryBackend, StorageBackend)
+
+WRITE_BEHIND_ENV = "PM_WRITE_BEHIND"
+DEFAULT_JOURNAL_PATH = "pm_journal.log"
+RETRY_SECONDS = 2.0
+
+
+class PendingWrite:
+    """A journaled write that has not reached the backend yet
+
+    Args:
+        seq (int): Position in the journal
+        op (str): StorageBackend method name
+        args (List[Any]): Arguments of the call
+        replayed (bool, optional): True if it may already have been
+            applied, after a restart or a failed attempt. Defaults to False.
+    """
+
+    __slots__ = ("seq", "op", "args", "replayed")
+
+    def __init__(self, seq: int, op: str, args: List[Any],
+                 replayed: bool = False) -> None:
+        self.seq = seq
+        self.op = op
+        self.args = args
+        self.replayed = replayed
+
+
+class WriteBehindBackend(ForwardingBackend):
+    """StorageBackend journaling writes locally and applying them later
+
+    Args:
+        inner (StorageBackend): Backend the writes are drained to
+        journal_path (str, optional): Journal file. Defaults to
+            pm_journal.log in the working directory.
+    """
+
+    def __init__(self, inner: StorageBackend,
+                 journal_path: str = DEFAULT_JOURNAL_PATH) -> None:
+        super().__init__(inner)
+        self.journal_path = journal_path
+        self.last_error: Exception | None = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending: List[PendingWrite] = self._recover()
+        # Collections read while they had pending writes, kept up to date
+        self._views: Dict[Tuple[str, str], MemoryBackend] = {}
+        self._seq = self._pending[-1].seq if self._pending else 0
+        self._journal = open(journal_path, "a", encoding="utf-8")
+        self._stop = False
+        self._worker = threading.Thread(target=self._drain_forever,
+                                        daemon=True)
+        self._worker.start()
+
+    def _recover(self) -> List[PendingWrite]:
+        """Reads the writes left unacknowledged by a previous run
+
+        Returns:
+            List[PendingWrite]: The writes still to apply, in order
+        """
+
+        if not os.path.exists(self.journal_path):
+            return []
+
+        writes: Dict[int, PendingWrite] = {}
+        with open(self.journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    record = json_util.loads(line)
+                except ValueError:
+                    # A line torn by a crash was never acknowledged
+                    break
+                if "ack" in record:
+                    writes.pop(record["ack"], None)
+                else:
+                    writes[record["seq"]] = PendingWrite(
+                        record["seq"], record["op"], record["args"], True)
+        return [writes[seq] for seq in sorted(writes)]
+
+    def _append(self, op: str, *args: Any) -> None:
+        """Journals a write and queues it for the worker
+
+        Args:
+            op (str): StorageBackend method name
+            *args (Any): Arguments of the call
+        """
+
+        with self._lock:
+            self._seq += 1
+            self._journal.write(json_util.dumps(
+                {"seq": self._seq, "op": op, "args": list(args)}) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            write = PendingWrite(self._seq, op, copy.deepcopy(list(args)))
+            self._pending.append(write)
+            view = self._views.get((args[0], args[1]))
+            if view is not None:
+                _apply_to_view(view, write)
+            self._changed.notify_all()
+
+    def _acknowledge(self, count: int) -> None:
+        """Marks the oldest pending writes as applied
+
+        Args:
+            count (int): Number of writes applied
+        """
+
+        with self._lock:
+            done = self._pending[:count]
+            del self._pending[:count]
+            waiting = {(write.args[0], write.args[1])
+                       for write in self._pending}
+            for key in list(self._views):
+                if key not in waiting:
+                    del self._views[key]
+            if self._pending:
+                self._journal.write("".join(
+                    json_util.dumps({"ack": write.seq}) + "\n"
+                    for write in done))
+                self._journal.flush()
+            else:
+                # Nothing left to replay, start an empty journal
+                self._journal.truncate(0)
+                self._journal.seek(0)
+            os.fsync(self._journal.fileno())
+            self.last_error = None
+            self._changed.notify_all()
+
+    def _drain_forever(self) -> None:
+        """Applies pending writes until the backend is closed
+        """
+
+        while True:
+            with self._lock:
+                while not self._pending and not self._stop:
+                    self._changed.wait()
+                if self._stop:
+                    return
+                batch = list(self._pending)
+
+            try:
+                for count, op, args, replayed in _coalesce(batch):
+                    self._apply(op, args, replayed)
+                    self._acknowledge(count)
+                    if self._stop:
+                        return
+            except Exception as ex:
+                with self._lock:
+                    self.last_error = ex
+                    for write in self._pending:
+                        write.replayed = True
+                    if not self._stop:
+                        self._changed.wait(RETRY_SECONDS)
+                    if self._stop:
+                        return
+
+    def _apply(self, op: str, args: List[Any], replayed: bool) -> None:
+        """Sends one coalesced write to the backend
+
+        Args:
+            op (str): StorageBackend method name
+            args (List[Any]): Arguments of the call
+            replayed (bool): Whether some of it may already be applied
+        """
+
+        if op != "insert_entries":
+            getattr(self.inner, op)(*args)
+            return
+
+        database_name, collection_name, entries = args
+        if replayed:
+            ids = [entry["_id"] for entry in entries]
+            present = {document["_id"] for document in
+                       self.inner.find_entries(database_name,
+                                               collection_name,
+                                               {"_id": {"$in": ids}})}
+            entries = [entry for entry in entries
+                       if entry["_id"] not in present]
+        if not entries:
+            return
+        try:
+            self.inner.insert_entries(database_name, collection_name,
+                                      entries)
+        except (BulkWriteError, DuplicateKeyError):
+            # Another writer applied part of the batch first
+            for entry in entries:
+                try:
+                    self.inner.insert_entry(database_name, collection_name,
+                                            entry)
+                except DuplicateKeyError:
+                    pass
+
+    @property
+    def pending(self) -> int:
+        """Number of writes not yet applied to the backend
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Waits until every pending write has been applied
+
+        Args:
+            timeout (float | None, optional): Seconds to wait.
+                Defaults to None, waiting as long as it takes.
+
+        Returns:
+            bool: True if nothing is pending
+        """
+
+        with self._lock:
+            return self._changed.wait_for(lambda: not self._pending,
+                                          timeout)
+
+    def close(self, timeout: float | None = None) -> bool:
+        """Drains what it can within the timeout and stops the worker
+
+        Writes that could not be applied stay in the journal and are
+        replayed by the next WriteBehindBackend using it.
+
+        Args:
+            timeout (float | None, optional): Seconds to wait for pending
+                writes. Defaults to None.
+
+        Returns:
+            bool: True if every write was applied
+        """
+
+        drained = self.flush(timeout)
+        with self._lock:
+            self._stop = True
+            self._changed.notify_all()
+        self._worker.join()
+        self._journal.close()
+        return drained
+
+    def _overlay(self, database_name: str,
+                 collection_name: str) -> MemoryBackend | None:
+        """Returns a collection with its pending writes applied
+
+        The collection is read from the backend once, when it is first
+        read with writes pending. Writes journaled after that are applied
+        to the same view as they are appended, and the view is dropped
+        once none of the collection's writes are pending.
+
+        Args:
+            database_name (str): Name of the database
+            collection_name (str): Name of the collection
+
+        Returns:
+            MemoryBackend | None: The collection as the writes leave it, or
+                None if it has no pending writes
+        """
+
+        key = (database_name, collection_name)
+        with self._lock:
+            view = self._views.get(key)
+            if view is not None:
+                return view
+            writes = [write for write in self._pending
+                      if write.args[:2] == [database_name, collection_name]]
+        if not writes:
+            return None
+
+        view = MemoryBackend()
+        view.insert_entries(database_name, collection_name,
+                            self.inner.find_entries(database_name,
+                                                    collection_name))
+        with self._lock:
+            if key in self._views:
+                return self._views[key]
+            # Writes read before the backend are applied even if the worker
+            # has drained them since, and those journaled meanwhile after
+            writes += [write for write in self._pending
+                       if write.seq > writes[-1].seq
+                       and write.args[:2] == [database_name,
+                                              collection_name]]
+            for write in writes:
+                _apply_to_view(view, write)
+            if any(write.args[:2] == [database_name, collection_name]
+                   for write in self._pending):
+                self._views[key] = view
+        return view
+
+    def insert_entry(self, database_name: str, collection_name: str,
+                     entry: Dict[str, Any]) -> None:
+        self.insert_entries(database_name, collection_name, [entry])
+
+    def insert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        for entry in entries:
+            entry.setdefault("_id", ObjectId())
+        self._append("insert_entries", database_name, collection_name,
+                     entries)
+
+    def find_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     projection: List[str] | None = None) -> Any:
+        view = self._overlay(database_name, collection_name)
+        if view is None:
+            return self.inner.find_entries(database_name, collection_name,
+                                           entries, projection)
+        return view.find_entries(database_name, collection_name, entries,
+                                 projection)
+
+    def iter_entries(self, database_name: str, collection_name: str,
+                     entries: Dict[str, Any] | None = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE
+                     ) -> Iterator[List[Dict[str, Any]]]:
+        view = self._overlay(database_name, collection_name)
+        if view is None:
+            return self.inner.iter_entries(database_name, collection_name,
+                                           entries, batch_size)
+        return view.iter_entries(database_name, collection_name, entries,
+                                 batch_size)
+
+    def count_entries(self, database_name: str, collection_name: str,
+                      entries: Dict[str, Any] | None = None,
+                      limit: int = 0) -> int:
+        view = self._overlay(database_name, collection_name)
+        if view is None:
+            return self.inner.count_entries(database_name, collection_name,
+                                            entries, limit)
+        return view.count_entries(database_name, collection_name, entries,
+                                  limit)
+
+    def update_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any],
+                     new_data: Dict[str, Any]) -> bool:
+        # Acknowledged before it is applied, so whether it matched is not
+        # known yet
+        self._append("update_entry", database_name, collection_name,
+                     old_data, new_data)
+        return True
+
+    def update_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any],
+                       new_data: Dict[str, Any]) -> None:
+        self._append("update_entries", database_name, collection_name,
+                     old_data, new_data)
+
+    def upsert_entries(self, database_name: str, collection_name: str,
+                       entries: List[Any]) -> None:
+        self._append("upsert_entries", database_name, collection_name,
+                     entries)
+
+    def delete_entry(self, database_name: str, collection_name: str,
+                     old_data: Dict[str, Any]) -> None:
+        self._append("delete_entry", database_name, collection_name,
+                     old_data)
+
+    def delete_entries(self, database_name: str, collection_name: str,
+                       old_data: Dict[str, Any]) -> None:
+        self._append("delete_entries", database_name, collection_name,
+                     old_data)
+
+    def delete_collection(self, database_name: str,
+                          collection_name: str) -> None:
+        self._append("delete_collection", database_name, collection_name)
+
+    def list_collection_names(self, database_name: str) -> List[str]:
+        names = self.inner.list_collection_names(database_name)
+        with self._lock:
+            writes = [write for write in self._pending
+                      if write.args[0] == database_name]
+        for write in writes:
+            collection_name = write.args[1]
+            if write.op == "delete_collection":
+                names = [name for name in names if name != collection_name]
+            elif (write.op in ("insert_entries", "upsert_entries")
+                  and collection_name not in names):
+                names.append(collection_name)
+        return names
+
+
+def _apply_to_view(view: MemoryBackend, write: PendingWrite) -> None:
+    """Applies a pending write to a collection view
+
+    Args:
+        view (MemoryBackend): The collection as read from the backend with
+            earlier writes applied
+        write (PendingWrite): The write to apply
+    """
+
+    if write.op != "insert_entries":
+        getattr(view, write.op)(*write.args)
+        return
+
+    database_name, collection_name, entries = write.args
+    # The worker may have applied it before the backend was read
+    present = {document["_id"] for document in view.find_entries(
+        database_name, collection_name,
+        {"_id": {"$in": [entry["_id"] for entry in entries]}}, ["_id"])}
+    view.insert_entries(database_name, collection_name,
+                        [entry for entry in entries
+                         if entry["_id"] not in present])
+
+
+def _coalesce(batch: List[PendingWrite]
+              ) -> List[Tuple[int, str, List[Any], bool]]:
+    """Merges runs of inserts into the same collection
+
+    Args:
+        batch (List[PendingWrite]): Pending writes in journal order
+
+    Returns:
+        List[Tuple[int, str, List[Any], bool]]: For every call to make, the
+            number of writes it covers, the method, its arguments and
+            whether any of them may already be applied
+    """
+
+    calls: List[Tuple[int, str, List[Any], bool]] = []
+    for write in batch:
+        if calls and write.op == "insert_entries":
+            count, op, args, replayed = calls[-1]
+            if op == "insert_entries" and args[:2] == write.args[:2]:
+                calls[-1] = (count + 1, op,
+                             args[:2] + [args[2] + write.args[2]],
+                             replayed or write.replayed)
+                continue
+        calls.append((1, write.op, list(write.args), write.replayed))
+    return calls